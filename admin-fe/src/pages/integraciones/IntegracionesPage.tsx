@@ -63,10 +63,22 @@ export default function IntegracionesPage() {
   })
 
   const syncMutation = useMutation({
-    mutationFn: (fromDate?: string) => api.post(
-      `/integrations/loyverse/${selectedEmpresa}/sync`,
-      fromDate ? { from_date: new Date(fromDate).toISOString() } : {}
-    ),
+    // La sincronización corre en segundo plano: se inicia y se consulta su progreso hasta que termine
+    mutationFn: async (fromDate?: string) => {
+      const started = await api.post(
+        `/integrations/loyverse/${selectedEmpresa}/sync`,
+        fromDate ? { from_date: new Date(fromDate).toISOString() } : {}
+      )
+      const progressUrl = `/integrations/loyverse/${selectedEmpresa}/sync/${started.data.sync_log_id}`
+      while (true) {
+        await new Promise((resolve) => setTimeout(resolve, 2000))
+        const progress = await api.get(progressUrl)
+        if (progress.data.status === 'error') {
+          throw { response: { data: { detail: `Error en sincronización: ${progress.data.message}` } } }
+        }
+        if (progress.data.status !== 'running') return progress
+      }
+    },
     onSuccess: (response) => {
       const data = response.data
       console.log('[Sync] Resultado:', data)
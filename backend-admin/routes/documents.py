@@ -16,6 +16,7 @@ import base64
 import gzip
 
 from utils.security import get_current_user, require_permission
+from services.xml_archive import load_document_xml
 
 BACKEND_FE_URL = os.environ.get("BACKEND_FE_URL", "http://localhost:8000")
 
@@ -128,7 +129,7 @@ async def list_documents(
     total = await fe_db.documents.count_documents(query)
     
     skip = (page - 1) * limit
-    cursor = fe_db.documents.find(query).sort("created_at", -1).skip(skip).limit(limit)
+    cursor = fe_db.documents.find(query, {"events": 0}).sort("created_at", -1).skip(skip).limit(limit)
     
     documents = []
     async for doc in cursor:
@@ -220,8 +221,6 @@ async def download_xml(
         raise HTTPException(status_code=404, detail="Documento no encontrado")
     
     xml_data = doc.get("xml_signed")
-    if not xml_data:
-        raise HTTPException(status_code=404, detail="XML no disponible")
     
     # Descomprimir si está comprimido
     if isinstance(xml_data, bytes):
@@ -229,8 +228,14 @@ async def download_xml(
             xml_content = gzip.decompress(xml_data).decode('utf-8')
         except:
             xml_content = xml_data.decode('utf-8') if isinstance(xml_data, bytes) else xml_data
-    else:
+    elif xml_data:
         xml_content = xml_data
+    else:
+        # backend-fe archiva el XML en document_xml (zstd con diccionario o gzip)
+        xml_content = await load_document_xml(fe_db, document_id)
+    
+    if not xml_content:
+        raise HTTPException(status_code=404, detail="XML no disponible")
     
     filename = f"{doc.get('access_key', document_id)}.xml"
     
@@ -3,12 +3,14 @@ Rutas de Integraciones
 - Configuración de integraciones por empresa
 - Loyverse: sincronización de ventas
 """
-import os
+import json
 import asyncio
 from fastapi import APIRouter, HTTPException, Request, Depends, Query
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 import uuid
 import httpx
 
@@ -18,35 +20,40 @@ from models.integration import (
     LoyverseConfig
 )
 from utils.security import get_current_user, require_permission
+from services.loyverse_pipeline import LOYVERSE_API_URL
+from services.loyverse_sync import create_sync_job, sync_jobs, sync_progress
 
 router = APIRouter(prefix="/integrations", tags=["Integraciones"])
 
-# Loyverse API Base URL
-LOYVERSE_API_URL = "https://api.loyverse.com/v1.0"
+# Intervalo de lectura del progreso para el stream SSE
+SYNC_STREAM_INTERVAL = 1.0
 
 
 async def wake_up_backend_fe(url: str, max_wait_seconds: int = 90) -> bool:
     """
     Despierta backend-fe (Render Free Tier duerme tras inactividad).
-    Llama al health endpoint hasta que responda 200.
+    Consulta /fe/health/ready hasta que responda 200: el servicio responde 503
+    mientras calienta (pool de firma, índices, warm-up), así no se envían
+    facturas a un proceso que todavía no puede emitir.
     """
     print(f"[Sync] Despertando backend-fe en {url}...")
     for attempt in range(max_wait_seconds // 5):
         try:
             async with httpx.AsyncClient(timeout=8.0) as client:
-                resp = await client.get(f"{url}/fe/health")
+                resp = await client.get(f"{url}/fe/health/ready")
                 if resp.status_code == 200:
                     print(f"[Sync] backend-fe listo tras {attempt * 5}s")
                     return True
+                if resp.status_code == 503:
+                    pending = [name for name, check in resp.json().get("checks", {}).items()
+                               if not check.get("ok") and check.get("required", True)]
+                    print(f"[Sync] backend-fe calentando: {', '.join(pending)}")
         except Exception:
             pass
         await asyncio.sleep(5)
     print(f"[Sync] backend-fe no respondio en {max_wait_seconds}s")
     return False
 
-# Backend FE URL (para crear facturas)
-BACKEND_FE_URL = os.environ.get("BACKEND_FE_URL", "http://localhost:8000")
-
 
 async def prepare_invoice_from_loyverse(receipt: dict, tenant_id: str, fe_db) -> Optional[dict]:
     """
@@ -465,7 +472,9 @@ async def sync_loyverse_sales(
     current_user: dict = Depends(require_permission("integrations:write"))
 ):
     """
-    Sincroniza ventas de Loyverse y genera facturas
+    Inicia la sincronización de ventas de Loyverse como job en segundo plano
+    (services/loyverse_sync.py). Retorna sync_log_id; el avance se consulta en
+    GET /loyverse/{tenant_id}/sync/{sync_log_id} o en su /stream (SSE).
     """
     admin_db = request.app.state.admin_db
     fe_db = request.app.state.fe_db
@@ -516,269 +525,106 @@ async def sync_loyverse_sales(
     
     print(f"[Sync] Rango: {from_date.isoformat()} -> {to_date.isoformat()}")
     
-    # Limpiar syncs anteriores que quedaron en "running" (stuck)
-    await admin_db.sync_logs.update_many(
-        {"tenant_id": tenant_id, "status": "running"},
-        {"$set": {"status": "failed", "errors": ["Cancelado: nueva sincronización iniciada"]}}
-    )
+    # Un solo job por tenant: si hay uno en curso (o pendiente de reanudar), se retorna ese
+    running = await admin_db.sync_logs.find_one({"tenant_id": tenant_id, "status": "running"})
+    if running and running.get("resumable"):
+        return _sync_in_progress(running)
+    if running:
+        # Logs "running" de la sincronización anterior (no reanudable) quedaron colgados
+        await admin_db.sync_logs.update_many(
+            {"tenant_id": tenant_id, "status": "running", "resumable": {"$ne": True}},
+            {"$set": {"status": "failed", "errors": ["Cancelado: nueva sincronización iniciada"]}}
+        )
     
-    # Crear log de sincronización
-    sync_log_id = str(uuid.uuid4())
-    sync_log = {
-        "_id": sync_log_id,
-        "integration_id": str(integration["_id"]),
-        "tenant_id": tenant_id,
+    try:
+        sync_log_id = await create_sync_job(admin_db, integration, from_date, to_date, has_custom_date)
+    except DuplicateKeyError:
+        # Otra request creó el job entre la consulta y el insert (índice único por tenant en "running")
+        running = await admin_db.sync_logs.find_one({"tenant_id": tenant_id, "status": "running"})
+        if running is None:
+            raise HTTPException(status_code=409, detail="Sincronización en curso, reintente en unos segundos")
+        return _sync_in_progress(running)
+    sync_jobs.launch(admin_db, fe_db, sync_log_id, prepare_invoice_from_loyverse, wake_up_backend_fe)
+    
+    return {
+        "success": True,
+        "sync_log_id": sync_log_id,
         "status": "running",
-        "records_processed": 0,
-        "records_success": 0,
-        "records_failed": 0,
-        "errors": [],
-        "started_at": now,
-        "created_at": now
+        "message": "Sincronización iniciada"
     }
-    await admin_db.sync_logs.insert_one(sync_log)
-    
-    try:
-        # Obtener recibos de Loyverse
-        receipts = []
-        cursor = None
-        
-        # Usar isoformat para fechas (más robusto que strftime manual)
-        from_date_str = from_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        to_date_str = to_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        
-        print(f"[Sync] Llamando Loyverse API: created_at_min={from_date_str}, created_at_max={to_date_str}")
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            while True:
-                params = {
-                    "created_at_min": from_date_str,
-                    "created_at_max": to_date_str,
-                    "limit": 250
-                }
-                if cursor:
-                    params["cursor"] = cursor
-                
-                response = await client.get(
-                    f"{LOYVERSE_API_URL}/receipts",
-                    headers={"Authorization": f"Bearer {api_key}"},
-                    params=params
-                )
-                
-                if response.status_code != 200:
-                    raise Exception(f"Error obteniendo recibos de Loyverse (HTTP {response.status_code}): {response.text}")
-                
-                data = response.json()
-                response_keys = list(data.keys())
-                print(f"[Sync] Loyverse response keys: {response_keys}")
-                
-                batch = data.get("receipts", [])
-                # Si no hay receipts, buscar en otras claves (por si la API cambió)
-                if not batch:
-                    for key in response_keys:
-                        if isinstance(data[key], list) and len(data[key]) > 0:
-                            first_item = data[key][0]
-                            if isinstance(first_item, dict) and "receipt_number" in first_item:
-                                print(f"[Sync] Recibos encontrados bajo clave '{key}' en vez de 'receipts'!")
-                                batch = data[key]
-                                break
-                
-                print(f"[Sync] Loyverse devolvió {len(batch)} recibos en este lote")
-                receipts.extend(batch)
-                
-                cursor = data.get("cursor")
-                if not cursor:
-                    break
-        
-        # Si no hay recibos con filtro de fecha, intentar SIN filtro como diagnóstico
-        if not receipts and has_custom_date:
-            print(f"[Sync] 0 recibos con filtro de fecha. Probando SIN filtro...")
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                test_response = await client.get(
-                    f"{LOYVERSE_API_URL}/receipts",
-                    headers={"Authorization": f"Bearer {api_key}"},
-                    params={"limit": 10}
-                )
-                if test_response.status_code == 200:
-                    test_data = test_response.json()
-                    test_keys = list(test_data.keys())
-                    test_receipts = test_data.get("receipts", [])
-                    if not test_receipts:
-                        for key in test_keys:
-                            if isinstance(test_data[key], list):
-                                test_receipts = test_data[key]
-                                break
-                    print(f"[Sync] SIN filtro: keys={test_keys}, recibos={len(test_receipts)}")
-                    if test_receipts:
-                        first = test_receipts[0]
-                        print(f"[Sync] Primer recibo: number={first.get('receipt_number')}, created_at={first.get('created_at')}")
-                else:
-                    print(f"[Sync] Test sin filtro falló: HTTP {test_response.status_code}")
-        
-        # Filtrar solo ventas (excluir reembolsos)
-        all_receipts = receipts
-        receipts = [r for r in all_receipts if r.get("receipt_type", "SALE") == "SALE"]
-        skipped_refunds = len(all_receipts) - len(receipts)
-        
-        print(f"[Sync] Total recibos Loyverse: {len(all_receipts)}, ventas: {len(receipts)}, reembolsos omitidos: {skipped_refunds}")
-        
-        records_processed = len(receipts)
-        records_success = 0
-        records_failed = 0
-        records_skipped = 0
-        errors = []
-        
-        # Despertar backend-fe antes de procesar (cold start de Render)
-        if receipts:
-            await wake_up_backend_fe(BACKEND_FE_URL)
-        
-        # Procesar cada recibo y crear factura
-        for receipt in receipts:
-            try:
-                # Verificar si ya fue procesado
-                existing_doc = await fe_db.documents.find_one({
-                    "tenant_id": tenant_id,
-                    "external_reference": f"loyverse:{receipt['receipt_number']}"
-                })
-                
-                if existing_doc is not None:
-                    records_skipped += 1
-                    print(f"[Sync] Recibo {receipt['receipt_number']} ya existe, saltando")
-                    continue  # Ya procesado
-                
-                # Preparar datos para factura desde recibo Loyverse
-                invoice_data = await prepare_invoice_from_loyverse(receipt, tenant_id, fe_db)
-                
-                if invoice_data is not None:
-                    # Pausa entre cada recibo para no saturar backend-fe
-                    await asyncio.sleep(3)
-                    
-                    # Llamar a backend-fe para crear la factura con retry
-                    max_retries = 5
-                    retry_delays = [15, 30, 60, 90, 120]  # espera progresiva
-                    created = False
-                    for attempt in range(max_retries):
-                        async with httpx.AsyncClient(timeout=120.0) as fe_client:
-                            fe_response = await fe_client.post(
-                                f"{BACKEND_FE_URL}/fe/documents/invoice",
-                                json=invoice_data,
-                                headers={"X-Tenant-ID": tenant_id}
-                            )
-                            
-                            if fe_response.status_code in [200, 201]:
-                                # Marcar como procesado guardando referencia
-                                result = fe_response.json()
-                                await fe_db.documents.update_one(
-                                    {"_id": result.get("document_id")},
-                                    {"$set": {"external_reference": f"loyverse:{receipt['receipt_number']}"}}
-                                )
-                                records_success += 1
-                                created = True
-                                break
-                            elif fe_response.status_code == 429:
-                                # Rate limited, esperar tiempo progresivo y reintentar
-                                wait_time = retry_delays[attempt] if attempt < len(retry_delays) else 120
-                                if attempt < max_retries - 1:
-                                    await asyncio.sleep(wait_time)
-                                    continue
-                                else:
-                                    raise Exception(f"Rate limit excedido después de {max_retries} intentos ({sum(retry_delays[:max_retries])}s de espera total)")
-                            else:
-                                raise Exception(f"Error creando factura: {fe_response.text}")
-                    
-                    if not created and not any(True for _ in []):
-                        pass  # excepción ya fue lanzada arriba
-                else:
-                    # Recibo sin items válidos, saltar
-                    continue
-                
-            except Exception as e:
-                records_failed += 1
-                errors.append({
-                    "receipt_number": receipt.get("receipt_number"),
-                    "error": str(e)
-                })
-        
-        # Actualizar log
-        await admin_db.sync_logs.update_one(
-            {"_id": sync_log_id},
-            {"$set": {
-                "status": "completed",
-                "records_processed": records_processed,
-                "records_success": records_success,
-                "records_failed": records_failed,
-                "errors": errors[:10],  # Limitar errores guardados
-                "completed_at": datetime.now(timezone.utc)
-            }}
-        )
-        
-        # Actualizar última sincronización
-        # - Todo exitoso: avanzar a now
-        # - Algunos fallos: retroceder 1 hora para re-intentar
-        # - Todo falló: mantener from_date original para re-intentar todo
-        if records_success > 0 and records_failed == 0:
-            effective_last_sync = now
-        elif records_success > 0:
-            effective_last_sync = now - timedelta(hours=1)
-        else:
-            effective_last_sync = from_date
-        await admin_db.integrations.update_one(
-            {"_id": integration["_id"]},
-            {"$set": {
-                "last_sync": effective_last_sync,
-                "last_error": None if records_failed == 0 else f"{records_failed} errores",
-                "status": "active"
-            }}
-        )
-        
-        message_parts = [f"Sincronización completada: {records_success}/{records_processed} exitosos"]
-        if records_skipped > 0:
-            message_parts.append(f"{records_skipped} ya existían")
-        if skipped_refunds > 0:
-            message_parts.append(f"{skipped_refunds} reembolsos omitidos")
-        if records_failed > 0:
-            message_parts.append(f"{records_failed} fallidos")
-        
-        return {
-            "success": True,
-            "sync_log_id": sync_log_id,
-            "records_processed": records_processed,
-            "records_success": records_success,
-            "records_failed": records_failed,
-            "records_skipped": records_skipped,
-            "message": ", ".join(message_parts),
-            "debug": {
-                "from_date": from_date.isoformat(),
-                "to_date": to_date.isoformat(),
-                "custom_date_used": has_custom_date,
-                "loyverse_total_receipts": len(all_receipts),
-                "loyverse_sales": len(receipts),
-                "loyverse_refunds_skipped": skipped_refunds,
-                "errors": errors[:5]
-            }
-        }
-        
-    except Exception as e:
-        # Actualizar log con error
-        await admin_db.sync_logs.update_one(
-            {"_id": sync_log_id},
-            {"$set": {
-                "status": "error",
-                "error_message": str(e),
-                "completed_at": datetime.now(timezone.utc)
-            }}
-        )
-        
-        # Actualizar integración
-        await admin_db.integrations.update_one(
-            {"_id": integration["_id"]},
-            {"$set": {
-                "last_error": str(e),
-                "status": "error"
-            }}
-        )
-        
-        raise HTTPException(status_code=500, detail=f"Error en sincronización: {str(e)}")
+
+
+def _sync_in_progress(log: dict) -> dict:
+    return {
+        "success": True,
+        "sync_log_id": log["_id"],
+        "status": "running",
+        "message": "Ya hay una sincronización en curso"
+    }
+
+
+async def _get_sync_log(admin_db, tenant_id: str, sync_log_id: str) -> dict:
+    log = await admin_db.sync_logs.find_one({"_id": sync_log_id, "tenant_id": tenant_id})
+    if not log:
+        raise HTTPException(status_code=404, detail="Sincronización no encontrada")
+    return log
+
+
+@router.get("/loyverse/{tenant_id}/sync/{sync_log_id}")
+async def get_sync_progress(
+    request: Request,
+    tenant_id: str,
+    sync_log_id: str,
+    current_user: dict = Depends(require_permission("integrations:read"))
+):
+    """
+    Progreso de una sincronización (polling)
+    """
+    return sync_progress(await _get_sync_log(request.app.state.admin_db, tenant_id, sync_log_id))
+
+
+@router.get("/loyverse/{tenant_id}/sync/{sync_log_id}/stream")
+async def stream_sync_progress(
+    request: Request,
+    tenant_id: str,
+    sync_log_id: str,
+    current_user: dict = Depends(require_permission("integrations:read"))
+):
+    """
+    Stream SSE del progreso de una sincronización: eventos "progress" cuando
+    cambia y un "done" final al terminar
+    """
+    admin_db = request.app.state.admin_db
+    await _get_sync_log(admin_db, tenant_id, sync_log_id)
+    
+    async def event_source():
+        yield ": conectado\n\n"
+        last = None
+        idle = 0.0
+        while not await request.is_disconnected():
+            log = await admin_db.sync_logs.find_one({"_id": sync_log_id})
+            if log is None:
+                return
+            progress = sync_progress(log)
+            payload = json.dumps(progress, default=str)
+            if progress["status"] != "running":
+                yield f"event: done\ndata: {payload}\n\n"
+                return
+            if payload != last:
+                last = payload
+                idle = 0.0
+                yield f"event: progress\ndata: {payload}\n\n"
+            elif idle >= 15:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(SYNC_STREAM_INTERVAL)
+            idle += SYNC_STREAM_INTERVAL
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @router.delete("/loyverse/{tenant_id}")
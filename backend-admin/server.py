@@ -21,6 +21,9 @@ from routes.integrations import router as integrations_router
 from routes.dashboard import router as dashboard_router
 from routes.documents import router as documents_router
 from routes.diagnostico import router as diagnostico_router
+from routes.integrations import prepare_invoice_from_loyverse, wake_up_backend_fe
+from services.loyverse_pipeline import close_pipeline_clients
+from services.loyverse_sync import sync_jobs
 
 # Configuración
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
@@ -72,23 +75,48 @@ async def lifespan(app: FastAPI):
         # Sync logs
         await admin_db.sync_logs.create_index([("tenant_id", 1), ("created_at", -1)])
         await admin_db.sync_logs.create_index("integration_id")
+        await admin_db.sync_logs.create_index([("status", 1), ("heartbeat_at", 1)])
         
         print("✅ Índices creados correctamente")
     except Exception as e:
         print(f"⚠️ Error creando índices: {e}")
     
+    try:
+        # Logs "running" de la sincronización anterior (no reanudable) bloquearían el índice único
+        legacy = await admin_db.sync_logs.update_many(
+            {"status": "running", "resumable": {"$ne": True}},
+            {"$set": {"status": "failed", "errors": ["Cancelado: sincronización no reanudable interrumpida"]}}
+        )
+        if legacy.modified_count:
+            print(f"ℹ️ {legacy.modified_count} sync_logs running antiguos marcados como failed")
+        # Un solo job "running" por tenant (sync_loyverse_sales maneja el DuplicateKeyError)
+        await admin_db.sync_logs.create_index(
+            [("tenant_id", 1)],
+            name="tenant_running_unique",
+            unique=True,
+            partialFilterExpression={"status": "running"}
+        )
+    except Exception as e:
+        print(f"⚠️ Error creando índice único de sync_logs running (¿jobs duplicados?): {e}")
+    
     # Crear roles por defecto si no existen
     await create_default_roles(admin_db)
     
     # Crear usuario admin por defecto si no existe
     await create_default_admin(admin_db)
     
+    # Reanudar sincronizaciones Loyverse interrumpidas (caída, redeploy)
+    sync_jobs.start_watchdog(admin_db, fe_db, prepare_invoice_from_loyverse, wake_up_backend_fe)
+    print("🔄 Watchdog de sincronizaciones Loyverse iniciado")
+    
     print("✅ Backend Admin iniciado en puerto 8003")
     
     yield
     
     # Shutdown
     print("🛑 Cerrando conexiones...")
+    await sync_jobs.shutdown()
+    await close_pipeline_clients()
     client.close()
     print("✅ Backend Admin cerrado")
 
@@ -0,0 +1,312 @@
+"""
+Pipeline de sincronización Loyverse -> backend-fe
+
+    páginas de /receipts  ->  cola acotada  ->  N emisores (transformar + POST a backend-fe)
+
+- Clientes httpx compartidos (keep-alive) hacia Loyverse y backend-fe.
+- Un token bucket por destino limita la tasa de requests; cuando la API
+  responde 429/503 con Retry-After, el bucket se pausa para todos los emisores
+  (no solo para el que recibió el 429).
+- Reintentos con el Retry-After del servidor, o backoff exponencial con jitter.
+  El POST de facturas no es idempotente: solo se reintenta en 429 o si la
+  conexión falló antes de enviar la request; además lleva external_reference
+  ("loyverse:<receipt_number>"), que backend-fe deduplica con un índice único.
+- La lectura de páginas sigue mientras los emisores trabajan; la cola acotada
+  evita tener todos los recibos en memoria.
+"""
+import os
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+LOYVERSE_API_URL = "https://api.loyverse.com/v1.0"
+BACKEND_FE_URL = os.environ.get("BACKEND_FE_URL", "http://localhost:8000")
+
+LOYVERSE_PAGE_SIZE = 250
+LOYVERSE_API_RATE = float(os.environ.get("LOYVERSE_API_RATE", "4"))          # requests/s
+LOYVERSE_API_BURST = int(os.environ.get("LOYVERSE_API_BURST", "5"))
+LOYVERSE_FE_RATE = float(os.environ.get("LOYVERSE_FE_RATE", "8"))            # facturas/s hacia backend-fe
+LOYVERSE_FE_BURST = int(os.environ.get("LOYVERSE_FE_BURST", "8"))
+LOYVERSE_SYNC_EMITTERS = int(os.environ.get("LOYVERSE_SYNC_EMITTERS", "4"))
+# async: backend-fe responde al firmar y el worker SRI autoriza en segundo plano
+LOYVERSE_FE_MODE = os.environ.get("LOYVERSE_FE_MODE", "async")
+LOYVERSE_MAX_ATTEMPTS = int(os.environ.get("LOYVERSE_MAX_ATTEMPTS", "6"))
+LOYVERSE_BACKOFF_BASE = 1.0
+LOYVERSE_BACKOFF_MAX = 120.0
+
+RETRYABLE_STATUS = {429, 502, 503, 504}
+# Requests no idempotentes: el servidor no procesó nada
+UNSENT_RETRYABLE_STATUS = {429}
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class TokenBucket:
+    """
+    Token bucket asíncrono: `rate` tokens por segundo, hasta `capacity` acumulados.
+    pause(s) bloquea a todos los consumidores (Retry-After del servidor).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+
+
+def retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """Segundos a esperar: Retry-After (segundos o fecha HTTP) o backoff exponencial con jitter"""
+    if response is not None:
+        value = response.headers.get("Retry-After")
+        if value:
+            try:
+                return min(max(float(value), 0.0), LOYVERSE_BACKOFF_MAX)
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(value)
+                    return min(max((when - datetime.now(timezone.utc)).total_seconds(), 0.0), LOYVERSE_BACKOFF_MAX)
+                except (TypeError, ValueError):
+                    pass
+    delay = min(LOYVERSE_BACKOFF_BASE * (2 ** attempt), LOYVERSE_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _client(name: str, **kwargs) -> httpx.AsyncClient:
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _clients[name] = httpx.AsyncClient(**kwargs)
+    return client
+
+
+def get_loyverse_client() -> httpx.AsyncClient:
+    return _client("loyverse", base_url=LOYVERSE_API_URL, timeout=30.0,
+                   limits=httpx.Limits(max_connections=4, max_keepalive_connections=4))
+
+
+def get_fe_client() -> httpx.AsyncClient:
+    connections = max(LOYVERSE_SYNC_EMITTERS, 1) * 2
+    return _client("fe", base_url=BACKEND_FE_URL, timeout=120.0,
+                   limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections))
+
+
+async def close_pipeline_clients():
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+
+loyverse_bucket = TokenBucket(LOYVERSE_API_RATE, LOYVERSE_API_BURST)
+fe_bucket = TokenBucket(LOYVERSE_FE_RATE, LOYVERSE_FE_BURST)
+
+
+async def request_with_retry(client: httpx.AsyncClient, bucket: TokenBucket, method: str, url: str,
+                             idempotent: bool = True, **kwargs) -> httpx.Response:
+    """
+    Request con token bucket y reintentos en 429/5xx transitorios y errores de red.
+    Con idempotent=False solo se reintenta lo que seguro no llegó a procesarse
+    (429 y errores de conexión): un 502/504 o un ReadTimeout pueden llegar
+    después de que el servidor ya creó el documento.
+    """
+    retry_errors = httpx.TransportError if idempotent else UNSENT_ERRORS
+    retry_status = RETRYABLE_STATUS if idempotent else UNSENT_RETRYABLE_STATUS
+    for attempt in range(LOYVERSE_MAX_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except retry_errors:
+            if attempt == LOYVERSE_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code not in retry_status or attempt == LOYVERSE_MAX_ATTEMPTS - 1:
+            return response
+        delay = retry_delay(response, attempt)
+        if response.status_code == 429:
+            bucket.pause(delay)
+        else:
+            await asyncio.sleep(delay)
+    return response
+
+
+def receipts_from_page(data: dict) -> List[dict]:
+    """Recibos de una página (busca otra clave con recibos si 'receipts' viene vacío)"""
+    batch = data.get("receipts", [])
+    if not batch:
+        for key, value in data.items():
+            if isinstance(value, list) and value and isinstance(value[0], dict) and "receipt_number" in value[0]:
+                print(f"[Sync] Recibos encontrados bajo clave '{key}' en vez de 'receipts'!")
+                return value
+    return batch
+
+
+async def fetch_receipt_pages(api_key: str, created_at_min: str, created_at_max: str,
+                              cursor: Optional[str] = None) -> AsyncIterator[tuple]:
+    """Páginas de recibos de Loyverse: produce (recibos, cursor de la página siguiente)"""
+    client = get_loyverse_client()
+    while True:
+        params = {"created_at_min": created_at_min, "created_at_max": created_at_max, "limit": LOYVERSE_PAGE_SIZE}
+        if cursor:
+            params["cursor"] = cursor
+        response = await request_with_retry(
+            client, loyverse_bucket, "GET", "/receipts",
+            headers={"Authorization": f"Bearer {api_key}"}, params=params
+        )
+        if response.status_code != 200:
+            raise Exception(f"Error obteniendo recibos de Loyverse (HTTP {response.status_code}): {response.text}")
+        data = response.json()
+        cursor = data.get("cursor")
+        yield receipts_from_page(data), cursor
+        if not cursor:
+            return
+
+
+class SyncStats:
+    def __init__(self):
+        self.fetched = 0
+        self.refunds_skipped = 0
+        self.processed = 0
+        self.success = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors: List[dict] = []
+        self.started = time.monotonic()
+
+    def as_dict(self) -> dict:
+        return {
+            "fetched": self.fetched,
+            "refunds_skipped": self.refunds_skipped,
+            "processed": self.processed,
+            "success": self.success,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_seconds": round(time.monotonic() - self.started, 1)
+        }
+
+
+Transform = Callable[[dict, str, object], Awaitable[Optional[dict]]]
+
+
+async def emit_invoice(tenant_id: str, invoice_data: dict) -> dict:
+    """Crea la factura en backend-fe; lanza Exception si no se pudo"""
+    response = await request_with_retry(
+        get_fe_client(), fe_bucket, "POST", "/fe/documents/invoice", idempotent=False,
+        params={"mode": LOYVERSE_FE_MODE}, json=invoice_data, headers={"X-Tenant-ID": tenant_id}
+    )
+    if response.status_code in (200, 201):
+        return response.json()
+    if response.status_code == 429:
+        raise Exception(f"Rate limit excedido después de {LOYVERSE_MAX_ATTEMPTS} intentos")
+    raise Exception(f"Error creando factura (HTTP {response.status_code}): {response.text[:500]}")
+
+
+async def process_receipt(fe_db, tenant_id: str, receipt: dict, transform: Transform, stats: SyncStats) -> str:
+    """
+    Transforma y emite un recibo. Retorna "success", "skipped" o "failed"
+    (el error queda en stats.errors).
+    """
+    reference = f"loyverse:{receipt['receipt_number']}"
+    try:
+        # Atajo para no transformar recibos ya emitidos; la garantía es el índice único
+        existing_doc = await fe_db.documents.find_one(
+            {"tenant_id": tenant_id, "external_reference": reference}, {"_id": 1}
+        )
+        if existing_doc is not None:
+            stats.skipped += 1
+            return "skipped"
+
+        invoice_data = await transform(receipt, tenant_id, fe_db)
+        if invoice_data is None:
+            # Recibo sin items válidos
+            stats.skipped += 1
+            return "skipped"
+
+        # backend-fe deduplica por (tenant_id, external_reference) con un índice único
+        invoice_data["external_reference"] = reference
+        result = await emit_invoice(tenant_id, invoice_data)
+        if result.get("duplicate"):
+            stats.skipped += 1
+            return "skipped"
+        stats.success += 1
+        return "success"
+    except Exception as e:
+        stats.failed += 1
+        stats.errors.append({"receipt_number": receipt.get("receipt_number"), "error": str(e)})
+        return "failed"
+
+
+async def run_pipeline(fe_db, tenant_id: str, pages: AsyncIterator[tuple], transform: Transform,
+                       emitters: int = LOYVERSE_SYNC_EMITTERS, stats: Optional[SyncStats] = None,
+                       on_receipt: Optional[Callable[[dict, str], Awaitable[None]]] = None) -> SyncStats:
+    """
+    Consume `pages` (fetch_receipt_pages) y emite las ventas con `emitters`
+    tareas concurrentes. `on_receipt(recibo, resultado)` se llama al terminar cada uno.
+    """
+    stats = stats or SyncStats()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=LOYVERSE_PAGE_SIZE)
+
+    async def produce():
+        async for receipts, _ in pages:
+            stats.fetched += len(receipts)
+            for receipt in receipts:
+                if receipt.get("receipt_type", "SALE") != "SALE":
+                    stats.refunds_skipped += 1
+                    continue
+                await queue.put(receipt)
+
+    async def emit():
+        while True:
+            receipt = await queue.get()
+            try:
+                stats.processed += 1
+                outcome = await process_receipt(fe_db, tenant_id, receipt, transform, stats)
+                if on_receipt is not None:
+                    await on_receipt(receipt, outcome)
+            except Exception as e:
+                print(f"[Sync] Error procesando recibo {receipt.get('receipt_number')}: {e}")
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(emit()) for _ in range(max(1, emitters))]
+    try:
+        await produce()
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return stats
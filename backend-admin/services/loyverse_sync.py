@@ -0,0 +1,466 @@
+"""
+Sincronización Loyverse como job en segundo plano, reanudable
+
+Cada sincronización es un documento de admin_db.sync_logs (resumable=True)
+que guarda su propio avance:
+
+- rango fijo (from_date/to_date) decidido al crear el job;
+- `cursor`: cursor de Loyverse de la primera página aún no terminada
+  (se avanza solo cuando todas las ventas de esa página quedaron procesadas);
+- `checkpoint`: receipt_number ya procesados de páginas no terminadas
+  (checkpoint por recibo: al reanudar no se vuelven a procesar);
+- contadores ($inc por recibo y por página) y `earliest_failed_at`.
+
+Las páginas se procesan a medida que llegan (services/loyverse_pipeline.py).
+Un job vivo actualiza `heartbeat_at`; el watchdog de cada instancia toma los
+jobs "running" sin heartbeat reciente (proceso caído, redeploy) y los reanuda
+desde el cursor guardado. La deduplicación por external_reference en backend-fe
+cubre el caso de un recibo emitido justo antes de la caída.
+
+Al terminar, last_sync avanza a to_date, o a la fecha del recibo fallido más
+antiguo si hubo fallos (antes se retrocedía una hora fija).
+"""
+import os
+import socket
+import asyncio
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+import uuid
+
+from services.loyverse_pipeline import (
+    BACKEND_FE_URL, SyncStats, Transform, fetch_receipt_pages, get_loyverse_client, receipts_from_page, run_pipeline
+)
+
+LOYVERSE_SYNC_HEARTBEAT_SECONDS = float(os.environ.get("LOYVERSE_SYNC_HEARTBEAT_SECONDS", "15"))
+LOYVERSE_SYNC_STALE_SECONDS = float(os.environ.get("LOYVERSE_SYNC_STALE_SECONDS", "90"))
+LOYVERSE_SYNC_WATCHDOG_SECONDS = float(os.environ.get("LOYVERSE_SYNC_WATCHDOG_SECONDS", "30"))
+LOYVERSE_SYNC_MAX_ERRORS = 50
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_ERROR = "error"
+
+Wake = Callable[[str], Awaitable[bool]]
+
+
+def _receipt_time(receipt: dict) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(receipt["created_at"].replace("Z", "+00:00"))
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+async def create_sync_job(admin_db, integration: dict, from_date: datetime, to_date: datetime,
+                          has_custom_date: bool) -> str:
+    """Registra el job en sync_logs y retorna su id (el job se lanza con sync_jobs.launch)"""
+    now = datetime.now(timezone.utc)
+    sync_log_id = str(uuid.uuid4())
+    await admin_db.sync_logs.insert_one({
+        "_id": sync_log_id,
+        "integration_id": str(integration["_id"]),
+        "tenant_id": integration["tenant_id"],
+        "status": STATUS_RUNNING,
+        "resumable": True,
+        "from_date": from_date,
+        "to_date": to_date,
+        "custom_date_used": has_custom_date,
+        "cursor": None,
+        "fetch_done": False,
+        "checkpoint": [],
+        "pages_done": 0,
+        "records_fetched": 0,
+        "refunds_skipped": 0,
+        "records_processed": 0,
+        "records_success": 0,
+        "records_failed": 0,
+        "records_skipped": 0,
+        "earliest_failed_at": None,
+        "errors": [],
+        "owner": INSTANCE_ID,
+        "resumes": 0,
+        "heartbeat_at": now,
+        "started_at": now,
+        "created_at": now
+    })
+    return sync_log_id
+
+
+class _Page:
+    __slots__ = ("cursor", "next_cursor", "sales", "pending", "refunds", "fetched")
+
+    def __init__(self, cursor: Optional[str], next_cursor: Optional[str], sales: List[str],
+                 pending: set, refunds: int, fetched: int):
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.sales = sales
+        self.pending = pending
+        self.refunds = refunds
+        self.fetched = fetched
+
+
+class _Checkpoints:
+    """
+    Checkpoints de un job: por recibo (contadores + checkpoint) y por página
+    (cursor). Las páginas se cierran en orden: el cursor guardado nunca salta
+    una página con recibos pendientes, aunque los emisores terminen desordenados.
+    Cada escritura exige owner == INSTANCE_ID: si otra instancia tomó el job,
+    se detiene el runner en vez de pisar su progreso.
+    """
+
+    def __init__(self, admin_db, sync_log_id: str, done: set, stats: SyncStats, runner: asyncio.Task):
+        self.admin_db = admin_db
+        self.sync_log_id = sync_log_id
+        self.done = done
+        self.stats = stats
+        self.runner = runner
+        self._pages: deque = deque()
+        self._page_of: Dict[str, _Page] = {}
+        self._lock = asyncio.Lock()
+
+    async def register(self, cursor: Optional[str], next_cursor: Optional[str], receipts: List[dict]) -> List[dict]:
+        """Registra una página; retorna las ventas que faltan procesar"""
+        sales = [r for r in receipts if r.get("receipt_type", "SALE") == "SALE"]
+        pending = [r for r in sales if str(r["receipt_number"]) not in self.done]
+        page = _Page(cursor, next_cursor, [str(r["receipt_number"]) for r in sales],
+                     {str(r["receipt_number"]) for r in pending}, len(receipts) - len(sales), len(receipts))
+        for receipt in pending:
+            self._page_of[str(receipt["receipt_number"])] = page
+        self._pages.append(page)
+        await self._advance()
+        return pending
+
+    async def on_receipt(self, receipt: dict, outcome: str):
+        number = str(receipt["receipt_number"])
+        update = {
+            "$inc": {"records_processed": 1, f"records_{outcome}": 1},
+            "$push": {"checkpoint": number}
+        }
+        if outcome == "failed":
+            error = next((e for e in reversed(self.stats.errors) if str(e["receipt_number"]) == number),
+                         {"receipt_number": number, "error": "desconocido"})
+            update["$push"]["errors"] = {"$each": [error], "$slice": -LOYVERSE_SYNC_MAX_ERRORS}
+            created_at = _receipt_time(receipt)
+            if created_at is not None:
+                update["$min"] = {"earliest_failed_at": created_at}
+        if not await self._update(update):
+            return
+
+        page = self._page_of.pop(number, None)
+        if page is not None:
+            page.pending.discard(number)
+        await self._advance()
+
+    async def _advance(self):
+        async with self._lock:
+            while self._pages and not self._pages[0].pending:
+                page = self._pages.popleft()
+                if not await self._update({
+                    "$set": {"cursor": page.next_cursor, "fetch_done": page.next_cursor is None},
+                    "$inc": {"pages_done": 1, "records_fetched": page.fetched, "refunds_skipped": page.refunds},
+                    "$pullAll": {"checkpoint": page.sales}
+                }):
+                    return
+
+    async def _update(self, update: dict) -> bool:
+        """Aplica `update` si esta instancia sigue siendo dueña; si no, detiene el runner"""
+        result = await self.admin_db.sync_logs.update_one(
+            {"_id": self.sync_log_id, "owner": INSTANCE_ID}, update
+        )
+        if result.matched_count == 0:
+            print(f"[Sync] {self.sync_log_id} fue tomado por otra instancia; deteniendo")
+            self.runner.cancel()
+            return False
+        return True
+
+
+async def _pages_from(api_key: str, from_str: str, to_str: str, cursor: Optional[str]):
+    """(cursor de la página, recibos, cursor siguiente); si Loyverse rechaza el cursor guardado, reinicia el rango"""
+    received = False
+    page_cursor = cursor
+    try:
+        async for receipts, next_cursor in fetch_receipt_pages(api_key, from_str, to_str, cursor):
+            received = True
+            yield page_cursor, receipts, next_cursor
+            page_cursor = next_cursor
+    except Exception as e:
+        if received or not cursor:
+            raise
+        print(f"[Sync] Loyverse rechazó el cursor guardado ({e}); reiniciando desde el inicio del rango")
+        page_cursor = None
+        async for receipts, next_cursor in fetch_receipt_pages(api_key, from_str, to_str):
+            yield page_cursor, receipts, next_cursor
+            page_cursor = next_cursor
+
+
+async def _diagnose_empty_range(api_key: str):
+    """Sin recibos en un rango explícito: consulta SIN filtro para el log"""
+    print(f"[Sync] 0 recibos con filtro de fecha. Probando SIN filtro...")
+    try:
+        test_response = await get_loyverse_client().get(
+            "/receipts",
+            headers={"Authorization": f"Bearer {api_key}"},
+            params={"limit": 10}
+        )
+    except Exception as e:
+        print(f"[Sync] Test sin filtro falló: {e}")
+        return
+    if test_response.status_code == 200:
+        test_data = test_response.json()
+        test_receipts = receipts_from_page(test_data)
+        print(f"[Sync] SIN filtro: keys={list(test_data.keys())}, recibos={len(test_receipts)}")
+        if test_receipts:
+            first = test_receipts[0]
+            print(f"[Sync] Primer recibo: number={first.get('receipt_number')}, created_at={first.get('created_at')}")
+    else:
+        print(f"[Sync] Test sin filtro falló: HTTP {test_response.status_code}")
+
+
+async def _heartbeat(admin_db, sync_log_id: str, runner: asyncio.Task):
+    """
+    Renueva heartbeat_at mientras esta instancia sea dueña del job. Si el
+    watchdog de otra instancia lo tomó (heartbeats perdidos), detiene el runner:
+    el nuevo dueño continúa desde el checkpoint.
+    """
+    while True:
+        await asyncio.sleep(LOYVERSE_SYNC_HEARTBEAT_SECONDS)
+        try:
+            result = await admin_db.sync_logs.update_one(
+                # Sin filtrar por status: un job recién cerrado no debe cancelar a _finish
+                {"_id": sync_log_id, "owner": INSTANCE_ID},
+                {"$set": {"heartbeat_at": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            # Error transitorio de MongoDB: se reintenta en el siguiente latido
+            print(f"[Sync] Error renovando heartbeat de {sync_log_id}: {e}")
+            continue
+        if result.matched_count == 0:
+            print(f"[Sync] {sync_log_id} fue tomado por otra instancia; deteniendo")
+            runner.cancel()
+            return
+
+
+async def _finish(admin_db, log: dict):
+    """
+    Cierra el job: resumen, last_sync y estado de la integración. Si otra
+    instancia tomó el job, no toca nada: el cierre le corresponde al nuevo dueño.
+    """
+    from_date = _as_utc(log["from_date"])
+    to_date = _as_utc(log["to_date"])
+    processed = log.get("records_processed", 0)
+    success = log.get("records_success", 0)
+    failed = log.get("records_failed", 0)
+    skipped = log.get("records_skipped", 0)
+    refunds = log.get("refunds_skipped", 0)
+    errors = log.get("errors", [])
+
+    # last_sync: todo el rango si no hubo fallos; si no, desde el recibo fallido más antiguo
+    if failed == 0:
+        effective_last_sync = to_date
+    else:
+        effective_last_sync = max(_as_utc(log["earliest_failed_at"]), from_date) if log.get("earliest_failed_at") else from_date
+
+    message_parts = [f"Sincronización completada: {success}/{processed} exitosos"]
+    if skipped > 0:
+        message_parts.append(f"{skipped} ya existían")
+    if refunds > 0:
+        message_parts.append(f"{refunds} reembolsos omitidos")
+    if failed > 0:
+        message_parts.append(f"{failed} fallidos")
+
+    result = await admin_db.sync_logs.update_one(
+        {"_id": log["_id"], "owner": INSTANCE_ID, "status": STATUS_RUNNING},
+        {"$set": {
+            "status": STATUS_COMPLETED,
+            "message": ", ".join(message_parts),
+            "debug": {
+                "from_date": from_date.isoformat(),
+                "to_date": to_date.isoformat(),
+                "custom_date_used": log.get("custom_date_used", False),
+                "loyverse_total_receipts": log.get("records_fetched", 0),
+                "loyverse_sales": log.get("records_fetched", 0) - refunds,
+                "loyverse_refunds_skipped": refunds,
+                "errors": errors[:5]
+            },
+            "checkpoint": [],
+            "completed_at": datetime.now(timezone.utc)
+        }}
+    )
+    if result.matched_count == 0:
+        print(f"[Sync] {log['_id']} fue tomado por otra instancia; no se cierra")
+        return
+    await admin_db.integrations.update_one(
+        {"tenant_id": log["tenant_id"], "type": "loyverse"},
+        {"$set": {
+            "last_sync": effective_last_sync,
+            "last_error": None if failed == 0 else f"{failed} errores",
+            "status": "active"
+        }}
+    )
+
+
+async def run_sync_job(admin_db, fe_db, sync_log_id: str, transform: Transform, wake: Wake):
+    """Ejecuta (o reanuda) un job desde su último checkpoint"""
+    log = await admin_db.sync_logs.find_one({"_id": sync_log_id})
+    if log is None or log["status"] != STATUS_RUNNING:
+        return
+    tenant_id = log["tenant_id"]
+    heartbeat = asyncio.create_task(_heartbeat(admin_db, sync_log_id, asyncio.current_task()))
+    try:
+        integration = await admin_db.integrations.find_one({"tenant_id": tenant_id, "type": "loyverse"})
+        api_key = (integration or {}).get("config", {}).get("api_key")
+        if not api_key:
+            raise Exception("Integración Loyverse eliminada o sin API Key")
+
+        if not log.get("fetch_done"):
+            if log.get("cursor") or log.get("checkpoint"):
+                print(f"[Sync] Reanudando {sync_log_id}: {log.get('pages_done', 0)} páginas y "
+                      f"{len(log.get('checkpoint', []))} recibos ya procesados")
+            from_str = _as_utc(log["from_date"]).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            to_str = _as_utc(log["to_date"]).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            print(f"[Sync] Llamando Loyverse API: created_at_min={from_str}, created_at_max={to_str}")
+
+            stats = SyncStats()
+            checkpoints = _Checkpoints(admin_db, sync_log_id, set(log.get("checkpoint", [])), stats,
+                                       asyncio.current_task())
+
+            async def pages():
+                # Despertar backend-fe antes de la primera venta (cold start de Render)
+                woken = False
+                async for page_cursor, receipts, next_cursor in _pages_from(api_key, from_str, to_str, log.get("cursor")):
+                    print(f"[Sync] Loyverse devolvió {len(receipts)} recibos en este lote")
+                    pending = await checkpoints.register(page_cursor, next_cursor, receipts)
+                    if pending and not woken:
+                        await wake(BACKEND_FE_URL)
+                        woken = True
+                    yield pending, next_cursor
+
+            await run_pipeline(fe_db, tenant_id, pages(), transform, stats=stats, on_receipt=checkpoints.on_receipt)
+            print(f"[Sync] {sync_log_id}: {stats.processed} ventas procesadas en esta ejecución, "
+                  f"{stats.as_dict()['elapsed_seconds']}s")
+
+        log = await admin_db.sync_logs.find_one({"_id": sync_log_id})
+        if log.get("records_fetched", 0) == 0 and log.get("custom_date_used"):
+            await _diagnose_empty_range(api_key)
+        await _finish(admin_db, log)
+    except asyncio.CancelledError:
+        # Apagado o job tomado por otra instancia: queda "running" con su cursor
+        raise
+    except Exception as e:
+        print(f"[Sync] Error en sincronización {sync_log_id}: {e}")
+        result = await admin_db.sync_logs.update_one(
+            {"_id": sync_log_id, "owner": INSTANCE_ID},
+            {"$set": {
+                "status": STATUS_ERROR,
+                "error_message": str(e),
+                "completed_at": datetime.now(timezone.utc)
+            }}
+        )
+        if result.matched_count == 0:
+            # Otra instancia tomó el job: el error de esta ejecución ya no aplica
+            return
+        await admin_db.integrations.update_one(
+            {"tenant_id": tenant_id, "type": "loyverse"},
+            {"$set": {"last_error": str(e), "status": "error"}}
+        )
+    finally:
+        heartbeat.cancel()
+
+
+def sync_progress(log: dict) -> dict:
+    """Vista de progreso de un job (endpoint de polling y eventos SSE)"""
+    return {
+        "sync_log_id": str(log["_id"]),
+        "status": log["status"],
+        "pages_done": log.get("pages_done", 0),
+        "fetch_done": log.get("fetch_done", False),
+        "records_fetched": log.get("records_fetched", 0),
+        "records_processed": log.get("records_processed", 0),
+        "records_success": log.get("records_success", 0),
+        "records_failed": log.get("records_failed", 0),
+        "records_skipped": log.get("records_skipped", 0),
+        "refunds_skipped": log.get("refunds_skipped", 0),
+        "resumes": log.get("resumes", 0),
+        "message": log.get("message") or log.get("error_message"),
+        "debug": log.get("debug"),
+        "errors": log.get("errors", [])[:5],
+        "heartbeat_at": log.get("heartbeat_at"),
+        "started_at": log.get("started_at"),
+        "completed_at": log.get("completed_at")
+    }
+
+
+def is_stale(log: dict) -> bool:
+    heartbeat_at = log.get("heartbeat_at")
+    if heartbeat_at is None:
+        return True
+    return _as_utc(heartbeat_at) < datetime.now(timezone.utc) - timedelta(seconds=LOYVERSE_SYNC_STALE_SECONDS)
+
+
+class SyncJobManager:
+    """Jobs de sincronización de esta instancia y watchdog de jobs abandonados"""
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._watchdog: Optional[asyncio.Task] = None
+        self.resumed = 0
+
+    def launch(self, admin_db, fe_db, sync_log_id: str, transform: Transform, wake: Wake):
+        if sync_log_id in self._tasks:
+            return
+        task = asyncio.create_task(run_sync_job(admin_db, fe_db, sync_log_id, transform, wake))
+        self._tasks[sync_log_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(sync_log_id, None))
+
+    async def resume_stale(self, admin_db, fe_db, transform: Transform, wake: Wake) -> int:
+        """Toma (claim atómico) y reanuda los jobs "running" sin heartbeat reciente"""
+        claimed = 0
+        while True:
+            now = datetime.now(timezone.utc)
+            log = await admin_db.sync_logs.find_one_and_update(
+                {
+                    "resumable": True,
+                    "status": STATUS_RUNNING,
+                    "heartbeat_at": {"$lt": now - timedelta(seconds=LOYVERSE_SYNC_STALE_SECONDS)},
+                    "_id": {"$nin": list(self._tasks)}
+                },
+                {"$set": {"heartbeat_at": now, "owner": INSTANCE_ID}, "$inc": {"resumes": 1}}
+            )
+            if log is None:
+                return claimed
+            print(f"[Sync] Reanudando job abandonado {log['_id']} (tenant {log['tenant_id']})")
+            self.launch(admin_db, fe_db, log["_id"], transform, wake)
+            claimed += 1
+            self.resumed += 1
+
+    def start_watchdog(self, admin_db, fe_db, transform: Transform, wake: Wake):
+        async def loop():
+            while True:
+                try:
+                    await self.resume_stale(admin_db, fe_db, transform, wake)
+                except Exception as e:
+                    print(f"[Sync] Error en watchdog de sincronización: {e}")
+                await asyncio.sleep(LOYVERSE_SYNC_WATCHDOG_SECONDS)
+
+        self._watchdog = asyncio.create_task(loop())
+
+    async def shutdown(self):
+        """Detiene watchdog y jobs; los jobs quedan "running" y otra instancia (o el próximo inicio) los reanuda"""
+        tasks = list(self._tasks.values())
+        if self._watchdog is not None:
+            tasks.append(self._watchdog)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"running": list(self._tasks), "resumed": self.resumed, "instance": INSTANCE_ID}
+
+
+sync_jobs = SyncJobManager()
@@ -0,0 +1,45 @@
+"""
+Lectura del archivo de XML firmados de backend-fe (fe_db.document_xml)
+
+backend-fe guarda cada XML con zstd y un diccionario por tenant
+(fe_db.xml_dictionaries), o con gzip en filas antiguas. Aquí solo se lee.
+"""
+import gzip
+from typing import Dict, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_decompressors: Dict[Optional[str], object] = {}
+
+
+async def _zstd_decompressor(fe_db, dict_id: Optional[str]):
+    decompressor = _decompressors.get(dict_id)
+    if decompressor is None:
+        if dict_id:
+            row = await fe_db.xml_dictionaries.find_one({"_id": dict_id})
+            if row is None:
+                raise LookupError(f"Diccionario {dict_id} no encontrado")
+            decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(row["dict_data"]))
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        _decompressors[dict_id] = decompressor
+    return decompressor
+
+
+async def load_document_xml(fe_db, document_id: str) -> Optional[str]:
+    """XML firmado de un documento, o None si no existe"""
+    xml_doc = await fe_db.document_xml.find_one({"document_id": document_id})
+    if xml_doc is None:
+        return None
+
+    if xml_doc.get("codec") == "zstd":
+        if zstandard is None:
+            raise RuntimeError("XML archivado con zstd pero la librería zstandard no está instalada")
+        decompressor = await _zstd_decompressor(fe_db, xml_doc.get("dict_id"))
+        return decompressor.decompress(xml_doc["xml_data"]).decode("utf-8")
+    if xml_doc.get("xml_gzip"):
+        return gzip.decompress(xml_doc["xml_gzip"]).decode("utf-8")
+    return xml_doc.get("xml_signed")
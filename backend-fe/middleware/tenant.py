@@ -1,68 +1,214 @@
 """
 Middleware para enforcement de tenant_id en todas las requests
 CRÍTICO: Garantiza aislamiento multi-tenant
+
+Middleware ASGI puro (sin BaseHTTPMiddleware): valida X-Tenant-ID y deja en
+request.state el TenantContext del tenant (emisor, configuración fiscal y
+metadatos del certificado activo) desde un caché LRU con TTL. Las rutas de
+configuración invalidan el contexto al modificarlo, pero solo en su réplica:
+en las demás el certificado cacheado puede quedar viejo hasta TENANT_CACHE_TTL,
+por eso services.signing_cache.get_signing_context verifica el activo antes de firmar.
 """
+import os
+import time
+import asyncio
+from collections import OrderedDict
 from fastapi import Request, HTTPException
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from typing import List
+from typing import Optional
+
+TENANT_CACHE_TTL = float(os.environ.get("TENANT_CACHE_TTL", "60"))
+TENANT_CACHE_MAX_ENTRIES = int(os.environ.get("TENANT_CACHE_MAX_ENTRIES", "1024"))
 
 # Rutas públicas que no requieren tenant_id
+# (/fe/metrics no usa tenant pero exige METRICS_TOKEN en la propia ruta)
 PUBLIC_PATHS = [
     "/fe/health",
+    "/fe/metrics",
     "/fe/docs",
     "/fe/openapi.json",
     "/fe/redoc",
     "/docs",
     "/openapi.json",
-    "/redoc",
-    "/"
+    "/redoc"
 ]
+# "/" solo como ruta exacta: como prefijo haría pública cualquier ruta
+PUBLIC_EXACT_PATHS = {"/"}
+
+# El certificado nunca se cachea con su contenido ni su contraseña
+CERTIFICATE_PROJECTION = {"file_data": 0, "password_encrypted": 0}
+
+
+class TenantContext:
+    """
+    Datos del tenant que usan las rutas de documentos:
+    - tenant: documento de tenants (None si aún no configuró el emisor)
+    - config: configs_fiscal
+    - certificate: certificado activo sin file_data ni password_encrypted
+    Los dicts son compartidos entre requests: no modificarlos.
+    """
 
-class TenantMiddleware(BaseHTTPMiddleware):
+    def __init__(self, tenant_id: str, tenant: Optional[dict], config: Optional[dict], certificate: Optional[dict]):
+        self.tenant_id = tenant_id
+        self.tenant = tenant
+        self.config = config
+        self.certificate = certificate
+        self.loaded_at = time.monotonic()
+
+    @property
+    def is_complete(self) -> bool:
+        return self.tenant is not None and self.config is not None and self.certificate is not None
+
+
+async def load_tenant_context(db, tenant_id: str) -> TenantContext:
+    tenant, config, certificate = await asyncio.gather(
+        db.tenants.find_one({"tenant_id": tenant_id}),
+        db.configs_fiscal.find_one({"tenant_id": tenant_id}),
+        db.certificates.find_one({"tenant_id": tenant_id, "is_active": True}, CERTIFICATE_PROJECTION)
+    )
+    return TenantContext(tenant_id, tenant, config, certificate)
+
+
+class TenantContextCache:
+    """
+    LRU con TTL de TenantContext por tenant_id.
+    Solo se cachean contextos completos: un tenant a medio configurar se lee de
+    la BD en cada request, así ninguna réplica se queda con un "no configurado".
+    """
+
+    def __init__(self, ttl: float = TENANT_CACHE_TTL, max_entries: int = TENANT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, TenantContext]" = OrderedDict()
+        self._locks: dict = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tenant_id: str) -> Optional[TenantContext]:
+        context = self._entries.get(tenant_id)
+        if context is None:
+            return None
+        if time.monotonic() - context.loaded_at > self.ttl:
+            del self._entries[tenant_id]
+            return None
+        self._entries.move_to_end(tenant_id)
+        return context
+
+    def put(self, context: TenantContext):
+        self._entries[context.tenant_id] = context
+        self._entries.move_to_end(context.tenant_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_load(self, db, tenant_id: str) -> TenantContext:
+        context = self.get(tenant_id)
+        if context is not None:
+            self.hits += 1
+            return context
+
+        # Una sola carga por tenant aunque lleguen varias requests a la vez
+        lock = self._locks.setdefault(tenant_id, asyncio.Lock())
+        async with lock:
+            context = self.get(tenant_id)
+            if context is not None:
+                self.hits += 1
+                return context
+            self.misses += 1
+            context = await load_tenant_context(db, tenant_id)
+            if context.is_complete:
+                self.put(context)
+        self._locks.pop(tenant_id, None)
+        return context
+
+    def invalidate(self, tenant_id: str):
+        self._entries.pop(tenant_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+tenant_cache = TenantContextCache()
+
+
+def invalidate_tenant_context(tenant_id: str):
+    """Descarta el contexto cacheado del tenant (emisor, configuración o certificado cambiados)"""
+    tenant_cache.invalidate(tenant_id)
+
+
+def _is_public(path: str) -> bool:
+    return path in PUBLIC_EXACT_PATHS or any(path.startswith(public) for public in PUBLIC_PATHS)
+
+
+class TenantMiddleware:
     """
     Middleware que valida y enforce tenant_id en TODAS las requests
     """
-    
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path
-        
-        # Permitir rutas públicas
-        if any(path.startswith(public) for public in PUBLIC_PATHS):
-            return await call_next(request)
-        
-        # Permitir OPTIONS (CORS preflight)
-        if request.method == "OPTIONS":
-            return await call_next(request)
-        
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Permitir rutas públicas y OPTIONS (CORS preflight)
+        if _is_public(scope["path"]) or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+
         # Obtener tenant_id del header
-        tenant_id = request.headers.get("X-Tenant-ID")
-        
+        tenant_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-tenant-id":
+                tenant_id = value.decode("latin-1")
+                break
+
         if not tenant_id:
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=401,
                 content={
                     "error": "X-Tenant-ID header requerido",
                     "detail": "Todas las requests deben incluir el header X-Tenant-ID"
                 }
             )
-        
+            return await response(scope, receive, send)
+
         # Validar formato básico del tenant_id
         if len(tenant_id) < 10:
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=400,
                 content={
                     "error": "X-Tenant-ID inválido",
                     "detail": "El tenant_id debe ser un UUID válido"
                 }
             )
-        
-        # Inyectar tenant_id en request.state para uso en endpoints
-        request.state.tenant_id = tenant_id
-        
-        # Continuar con la request
-        response = await call_next(request)
-        return response
+            return await response(scope, receive, send)
+
+        t_start = time.perf_counter()
+        context = await tenant_cache.get_or_load(scope["app"].state.db, tenant_id)
+        lookup_ms = (time.perf_counter() - t_start) * 1000
+        if context.tenant is not None and context.tenant.get("is_active") is False:
+            response = JSONResponse(
+                status_code=403,
+                content={
+                    "error": "Tenant inactivo",
+                    "detail": "Tenant no encontrado o inactivo"
+                }
+            )
+            return await response(scope, receive, send)
+
+        # Inyectar tenant_id y contexto en request.state para uso en endpoints
+        state = scope.setdefault("state", {})
+        state["tenant_id"] = tenant_id
+        state["tenant_context"] = context
+        state["tenant_lookup_ms"] = lookup_ms
+
+        await self.app(scope, receive, send)
 
 
 async def get_tenant_id(request: Request) -> str:
@@ -85,6 +231,23 @@ async def get_tenant_id(request: Request) -> str:
     return tenant_id
 
 
+async def get_tenant_context(request: Request) -> TenantContext:
+    """
+    Contexto del tenant resuelto por el middleware (o cargado aquí si la
+    request no pasó por él)
+    """
+    context = getattr(request.state, 'tenant_context', None)
+    if context is None:
+        tenant_id = await get_tenant_id(request)
+        context = await tenant_cache.get_or_load(request.app.state.db, tenant_id)
+    return context
+
+
+def request_lookup_ms(request: Request) -> float:
+    """Tiempo (ms) que tomó resolver el contexto del tenant en el middleware"""
+    return getattr(request.state, 'tenant_lookup_ms', 0.0)
+
+
 async def validate_tenant_exists(db, tenant_id: str) -> dict:
     """
     Valida que el tenant existe y está activo
@@ -28,6 +28,8 @@ class EmitterConfig(BaseModel):
     obligado_contabilidad: ObligadoContabilidad = ObligadoContabilidad.NO
     tipo_contribuyente: Optional[str] = None
     agente_retencion: Optional[str] = None
+    # Webhook del POS para el estado final de documentos emitidos en modo async
+    webhook_url: Optional[str] = None
 
 class FiscalConfigModel(BaseModel):
     iva_default: float = Field(default=15, ge=0)
@@ -15,7 +15,9 @@ class DocType(str, Enum):
 
 class SRIStatus(str, Enum):
     PENDIENTE = "PENDIENTE"
+    FIRMADO = "FIRMADO"
     ENVIADO = "ENVIADO"
+    EN_PROCESO = "EN_PROCESO"
     AUTORIZADO = "AUTORIZADO"
     RECHAZADO = "RECHAZADO"
     NO_AUTORIZADO = "NO_AUTORIZADO"
@@ -53,7 +55,8 @@ class ItemModel(BaseModel):
     quantity: float = Field(..., gt=0)
     unit_price: float = Field(..., ge=0)
     discount: float = Field(default=0, ge=0)
-    iva_rate: float = Field(default=15, description="0, 12, 15")
+    iva_rate: float = Field(default=15, description="0, 5, 8, 12, 13, 14, 15")
+    iva_code: Optional[str] = Field(default=None, description="Código SRI de tarifa; 6=No objeto, 7=Exento (por defecto según iva_rate)")
 
 class PaymentModel(BaseModel):
     method: str = Field(default="01", description="Código forma de pago SRI")
@@ -68,6 +71,15 @@ class InvoiceCreate(BaseModel):
     customer: CustomerModel
     items: List[ItemModel] = Field(..., min_length=1)
     payments: List[PaymentModel] = Field(default=[])
+    callback_url: Optional[str] = Field(default=None, description="Webhook para el estado final (mode=async); solo el webhook_url registrado del emisor")
+    external_reference: Optional[str] = Field(
+        default=None, min_length=1, max_length=100,
+        description="Referencia del sistema de origen (pos:<factura_id>, loyverse:<recibo>); una factura por referencia"
+    )
+
+class InvoiceBatchCreate(BaseModel):
+    invoices: List[InvoiceCreate] = Field(..., min_length=1)
+    callback_url: Optional[str] = Field(default=None, description="Webhook de las facturas del lote (mode=async); solo el webhook_url registrado del emisor")
 
 class CreditNoteCreate(BaseModel):
     invoice_id: str = Field(..., description="ID de la factura original")
@@ -133,3 +145,4 @@ class DocumentCreateResponse(BaseModel):
     sri_status: str
     sri_authorization_number: Optional[str] = None
     sri_messages: List[dict] = []
+    duplicate: bool = False
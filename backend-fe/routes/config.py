@@ -8,13 +8,17 @@ from fastapi import APIRouter, HTTPException, Request, UploadFile, File, Form, D
 from datetime import datetime, timezone
 from typing import Optional
 import uuid
+import asyncio
 
 from models.config import EmitterConfig, FullConfigResponse
 from models.certificate import CertificateResponse, CertificateInfo
-from middleware.tenant import get_tenant_id, validate_tenant_exists
+from middleware.tenant import get_tenant_id, validate_tenant_exists, invalidate_tenant_context
 from services.xml_signer import load_p12_certificate, get_certificate_info
-from utils.crypto import encrypt_password
-from utils.validators import validate_ruc, validate_email, validate_phone
+from services.signing_cache import invalidate_signing_context
+from services.java_signer_client import unregister_certificate
+from services.sequential import sequential_lease_report
+from utils.crypto import encrypt_password, generate_random_key
+from utils.validators import validate_ruc, validate_email, validate_phone, validate_webhook_url
 
 router = APIRouter(prefix="/fe/config", tags=["Configuración"])
 
@@ -50,6 +54,12 @@ async def save_emitter_config(
     if not valid:
         raise HTTPException(status_code=400, detail=msg)
     
+    # Webhook del POS (modo async): https a un host público, firmado con webhook_secret
+    webhook_url = (config.webhook_url or "").strip() or None
+    valid, msg = await asyncio.to_thread(validate_webhook_url, webhook_url)
+    if not valid:
+        raise HTTPException(status_code=400, detail=msg)
+    
     now = datetime.now(timezone.utc)
     
     # Verificar si tenant existe
@@ -126,6 +136,10 @@ async def save_emitter_config(
         upsert=True
     )
     
+    # El secreto del webhook se genera una vez y se conserva en las actualizaciones
+    existing_config = await db.configs_fiscal.find_one({"tenant_id": tenant_id}, {"webhook_secret": 1})
+    webhook_secret = (existing_config or {}).get("webhook_secret") or generate_random_key(32)
+    
     # Crear/actualizar configuración fiscal
     await db.configs_fiscal.update_one(
         {"tenant_id": tenant_id},
@@ -135,6 +149,8 @@ async def save_emitter_config(
                 "obligado_contabilidad": config.obligado_contabilidad,
                 "tipo_contribuyente": config.tipo_contribuyente,
                 "agente_retencion": config.agente_retencion,
+                "webhook_url": webhook_url,
+                "webhook_secret": webhook_secret,
                 "config": {
                     "iva_default": 15,
                     "moneda": "DOLAR",
@@ -155,12 +171,17 @@ async def save_emitter_config(
         },
         upsert=True
     )
+    invalidate_tenant_context(tenant_id)
     
-    return {
+    response = {
         "success": True,
         "tenant_id": tenant_id,
         "message": "Configuración del emisor guardada correctamente"
     }
+    if webhook_url:
+        # Para verificar X-FE-Signature en el POS
+        response["webhook_secret"] = webhook_secret
+    return response
 
 
 @router.post("/certificate")
@@ -230,6 +251,8 @@ async def upload_certificate(
     }
     
     await db.certificates.insert_one(cert_doc)
+    invalidate_signing_context(tenant_id)
+    invalidate_tenant_context(tenant_id)
     
     # Calcular días hasta expiración
     days_until_expiry = (cert_info["valid_to"] - datetime.now()).days
@@ -259,7 +282,7 @@ async def get_config(request: Request):
     tenant = await db.tenants.find_one({"tenant_id": tenant_id}, {"_id": 0, "file_data": 0})
     
     # Obtener config fiscal
-    fiscal = await db.configs_fiscal.find_one({"tenant_id": tenant_id}, {"_id": 0})
+    fiscal = await db.configs_fiscal.find_one({"tenant_id": tenant_id}, {"_id": 0, "webhook_secret": 0})
     
     # Obtener certificado activo (sin file_data)
     certificate = await db.certificates.find_one(
@@ -289,7 +312,9 @@ async def get_config(request: Request):
         "fiscal": fiscal,
         "certificate": certificate,
         "is_configured": is_configured,
-        "missing_config": missing
+        "missing_config": missing,
+        # Rangos de secuenciales reservados y huecos de rangos abandonados
+        "sequential_leases": await sequential_lease_report(db, tenant_id)
     }
 
 
@@ -302,6 +327,11 @@ async def delete_certificate(request: Request):
     db = request.app.state.db
     
     result = await db.certificates.delete_many({"tenant_id": tenant_id})
+    invalidate_tenant_context(tenant_id)
+    # Liberar también la clave registrada en el firmador Java
+    for context in invalidate_signing_context(tenant_id):
+        if context.java_handle:
+            await unregister_certificate(context.java_handle)
     
     return {
         "success": True,
@@ -7,105 +7,79 @@ Rutas de Documentos Electrónicos
 - Reenviar documentos
 """
 from fastapi import APIRouter, HTTPException, Request, Query
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
 import uuid
-import gzip
+import json
+import time
+import base64
+import asyncio
+
+from pymongo.errors import DuplicateKeyError
 
 from models.document import (
-    InvoiceCreate, CreditNoteCreate, DocumentResponse, 
+    InvoiceCreate, InvoiceBatchCreate, CreditNoteCreate, DocumentResponse, 
     DocumentListResponse, DocumentCreateResponse
 )
-from middleware.tenant import get_tenant_id
-from services.sequential import get_next_sequential, format_doc_number
+from middleware.tenant import get_tenant_id, get_tenant_context, request_lookup_ms
+from services.sequential import allocate_sequential, format_doc_number
 from services.access_key import generate_access_key
 from services.xml_generator import generate_invoice_xml, generate_credit_note_xml
-from services.xml_signer_sri import sign_xml_xades_sri
-from services.java_signer_client import sign_xml_with_java
-from services.sri_client import SRIClient
-from services.pdf_generator import generate_ride_pdf
-from utils.crypto import decrypt_password
+from services.java_signer_client import sign_xml_with_java_handle
+from services.signing_cache import get_signing_context
+from services.signing_pool import signing_pool
+from services.sri_client import get_sri_client
+from services.sri_worker import sri_worker, status_broker, apply_sri_result
+from services.sri_reconciler import reconcile_pending
+from services.events import EventRecorder, record_event, embedded_events_complete
+from services.ride_cache import ride_renderer, ride_emitter
+from services.document_export import stream_export_zip
+from services.document_counts import document_counts
+from services.xml_archive import xml_archive
+from services.totals import calculate_totals
+from services.invoice_batch import stream_invoice_batch, INVOICE_BATCH_MAX_ITEMS
+from services.pipeline_metrics import StageTimer, SIGNER_JAVA, SIGNER_PYTHON
 
 router = APIRouter(prefix="/fe/documents", tags=["Documentos"])
 
 
-def calculate_totals(items: list, iva_default: float = 15) -> dict:
+def _callback_url(config: dict, callback_url: Optional[str]) -> Optional[str]:
     """
-    Calcula totales a partir de items
+    Webhook del documento: solo el registrado en la configuración del emisor
+    (validado al guardarlo), nunca una URL arbitraria del cliente
     """
-    subtotal_0 = 0.0
-    subtotal_12 = 0.0
-    subtotal_15 = 0.0
-    total_discount = 0.0
-    
-    processed_items = []
-    
-    for i, item in enumerate(items):
-        quantity = float(item.quantity)
-        unit_price = float(item.unit_price)
-        discount = float(item.discount) if item.discount else 0
-        iva_rate = float(item.iva_rate) if item.iva_rate is not None else iva_default
-        
-        subtotal_before_discount = quantity * unit_price
-        subtotal = subtotal_before_discount - discount
-        iva_amount = subtotal * iva_rate / 100
-        total = subtotal + iva_amount
-        
-        # Agregar a subtotales por tasa
-        if iva_rate == 0:
-            subtotal_0 += subtotal
-        elif iva_rate == 12:
-            subtotal_12 += subtotal
-        else:  # 15% u otras
-            subtotal_15 += subtotal
-        
-        total_discount += discount
-        
-        processed_items.append({
-            "sequence": i + 1,
-            "code": item.code,
-            "auxiliary_code": item.auxiliary_code,
-            "description": item.description,
-            "quantity": quantity,
-            "unit_price": unit_price,
-            "discount": discount,
-            "subtotal_before_discount": round(subtotal_before_discount, 2),
-            "subtotal": round(subtotal, 2),
-            "iva_rate": iva_rate,
-            "iva_amount": round(iva_amount, 2),
-            "total": round(total, 2)
-        })
-    
-    # Calcular IVAs
-    total_iva_0 = 0.0
-    total_iva_12 = round(subtotal_12 * 0.12, 2)
-    total_iva_15 = round(subtotal_15 * 0.15, 2)
-    total_iva = total_iva_0 + total_iva_12 + total_iva_15
-    
-    # Total final
-    total = round(subtotal_0 + subtotal_12 + subtotal_15 + total_iva, 2)
-    
-    totals = {
-        "subtotal_0": round(subtotal_0, 2),
-        "subtotal_12": round(subtotal_12, 2),
-        "subtotal_15": round(subtotal_15, 2),
-        "subtotal_not_subject": 0.0,
-        "subtotal_exempt": 0.0,
-        "total_discount": round(total_discount, 2),
-        "total_iva_0": total_iva_0,
-        "total_iva_12": total_iva_12,
-        "total_iva_15": total_iva_15,
-        "total_iva": round(total_iva, 2),
-        "propina": 0.0,
-        "total": total
-    }
-    
-    return totals, processed_items
+    registered = config.get("webhook_url")
+    if callback_url and callback_url != registered:
+        raise HTTPException(status_code=400, detail="callback_url debe ser el webhook_url registrado en la configuración del emisor")
+    return registered
+
+
+async def _existing_invoice(db, tenant_id: str, external_reference: str) -> Optional[DocumentCreateResponse]:
+    """Factura ya emitida con esa referencia externa (reintento del cliente), si existe"""
+    doc = await db.documents.find_one(
+        {"tenant_id": tenant_id, "external_reference": external_reference},
+        {"doc_number": 1, "access_key": 1, "sri_status": 1, "sri_authorization_number": 1, "sri_messages": 1}
+    )
+    if doc is None:
+        return None
+    return DocumentCreateResponse(
+        document_id=doc["_id"],
+        doc_number=doc["doc_number"],
+        access_key=doc["access_key"],
+        sri_status=doc["sri_status"],
+        sri_authorization_number=doc.get("sri_authorization_number"),
+        sri_messages=doc.get("sri_messages", []),
+        duplicate=True
+    )
 
 
 @router.post("/invoice", response_model=DocumentCreateResponse)
-async def create_invoice(request: Request, invoice: InvoiceCreate):
+async def create_invoice(
+    request: Request,
+    invoice: InvoiceCreate,
+    mode: str = Query("sync", pattern="^(sync|async)$")
+):
     """
     Crea una factura electrónica
     1. Genera secuencial
@@ -115,20 +89,37 @@ async def create_invoice(request: Request, invoice: InvoiceCreate):
     5. Firma XML
     6. Envía a SRI
     7. Actualiza estado
+
+    Con mode=async retorna después del paso 5 con sri_status=FIRMADO; la
+    recepción y autorización corren en services.sri_worker y el estado final
+    se notifica por webhook (webhook_url registrado del emisor; invoice.callback_url
+    solo puede repetirlo) y por GET /fe/documents/stream.
+
+    Con invoice.external_reference la creación es idempotente: si ya existe una
+    factura con esa referencia se retorna esa (duplicate=True) sin emitir otra.
     """
+    t_lookup = time.perf_counter()
     tenant_id = await get_tenant_id(request)
     db = request.app.state.db
     
-    # Validar configuración completa
-    tenant = await db.tenants.find_one({"tenant_id": tenant_id})
+    if invoice.external_reference:
+        existing = await _existing_invoice(db, tenant_id, invoice.external_reference)
+        if existing is not None:
+            return existing
+    
+    # Validar configuración completa (contexto cacheado por el middleware de tenant)
+    context = await get_tenant_context(request)
+    tenant = context.tenant
     if tenant is None:
         raise HTTPException(status_code=400, detail="Configuración del emisor no encontrada. Configure primero.")
     
-    config = await db.configs_fiscal.find_one({"tenant_id": tenant_id})
+    config = context.config
     if config is None:
         raise HTTPException(status_code=400, detail="Configuración fiscal no encontrada. Configure primero.")
+    callback_url = _callback_url(config, invoice.callback_url)
     
-    certificate = await db.certificates.find_one({"tenant_id": tenant_id, "is_active": True})
+    # Sin file_data: el contexto de firma cacheado lo lee solo si hace falta
+    certificate = context.certificate
     if certificate is None:
         raise HTTPException(status_code=400, detail="Certificado no configurado. Suba un certificado primero.")
     
@@ -143,34 +134,43 @@ async def create_invoice(request: Request, invoice: InvoiceCreate):
     # Obtener ambiente configurado
     ambiente = config.get("ambiente", "pruebas")
     
+    # Tiempos por etapa (evento del documento y GET /fe/metrics)
+    timer = StageTimer(tenant_id, ambiente)
+    timer.add("lookup", request_lookup_ms(request) + (time.perf_counter() - t_lookup) * 1000)
+    
     # Usar fecha actual de Ecuador (UTC-5) para el SRI
     # El SRI valida contra la fecha de Ecuador, no UTC
     ecuador_offset = timedelta(hours=-5)
     issue_date_for_sri = now + ecuador_offset
     
-    # Obtener secuencial atómico
-    sequential = await get_next_sequential(
-        db, tenant_id, 
-        invoice.store_code, 
-        invoice.emission_point, 
-        "01"  # Factura
-    )
+    # Calcular totales (antes del secuencial: una tarifa inválida no consume número)
+    try:
+        totals, processed_items = calculate_totals(invoice.items, config.get("config", {}).get("iva_default", 15))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Obtener secuencial atómico (por bloques si SEQUENTIAL_BLOCK_SIZE > 1)
+    with timer.stage("sequential"):
+        sequential = await allocate_sequential(
+            db, tenant_id, 
+            invoice.store_code, 
+            invoice.emission_point, 
+            "01"  # Factura
+        )
     
     doc_number = format_doc_number(invoice.store_code, invoice.emission_point, sequential)
     
     # Generar clave de acceso
-    access_key = generate_access_key(
-        issue_date=issue_date_for_sri,
-        doc_type="01",
-        ruc=tenant["ruc"],
-        ambiente=ambiente,
-        establecimiento=invoice.store_code,
-        punto_emision=invoice.emission_point,
-        secuencial=sequential
-    )
-    
-    # Calcular totales
-    totals, processed_items = calculate_totals(invoice.items, config.get("config", {}).get("iva_default", 15))
+    with timer.stage("access_key"):
+        access_key = generate_access_key(
+            issue_date=issue_date_for_sri,
+            doc_type="01",
+            ruc=tenant["ruc"],
+            ambiente=ambiente,
+            establecimiento=invoice.store_code,
+            punto_emision=invoice.emission_point,
+            secuencial=sequential
+        )
     
     # Procesar pagos
     payments = []
@@ -223,23 +223,28 @@ async def create_invoice(request: Request, invoice: InvoiceCreate):
         "created_at": now,
         "updated_at": now,
         "created_by_system": "POS",
+        "external_reference": invoice.external_reference,
         "is_voided": False,
         "has_credit_note": False
     }
     
-    await db.documents.insert_one(document)
-    
-    # Registrar evento
-    await db.document_events.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "event_type": "CREADO",
-        "status": "success",
-        "message": "Documento creado",
-        "metadata": {},
-        "created_at": now
-    })
+    # Eventos: se acumulan y se escriben junto con los cambios de estado
+    events = EventRecorder(document_id, tenant_id)
+    events.add("CREADO", "success", "Documento creado")
+    events.attach(document)
+    with timer.stage("store"):
+        try:
+            await db.documents.insert_one(document)
+        except DuplicateKeyError:
+            # Otra request con la misma referencia ganó la carrera (índice único
+            # tenant_id + external_reference); el secuencial reservado queda sin usar
+            existing = None
+            if invoice.external_reference:
+                existing = await _existing_invoice(db, tenant_id, invoice.external_reference)
+            if existing is None:
+                raise
+            return existing
+    document_counts.invalidate(tenant_id)
     
     # Generar XML
     emitter_data = {
@@ -251,105 +256,81 @@ async def create_invoice(request: Request, invoice: InvoiceCreate):
         "contribuyente_especial": config.get("tipo_contribuyente")
     }
     
-    xml_unsigned = generate_invoice_xml(
-        access_key=access_key,
-        emitter=emitter_data,
-        customer=document["customer"],
-        items=processed_items,
-        totals=totals,
-        payments=payments,
-        issue_date=issue_date_for_sri,  # Usar la fecha ajustada para Ecuador
-        store_code=invoice.store_code,
-        emission_point=invoice.emission_point,
-        sequential=sequential,
-        ambiente=ambiente
-    )
+    with timer.stage("xml"):
+        xml_unsigned = generate_invoice_xml(
+            access_key=access_key,
+            emitter=emitter_data,
+            customer=document["customer"],
+            items=processed_items,
+            totals=totals,
+            payments=payments,
+            issue_date=issue_date_for_sri,  # Usar la fecha ajustada para Ecuador
+            store_code=invoice.store_code,
+            emission_point=invoice.emission_point,
+            sequential=sequential,
+            ambiente=ambiente
+        )
     
     # Firmar XML
     try:
-        cert_password = decrypt_password(certificate["password_encrypted"])
-        p12_data = bytes(certificate["file_data"]) if not isinstance(certificate["file_data"], bytes) else certificate["file_data"]
-        # Intentar con servicio Java primero, si falla usar firmador Python
-        try:
-            xml_signed = await sign_xml_with_java(xml_unsigned, p12_data, cert_password)
-            print(f"[Firma] Documento {doc_number} firmado con servicio Java")
-        except Exception as java_err:
-            print(f"[Firma] Java signer no disponible ({str(java_err)[:100]}), usando firmador Python")
-            xml_signed = sign_xml_xades_sri(xml_unsigned, p12_data, cert_password)
-            print(f"[Firma] Documento {doc_number} firmado con firmador Python XAdES-SRI")
+        with timer.stage("sign"):
+            signing_context = await get_signing_context(db, tenant_id, certificate)
+            # Intentar con servicio Java primero, si falla usar firmador Python
+            try:
+                xml_signed = await sign_xml_with_java_handle(signing_context, xml_unsigned)
+                timer.signer = SIGNER_JAVA
+                print(f"[Firma] Documento {doc_number} firmado con servicio Java")
+            except Exception as java_err:
+                print(f"[Firma] Java signer no disponible ({str(java_err)[:100]}), usando firmador Python")
+                xml_signed = await signing_pool.sign(signing_context, xml_unsigned)
+                timer.signer = SIGNER_PYTHON
+                print(f"[Firma] Documento {doc_number} firmado con firmador Python XAdES-SRI")
     except Exception as e:
         # Actualizar estado a ERROR
-        await db.documents.update_one(
-            {"_id": document_id},
-            {"$set": {"sri_status": "ERROR", "sri_messages": [{"mensaje": f"Error al firmar: {str(e)}"}]}}
-        )
-        await db.document_events.insert_one({
+        events.add("ERROR", "error", f"Error al firmar XML: {str(e)}", timer.as_metadata())
+        await events.flush(db, {"$set": {"sri_status": "ERROR", "sri_messages": [{"mensaje": f"Error al firmar: {str(e)}"}]}})
+        raise HTTPException(status_code=500, detail=f"Error al firmar documento: {str(e)}")
+    
+    # Guardar XML comprimido (zstd con diccionario del tenant, o gzip)
+    with timer.stage("store"):
+        xml_fields = await xml_archive.encode(db, tenant_id, xml_signed.encode('utf-8'))
+        await db.document_xml.insert_one({
             "_id": str(uuid.uuid4()),
             "document_id": document_id,
             "tenant_id": tenant_id,
-            "event_type": "ERROR",
-            "status": "error",
-            "message": f"Error al firmar XML: {str(e)}",
-            "created_at": datetime.now(timezone.utc)
+            **xml_fields,
+            "encoding": "UTF-8",
+            "created_at": now
         })
-        raise HTTPException(status_code=500, detail=f"Error al firmar documento: {str(e)}")
-    
-    # Guardar XML comprimido
-    xml_gzip = gzip.compress(xml_signed.encode('utf-8'))
-    await db.document_xml.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "xml_gzip": xml_gzip,
-        "is_compressed": True,
-        "encoding": "UTF-8",
-        "size_bytes": len(xml_signed),
-        "created_at": now
-    })
     
-    await db.document_events.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "event_type": "FIRMADO",
-        "status": "success",
-        "message": "XML firmado correctamente",
-        "created_at": datetime.now(timezone.utc)
-    })
+    signed_event = events.add("FIRMADO", "success", "XML firmado correctamente")
+    
+    if mode == "async":
+        # Recepción y autorización se miden en el worker SRI
+        timer.observe()
+        signed_event["metadata"].update(timer.as_metadata())
+        await events.flush(db, {"$set": {"sri_status": "FIRMADO", "updated_at": datetime.now(timezone.utc)}})
+        document["signer"] = timer.signer
+        await sri_worker.enqueue(db, document, ambiente, callback_url)
+        return DocumentCreateResponse(
+            document_id=document_id,
+            doc_number=doc_number,
+            access_key=access_key,
+            sri_status="FIRMADO"
+        )
     
     # Enviar a SRI
     print(f"[SRI] Enviando documento {doc_number} a SRI...")
-    sri_client = SRIClient(ambiente=ambiente)
+    sri_client = get_sri_client(ambiente)
     sri_status, auth_number, auth_date, sri_messages = await sri_client.emitir_y_autorizar(
-        xml_signed, access_key
+        xml_signed, access_key, timings=timer.timings
     )
     print(f"[SRI] Resultado: status={sri_status}, auth={auth_number}")
+    timer.observe()
     
-    # Actualizar documento con resultado SRI
-    update_data = {
-        "sri_status": sri_status,
-        "sri_messages": sri_messages,
-        "updated_at": datetime.now(timezone.utc)
-    }
-    
-    if auth_number:
-        update_data["sri_authorization_number"] = auth_number
-    if auth_date:
-        update_data["sri_authorization_date"] = auth_date
-    
-    await db.documents.update_one({"_id": document_id}, {"$set": update_data})
-    
-    # Registrar evento SRI
-    await db.document_events.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "event_type": sri_status,
-        "status": "success" if sri_status == "AUTORIZADO" else "error",
-        "message": f"Respuesta SRI: {sri_status}",
-        "metadata": {"messages": sri_messages},
-        "created_at": datetime.now(timezone.utc)
-    })
+    # Actualizar documento con resultado SRI y registrar evento (con los tiempos por etapa)
+    await apply_sri_result(db, document_id, tenant_id, sri_status, auth_number, auth_date, sri_messages, events,
+                           timer.as_metadata())
     
     return DocumentCreateResponse(
         document_id=document_id,
@@ -361,11 +342,64 @@ async def create_invoice(request: Request, invoice: InvoiceCreate):
     )
 
 
+@router.post("/invoices/batch")
+async def create_invoice_batch(
+    request: Request,
+    batch: InvoiceBatchCreate,
+    mode: str = Query("sync", pattern="^(sync|async)$")
+):
+    """
+    Crea varias facturas electrónicas en una sola request (sincronización
+    Loyverse, cierre de caja del POS)
+
+    El contexto del tenant y el material de firma se cargan una vez, los
+    secuenciales salen de un rango reservado por punto de emisión y documentos
+    y XML se insertan por lotes. La respuesta es NDJSON: una línea por factura
+    ({"index", "document_id", "doc_number", "access_key", "sri_status", ...}) a
+    medida que termina, y al final {"summary": {...}}.
+    Con mode=async las facturas quedan FIRMADO y se encolan en el worker SRI.
+    """
+    tenant_id = await get_tenant_id(request)
+    db = request.app.state.db
+    
+    if len(batch.invoices) > INVOICE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {INVOICE_BATCH_MAX_ITEMS} facturas por lote")
+    
+    context = await get_tenant_context(request)
+    if context.tenant is None:
+        raise HTTPException(status_code=400, detail="Configuración del emisor no encontrada. Configure primero.")
+    if context.config is None:
+        raise HTTPException(status_code=400, detail="Configuración fiscal no encontrada. Configure primero.")
+    if context.certificate is None:
+        raise HTTPException(status_code=400, detail="Certificado no configurado. Suba un certificado primero.")
+    
+    valid_to = context.certificate["certificate_info"].get("valid_to")
+    if valid_to and valid_to < datetime.now():
+        raise HTTPException(status_code=400, detail="El certificado está expirado. Suba uno nuevo.")
+    
+    callback_url = _callback_url(context.config, batch.callback_url)
+    for invoice in batch.invoices:
+        _callback_url(context.config, invoice.callback_url)
+    
+    # El material de firma se valida antes de empezar el stream
+    try:
+        signing_context = await get_signing_context(db, tenant_id, context.certificate)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al cargar el certificado: {str(e)}")
+    
+    return StreamingResponse(
+        stream_invoice_batch(db, context, signing_context, batch.invoices, mode, callback_url,
+                             request_lookup_ms(request)),
+        media_type="application/x-ndjson"
+    )
+
+
 @router.post("/credit-note", response_model=DocumentCreateResponse)
 async def create_credit_note(request: Request, credit_note: CreditNoteCreate):
     """
     Crea una nota de crédito electrónica
     """
+    t_lookup = time.perf_counter()
     tenant_id = await get_tenant_id(request)
     db = request.app.state.db
     
@@ -392,36 +426,43 @@ async def create_credit_note(request: Request, credit_note: CreditNoteCreate):
             detail="El SRI no permite crear Notas de Crédito para facturas emitidas a 'Consumidor Final'. Solo puede crear NC para clientes identificados."
         )
     
-    # Obtener configuraciones
-    tenant = await db.tenants.find_one({"tenant_id": tenant_id})
-    config = await db.configs_fiscal.find_one({"tenant_id": tenant_id})
-    certificate = await db.certificates.find_one({"tenant_id": tenant_id, "is_active": True})
+    # Obtener configuraciones (contexto cacheado por el middleware de tenant)
+    context = await get_tenant_context(request)
+    tenant, config, certificate = context.tenant, context.config, context.certificate
     
     if not all([tenant, config, certificate]):
         raise HTTPException(status_code=400, detail="Configuración incompleta")
     
+    ambiente = config.get("ambiente", "pruebas")
+    timer = StageTimer(tenant_id, ambiente)
+    timer.add("lookup", request_lookup_ms(request) + (time.perf_counter() - t_lookup) * 1000)
+    
     now = datetime.now(timezone.utc)
     store_code = invoice["store"]["code"]
     emission_point = invoice["store"]["emission_point"]
     
+    # Calcular totales (antes del secuencial: una tarifa inválida no consume número)
+    try:
+        totals, processed_items = calculate_totals(credit_note.items)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     # Obtener secuencial para NC
-    sequential = await get_next_sequential(db, tenant_id, store_code, emission_point, "04")
+    with timer.stage("sequential"):
+        sequential = await allocate_sequential(db, tenant_id, store_code, emission_point, "04")
     doc_number = format_doc_number(store_code, emission_point, sequential)
     
     # Generar clave de acceso
-    ambiente = config.get("ambiente", "pruebas")
-    access_key = generate_access_key(
-        issue_date=now,
-        doc_type="04",
-        ruc=tenant["ruc"],
-        ambiente=ambiente,
-        establecimiento=store_code,
-        punto_emision=emission_point,
-        secuencial=sequential
-    )
-    
-    # Calcular totales
-    totals, processed_items = calculate_totals(credit_note.items)
+    with timer.stage("access_key"):
+        access_key = generate_access_key(
+            issue_date=now,
+            doc_type="04",
+            ruc=tenant["ruc"],
+            ambiente=ambiente,
+            establecimiento=store_code,
+            punto_emision=emission_point,
+            secuencial=sequential
+        )
     
     # Referencia a factura
     invoice_reference = {
@@ -456,8 +497,13 @@ async def create_credit_note(request: Request, credit_note: CreditNoteCreate):
         "is_voided": False,
         "has_credit_note": False
     }
+    # Sin eventos todavía: los de la firma y la respuesta SRI se agregan al array embebido
+    events = EventRecorder(document_id, tenant_id)
+    events.attach(document)
     
-    await db.documents.insert_one(document)
+    with timer.stage("store"):
+        await db.documents.insert_one(document)
+    document_counts.invalidate(tenant_id)
     
     # Generar y firmar XML
     emitter_data = {
@@ -468,67 +514,61 @@ async def create_credit_note(request: Request, credit_note: CreditNoteCreate):
         "obligado_contabilidad": config.get("obligado_contabilidad", "NO")
     }
     
-    xml_unsigned = generate_credit_note_xml(
-        access_key=access_key,
-        emitter=emitter_data,
-        customer=invoice["customer"],
-        items=processed_items,
-        totals=totals,
-        invoice_reference=invoice_reference,
-        issue_date=now,
-        store_code=store_code,
-        emission_point=emission_point,
-        sequential=sequential,
-        ambiente=ambiente
-    )
+    with timer.stage("xml"):
+        xml_unsigned = generate_credit_note_xml(
+            access_key=access_key,
+            emitter=emitter_data,
+            customer=invoice["customer"],
+            items=processed_items,
+            totals=totals,
+            invoice_reference=invoice_reference,
+            issue_date=now,
+            store_code=store_code,
+            emission_point=emission_point,
+            sequential=sequential,
+            ambiente=ambiente
+        )
     
     # Firmar XML
     try:
-        cert_password = decrypt_password(certificate["password_encrypted"])
-        p12_data = bytes(certificate["file_data"]) if not isinstance(certificate["file_data"], bytes) else certificate["file_data"]
-        try:
-            xml_signed = await sign_xml_with_java(xml_unsigned, p12_data, cert_password)
-            print(f"[Firma NC] Nota de crédito {doc_number} firmada con servicio Java")
-        except Exception as java_err:
-            print(f"[Firma NC] Java signer no disponible ({str(java_err)[:100]}), usando firmador Python")
-            xml_signed = sign_xml_xades_sri(xml_unsigned, p12_data, cert_password)
-            print(f"[Firma NC] Nota de crédito {doc_number} firmada con firmador Python XAdES-SRI")
+        with timer.stage("sign"):
+            signing_context = await get_signing_context(db, tenant_id, certificate)
+            try:
+                xml_signed = await sign_xml_with_java_handle(signing_context, xml_unsigned)
+                timer.signer = SIGNER_JAVA
+                print(f"[Firma NC] Nota de crédito {doc_number} firmada con servicio Java")
+            except Exception as java_err:
+                print(f"[Firma NC] Java signer no disponible ({str(java_err)[:100]}), usando firmador Python")
+                xml_signed = await signing_pool.sign(signing_context, xml_unsigned)
+                timer.signer = SIGNER_PYTHON
+                print(f"[Firma NC] Nota de crédito {doc_number} firmada con firmador Python XAdES-SRI")
     except Exception as e:
         # Actualizar estado a ERROR
-        await db.documents.update_one(
-            {"_id": document_id},
-            {"$set": {"sri_status": "ERROR", "sri_messages": [{"mensaje": f"Error al firmar: {str(e)}"}]}}
-        )
+        events.add("ERROR", "error", f"Error al firmar XML: {str(e)}", timer.as_metadata())
+        await events.flush(db, {"$set": {"sri_status": "ERROR", "sri_messages": [{"mensaje": f"Error al firmar: {str(e)}"}]}})
         raise HTTPException(status_code=500, detail=f"Error al firmar documento: {str(e)}")
     
     # Guardar XML
-    xml_gzip = gzip.compress(xml_signed.encode('utf-8'))
-    await db.document_xml.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "xml_gzip": xml_gzip,
-        "is_compressed": True,
-        "created_at": now
-    })
+    with timer.stage("store"):
+        xml_fields = await xml_archive.encode(db, tenant_id, xml_signed.encode('utf-8'))
+        await db.document_xml.insert_one({
+            "_id": str(uuid.uuid4()),
+            "document_id": document_id,
+            "tenant_id": tenant_id,
+            **xml_fields,
+            "created_at": now
+        })
     
     # Enviar a SRI
-    sri_client = SRIClient(ambiente=ambiente)
+    sri_client = get_sri_client(ambiente)
     sri_status, auth_number, auth_date, sri_messages = await sri_client.emitir_y_autorizar(
-        xml_signed, access_key
+        xml_signed, access_key, timings=timer.timings
     )
+    timer.observe()
     
-    # Actualizar NC
-    await db.documents.update_one(
-        {"_id": document_id},
-        {"$set": {
-            "sri_status": sri_status,
-            "sri_authorization_number": auth_number,
-            "sri_authorization_date": auth_date,
-            "sri_messages": sri_messages,
-            "updated_at": datetime.now(timezone.utc)
-        }}
-    )
+    # Actualizar NC (el evento de la respuesta SRI lleva los tiempos por etapa)
+    await apply_sri_result(db, document_id, tenant_id, sri_status, auth_number, auth_date, sri_messages,
+                           recorder=events, metadata=timer.as_metadata())
     
     # Marcar factura original como que tiene NC (independientemente del estado)
     await db.documents.update_one(
@@ -546,6 +586,37 @@ async def create_credit_note(request: Request, credit_note: CreditNoteCreate):
     )
 
 
+LIST_PROJECTION = {"_id": 1, "tenant_id": 1, "doc_type": 1, "doc_number": 1,
+                   "access_key": 1, "store": 1, "issue_date": 1, "customer": 1,
+                   "totals": 1, "sri_status": 1, "sri_authorization_number": 1,
+                   "created_at": 1, "is_voided": 1, "has_credit_note": 1, "invoice_reference": 1}
+
+
+def _encode_cursor(doc: dict) -> str:
+    """Cursor opaco con la posición (issue_date, doc_number) del último documento"""
+    issue_date = doc["issue_date"]
+    payload = {
+        "d": issue_date.isoformat() if isinstance(issue_date, datetime) else str(issue_date),
+        "n": doc["doc_number"]
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        issue_date = datetime.fromisoformat(payload["d"])
+        doc_number = payload["n"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    # Siguiente página en orden (issue_date desc, doc_number desc)
+    return {"$or": [
+        {"issue_date": {"$lt": issue_date}},
+        {"issue_date": issue_date, "doc_number": {"$lt": doc_number}}
+    ]}
+
+
 @router.get("")
 async def list_documents(
     request: Request,
@@ -555,10 +626,16 @@ async def list_documents(
     doc_type: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    customer_id: Optional[str] = None
+    customer_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    with_total: bool = True
 ):
     """
     Lista documentos electrónicos con filtros y paginación
+    
+    - cursor: paginación por keyset (issue_date, doc_number); usar el next_cursor
+      de la respuesta anterior. Sin cursor se mantiene la paginación por página.
+    - with_total=false: no calcula el total (scroll infinito)
     """
     tenant_id = await get_tenant_id(request)
     db = request.app.state.db
@@ -592,35 +669,107 @@ async def list_documents(
     if customer_id:
         query["customer.identification"] = customer_id
     
-    # Contar total
-    total = await db.documents.count_documents(query)
+    # Total cacheado por tenant y filtro (no en cada página)
+    total = await document_counts.count(db, tenant_id, query) if with_total else None
     
-    # Obtener documentos - ordenar por número de documento descendente
-    skip = (page - 1) * limit
-    cursor = db.documents.find(query, {"_id": 1, "tenant_id": 1, "doc_type": 1, "doc_number": 1, 
-                                        "access_key": 1, "store": 1, "issue_date": 1, "customer": 1,
-                                        "totals": 1, "sri_status": 1, "sri_authorization_number": 1,
-                                        "created_at": 1, "is_voided": 1, "has_credit_note": 1, "invoice_reference": 1})
-    cursor = cursor.sort("doc_number", -1).skip(skip).limit(limit)
+    # Ordenar por fecha de emisión y número descendente (índices compuestos por tenant)
+    page_query = {**query, **_decode_cursor(cursor)} if cursor else query
+    find_cursor = db.documents.find(page_query, LIST_PROJECTION)
+    find_cursor = find_cursor.sort([("issue_date", -1), ("doc_number", -1)])
+    if not cursor and page > 1:
+        find_cursor = find_cursor.skip((page - 1) * limit)
+    find_cursor = find_cursor.limit(limit + 1)
     
     documents = []
-    async for doc in cursor:
+    async for doc in find_cursor:
+        documents.append(doc)
+    
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+    next_cursor = _encode_cursor(documents[-1]) if has_more else None
+    
+    for doc in documents:
         doc["document_id"] = doc.pop("_id")
         doc["items"] = []  # No incluir items en listado
         doc["payments"] = []
         doc["sri_messages"] = []
-        documents.append(doc)
     
-    pages = (total + limit - 1) // limit
+    pages = (total + limit - 1) // limit if total is not None else None
     
     return {
         "documents": documents,
         "total": total,
         "page": page,
-        "pages": pages
+        "pages": pages,
+        "has_more": has_more,
+        "next_cursor": next_cursor
     }
 
 
+@router.get("/export.zip")
+async def export_documents_zip(
+    request: Request,
+    date_from: str,
+    date_to: str,
+    status: Optional[str] = "AUTORIZADO",
+    doc_type: Optional[str] = None,
+    include_pdf: bool = True
+):
+    """
+    Exporta en un ZIP (en streaming) el XML y el RIDE de los documentos de un rango de fechas
+    """
+    tenant_id = await get_tenant_id(request)
+    db = request.app.state.db
+    
+    try:
+        df = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
+        dt = datetime.fromisoformat(date_to.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fechas inválidas, use formato ISO (YYYY-MM-DD)")
+    
+    query = {"tenant_id": tenant_id, "issue_date": {"$gte": df, "$lte": dt}}
+    if status:
+        query["sri_status"] = status
+    if doc_type:
+        query["doc_type"] = doc_type
+    
+    filename = f"comprobantes_{df.strftime('%Y%m%d')}_{dt.strftime('%Y%m%d')}.zip"
+    
+    return StreamingResponse(
+        stream_export_zip(db, request.app.state.mongo_client, await get_tenant_context(request), query, include_pdf),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+@router.get("/stream")
+async def stream_document_status(request: Request):
+    """
+    Stream SSE con los estados finales de documentos emitidos en modo async
+    """
+    tenant_id = await get_tenant_id(request)
+    queue = status_broker.subscribe(tenant_id)
+    
+    async def event_source():
+        try:
+            yield ": conectado\n\n"
+            while not await request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {payload['event']}\ndata: {json.dumps(payload, default=str)}\n\n"
+        finally:
+            status_broker.unsubscribe(tenant_id, queue)
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/{document_id}")
 async def get_document(request: Request, document_id: str):
     """
@@ -634,12 +783,22 @@ async def get_document(request: Request, document_id: str):
     if document is None:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    # Obtener eventos
-    events = []
-    cursor = db.document_events.find({"document_id": document_id}).sort("created_at", -1)
-    async for event in cursor:
-        event["event_id"] = str(event.pop("_id"))
-        events.append(event)
+    # Eventos embebidos (más recientes primero) si están completos; si no
+    # (documento anterior a los eventos embebidos o array recortado) document_events
+    complete = embedded_events_complete(document)
+    embedded = document.pop("events", [])
+    document.pop("events_embedded", None)
+    if complete:
+        events = [
+            {**event, "document_id": document_id, "tenant_id": tenant_id}
+            for event in reversed(embedded)
+        ]
+    else:
+        events = []
+        cursor = db.document_events.find({"document_id": document_id}).sort("created_at", -1)
+        async for event in cursor:
+            event["event_id"] = str(event.pop("_id"))
+            events.append(event)
     
     document["document_id"] = document.pop("_id")
     
@@ -667,11 +826,8 @@ async def download_xml(request: Request, document_id: str):
     if xml_doc is None:
         raise HTTPException(status_code=404, detail="XML no encontrado")
     
-    # Descomprimir si es necesario
-    if xml_doc.get("is_compressed") and xml_doc.get("xml_gzip"):
-        xml_content = gzip.decompress(xml_doc["xml_gzip"]).decode('utf-8')
-    else:
-        xml_content = xml_doc.get("xml_signed", "")
+    # Descomprimir según el codec de la fila (zstd, gzip o texto)
+    xml_content = (await xml_archive.decode(db, xml_doc)).decode('utf-8')
     
     filename = f"{document['doc_number'].replace('-', '')}.xml"
     
@@ -694,50 +850,31 @@ async def download_pdf(request: Request, document_id: str):
     if document is None:
         raise HTTPException(status_code=404, detail="Documento no encontrado")
     
-    tenant = await db.tenants.find_one({"tenant_id": tenant_id})
-    config = await db.configs_fiscal.find_one({"tenant_id": tenant_id})
+    context = await get_tenant_context(request)
+    tenant, config = context.tenant, context.config
+    if tenant is None:
+        raise HTTPException(status_code=400, detail="Configuración del emisor no encontrada")
     
-    # Obtener logo del POS (configuraciones del negocio)
-    # El logo se guarda en facturacion_db.configuraciones con el tenant_id como _id
-    logo_base64 = None
-    try:
-        import os
-        from motor.motor_asyncio import AsyncIOMotorClient
-        mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
-        pos_client = AsyncIOMotorClient(mongo_url)
-        facturacion_db = pos_client["facturacion_db"]
-        
-        # Buscar la configuración del negocio usando el tenant_id
-        pos_config = await facturacion_db.configuraciones.find_one({"_id": tenant_id})
-        if pos_config and pos_config.get("logo_url"):
-            logo_url = pos_config["logo_url"]
-            # El logo_url viene como data:image/xxx;base64,xxxxx
-            if logo_url and "base64," in logo_url:
-                logo_base64 = logo_url.split("base64,")[1]
-        
-        pos_client.close()
-    except Exception as e:
-        print(f"Error obteniendo logo del POS: {e}")
+    # Logo del POS (cacheado por tenant, con el cliente Mongo de la app)
+    logo_base64, logo_hash = await ride_renderer.get_logo(request.app.state.mongo_client, tenant_id)
     
-    emitter = {
-        "ruc": tenant["ruc"],
-        "razon_social": tenant["razon_social"],
-        "nombre_comercial": tenant.get("nombre_comercial"),
-        "direccion": tenant.get("address", {}).get("direccion", ""),
-        "telefono": tenant.get("phone"),
-        "ambiente": config.get("ambiente", "pruebas") if config else "pruebas",
-        "obligado_contabilidad": config.get("obligado_contabilidad", "NO") if config else "NO",
-        "contribuyente_especial": config.get("tipo_contribuyente") if config else None
-    }
+    # Versión del RIDE: estado del documento + configuración del emisor + logo
+    etag = f'"{ride_renderer.compute_etag(document, tenant, config, logo_hash)}"'
+    filename = f"{document['doc_number'].replace('-', '')}.pdf"
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
     
-    pdf_bytes = generate_ride_pdf(document, emitter, logo_base64)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=cache_headers)
     
-    filename = f"{document['doc_number'].replace('-', '')}.pdf"
+    emitter = ride_emitter(tenant, config)
+    
+    pdf_bytes = await ride_renderer.get_pdf(db, document, emitter, logo_base64, etag)
     
     return Response(
         content=pdf_bytes,
         media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+        headers={"Content-Disposition": f"attachment; filename={filename}", **cache_headers}
     )
 
 
@@ -761,25 +898,25 @@ async def resend_document(request: Request, document_id: str):
     if xml_doc is None:
         raise HTTPException(status_code=404, detail="XML no encontrado")
     
-    if xml_doc.get("is_compressed"):
-        xml_signed = gzip.decompress(xml_doc["xml_gzip"]).decode('utf-8')
-    else:
-        xml_signed = xml_doc.get("xml_signed", "")
+    xml_signed = (await xml_archive.decode(db, xml_doc)).decode('utf-8')
     
     # Obtener config
-    config = await db.configs_fiscal.find_one({"tenant_id": tenant_id})
+    config = (await get_tenant_context(request)).config
     ambiente = config.get("ambiente", "pruebas") if config else "pruebas"
     
     # Reenviar
-    sri_client = SRIClient(ambiente=ambiente)
+    sri_client = get_sri_client(ambiente)
     sri_status, auth_number, auth_date, sri_messages = await sri_client.emitir_y_autorizar(
         xml_signed, document["access_key"]
     )
     
     # Actualizar
-    await db.documents.update_one(
-        {"_id": document_id},
-        {"$set": {
+    await record_event(
+        db, document_id, tenant_id, "REENVIADO",
+        "success" if sri_status == "AUTORIZADO" else "error",
+        f"Reenvío: {sri_status}",
+        {"messages": sri_messages},
+        update={"$set": {
             "sri_status": sri_status,
             "sri_authorization_number": auth_number,
             "sri_authorization_date": auth_date,
@@ -787,17 +924,7 @@ async def resend_document(request: Request, document_id: str):
             "updated_at": datetime.now(timezone.utc)
         }}
     )
-    
-    await db.document_events.insert_one({
-        "_id": str(uuid.uuid4()),
-        "document_id": document_id,
-        "tenant_id": tenant_id,
-        "event_type": "REENVIADO",
-        "status": "success" if sri_status == "AUTORIZADO" else "error",
-        "message": f"Reenvío: {sri_status}",
-        "metadata": {"messages": sri_messages},
-        "created_at": datetime.now(timezone.utc)
-    })
+    document_counts.invalidate(tenant_id)
     
     return {
         "success": sri_status == "AUTORIZADO",
@@ -812,118 +939,18 @@ async def sync_pending_documents(request: Request):
     """
     Sincroniza el estado de todos los documentos pendientes con el SRI.
     Actualiza los documentos que están en EN_PROCESO o ERROR.
+    Consulta en paralelo (acotado) y sin el backoff del loop programado.
     """
-    import httpx
-    import re
-    
     tenant_id = await get_tenant_id(request)
     db = request.app.state.db
     
-    # Buscar documentos en estados pendientes
-    pending_statuses = ["EN_PROCESO", "ERROR", "PENDIENTE"]
-    docs = await db.documents.find({
-        "tenant_id": tenant_id,
-        "sri_status": {"$in": pending_statuses}
-    }).to_list(100)
-    
-    if not docs:
-        return {
-            "synced": 0,
-            "authorized": 0,
-            "not_authorized": 0,
-            "still_pending": 0,
-            "message": "No hay documentos pendientes de sincronizar"
-        }
-    
-    # Obtener config para determinar ambiente
-    config = await db.configs_fiscal.find_one({"tenant_id": tenant_id})
-    ambiente = config.get("ambiente", "pruebas") if config else "pruebas"
+    summary = await reconcile_pending(db, tenant_id=tenant_id, force=True)
+    summary.pop("tenants", None)
     
-    # URL del servicio de autorización
-    if ambiente == "produccion":
-        auth_url = "https://cel.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline"
-    else:
-        auth_url = "https://celcer.sri.gob.ec/comprobantes-electronicos-ws/AutorizacionComprobantesOffline"
-    
-    authorized = 0
-    not_authorized = 0
-    still_pending = 0
-    results = []
-    
-    async with httpx.AsyncClient(timeout=30.0, verify=False) as http:
-        for doc in docs:
-            clave = doc.get('access_key')
-            if not clave:
-                continue
-            
-            soap = f'''<?xml version="1.0" encoding="UTF-8"?>
-<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.autorizacion">
-    <soapenv:Body>
-        <ec:autorizacionComprobante><claveAccesoComprobante>{clave}</claveAccesoComprobante></ec:autorizacionComprobante>
-    </soapenv:Body>
-</soapenv:Envelope>'''
-            
-            try:
-                resp = await http.post(
-                    auth_url,
-                    content=soap,
-                    headers={"Content-Type": "text/xml; charset=utf-8", "SOAPAction": ""}
-                )
-                
-                sri_estado = re.search(r'<estado>([^<]+)</estado>', resp.text)
-                sri_auth = re.search(r'<numeroAutorizacion>([^<]+)</numeroAutorizacion>', resp.text)
-                sri_fecha = re.search(r'<fechaAutorizacion>([^<]+)</fechaAutorizacion>', resp.text)
-                
-                if sri_estado:
-                    estado = sri_estado.group(1)
-                    old_status = doc.get('sri_status')
-                    
-                    # Solo actualizar si cambió el estado
-                    if estado != old_status:
-                        update = {
-                            "sri_status": estado,
-                            "updated_at": datetime.now(timezone.utc)
-                        }
-                        
-                        if sri_auth:
-                            update["sri_authorization_number"] = sri_auth.group(1)
-                        if sri_fecha:
-                            try:
-                                update["sri_authorization_date"] = datetime.fromisoformat(
-                                    sri_fecha.group(1).replace('Z', '+00:00')
-                                )
-                            except:
-                                pass
-                        
-                        await db.documents.update_one(
-                            {"_id": doc["_id"]},
-                            {"$set": update}
-                        )
-                        
-                        results.append({
-                            "doc_number": doc.get('doc_number'),
-                            "old_status": old_status,
-                            "new_status": estado,
-                            "authorization": sri_auth.group(1) if sri_auth else None
-                        })
-                    
-                    # Contar resultados
-                    if estado == "AUTORIZADO":
-                        authorized += 1
-                    elif estado in ["NO AUTORIZADO", "NO_AUTORIZADO", "RECHAZADO"]:
-                        not_authorized += 1
-                    else:
-                        still_pending += 1
-                        
-            except Exception as e:
-                print(f"Error sincronizando {doc.get('doc_number')}: {e}")
-                still_pending += 1
+    if summary["synced"] == 0:
+        return {**summary, "message": "No hay documentos pendientes de sincronizar"}
     
     return {
-        "synced": len(docs),
-        "authorized": authorized,
-        "not_authorized": not_authorized,
-        "still_pending": still_pending,
-        "results": results,
-        "message": f"Sincronización completada: {authorized} autorizados, {not_authorized} no autorizados, {still_pending} pendientes"
+        **summary,
+        "message": f"Sincronización completada: {summary['authorized']} autorizados, {summary['not_authorized']} no autorizados, {summary['still_pending']} pendientes"
     }
@@ -1,9 +1,21 @@
 """
 Rutas de Health Check y Monitoreo
 """
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, JSONResponse
 from datetime import datetime, timezone
 
+from services.signing_pool import signing_pool
+from services.signing_cache import signing_cache
+from services.ride_cache import ride_renderer
+from services.document_counts import document_counts
+from middleware.tenant import tenant_cache
+from services.sri_worker import sri_worker
+from services.sri_reconciler import sri_reconciler
+from services.pipeline_metrics import stage_histograms, metrics_authorized
+from services.readiness import check_readiness
+
 router = APIRouter(tags=["Health"])
 
 @router.get("/fe/health")
@@ -27,3 +39,57 @@ async def health_check(request: Request):
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "version": "1.0.0"
     }
+
+
+@router.get("/fe/health/ready")
+async def readiness_check(request: Request):
+    """
+    Readiness: MongoDB (latencia), índices críticos, pool de firma caliente y
+    warm-up de inicio terminado. 200 si está listo para emitir, 503 si no.
+    El firmador Java se reporta pero no es obligatorio (hay firmador Python).
+    """
+    result = await check_readiness(request.app.state.db)
+    result["timestamp"] = datetime.now(timezone.utc).isoformat()
+    return JSONResponse(
+        status_code=200 if result["ready"] else 503,
+        content=jsonable_encoder(result)
+    )
+
+
+@router.get("/fe/health/signing")
+async def signing_stats():
+    """
+    Métricas del motor de firma: pool de procesos y caché de contextos
+    """
+    return {
+        "pool": signing_pool.stats(),
+        "cache": signing_cache.stats(),
+        "ride": ride_renderer.stats(),
+        "document_counts": document_counts.stats(),
+        "tenants": tenant_cache.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+
+@router.get("/fe/health/sri-jobs")
+async def sri_jobs_stats():
+    """
+    Estado de la cola de envío al SRI (mode=async) y del reconciliador
+    """
+    return {
+        **(await sri_worker.stats()),
+        "reconciler": sri_reconciler.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+
+@router.get("/fe/metrics", response_class=PlainTextResponse)
+async def pipeline_metrics(request: Request):
+    """
+    Histogramas de duración por etapa de la emisión (formato de texto Prometheus)
+    Etiquetas: stage, tenant, ambiente, signer (java/python)
+    Requiere Authorization: Bearer <METRICS_TOKEN>; tenant solo para METRICS_TENANTS
+    """
+    if not metrics_authorized(request.headers.get("authorization")):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido o no configurado")
+    return PlainTextResponse(stage_histograms.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
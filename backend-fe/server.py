@@ -4,6 +4,7 @@ Servidor FastAPI Multi-Tenant
 Puerto: 8002
 """
 import os
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -21,6 +22,15 @@ from routes.health import router as health_router
 # Importar middleware
 from middleware.tenant import TenantMiddleware
 
+from services.signing_pool import signing_pool
+from services.java_signer_client import close_java_signer_client
+from services.sri_client import close_sri_clients
+from services.sri_worker import sri_worker
+from services.sri_reconciler import sri_reconciler
+from services.ride_cache import ride_renderer
+from services.sequential import sequential_allocator
+from services.readiness import warm_up
+
 # Configuración
 MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.environ.get("DB_NAME", "fe_db")
@@ -66,6 +76,8 @@ async def lifespan(app: FastAPI):
             [("tenant_id", 1), ("store_code", 1), ("emission_point", 1), ("doc_type", 1)],
             unique=True
         )
+        await db.sequential_leases.create_index([("tenant_id", 1), ("leased_at", -1)])
+        await db.sequential_leases.create_index([("status", 1), ("expires_at", 1)])
         
         # Documents
         await db.documents.create_index([("tenant_id", 1), ("doc_number", 1)], unique=True)
@@ -74,25 +86,73 @@ async def lifespan(app: FastAPI):
         await db.documents.create_index([("tenant_id", 1), ("sri_status", 1), ("issue_date", -1)])
         await db.documents.create_index([("tenant_id", 1), ("customer.identification", 1)])
         await db.documents.create_index("invoice_reference.invoice_id")
+        await db.documents.create_index([("tenant_id", 1), ("sri_status", 1), ("_id", 1)])
+        # Listado con keyset (issue_date, doc_number)
+        await db.documents.create_index([("tenant_id", 1), ("issue_date", -1), ("doc_number", -1)])
+        await db.documents.create_index([("tenant_id", 1), ("sri_status", 1), ("issue_date", -1), ("doc_number", -1)])
+        await db.documents.create_index([("tenant_id", 1), ("doc_type", 1), ("issue_date", -1), ("doc_number", -1)])
         
         # Document XML
         await db.document_xml.create_index("document_id", unique=True)
         await db.document_xml.create_index("tenant_id")
+        await db.document_xml.create_index("dict_id", sparse=True)
+        await db.xml_dictionaries.create_index([("tenant_id", 1), ("version", -1)])
         
         # Document Events
         await db.document_events.create_index([("document_id", 1), ("created_at", -1)])
         await db.document_events.create_index([("tenant_id", 1), ("event_type", 1), ("created_at", -1)])
         
+        # RIDE PDF cacheados (GridFS)
+        await db["ride_pdfs.files"].create_index([("filename", 1), ("metadata.etag", 1)])
+        
+        # SRI Jobs (modo async)
+        await db.sri_jobs.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.sri_jobs.create_index("document_id")
+        
         print("✅ Índices creados correctamente")
     except Exception as e:
         print(f"⚠️ Error creando índices: {e}")
     
+    # Una factura por referencia externa (reintentos del POS y de la sincronización Loyverse).
+    # Aparte: si ya hay duplicados en la colección falla sin afectar a los demás índices
+    try:
+        await db.documents.create_index(
+            [("tenant_id", 1), ("external_reference", 1)],
+            unique=True,
+            partialFilterExpression={"external_reference": {"$type": "string"}}
+        )
+    except Exception as e:
+        print(f"⚠️ Error creando índice único de external_reference (¿documentos duplicados?): {e}")
+    
+    # Pool de procesos para firma XAdES
+    await signing_pool.start()
+    print(f"🔏 Pool de firma listo ({signing_pool.workers} procesos)")
+    
+    # Workers de recepción/autorización SRI (mode=async)
+    await sri_worker.start(db)
+    print(f"📨 Workers SRI iniciados ({sri_worker.workers})")
+    
+    # Reconciliación programada de pendientes
+    await sri_reconciler.start(db)
+    
+    # Warm-up en segundo plano: /fe/health/ready responde 503 hasta que termine
+    warmup_task = asyncio.create_task(warm_up(db))
+    print("🔥 Warm-up iniciado (imports, tenants recientes, conexiones SRI)")
+    
     print("✅ Backend FE iniciado en puerto 8002")
     
     yield
     
     # Shutdown
     print("🛑 Cerrando conexiones...")
+    warmup_task.cancel()
+    await sri_reconciler.stop()
+    await sri_worker.stop()
+    await sequential_allocator.release(db)
+    await signing_pool.shutdown()
+    await ride_renderer.shutdown()
+    await close_java_signer_client()
+    await close_sri_clients()
     client.close()
     print("✅ Backend FE cerrado")
 
@@ -0,0 +1,58 @@
+"""
+Conteos cacheados para el listado de documentos
+
+count_documents exacto en cada página recorre todo el índice del filtro; en un
+tenant con cientos de miles de documentos es lo más caro del listado. El total
+se cachea por (tenant, filtro) durante DOCUMENT_COUNT_CACHE_TTL segundos y se
+invalida cuando el tenant emite un documento nuevo o cambia el sri_status de
+uno (apply_sri_result, EN_PROCESO del worker, reenvío).
+
+La invalidación es local al proceso: en otra réplica (o tras los cambios de
+FIRMADO/ERROR durante la emisión) los totales filtrados por estado son
+aproximados hasta que vence el TTL. Los ítems de la página siempre son exactos.
+"""
+import os
+import json
+import time
+from typing import Dict, Tuple
+
+DOCUMENT_COUNT_CACHE_TTL = float(os.environ.get("DOCUMENT_COUNT_CACHE_TTL", "30"))
+DOCUMENT_COUNT_MAX_KEYS = int(os.environ.get("DOCUMENT_COUNT_MAX_KEYS", "64"))
+
+
+class DocumentCountCache:
+    """Totales por tenant y filtro con TTL"""
+
+    def __init__(self, ttl: float = DOCUMENT_COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self._entries: Dict[str, Dict[str, Tuple[float, int]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def count(self, db, tenant_id: str, query: dict) -> int:
+        key = json.dumps(query, sort_keys=True, default=str)
+        tenant_entries = self._entries.setdefault(tenant_id, {})
+        cached = tenant_entries.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        total = await db.documents.count_documents(query)
+        if len(tenant_entries) >= DOCUMENT_COUNT_MAX_KEYS:
+            tenant_entries.clear()
+        tenant_entries[key] = (time.monotonic(), total)
+        return total
+
+    def invalidate(self, tenant_id: str):
+        self._entries.pop(tenant_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "tenants": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+document_counts = DocumentCountCache()
@@ -0,0 +1,128 @@
+"""
+Exportación masiva de XML y RIDE (PDF) en un ZIP en streaming
+
+- Un solo cursor (aggregate + $lookup) recorre documents unido a document_xml,
+  sin consultar documento por documento.
+- El XML archivado (zstd o gzip) se descomprime por bloques y se escribe
+  directo en la entrada del ZIP, sin armar el XML completo en memoria.
+- Los PDF se renderizan en el pool de procesos del RIDE (con la caché de
+  GridFS) con una ventana acotada de renders en curso (EXPORT_PDF_WINDOW), así
+  la memoria no crece con el tamaño del rango.
+"""
+import io
+import os
+import asyncio
+import zipfile
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
+
+from services.ride_cache import ride_renderer, ride_emitter
+from services.xml_archive import xml_archive, iter_xml_chunks
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "50"))
+EXPORT_PDF_WINDOW = int(os.environ.get("EXPORT_PDF_WINDOW", "8"))
+
+DOC_TYPE_FOLDERS = {"01": "facturas", "04": "notas_credito"}
+
+
+class _ZipSink(io.RawIOBase):
+    """Destino no 'seekable' del ZipFile: acumula bytes hasta que se drenan"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _entry_name(document: dict, extension: str) -> str:
+    folder = DOC_TYPE_FOLDERS.get(document.get("doc_type"), document.get("doc_type", "otros"))
+    return f"{folder}/{document['doc_number'].replace('-', '')}.{extension}"
+
+
+async def stream_export_zip(db, mongo_client, context, query: Dict,
+                            include_pdf: bool = True) -> AsyncIterator[bytes]:
+    """Genera el ZIP de los documentos de `query` (context: TenantContext) como bloques de bytes"""
+    tenant_id, tenant, config = context.tenant_id, context.tenant, context.config
+    emitter = ride_emitter(tenant, config) if tenant else None
+    logo_base64, logo_hash = None, "none"
+    if include_pdf and emitter is not None:
+        logo_base64, logo_hash = await ride_renderer.get_logo(mongo_client, tenant_id)
+
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"issue_date": 1, "_id": 1}},
+        {"$project": {"events": 0}},
+        {"$lookup": {
+            "from": "document_xml",
+            "localField": "_id",
+            "foreignField": "document_id",
+            "as": "xml"
+        }}
+    ]
+
+    sink = _ZipSink()
+    zf = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+    pending: deque = deque()
+
+    def render_pdf(document: dict) -> Optional[asyncio.Task]:
+        if not include_pdf or emitter is None:
+            return None
+        etag = f'"{ride_renderer.compute_etag(document, tenant, config, logo_hash)}"'
+        return asyncio.create_task(ride_renderer.get_pdf(db, document, emitter, logo_base64, etag))
+
+    def write_entries(document: dict, xml_doc: Optional[dict], dictionary, pdf_bytes: Optional[bytes]):
+        if xml_doc is not None:
+            with zf.open(_entry_name(document, "xml"), mode="w", force_zip64=True) as entry:
+                for chunk in iter_xml_chunks(xml_doc, dictionary):
+                    entry.write(chunk)
+        if pdf_bytes is not None:
+            # El PDF ya viene comprimido internamente
+            zf.writestr(_entry_name(document, "pdf"), pdf_bytes, compress_type=zipfile.ZIP_STORED)
+
+    async def flush_oldest() -> bytes:
+        document, xml_doc, dictionary, task = pending.popleft()
+        pdf_bytes = None
+        if task is not None:
+            try:
+                pdf_bytes = await task
+            except Exception as e:
+                print(f"Error generando RIDE de {document.get('doc_number')} para exportación: {e}")
+        write_entries(document, xml_doc, dictionary, pdf_bytes)
+        return sink.drain()
+
+    try:
+        cursor = db.documents.aggregate(pipeline, batchSize=EXPORT_BATCH_SIZE)
+        async for document in cursor:
+            xml_docs = document.pop("xml", [])
+            xml_doc = xml_docs[0] if xml_docs else None
+            dictionary = await xml_archive.prepare(db, xml_doc) if xml_doc is not None else None
+            pending.append((document, xml_doc, dictionary, render_pdf(document)))
+            if len(pending) >= EXPORT_PDF_WINDOW:
+                data = await flush_oldest()
+                if data:
+                    yield data
+
+        while pending:
+            data = await flush_oldest()
+            if data:
+                yield data
+
+        zf.close()
+        data = sink.drain()
+        if data:
+            yield data
+    finally:
+        # Cliente desconectado o error: no dejar renders huérfanos
+        for _, _, _, task in pending:
+            if task is not None:
+                task.cancel()
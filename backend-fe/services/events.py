@@ -0,0 +1,115 @@
+"""
+Registro de eventos de documentos con escrituras agrupadas
+
+Los eventos de un documento se acumulan durante la request y se escriben
+juntos al final:
+- embebidos en el documento (array `events`, acotado a DOCUMENT_EVENTS_MAX)
+  dentro del mismo update que cambia su estado, para que get_document los
+  sirva sin una segunda consulta
+- en document_events con un solo insert_many (historial completo / auditoría)
+
+El array embebido solo está completo si el documento se insertó con attach()
+(events_embedded=True) y no llegó al tope; embedded_events_complete() decide si
+get_document puede servirlo o debe leer document_events.
+"""
+import os
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+DOCUMENT_EVENTS_MAX = int(os.environ.get("DOCUMENT_EVENTS_MAX", "50"))
+
+EMBEDDED_FIELDS = ("event_type", "status", "message", "metadata", "created_at")
+
+
+def embedded_events_complete(document: dict) -> bool:
+    """
+    True si documents.events tiene todo el historial: el documento nació con
+    eventos embebidos (los anteriores a este cambio reciben un array parcial en
+    su primer $push) y el $slice todavía no descartó eventos viejos
+    """
+    return bool(document.get("events_embedded")) and len(document.get("events", [])) < DOCUMENT_EVENTS_MAX
+
+
+def embedded_event(event: dict) -> dict:
+    """Forma del evento dentro de documents.events"""
+    embedded = {"event_id": event["_id"]}
+    for field in EMBEDDED_FIELDS:
+        if field in event:
+            embedded[field] = event[field]
+    return embedded
+
+
+class EventRecorder:
+    """Acumula los eventos de un documento y los escribe en una sola pasada"""
+
+    def __init__(self, document_id: str, tenant_id: str):
+        self.document_id = document_id
+        self.tenant_id = tenant_id
+        self._to_embed: List[dict] = []
+        self._to_log: List[dict] = []
+
+    def add(self, event_type: str, status: str, message: str, metadata: Optional[Dict] = None) -> dict:
+        event = {
+            "_id": str(uuid.uuid4()),
+            "document_id": self.document_id,
+            "tenant_id": self.tenant_id,
+            "event_type": event_type,
+            "status": status,
+            "message": message,
+            "metadata": metadata or {},
+            "created_at": datetime.now(timezone.utc)
+        }
+        self._to_embed.append(event)
+        self._to_log.append(event)
+        return event
+
+    def attach(self, document: dict):
+        """Embebe los eventos pendientes en un documento que aún no se insertó"""
+        document["events"] = document.get("events", []) + [embedded_event(e) for e in self._to_embed]
+        document["events_embedded"] = True
+        self._to_embed = []
+
+    async def flush(self, db, update: Optional[dict] = None):
+        """
+        Escribe los eventos pendientes. `update` (p.ej. {"$set": {...}}) se
+        combina con el $push de eventos en un único update_one del documento.
+        """
+        update = dict(update or {})
+        if self._to_embed:
+            update["$push"] = {"events": {
+                "$each": [embedded_event(e) for e in self._to_embed],
+                "$slice": -DOCUMENT_EVENTS_MAX
+            }}
+
+        writes = []
+        if update:
+            writes.append(db.documents.update_one({"_id": self.document_id}, update))
+        if self._to_log:
+            writes.append(db.document_events.insert_many(self._to_log, ordered=False))
+        self._to_embed = []
+        self._to_log = []
+        if writes:
+            await asyncio.gather(*writes)
+
+
+async def record_event(db, document_id: str, tenant_id: str, event_type: str, status: str,
+                       message: str, metadata: Optional[Dict] = None, update: Optional[dict] = None):
+    """Atajo para un evento suelto (opcionalmente junto con un update del documento)"""
+    recorder = EventRecorder(document_id, tenant_id)
+    recorder.add(event_type, status, message, metadata)
+    await recorder.flush(db, update)
+
+
+async def flush_event_logs(db, recorders: List[EventRecorder]):
+    """
+    Escribe en un solo insert_many los eventos de varios documentos cuyos
+    eventos ya se embebieron con attach() (inserción por lotes)
+    """
+    events = []
+    for recorder in recorders:
+        events.extend(recorder._to_log)
+        recorder._to_log = []
+    if events:
+        await db.document_events.insert_many(events, ordered=False)
@@ -0,0 +1,482 @@
+"""
+Emisión de facturas por lotes (POST /fe/documents/invoices/batch)
+
+Para N facturas de un mismo tenant:
+- el contexto (emisor, configuración, certificado y material de firma) se
+  resuelve una sola vez;
+- los secuenciales salen de un rango reservado con un solo $inc por punto de
+  emisión (registrado en sequential_leases);
+- los XML se firman con una sola llamada al firmador Java (/sign/batch); los
+  que el firmador no pudo firmar se firman en el pool Python (concurrencia acotada);
+- documentos, XML y eventos se insertan con insert_many;
+- todos los firmados se encolan en sri_jobs junto con el insert, antes de la
+  primera línea de la respuesta; en async los envía el worker SRI. En sync
+  quedan retenidos para la request, que reclama cada job (lease propio) recién
+  cuando le toca enviarlo, con concurrencia acotada. Si el cliente se
+  desconecta, el worker SRI retoma lo que quedó sin enviar.
+
+Cada factura produce una línea NDJSON con su resultado, en el orden en que
+termina; la última línea es el resumen del lote. Las facturas cuyo
+external_reference ya existe no se emiten otra vez: su línea trae el documento
+existente con "duplicate": true.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from pymongo.errors import BulkWriteError
+
+from services.sequential import sequential_allocator, format_doc_number
+from services.access_key import generate_access_key
+from services.xml_generator import generate_invoice_xml
+from services.java_signer_client import sign_batch_with_java
+from services.signing_pool import signing_pool
+from services.sri_client import get_sri_client
+from services.sri_worker import sri_worker, apply_sri_result
+from services.events import EventRecorder, flush_event_logs
+from services.document_counts import document_counts
+from services.xml_archive import xml_archive
+from services.totals import calculate_totals
+from services.pipeline_metrics import StageTimer, SIGNER_JAVA, SIGNER_PYTHON
+
+INVOICE_BATCH_MAX_ITEMS = int(os.environ.get("INVOICE_BATCH_MAX_ITEMS", "200"))
+INVOICE_BATCH_SIGN_CONCURRENCY = int(os.environ.get("INVOICE_BATCH_SIGN_CONCURRENCY", str(signing_pool.max_pending)))
+INVOICE_BATCH_SRI_CONCURRENCY = int(os.environ.get("INVOICE_BATCH_SRI_CONCURRENCY", "8"))
+
+
+def _line(payload: dict) -> bytes:
+    return (json.dumps(payload, default=str, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _duplicate_result(index: int, doc: dict) -> dict:
+    return {
+        "index": index,
+        "document_id": doc["_id"],
+        "doc_number": doc["doc_number"],
+        "access_key": doc["access_key"],
+        "sri_status": doc["sri_status"],
+        "duplicate": True
+    }
+
+
+async def _existing_by_reference(db, tenant_id: str, references: List[str]) -> Dict[str, dict]:
+    if not references:
+        return {}
+    cursor = db.documents.find(
+        {"tenant_id": tenant_id, "external_reference": {"$in": references}},
+        {"external_reference": 1, "doc_number": 1, "access_key": 1, "sri_status": 1}
+    )
+    return {doc["external_reference"]: doc async for doc in cursor}
+
+
+def _payments(invoice, totals: dict) -> List[dict]:
+    if not invoice.payments:
+        # Pago por defecto: efectivo
+        return [{"method": "01", "total": totals["total"], "term": 0, "time_unit": "dias"}]
+    return [
+        {"method": p.method, "total": float(p.total), "term": p.term, "time_unit": p.time_unit}
+        for p in invoice.payments
+    ]
+
+
+class _Item:
+    """Estado de una factura del lote"""
+
+    def __init__(self, index: int, invoice, timer: StageTimer):
+        self.index = index
+        self.invoice = invoice
+        self.timer = timer
+        self.document: Optional[dict] = None
+        self.events: Optional[EventRecorder] = None
+        self.totals: Optional[dict] = None
+        self.processed_items: Optional[List[dict]] = None
+        self.sequential = 0
+        self.xml_unsigned: Optional[str] = None
+        self.xml_signed: Optional[str] = None
+        self.signed_event: Optional[dict] = None
+
+    def result(self, **extra) -> dict:
+        result = {"index": self.index}
+        if self.document is not None:
+            result.update({
+                "document_id": self.document["_id"],
+                "doc_number": self.document["doc_number"],
+                "access_key": self.document["access_key"],
+                "sri_status": self.document["sri_status"]
+            })
+        result.update(extra)
+        return result
+
+
+def _mark_signed(item: _Item):
+    item.document["sri_status"] = "FIRMADO"
+    item.signed_event = item.events.add("FIRMADO", "success", "XML firmado correctamente")
+
+
+async def _sign_python(signing_context, item: _Item, semaphore: asyncio.Semaphore):
+    doc_number = item.document["doc_number"]
+    async with semaphore:
+        try:
+            with item.timer.stage("sign"):
+                item.xml_signed = await signing_pool.sign(signing_context, item.xml_unsigned)
+            item.timer.signer = SIGNER_PYTHON
+        except Exception as e:
+            message = f"Error al firmar: {str(e)}"
+            item.document["sri_status"] = "ERROR"
+            item.document["sri_messages"] = [{"mensaje": message}]
+            item.events.add("ERROR", "error", f"Error al firmar XML: {str(e)}")
+            print(f"[Lote] Documento {doc_number} no firmado: {e}")
+            return
+    _mark_signed(item)
+
+
+async def _sign_all(signing_context, items: List[_Item]):
+    """Firma el lote en un solo round trip al firmador Java; fallback Python por documento"""
+    t_start = time.perf_counter()
+    try:
+        results = await sign_batch_with_java(signing_context, [item.xml_unsigned for item in items])
+    except Exception as java_err:
+        print(f"[Lote] Java signer no disponible ({str(java_err)[:100]}), usando firmador Python")
+        results = [java_err] * len(items)
+    share = (time.perf_counter() - t_start) * 1000 / len(items)
+
+    fallback = []
+    for item, result in zip(items, results):
+        item.timer.add("sign", share)
+        if isinstance(result, Exception):
+            fallback.append(item)
+            continue
+        item.xml_signed = result
+        item.timer.signer = SIGNER_JAVA
+        _mark_signed(item)
+
+    if fallback:
+        if len(fallback) < len(items):
+            print(f"[Lote] {len(fallback)} documentos rechazados por el firmador Java, usando firmador Python")
+        semaphore = asyncio.Semaphore(max(1, INVOICE_BATCH_SIGN_CONCURRENCY))
+        await asyncio.gather(*[_sign_python(signing_context, item, semaphore) for item in fallback])
+
+
+async def _emit(db, context, signing_context, items: List[_Item], mode: str,
+                callback_url: Optional[str]) -> Tuple[List[_Item], List[_Item]]:
+    """
+    Reserva secuenciales, arma y firma los XML y guarda el lote.
+    Retorna (items guardados, items cuyo external_reference ya emitió otra request).
+    Los rangos de secuenciales se cierran aunque el lote se corte.
+    """
+    tenant_id = context.tenant_id
+    tenant, config = context.tenant, context.config
+    ambiente = config.get("ambiente", "pruebas")
+
+    leases = []
+    try:
+        # Un rango de secuenciales por punto de emisión
+        groups: Dict[tuple, List[_Item]] = {}
+        for item in items:
+            groups.setdefault((item.invoice.store_code, item.invoice.emission_point), []).append(item)
+        for (store_code, emission_point), group in groups.items():
+            t_start = time.perf_counter()
+            lease_id, start, end = await sequential_allocator.reserve(
+                db, tenant_id, store_code, emission_point, "01", len(group)
+            )
+            share = (time.perf_counter() - t_start) * 1000 / len(group)
+            for item in group:
+                item.timer.add("sequential", share)
+            leases.append((lease_id, end))
+            for offset, item in enumerate(group):
+                item.sequential = start + offset
+
+        emitter_data = {
+            "ruc": tenant["ruc"],
+            "razon_social": tenant["razon_social"],
+            "nombre_comercial": tenant.get("nombre_comercial"),
+            "direccion": tenant.get("address", {}).get("direccion", ""),
+            "obligado_contabilidad": config.get("obligado_contabilidad", "NO"),
+            "contribuyente_especial": config.get("tipo_contribuyente")
+        }
+
+        # Fecha de Ecuador (UTC-5): el SRI valida contra ella
+        now = datetime.now(timezone.utc)
+        issue_date_for_sri = now + timedelta(hours=-5)
+
+        for item in items:
+            invoice = item.invoice
+            doc_number = format_doc_number(invoice.store_code, invoice.emission_point, item.sequential)
+            with item.timer.stage("access_key"):
+                access_key = generate_access_key(
+                    issue_date=issue_date_for_sri,
+                    doc_type="01",
+                    ruc=tenant["ruc"],
+                    ambiente=ambiente,
+                    establecimiento=invoice.store_code,
+                    punto_emision=invoice.emission_point,
+                    secuencial=item.sequential
+                )
+            payments = _payments(invoice, item.totals)
+            document_id = str(uuid.uuid4())
+            item.document = {
+                "_id": document_id,
+                "tenant_id": tenant_id,
+                "doc_type": "01",
+                "doc_number": doc_number,
+                "access_key": access_key,
+                "store": {
+                    "code": invoice.store_code,
+                    "emission_point": invoice.emission_point,
+                    "name": f"Establecimiento {invoice.store_code}"
+                },
+                "issue_date": issue_date_for_sri,
+                "customer": {
+                    "identification_type": invoice.customer.identification_type,
+                    "identification": invoice.customer.identification,
+                    "name": invoice.customer.name,
+                    "email": invoice.customer.email,
+                    "phone": invoice.customer.phone,
+                    "address": invoice.customer.address
+                },
+                "items": item.processed_items,
+                "totals": item.totals,
+                "payments": payments,
+                "sri_status": "PENDIENTE",
+                "sri_authorization_number": None,
+                "sri_authorization_date": None,
+                "sri_messages": [],
+                "created_at": now,
+                "updated_at": now,
+                "created_by_system": "POS",
+                "external_reference": invoice.external_reference,
+                "is_voided": False,
+                "has_credit_note": False
+            }
+            item.events = EventRecorder(document_id, tenant_id)
+            item.events.add("CREADO", "success", "Documento creado")
+            with item.timer.stage("xml"):
+                item.xml_unsigned = generate_invoice_xml(
+                    access_key=access_key,
+                    emitter=emitter_data,
+                    customer=item.document["customer"],
+                    items=item.processed_items,
+                    totals=item.totals,
+                    payments=payments,
+                    issue_date=issue_date_for_sri,
+                    store_code=invoice.store_code,
+                    emission_point=invoice.emission_point,
+                    sequential=item.sequential,
+                    ambiente=ambiente
+                )
+
+        await _sign_all(signing_context, items)
+
+        # El guardado corre protegido: si el cliente se desconecta la request se
+        # cancela, pero documentos, XML y jobs SRI se escriben completos
+        return await asyncio.shield(asyncio.ensure_future(
+            _store(db, tenant_id, items, mode, ambiente, callback_url, now)
+        ))
+    finally:
+        for lease_id, end in leases:
+            await asyncio.shield(sequential_allocator.finish(db, lease_id, end))
+
+
+async def _store(db, tenant_id: str, items: List[_Item], mode: str, ambiente: str,
+                 callback_url: Optional[str], now: datetime) -> Tuple[List[_Item], List[_Item]]:
+    """
+    Inserta documentos, XML y eventos y encola en sri_jobs todos los firmados
+    antes de que el stream produzca la primera línea: en sync quedan retenidos
+    para que la request los envíe; si no llega a hacerlo, el worker SRI los retoma.
+    """
+    # Los no firmados también se insertan (ERROR): así el rango no deja huecos
+    xml_rows = []
+    for item in items:
+        if item.xml_signed is not None:
+            with item.timer.stage("store"):
+                xml_fields = await xml_archive.encode(db, tenant_id, item.xml_signed.encode("utf-8"))
+            if mode == "async":
+                # Recepción y autorización se miden en el worker SRI
+                item.signed_event["metadata"].update(item.timer.as_metadata())
+            xml_rows.append({
+                "_id": str(uuid.uuid4()),
+                "document_id": item.document["_id"],
+                "tenant_id": tenant_id,
+                **xml_fields,
+                "encoding": "UTF-8",
+                "created_at": now
+            })
+        item.events.attach(item.document)
+
+    t_start = time.perf_counter()
+    raced: List[_Item] = []
+    try:
+        await db.documents.insert_many([item.document for item in items], ordered=False)
+    except BulkWriteError as e:
+        # Solo se toleran las referencias emitidas por otra request en paralelo
+        # (índice único tenant_id + external_reference); sus secuenciales quedan sin usar
+        failed = set()
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != 11000 or "external_reference" not in (error.get("keyPattern") or {}):
+                raise
+            failed.add(error["index"])
+        raced = [item for position, item in enumerate(items) if position in failed]
+        items = [item for position, item in enumerate(items) if position not in failed]
+        inserted = {item.document["_id"] for item in items}
+        xml_rows = [row for row in xml_rows if row["document_id"] in inserted]
+    document_counts.invalidate(tenant_id)
+    if xml_rows:
+        await db.document_xml.insert_many(xml_rows, ordered=False)
+    await flush_event_logs(db, [item.events for item in items])
+    share = (time.perf_counter() - t_start) * 1000 / max(1, len(items))
+    for item in items:
+        item.timer.add("store", share)
+
+    by_callback: Dict[Optional[str], List[dict]] = {}
+    for item in items:
+        if item.xml_signed is None:
+            continue
+        if mode == "async":
+            item.timer.observe()
+        by_callback.setdefault(item.invoice.callback_url or callback_url, []).append(
+            {**item.document, "signer": item.timer.signer}
+        )
+    for url, documents in by_callback.items():
+        await sri_worker.enqueue_many(db, documents, ambiente, url, hold=(mode == "sync"))
+    return items, raced
+
+
+async def stream_invoice_batch(db, context, signing_context, invoices: list, mode: str = "sync",
+                               callback_url: Optional[str] = None, lookup_ms: float = 0.0) -> AsyncIterator[bytes]:
+    """
+    Emite las facturas y produce una línea NDJSON por factura más el resumen.
+    `context` es el TenantContext ya validado (emisor, configuración y certificado)
+    y `signing_context` su material de firma. `callback_url` (el webhook
+    registrado del emisor, ya validado por la ruta) aplica a las facturas sin
+    callback_url propio.
+    Las etapas compartidas (lookup, secuencial, inserts) se reparten entre las
+    facturas en los tiempos por etapa.
+    """
+    tenant_id = context.tenant_id
+    config = context.config
+    ambiente = config.get("ambiente", "pruebas")
+    iva_default = config.get("config", {}).get("iva_default", 15)
+    callback_url = callback_url or config.get("webhook_url")
+    counts: Dict[str, int] = {}
+
+    def count(status: str):
+        counts[status] = counts.get(status, 0) + 1
+
+    # Referencias ya emitidas (reintento del lote): no consumen secuencial
+    existing = await _existing_by_reference(
+        db, tenant_id, [invoice.external_reference for invoice in invoices if invoice.external_reference]
+    )
+    references = set()
+
+    # Totales primero: una factura inválida no consume secuencial
+    items: List[_Item] = []
+    for index, invoice in enumerate(invoices):
+        reference = invoice.external_reference
+        if reference in existing:
+            count("DUPLICADO")
+            yield _line(_duplicate_result(index, existing[reference]))
+            continue
+        if reference:
+            if reference in references:
+                count("INVALIDO")
+                yield _line({"index": index, "sri_status": "INVALIDO",
+                             "error": f"external_reference repetido en el lote: {reference}"})
+                continue
+            references.add(reference)
+        item = _Item(index, invoice, StageTimer(tenant_id, ambiente))
+        try:
+            item.totals, item.processed_items = calculate_totals(invoice.items, iva_default)
+        except ValueError as e:
+            count("INVALIDO")
+            yield _line(item.result(sri_status="INVALIDO", error=str(e)))
+            continue
+        items.append(item)
+
+    if items:
+        for item in items:
+            item.timer.add("lookup", lookup_ms / len(items))
+
+        items, raced = await _emit(db, context, signing_context, items, mode, callback_url)
+
+        if raced:
+            winners = await _existing_by_reference(db, tenant_id, [item.invoice.external_reference for item in raced])
+            for item in raced:
+                count("DUPLICADO")
+                doc = winners.get(item.invoice.external_reference)
+                if doc is None:
+                    yield _line({"index": item.index, "sri_status": "ERROR",
+                                 "error": "Documento duplicado por external_reference"})
+                else:
+                    yield _line(_duplicate_result(item.index, doc))
+
+        signed = [item for item in items if item.xml_signed is not None]
+        for item in items:
+            if item.xml_signed is None:
+                count("ERROR")
+                yield _line(item.result(sri_messages=item.document["sri_messages"]))
+
+        if mode == "async":
+            for item in signed:
+                count("FIRMADO")
+                yield _line(item.result())
+        else:
+            async for line in _submit(db, signed, ambiente, count):
+                yield line
+
+    yield _line({"summary": {"total": len(invoices), "by_status": counts}})
+
+
+async def _submit(db, items: List[_Item], ambiente: str, count) -> AsyncIterator[bytes]:
+    """
+    Envía al SRI con concurrencia acotada los jobs retenidos del lote. Cada job
+    se reclama al empezar su propio envío, así el lease no corre mientras espera
+    turno; lo que no se pudo enviar se devuelve al worker SRI.
+    """
+    sri_client = get_sri_client(ambiente)
+    semaphore = asyncio.Semaphore(max(1, INVOICE_BATCH_SRI_CONCURRENCY))
+
+    async def submit(item: _Item) -> dict:
+        async with semaphore:
+            job = await sri_worker.claim(db, item.document["_id"])
+            if job is None:
+                # La espera del job venció y lo tomó el worker SRI
+                return item.result(queued=True)
+            try:
+                sri_status, auth_number, auth_date, sri_messages = await sri_client.emitir_y_autorizar(
+                    item.xml_signed, item.document["access_key"], timings=item.timer.timings
+                )
+                if not await sri_worker.renew(db, job):
+                    # Lease vencido: el worker SRI ya lo retomó y guarda él el resultado
+                    return item.result(queued=True)
+                item.timer.observe()
+                await apply_sri_result(db, item.document["_id"], item.document["tenant_id"], sri_status,
+                                       auth_number, auth_date, sri_messages, item.events, item.timer.as_metadata())
+            except asyncio.CancelledError:
+                await asyncio.shield(sri_worker.release(db, job))
+                raise
+            except Exception as e:
+                # Resultado desconocido: el worker SRI lo retoma (maneja "clave ya registrada")
+                await sri_worker.release(db, job)
+                return item.result(queued=True, error=str(e))
+            await sri_worker.complete(db, job, sri_status)
+        item.document["sri_status"] = sri_status
+        return item.result(sri_authorization_number=auth_number, sri_messages=sri_messages)
+
+    tasks = {asyncio.ensure_future(submit(item)): item for item in items}
+    try:
+        for future in asyncio.as_completed(list(tasks)):
+            result = await future
+            count(result["sri_status"])
+            yield _line(result)
+    finally:
+        # Cliente desconectado: los envíos en curso devuelven su job y los que no
+        # empezaron pasan ya al worker SRI
+        pending = [item.document["_id"] for task, item in tasks.items() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.shield(asyncio.gather(*tasks, return_exceptions=True))
+        await asyncio.shield(sri_worker.release_held(db, pending))
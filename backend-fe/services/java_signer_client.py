@@ -1,50 +1,189 @@
 """
 Cliente para el servicio de firma XAdES Java
+
+Protocolo por handle: el .p12 y su contraseña se registran una sola vez en el
+firmador (POST /certificates) y luego cada documento se firma enviando solo el
+handle y el XML. Si el firmador se reinició y no conoce el handle, se vuelve a
+registrar y se reintenta.
+
+Los lotes (services/invoice_batch.py) se firman en un solo round trip con
+POST /sign/batch; el resultado trae el error de cada documento por separado.
 """
+import os
 import httpx
 import base64
-from typing import Optional
+import asyncio
+from typing import List, Optional, Union
+
+JAVA_SIGNER_URL = os.environ.get("JAVA_SIGNER_URL", "http://localhost:8003").rstrip("/")
+if JAVA_SIGNER_URL.endswith("/sign"):
+    # Compatibilidad con la configuración anterior que apuntaba al endpoint
+    JAVA_SIGNER_URL = JAVA_SIGNER_URL[:-len("/sign")]
+
+JAVA_SIGNER_TIMEOUT = float(os.environ.get("JAVA_SIGNER_TIMEOUT", "60"))
+JAVA_SIGNER_MAX_CONNECTIONS = int(os.environ.get("JAVA_SIGNER_MAX_CONNECTIONS", "20"))
+
+
+class JavaSignerError(Exception):
+    """Error retornado por el servicio de firma Java"""
+
+
+class UnknownHandleError(JavaSignerError):
+    """El firmador no tiene registrado el handle (p.ej. se reinició)"""
+
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_java_signer_client() -> httpx.AsyncClient:
+    """Cliente HTTP compartido (keep-alive) hacia el firmador Java"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=JAVA_SIGNER_URL,
+            timeout=JAVA_SIGNER_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=JAVA_SIGNER_MAX_CONNECTIONS,
+                max_keepalive_connections=JAVA_SIGNER_MAX_CONNECTIONS
+            )
+        )
+    return _client
 
-JAVA_SIGNER_URL = "http://localhost:8003/sign"
+
+async def close_java_signer_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _post(path: str, payload: dict) -> dict:
+    response = await get_java_signer_client().post(path, json=payload)
+    result = response.json()
+    if response.status_code == 404 and result.get("code") == "UNKNOWN_HANDLE":
+        raise UnknownHandleError(result.get("error", "Certificado no registrado"))
+    if not result.get("success"):
+        raise JavaSignerError(f"Error al firmar XML: {result.get('error', 'Error desconocido')}")
+    return result
+
+
+def _encode_xml(xml_content: str) -> str:
+    return base64.b64encode(xml_content.encode('utf-8')).decode()
+
+
+def _decode_xml(signed_b64: str) -> str:
+    return base64.b64decode(signed_b64).decode('utf-8')
+
+
+async def register_certificate(p12_data: bytes, password: str) -> str:
+    """
+    Registra el certificado en el firmador Java
+
+    Returns:
+        handle con el que se firman los documentos
+    """
+    result = await _post("/certificates", {
+        "p12": base64.b64encode(p12_data).decode(),
+        "password": password
+    })
+    return result["handle"]
+
+
+async def unregister_certificate(handle: str):
+    """Elimina un certificado registrado (best-effort)"""
+    try:
+        await get_java_signer_client().delete(f"/certificates/{handle}")
+    except httpx.HTTPError:
+        pass
+
+
+async def _ensure_handle(signing_context, stale_handle: Optional[str] = None) -> str:
+    """Handle del certificado en el firmador, registrándolo una sola vez por contexto"""
+    if signing_context.java_handle and signing_context.java_handle != stale_handle:
+        return signing_context.java_handle
+
+    async with signing_context.java_lock:
+        if signing_context.java_handle and signing_context.java_handle != stale_handle:
+            return signing_context.java_handle
+        signing_context.java_handle = None
+        signing_context.java_handle = await register_certificate(signing_context.p12_data, signing_context.password)
+        return signing_context.java_handle
+
+
+async def sign_xml_with_java_handle(signing_context, xml_content: str) -> str:
+    """
+    Firma XML con el certificado de signing_context (services.signing_cache)
+    enviando solo el handle registrado
+
+    Raises:
+        JavaSignerError si hay error en la firma
+    """
+    handle = await _ensure_handle(signing_context)
+    try:
+        result = await _post("/sign", {"handle": handle, "xml": _encode_xml(xml_content)})
+    except UnknownHandleError:
+        handle = await _ensure_handle(signing_context, stale_handle=handle)
+        result = await _post("/sign", {"handle": handle, "xml": _encode_xml(xml_content)})
+    return _decode_xml(result["signed_xml"])
+
+
+async def sign_batch_with_java(signing_context, xml_contents: List[str]) -> List[Union[str, JavaSignerError]]:
+    """
+    Firma varios XML en un solo round trip
+
+    Returns:
+        Lista en el mismo orden: XML firmado, o JavaSignerError si ese documento falló
+    """
+    if not xml_contents:
+        return []
+    payload_xmls = [_encode_xml(xml) for xml in xml_contents]
+    handle = await _ensure_handle(signing_context)
+    try:
+        result = await _post("/sign/batch", {"handle": handle, "xmls": payload_xmls})
+    except UnknownHandleError:
+        handle = await _ensure_handle(signing_context, stale_handle=handle)
+        result = await _post("/sign/batch", {"handle": handle, "xmls": payload_xmls})
+
+    signed = []
+    for item in result["results"]:
+        if item.get("success"):
+            signed.append(_decode_xml(item["signed_xml"]))
+        else:
+            signed.append(JavaSignerError(f"Error al firmar XML: {item.get('error', 'Error desconocido')}"))
+    return signed
 
 
 async def sign_xml_with_java(xml_content: str, p12_data: bytes, password: str) -> str:
     """
-    Firma XML usando el servicio Java XAdES
-    
+    Firma XML usando el servicio Java XAdES enviando el certificado en la request
+    (sin registro previo)
+
     Args:
         xml_content: XML sin firmar
         p12_data: Contenido del archivo .p12 como bytes
         password: Contraseña del certificado
-    
+
     Returns:
         XML firmado
-    
+
     Raises:
-        Exception si hay error en la firma
-    """
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(
-            JAVA_SIGNER_URL,
-            json={
-                "xml": base64.b64encode(xml_content.encode('utf-8')).decode(),
-                "p12": base64.b64encode(p12_data).decode(),
-                "password": password
-            }
-        )
-        
-        result = response.json()
-        
-        if not result.get("success"):
-            raise Exception(f"Error al firmar XML: {result.get('error', 'Error desconocido')}")
-        
-        signed_xml = base64.b64decode(result["signed_xml"]).decode('utf-8')
-        return signed_xml
+        JavaSignerError si hay error en la firma
+    """
+    result = await _post("/sign", {
+        "xml": _encode_xml(xml_content),
+        "p12": base64.b64encode(p12_data).decode(),
+        "password": password
+    })
+    return _decode_xml(result["signed_xml"])
 
 
 def sign_xml_with_java_sync(xml_content: str, p12_data: bytes, password: str) -> str:
     """
     Versión síncrona del firmador (para compatibilidad)
     """
-    import asyncio
-    return asyncio.run(sign_xml_with_java(xml_content, p12_data, password))
+    async def _sign():
+        try:
+            return await sign_xml_with_java(xml_content, p12_data, password)
+        finally:
+            await close_java_signer_client()
+    return asyncio.run(_sign())
@@ -365,17 +365,33 @@ def generate_ride_pdf(document: dict, emitter: dict, logo_base64: Optional[str]
     ]))
     
     # Totales (columna derecha)
-    subtotal_sin_iva = totals.get('subtotal_0', 0) + totals.get('subtotal_12', 0) + totals.get('subtotal_15', 0)
+    # Tarifas distintas de 0% y 15% (5%, 8%, 12%...) vienen en iva_breakdown
+    other_rates = [
+        tax for tax in totals.get('iva_breakdown', [])
+        if tax['code'] not in ('0', '4', '6', '7')
+    ]
+    if 'subtotal' in totals:
+        subtotal_sin_iva = totals['subtotal']
+    else:
+        subtotal_sin_iva = totals.get('subtotal_0', 0) + totals.get('subtotal_12', 0) + totals.get('subtotal_15', 0)
     
     totals_data = [
         [Paragraph("<b>SUBTOTAL 15%</b>", style_small), f"{totals.get('subtotal_15', 0):.2f}"],
+    ]
+    for tax in other_rates:
+        totals_data.append([Paragraph(f"<b>SUBTOTAL {tax['rate']:g}%</b>", style_small), f"{tax['base']:.2f}"])
+    totals_data += [
         [Paragraph("<b>SUBTOTAL 0%</b>", style_small), f"{totals.get('subtotal_0', 0):.2f}"],
-        [Paragraph("<b>SUBTOTAL No Objeto de IVA</b>", style_small), "0.00"],
-        [Paragraph("<b>SUBTOTAL Exento de IVA</b>", style_small), "0.00"],
+        [Paragraph("<b>SUBTOTAL No Objeto de IVA</b>", style_small), f"{totals.get('subtotal_not_subject', 0):.2f}"],
+        [Paragraph("<b>SUBTOTAL Exento de IVA</b>", style_small), f"{totals.get('subtotal_exempt', 0):.2f}"],
         [Paragraph("<b>SUBTOTAL SIN IMPUESTOS</b>", style_small), f"{subtotal_sin_iva:.2f}"],
         [Paragraph("<b>DESCUENTO</b>", style_small), f"{totals.get('total_discount', 0):.2f}"],
         [Paragraph("<b>ICE</b>", style_small), "0.00"],
         [Paragraph("<b>IVA 15%</b>", style_small), f"{totals.get('total_iva_15', totals.get('total_iva', 0)):.2f}"],
+    ]
+    for tax in other_rates:
+        totals_data.append([Paragraph(f"<b>IVA {tax['rate']:g}%</b>", style_small), f"{tax['value']:.2f}"])
+    totals_data += [
         [Paragraph("<b>IRBPNR</b>", style_small), "0.00"],
         [Paragraph("<b>PROPINA</b>", style_small), "0.00"],
         [Paragraph("<b>VALOR TOTAL</b>", style_bold_small), f"{totals.get('total', 0):.2f}"],
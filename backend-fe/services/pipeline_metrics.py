@@ -0,0 +1,132 @@
+"""
+Tiempos por etapa del pipeline de emisión (create_invoice, nota de crédito, lote, worker SRI)
+
+Cada documento mide sus etapas con un StageTimer:
+
+    timer = StageTimer(tenant_id, ambiente)
+    with timer.stage("xml"):
+        xml_unsigned = generate_invoice_xml(...)
+    timer.signer = "java"
+    timer.observe()           # histogramas de /fe/metrics
+    timer.as_metadata()       # {"timings_ms": {...}, "signer": "java"} para el evento
+
+Los histogramas se exponen en GET /fe/metrics en formato de texto Prometheus,
+con etiquetas stage, tenant, ambiente y signer. El endpoint exige
+"Authorization: Bearer <METRICS_TOKEN>" (sin METRICS_TOKEN queda deshabilitado).
+El tenant_id solo aparece como etiqueta para los tenants listados en
+METRICS_TENANTS (separados por coma); el resto se agrupa en tenant="other".
+"""
+import os
+import hmac
+import time
+from contextlib import contextmanager
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_TENANTS = frozenset(t.strip() for t in os.environ.get("METRICS_TENANTS", "").split(",") if t.strip())
+
+STAGES = ("lookup", "sequential", "access_key", "xml", "sign", "store", "reception", "authorization")
+
+# Límites superiores en segundos (la autorización con esperas llega a decenas)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+SIGNER_JAVA = "java"
+SIGNER_PYTHON = "python"
+SIGNER_NONE = "none"
+
+
+class StageHistograms:
+    """Histogramas acumulados por (stage, tenant, ambiente, signer)"""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS, tenants: FrozenSet[str] = METRICS_TENANTS):
+        self.buckets = buckets
+        self.tenants = tenants
+        self._series: Dict[tuple, list] = {}  # labels -> [conteos por bucket, suma, cantidad]
+
+    def _tenant_label(self, tenant_id: str) -> str:
+        # Opt-in: un tenant_id fuera de la lista nunca sale en /fe/metrics
+        return tenant_id if tenant_id in self.tenants else "other"
+
+    def observe(self, tenant_id: str, ambiente: str, signer: str, timings_ms: Dict[str, float]):
+        tenant = self._tenant_label(tenant_id)
+        for stage, ms in timings_ms.items():
+            key = (stage, tenant, ambiente, signer)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            seconds = ms / 1000
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self) -> str:
+        """Exposición en formato de texto Prometheus (buckets acumulativos)"""
+        name = "fe_pipeline_stage_duration_seconds"
+        lines: List[str] = [
+            f"# HELP {name} Duración por etapa de la emisión de documentos electrónicos",
+            f"# TYPE {name} histogram"
+        ]
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        series = sorted(self._series.items(), key=lambda entry: (order.get(entry[0][0], len(order)), entry[0]))
+        for (stage, tenant, ambiente, signer), (counts, total, count) in series:
+            labels = (f'stage="{stage}",tenant="{_escape(tenant)}",'
+                      f'ambiente="{_escape(ambiente)}",signer="{signer}"')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def metrics_authorized(authorization: Optional[str], token: str = METRICS_TOKEN) -> bool:
+    """Valida el header Authorization del scraper contra METRICS_TOKEN"""
+    if not token or not authorization:
+        return False
+    scheme, _, credentials = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_histograms = StageHistograms()
+
+
+class StageTimer:
+    """Tiempos (ms) de las etapas de un documento"""
+
+    def __init__(self, tenant_id: str, ambiente: str = "pruebas"):
+        self.tenant_id = tenant_id
+        self.ambiente = ambiente
+        self.signer = SIGNER_NONE
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - t_start) * 1000)
+
+    def add(self, name: str, ms: float):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def as_metadata(self) -> dict:
+        return {
+            "timings_ms": {stage: round(ms, 3) for stage, ms in self.timings.items()},
+            "signer": self.signer
+        }
+
+    def observe(self):
+        """Registra en los histogramas las etapas medidas"""
+        if self.timings:
+            stage_histograms.observe(self.tenant_id, self.ambiente, self.signer, self.timings)
@@ -0,0 +1,180 @@
+"""
+Readiness y warm-up de backend-fe
+
+Al iniciar, warm_up() corre en segundo plano:
+- importa lxml, cryptography y reportlab (la primera factura no paga la importación);
+- abre el pool de conexiones hacia el SRI de cada ambiente en uso;
+- precarga contexto de tenant, material de firma y diccionario XML de los
+  tenants con documentos recientes.
+
+GET /fe/health/ready (check_readiness) responde 200 solo cuando MongoDB
+responde, los índices críticos existen, el pool de firma está caliente y el
+warm-up terminó; si no, 503 con el detalle de cada verificación. El firmador
+Java es opcional (hay firmador Python): se reporta pero no bloquea.
+"""
+import os
+import time
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from services.signing_pool import signing_pool
+from services.signing_cache import get_signing_context
+from services.java_signer_client import get_java_signer_client
+from services.sri_client import get_sri_client
+from services.xml_archive import xml_archive
+from middleware.tenant import tenant_cache
+
+WARMUP_TENANT_DAYS = int(os.environ.get("WARMUP_TENANT_DAYS", "7"))
+WARMUP_MAX_TENANTS = int(os.environ.get("WARMUP_MAX_TENANTS", "50"))
+READY_JAVA_SIGNER_TIMEOUT = float(os.environ.get("READY_JAVA_SIGNER_TIMEOUT", "2"))
+READY_MONGO_MAX_MS = float(os.environ.get("READY_MONGO_MAX_MS", "500"))
+
+# Índices sin los cuales la emisión es incorrecta (unicidad) o inaceptablemente lenta
+REQUIRED_INDEXES = {
+    "counters": [[("tenant_id", 1), ("store_code", 1), ("emission_point", 1), ("doc_type", 1)]],
+    "documents": [[("tenant_id", 1), ("doc_number", 1)], [("tenant_id", 1), ("access_key", 1)]],
+    "document_xml": [[("document_id", 1)]],
+    "sri_jobs": [[("status", 1), ("next_attempt_at", 1)]],
+    "tenants": [[("tenant_id", 1)]],
+}
+
+
+class WarmupState:
+    """Resultado del warm-up de inicio (un paso por entrada)"""
+
+    def __init__(self):
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.steps: Dict[str, dict] = {}
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def record(self, step: str, ok: bool, t_start: float, **detail):
+        self.steps[step] = {"ok": ok, "ms": round((time.perf_counter() - t_start) * 1000, 1), **detail}
+
+    def as_dict(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "steps": self.steps
+        }
+
+
+warmup_state = WarmupState()
+
+
+def _import_heavy_modules():
+    from lxml import etree  # noqa: F401
+    from cryptography.hazmat.primitives.serialization import pkcs12  # noqa: F401
+    import services.pdf_generator  # noqa: F401  (reportlab)
+
+
+async def _recent_tenants(db) -> List[str]:
+    since = datetime.now(timezone.utc) - timedelta(days=WARMUP_TENANT_DAYS)
+    rows = db.documents.aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {"_id": "$tenant_id", "last": {"$max": "$created_at"}}},
+        {"$sort": {"last": -1}},
+        {"$limit": WARMUP_MAX_TENANTS}
+    ])
+    return [row["_id"] async for row in rows]
+
+
+async def _prime_tenant(db, tenant_id: str) -> bool:
+    context = await tenant_cache.get_or_load(db, tenant_id)
+    if not context.is_complete:
+        return False
+    await asyncio.gather(
+        get_signing_context(db, tenant_id, context.certificate),
+        xml_archive.current_dictionary(db, tenant_id)
+    )
+    return True
+
+
+async def warm_up(db, state: WarmupState = warmup_state):
+    """Warm-up de inicio; cada paso registra su resultado y los errores no detienen los demás"""
+    state.started_at = datetime.now(timezone.utc)
+    loop = asyncio.get_running_loop()
+
+    t_start = time.perf_counter()
+    try:
+        await loop.run_in_executor(None, _import_heavy_modules)
+        state.record("imports", True, t_start)
+    except Exception as e:
+        state.record("imports", False, t_start, error=str(e)[:200])
+
+    t_start = time.perf_counter()
+    try:
+        tenants = await _recent_tenants(db)
+        results = await asyncio.gather(*[_prime_tenant(db, t) for t in tenants], return_exceptions=True)
+        primed = sum(1 for r in results if r is True)
+        state.record("tenants", True, t_start, recent=len(tenants), primed=primed)
+    except Exception as e:
+        state.record("tenants", False, t_start, error=str(e)[:200])
+
+    # Ambientes en uso (por defecto pruebas si aún no hay configuraciones)
+    t_start = time.perf_counter()
+    try:
+        ambientes = [a for a in await db.configs_fiscal.distinct("ambiente") if a] or ["pruebas"]
+        latencies = {}
+        for ambiente in ambientes:
+            try:
+                latencies[ambiente] = round(await get_sri_client(ambiente).warm_up(), 1)
+            except Exception as e:
+                latencies[ambiente] = f"error: {str(e)[:100]}"
+        # El SRI caído no impide emitir en mode=async: se registra pero no falla el paso
+        state.record("sri_connections", True, t_start, latency_ms=latencies)
+    except Exception as e:
+        state.record("sri_connections", False, t_start, error=str(e)[:200])
+
+    state.finished_at = datetime.now(timezone.utc)
+
+
+async def _check_mongo(db) -> dict:
+    t_start = time.perf_counter()
+    try:
+        await db.command("ping")
+    except Exception as e:
+        return {"ok": False, "error": str(e)[:200]}
+    ms = (time.perf_counter() - t_start) * 1000
+    return {"ok": ms <= READY_MONGO_MAX_MS, "latency_ms": round(ms, 1)}
+
+
+async def _check_indexes(db) -> dict:
+    missing = []
+    try:
+        for collection, required in REQUIRED_INDEXES.items():
+            present = [list(index["key"].items()) async for index in db[collection].list_indexes()]
+            for keys in required:
+                if [(field, direction) for field, direction in keys] not in present:
+                    missing.append(f"{collection}:{'_'.join(field for field, _ in keys)}")
+    except Exception as e:
+        return {"ok": False, "error": str(e)[:200]}
+    return {"ok": not missing, "missing": missing}
+
+
+async def _check_java_signer() -> dict:
+    t_start = time.perf_counter()
+    try:
+        response = await get_java_signer_client().get("/health", timeout=READY_JAVA_SIGNER_TIMEOUT)
+        ok = response.status_code == 200
+    except Exception as e:
+        return {"ok": False, "error": str(e)[:200]}
+    return {"ok": ok, "latency_ms": round((time.perf_counter() - t_start) * 1000, 1)}
+
+
+async def check_readiness(db) -> dict:
+    """Verificaciones de readiness; `ready` es False si falla alguna obligatoria"""
+    mongo, indexes, java_signer = await asyncio.gather(_check_mongo(db), _check_indexes(db), _check_java_signer())
+    checks = {
+        "mongo": mongo,
+        "indexes": indexes,
+        "signing_pool": {"ok": signing_pool.is_warm, "workers": signing_pool.workers},
+        "warmup": {"ok": warmup_state.done, **warmup_state.as_dict()},
+        "java_signer": {**java_signer, "required": False}
+    }
+    ready = all(check["ok"] for name, check in checks.items() if name != "java_signer")
+    return {"ready": ready, "checks": checks}
@@ -0,0 +1,170 @@
+"""
+Caché y render fuera del event loop del RIDE (PDF)
+
+- El PDF se guarda en GridFS (bucket ride_pdfs) por documento y versión: la
+  versión (ETag) cambia cuando cambia el estado SRI del documento, la
+  configuración del emisor o el logo, así que nunca se sirve un RIDE viejo.
+- El logo del POS se lee con el cliente Mongo de la app y se cachea por tenant.
+- ReportLab es CPU-bound: el render corre en un ProcessPoolExecutor.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from services.pdf_generator import generate_ride_pdf
+
+POS_DB_NAME = os.environ.get("POS_DB_NAME", "facturacion_db")
+RIDE_PDF_WORKERS = int(os.environ.get("RIDE_PDF_WORKERS", "2"))
+RIDE_LOGO_CACHE_TTL = float(os.environ.get("RIDE_LOGO_CACHE_TTL", "300"))
+RIDE_BUCKET = "ride_pdfs"
+
+# Campos del documento que se ven en el RIDE y pueden cambiar después de emitido
+VERSION_FIELDS = ("sri_status", "sri_authorization_number", "sri_authorization_date", "is_voided", "updated_at")
+
+
+def _stamp(value) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return "" if value is None else str(value)
+
+
+def ride_emitter(tenant: dict, config: Optional[dict]) -> dict:
+    """Datos del emisor que se imprimen en el RIDE"""
+    return {
+        "ruc": tenant["ruc"],
+        "razon_social": tenant["razon_social"],
+        "nombre_comercial": tenant.get("nombre_comercial"),
+        "direccion": tenant.get("address", {}).get("direccion", ""),
+        "telefono": tenant.get("phone"),
+        "ambiente": config.get("ambiente", "pruebas") if config else "pruebas",
+        "obligado_contabilidad": config.get("obligado_contabilidad", "NO") if config else "NO",
+        "contribuyente_especial": config.get("tipo_contribuyente") if config else None
+    }
+
+
+class RideRenderer:
+    """Render de RIDE con caché en GridFS y pool de procesos"""
+
+    def __init__(self, workers: int = RIDE_PDF_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._logos: Dict[str, Tuple[float, Optional[str], str]] = {}
+        self._render_locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if self._executor is None and self.workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def get_logo(self, mongo_client, tenant_id: str) -> Tuple[Optional[str], str]:
+        """
+        Logo del negocio (base64) desde configuraciones del POS, cacheado por tenant.
+        Retorna (logo_base64, hash corto del logo para la versión del RIDE).
+        """
+        cached = self._logos.get(tenant_id)
+        if cached is not None and time.monotonic() - cached[0] < RIDE_LOGO_CACHE_TTL:
+            return cached[1], cached[2]
+
+        logo_base64 = None
+        try:
+            # El logo se guarda en facturacion_db.configuraciones con el tenant_id como _id
+            pos_config = await mongo_client[POS_DB_NAME].configuraciones.find_one(
+                {"_id": tenant_id}, {"logo_url": 1}
+            )
+            logo_url = pos_config.get("logo_url") if pos_config else None
+            # El logo_url viene como data:image/xxx;base64,xxxxx
+            if logo_url and "base64," in logo_url:
+                logo_base64 = logo_url.split("base64,")[1]
+        except Exception as e:
+            print(f"Error obteniendo logo del POS: {e}")
+
+        logo_hash = hashlib.sha1(logo_base64.encode()).hexdigest()[:12] if logo_base64 else "none"
+        self._logos[tenant_id] = (time.monotonic(), logo_base64, logo_hash)
+        return logo_base64, logo_hash
+
+    def invalidate_logo(self, tenant_id: str):
+        self._logos.pop(tenant_id, None)
+
+    @staticmethod
+    def compute_etag(document: dict, tenant: dict, config: Optional[dict], logo_hash: str) -> str:
+        parts = [str(document["_id"])]
+        parts += [_stamp(document.get(field)) for field in VERSION_FIELDS]
+        parts.append(_stamp(tenant.get("updated_at")))
+        parts.append(_stamp(config.get("updated_at")) if config else "")
+        parts.append(logo_hash)
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    async def _render(self, document: dict, emitter: dict, logo_base64: Optional[str]) -> bytes:
+        document = {k: v for k, v in document.items() if k != "events"}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), generate_ride_pdf, document, emitter, logo_base64)
+
+    async def get_pdf(self, db, document: dict, emitter: dict, logo_base64: Optional[str], etag: str) -> bytes:
+        """PDF del documento para la versión `etag`, desde GridFS o renderizado"""
+        bucket = AsyncIOMotorGridFSBucket(db, bucket_name=RIDE_BUCKET)
+        filename = f"{document['_id']}.pdf"
+
+        cached = await self._read_cached(db, bucket, filename, etag)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        # Un solo render por documento aunque lleguen varias descargas a la vez
+        lock = self._render_locks.setdefault(filename, asyncio.Lock())
+        try:
+            async with lock:
+                cached = await self._read_cached(db, bucket, filename, etag)
+                if cached is not None:
+                    self.hits += 1
+                    return cached
+
+                self.misses += 1
+                pdf_bytes = await self._render(document, emitter, logo_base64)
+
+                # Reemplazar versiones anteriores del mismo documento
+                async for old in db[f"{RIDE_BUCKET}.files"].find({"filename": filename}, {"_id": 1}):
+                    await bucket.delete(old["_id"])
+                await bucket.upload_from_stream(
+                    filename, pdf_bytes,
+                    metadata={"etag": etag, "tenant_id": document["tenant_id"], "document_id": document["_id"]}
+                )
+                return pdf_bytes
+        finally:
+            # También si el render o GridFS fallan: si no, el dict crece con cada error
+            if self._render_locks.get(filename) is lock:
+                del self._render_locks[filename]
+
+    async def _read_cached(self, db, bucket, filename: str, etag: str) -> Optional[bytes]:
+        file_doc = await db[f"{RIDE_BUCKET}.files"].find_one({"filename": filename, "metadata.etag": etag}, {"_id": 1})
+        if file_doc is None:
+            return None
+        stream = await bucket.open_download_stream(file_doc["_id"])
+        return await stream.read()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "hits": self.hits,
+            "misses": self.misses,
+            "logos_cached": len(self._logos)
+        }
+
+
+ride_renderer = RideRenderer()
@@ -1,9 +1,24 @@
 """
 Servicio de Secuenciales Atómicos para documentos electrónicos
 Usa MongoDB $inc para garantizar unicidad incluso con alta concurrencia
+
+Asignación por bloques (opcional, SEQUENTIAL_BLOCK_SIZE > 1): cada proceso
+reserva rangos de N secuenciales con un solo $inc y los reparte en memoria,
+así la emisión masiva no se serializa sobre el documento de counters. Cada
+rango queda registrado en sequential_leases; los números de un rango que nunca
+llegaron a un documento (p.ej. el proceso murió) se reportan como huecos.
 """
+import os
+import uuid
+import socket
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Tuple
+
+SEQUENTIAL_BLOCK_SIZE = int(os.environ.get("SEQUENTIAL_BLOCK_SIZE", "0"))
+SEQUENTIAL_LEASE_SECONDS = float(os.environ.get("SEQUENTIAL_LEASE_SECONDS", "300"))
+SEQUENTIAL_REPORT_LEASES = int(os.environ.get("SEQUENTIAL_REPORT_LEASES", "50"))
 
 async def get_next_sequential(
     db: AsyncIOMotorDatabase,
@@ -106,3 +121,254 @@ async def set_sequential(
     )
     
     return result.modified_count > 0 or result.upserted_id is not None
+
+
+async def reserve_sequentials(
+    db: AsyncIOMotorDatabase,
+    tenant_id: str,
+    store_code: str,
+    emission_point: str,
+    doc_type: str,
+    count: int
+) -> Tuple[int, int]:
+    """
+    Reserva `count` secuenciales consecutivos con un solo $inc
+    Retorna (primero, último)
+    """
+    result = await db.counters.find_one_and_update(
+        {
+            "tenant_id": tenant_id,
+            "store_code": store_code,
+            "emission_point": emission_point,
+            "doc_type": doc_type
+        },
+        {
+            "$inc": {"sequence": count},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        },
+        upsert=True,
+        return_document=True
+    )
+    end = result["sequence"]
+    return end - count + 1, end
+
+
+class _Block:
+    def __init__(self, lease_id: str, start: int, end: int, expires_at: datetime):
+        self.lease_id = lease_id
+        self.start = start
+        self.end = end
+        self.next = start
+        self.expires_at = expires_at
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.next + 1
+
+
+class SequentialAllocator:
+    """
+    Reparte secuenciales desde rangos reservados por proceso.
+    Con block_size <= 1 equivale a get_next_sequential (un $inc por documento).
+    """
+
+    def __init__(self, block_size: int = SEQUENTIAL_BLOCK_SIZE, lease_seconds: float = SEQUENTIAL_LEASE_SECONDS):
+        self.block_size = block_size
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._blocks: Dict[tuple, _Block] = {}
+        self._locks: Dict[tuple, asyncio.Lock] = {}
+        self.allocated = 0
+        self.leases = 0
+
+    async def allocate(self, db, tenant_id: str, store_code: str, emission_point: str, doc_type: str) -> int:
+        if self.block_size <= 1:
+            return await get_next_sequential(db, tenant_id, store_code, emission_point, doc_type)
+
+        key = (tenant_id, store_code, emission_point, doc_type)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            block = self._blocks.get(key)
+            now = datetime.now(timezone.utc)
+            if block is not None and (block.remaining <= 0 or block.expires_at <= now):
+                await self._close(db, key, block, "closed" if block.remaining <= 0 else "expired")
+                block = None
+            if block is None:
+                block = await self._lease(db, key, now)
+            sequential = block.next
+            block.next += 1
+            self.allocated += 1
+            return sequential
+
+    async def reserve(self, db, tenant_id: str, store_code: str, emission_point: str, doc_type: str,
+                      count: int) -> Tuple[str, int, int]:
+        """
+        Reserva un rango de `count` secuenciales para un lote y lo registra.
+        Retorna (lease_id, primero, último); cerrar con finish() al insertar los documentos.
+        """
+        now = datetime.now(timezone.utc)
+        start, end = await reserve_sequentials(db, tenant_id, store_code, emission_point, doc_type, count)
+        lease_id = str(uuid.uuid4())
+        await self._record(db, lease_id, (tenant_id, store_code, emission_point, doc_type), start, end,
+                           now, now + timedelta(seconds=self.lease_seconds))
+        return lease_id, start, end
+
+    async def finish(self, db, lease_id: str, last_used: int):
+        await db.sequential_leases.update_one(
+            {"_id": lease_id},
+            {"$set": {"status": "closed", "last_used": last_used, "closed_at": datetime.now(timezone.utc)}}
+        )
+
+    async def _record(self, db, lease_id: str, key: tuple, start: int, end: int,
+                      now: datetime, expires_at: datetime):
+        tenant_id, store_code, emission_point, doc_type = key
+        await db.sequential_leases.insert_one({
+            "_id": lease_id,
+            "tenant_id": tenant_id,
+            "store_code": store_code,
+            "emission_point": emission_point,
+            "doc_type": doc_type,
+            "start": start,
+            "end": end,
+            "size": end - start + 1,
+            "owner": self.owner,
+            "status": "active",
+            "leased_at": now,
+            "expires_at": expires_at
+        })
+        self.leases += 1
+
+    async def _lease(self, db, key: tuple, now: datetime) -> _Block:
+        tenant_id, store_code, emission_point, doc_type = key
+        start, end = await reserve_sequentials(db, tenant_id, store_code, emission_point, doc_type, self.block_size)
+        block = _Block(str(uuid.uuid4()), start, end, now + timedelta(seconds=self.lease_seconds))
+        await self._record(db, block.lease_id, key, start, end, now, block.expires_at)
+        self._blocks[key] = block
+        return block
+
+    async def _close(self, db, key: tuple, block: _Block, status: str):
+        """Cierra el rango; si nadie reservó después, devuelve la cola sin usar al contador"""
+        self._blocks.pop(key, None)
+        last_used = block.next - 1
+        returned = False
+        if block.remaining > 0:
+            tenant_id, store_code, emission_point, doc_type = key
+            result = await db.counters.update_one(
+                {
+                    "tenant_id": tenant_id,
+                    "store_code": store_code,
+                    "emission_point": emission_point,
+                    "doc_type": doc_type,
+                    "sequence": block.end
+                },
+                {"$set": {"sequence": last_used, "updated_at": datetime.now(timezone.utc)}}
+            )
+            returned = result.modified_count > 0
+        await db.sequential_leases.update_one(
+            {"_id": block.lease_id},
+            {"$set": {
+                "status": status,
+                "last_used": last_used,
+                # Si la cola volvió al contador, el rango efectivo termina en last_used
+                "end": last_used if returned else block.end,
+                "returned": block.remaining if returned else 0,
+                "closed_at": datetime.now(timezone.utc)
+            }}
+        )
+
+    async def release(self, db):
+        """Cierra todos los rangos del proceso (al apagar)"""
+        for key, block in list(self._blocks.items()):
+            try:
+                await self._close(db, key, block, "released")
+            except Exception as e:
+                print(f"Error liberando secuenciales {block.start}-{block.end}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "block_size": self.block_size,
+            "lease_seconds": self.lease_seconds,
+            "allocated": self.allocated,
+            "leases": self.leases,
+            "active_blocks": [
+                {
+                    "store_code": key[1], "emission_point": key[2], "doc_type": key[3],
+                    "start": block.start, "end": block.end, "remaining": block.remaining
+                }
+                for key, block in self._blocks.items()
+            ]
+        }
+
+
+sequential_allocator = SequentialAllocator()
+
+
+async def allocate_sequential(
+    db: AsyncIOMotorDatabase,
+    tenant_id: str,
+    store_code: str,
+    emission_point: str,
+    doc_type: str
+) -> int:
+    """Siguiente secuencial: por bloques si SEQUENTIAL_BLOCK_SIZE > 1, si no un $inc por documento"""
+    return await sequential_allocator.allocate(db, tenant_id, store_code, emission_point, doc_type)
+
+
+async def sequential_lease_report(db: AsyncIOMotorDatabase, tenant_id: str) -> dict:
+    """
+    Utilización de los rangos reservados del tenant (los más recientes).
+    Un rango activo con expires_at vencido es de un proceso que murió: sus
+    números sin documento son huecos en la numeración.
+    """
+    now = datetime.now(timezone.utc)
+    leases: List[dict] = []
+    leased = used = 0
+    gaps: List[dict] = []
+
+    cursor = db.sequential_leases.find({"tenant_id": tenant_id}).sort("leased_at", -1).limit(SEQUENTIAL_REPORT_LEASES)
+    async for lease in cursor:
+        first = format_doc_number(lease["store_code"], lease["emission_point"], lease["start"])
+        last = format_doc_number(lease["store_code"], lease["emission_point"], lease["end"])
+        size = max(lease["end"] - lease["start"] + 1, 0)
+        issued = await db.documents.count_documents({
+            "tenant_id": tenant_id,
+            "doc_type": lease["doc_type"],
+            "doc_number": {"$gte": first, "$lte": last}
+        }) if size else 0
+
+        status = lease["status"]
+        expires_at = lease.get("expires_at")
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        if status == "active" and expires_at is not None and expires_at < now:
+            status = "abandoned"
+
+        leased += size
+        used += issued
+        if status != "active" and issued < size:
+            gaps.append({
+                "lease_id": lease["_id"],
+                "doc_type": lease["doc_type"],
+                "range": [first, last],
+                "unused": size - issued,
+                "status": status
+            })
+        leases.append({
+            "lease_id": lease["_id"],
+            "doc_type": lease["doc_type"],
+            "start": lease["start"],
+            "end": lease["end"],
+            "issued": issued,
+            "status": status,
+            "owner": lease.get("owner"),
+            "leased_at": lease.get("leased_at")
+        })
+
+    return {
+        "block_size": sequential_allocator.block_size,
+        "leased": leased,
+        "issued": used,
+        "utilization": round(used / leased, 4) if leased else None,
+        "gaps": gaps,
+        "leases": leases
+    }
@@ -0,0 +1,149 @@
+"""
+Caché de contextos de firma por tenant
+Evita desencriptar la contraseña (PBKDF2) y parsear el PKCS#12 en cada documento.
+
+La clave del caché es (tenant_id, certificate_id): al subir un certificado nuevo
+cambia su _id. El certificado que llega desde el TenantContext puede venir de
+otra réplica con caché vieja (hasta TENANT_CACHE_TTL), por eso
+get_signing_context consulta en la BD cuál es el certificado activo (lectura
+indexada de solo el _id) antes de firmar: ningún proceso firma con un
+certificado que ya no está activo, aunque no reciba la invalidación.
+"""
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from services.xml_signer_sri import load_signing_material
+from utils.crypto import decrypt_password
+from middleware.tenant import invalidate_tenant_context
+
+SIGNING_CACHE_TTL = float(os.environ.get("SIGNING_CACHE_TTL", "3600"))
+SIGNING_CACHE_MAX_ENTRIES = int(os.environ.get("SIGNING_CACHE_MAX_ENTRIES", "256"))
+
+
+class SigningContext:
+    """
+    Material de firma listo para usar:
+    - p12_data y password para el firmador Java
+    - material (clave privada y fragmentos KeyInfo/SigningCertificate) para el firmador Python
+    - java_handle: handle del certificado ya registrado en el firmador Java
+    """
+
+    def __init__(self, tenant_id: str, certificate_id: str, p12_data: bytes, password: str, material: dict):
+        self.tenant_id = tenant_id
+        self.certificate_id = certificate_id
+        self.p12_data = p12_data
+        self.password = password
+        self.material = material
+        self.java_handle: Optional[str] = None
+        self.java_lock = asyncio.Lock()
+        self.loaded_at = time.monotonic()
+
+
+class SigningContextCache:
+    """LRU con TTL de SigningContext por (tenant_id, certificate_id)"""
+
+    def __init__(self, ttl: float = SIGNING_CACHE_TTL, max_entries: int = SIGNING_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], SigningContext]" = OrderedDict()
+        self._locks: dict = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tenant_id: str, certificate_id: str) -> Optional[SigningContext]:
+        key = (tenant_id, certificate_id)
+        context = self._entries.get(key)
+        if context is None:
+            return None
+        if time.monotonic() - context.loaded_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return context
+
+    def put(self, context: SigningContext):
+        key = (context.tenant_id, context.certificate_id)
+        self._entries[key] = context
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tenant_id: str) -> List[SigningContext]:
+        return [self._entries.pop(key) for key in [k for k in self._entries if k[0] == tenant_id]]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    async def get_or_load(self, db, tenant_id: str, certificate: dict) -> SigningContext:
+        """
+        Retorna el contexto de firma del certificado, cargándolo si no está en caché.
+        `certificate` puede venir sin file_data/password_encrypted: en ese caso se leen
+        de la BD solo cuando hay que cargar.
+        """
+        certificate_id = str(certificate["_id"])
+        context = self.get(tenant_id, certificate_id)
+        if context is not None:
+            self.hits += 1
+            return context
+
+        # Un solo loader por certificado aunque lleguen varias requests a la vez
+        lock = self._locks.setdefault((tenant_id, certificate_id), asyncio.Lock())
+        async with lock:
+            context = self.get(tenant_id, certificate_id)
+            if context is not None:
+                self.hits += 1
+                return context
+
+            self.misses += 1
+            if "file_data" not in certificate or "password_encrypted" not in certificate:
+                certificate = await db.certificates.find_one({"_id": certificate["_id"], "tenant_id": tenant_id})
+                if certificate is None:
+                    raise ValueError("Certificado no encontrado")
+
+            p12_data = bytes(certificate["file_data"]) if not isinstance(certificate["file_data"], bytes) else certificate["file_data"]
+
+            # PBKDF2 y parseo PKCS#12 son CPU-bound: fuera del event loop
+            loop = asyncio.get_running_loop()
+            password = await loop.run_in_executor(None, decrypt_password, certificate["password_encrypted"])
+            material = await loop.run_in_executor(None, load_signing_material, p12_data, password)
+
+            context = SigningContext(tenant_id, certificate_id, p12_data, password, material)
+            self.put(context)
+        self._locks.pop((tenant_id, certificate_id), None)
+        return context
+
+
+signing_cache = SigningContextCache()
+
+
+async def get_signing_context(db, tenant_id: str, certificate: dict) -> SigningContext:
+    """
+    Contexto de firma cacheado para el certificado activo del tenant.
+    Si `certificate` (del TenantContext cacheado) ya no es el activo, firma con
+    el activo y descarta el contexto del tenant en esta réplica.
+    """
+    active = await db.certificates.find_one({"tenant_id": tenant_id, "is_active": True}, {"_id": 1})
+    if active is None:
+        invalidate_tenant_context(tenant_id)
+        raise ValueError("El tenant no tiene un certificado activo")
+    if str(active["_id"]) != str(certificate["_id"]):
+        invalidate_tenant_context(tenant_id)
+        certificate = active
+    return await signing_cache.get_or_load(db, tenant_id, certificate)
+
+
+def invalidate_signing_context(tenant_id: str) -> List[SigningContext]:
+    """Descarta los contextos de firma del tenant (al subir o eliminar certificados)"""
+    return signing_cache.invalidate(tenant_id)
@@ -0,0 +1,216 @@
+"""
+Motor de firma XAdES en un pool de procesos
+La canonicalización C14N, los digests SHA-1 y la firma RSA son CPU-bound: ejecutarlos
+en el event loop bloquea las requests de todos los tenants mientras se firma.
+
+Cada proceso del pool mantiene su propio caché de material de firma (clave privada
+ya parseada), porque las claves privadas no se pueden enviar entre procesos.
+
+Si un proceso del pool muere (BrokenProcessPool) el executor se reconstruye y
+la firma se reintenta una vez; mientras tanto is_warm es False.
+"""
+import os
+import time
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from services.xml_signer_sri import load_signing_material, sign_xml_xades_sri_with_material
+
+# Por proceso uvicorn: con varios workers de uvicorn, cpu_count() procesos cada uno sobresuscribe la CPU
+SIGNING_POOL_WORKERS = int(os.environ.get("SIGNING_POOL_WORKERS", "2"))
+SIGNING_POOL_MAX_PENDING = int(os.environ.get("SIGNING_POOL_MAX_PENDING", str(max(1, SIGNING_POOL_WORKERS) * 4)))
+SIGNING_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("SIGNING_POOL_ACQUIRE_TIMEOUT", "30"))
+SIGNING_POOL_WORKER_CACHE_SIZE = 64
+
+STAGES = ("queue_wait", "load", "c14n_digest", "rsa_sign", "assemble", "total")
+
+
+class SigningPoolBusy(Exception):
+    """No hubo capacidad en el pool de firma dentro del tiempo de espera"""
+
+
+# ---- Código que corre dentro de cada proceso del pool ----
+
+_worker_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+
+
+def _init_worker():
+    """Inicializa el proceso: importa lxml/cryptography una sola vez"""
+    from lxml import etree  # noqa: F401
+    from cryptography.hazmat.primitives.serialization import pkcs12  # noqa: F401
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+def _sign_in_worker(cache_key: tuple, p12_data: bytes, password: str, xml_content: str):
+    """Firma en el proceso del pool usando (o llenando) su caché de claves"""
+    timings = {}
+    t0 = time.perf_counter()
+    material = _worker_cache.get(cache_key)
+    if material is None:
+        material = load_signing_material(p12_data, password)
+        _worker_cache[cache_key] = material
+        while len(_worker_cache) > SIGNING_POOL_WORKER_CACHE_SIZE:
+            _worker_cache.popitem(last=False)
+    else:
+        _worker_cache.move_to_end(cache_key)
+    timings["load"] = (time.perf_counter() - t0) * 1000
+
+    signed_xml = sign_xml_xades_sri_with_material(xml_content, material, timings)
+    return signed_xml, timings
+
+
+# ---- API asíncrona (proceso principal) ----
+
+class SigningPool:
+    """
+    Firma documentos en un ProcessPoolExecutor.
+    - Backpressure: como máximo max_pending firmas en vuelo; el resto espera
+      hasta acquire_timeout y luego recibe SigningPoolBusy.
+    - Métricas: cantidad, errores y tiempos (ms) por etapa.
+    Con workers=0 firma en el thread pool por defecto (sin procesos).
+    """
+
+    def __init__(self, workers: int = SIGNING_POOL_WORKERS, max_pending: int = SIGNING_POOL_MAX_PENDING,
+                 acquire_timeout: float = SIGNING_POOL_ACQUIRE_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.acquire_timeout = acquire_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._warm = False
+        self._restart_lock = asyncio.Lock()
+        self.restarts = 0
+        self.signed = 0
+        self.errors = 0
+        self.rejected = 0
+        self._stage_sum = {stage: 0.0 for stage in STAGES}
+        self._stage_max = {stage: 0.0 for stage in STAGES}
+
+    async def start(self):
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        if self.workers > 0:
+            await self._start_executor()
+        self._warm = True
+
+    async def _start_executor(self):
+        # spawn: los procesos no heredan el event loop ni el cliente de MongoDB
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker
+        )
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self._executor, _warm_up) for _ in range(self.workers)])
+
+    async def _restart(self, broken: ProcessPoolExecutor):
+        """Reemplaza un executor roto (un proceso murió); no-op si otra firma ya lo reemplazó"""
+        async with self._restart_lock:
+            if self._executor is not broken:
+                return
+            self._warm = False
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.restarts += 1
+            print(f"[Firma] Pool de firma roto, reiniciando procesos (reinicio #{self.restarts})")
+            await self._start_executor()
+            self._warm = True
+
+    async def _run_in_pool(self, fn, *args):
+        """Ejecuta fn en el pool; si el pool está roto lo reconstruye y reintenta una vez"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return await loop.run_in_executor(executor, fn, *args)
+            except BrokenProcessPool:
+                self._warm = False
+                if attempt == 1:
+                    raise
+                await self._restart(executor)
+
+    async def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._warm = False
+
+    @property
+    def is_warm(self) -> bool:
+        return self._warm
+
+    async def sign(self, signing_context, xml_content: str) -> str:
+        """Firma xml_content con el certificado de signing_context (services.signing_cache)"""
+        if self._semaphore is None:
+            await self.start()
+
+        t_queue = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise SigningPoolBusy("Pool de firma saturado, intente nuevamente")
+
+        self._in_flight += 1
+        try:
+            queue_wait = (time.perf_counter() - t_queue) * 1000
+            t_start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                if self._executor is not None:
+                    cache_key = (signing_context.tenant_id, signing_context.certificate_id)
+                    signed_xml, timings = await self._run_in_pool(
+                        _sign_in_worker, cache_key, signing_context.p12_data, signing_context.password, xml_content
+                    )
+                else:
+                    timings = {"load": 0.0}
+                    signed_xml = await loop.run_in_executor(
+                        None, sign_xml_xades_sri_with_material, xml_content, signing_context.material, timings
+                    )
+            except Exception:
+                self.errors += 1
+                raise
+            timings["queue_wait"] = queue_wait
+            timings["total"] = (time.perf_counter() - t_start) * 1000
+            self._record(timings)
+            return signed_xml
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def _record(self, timings: dict):
+        self.signed += 1
+        for stage in STAGES:
+            value = timings.get(stage, 0.0)
+            self._stage_sum[stage] += value
+            if value > self._stage_max[stage]:
+                self._stage_max[stage] = value
+
+    def stats(self) -> dict:
+        return {
+            "mode": "process" if self.workers > 0 else "thread",
+            "workers": self.workers,
+            "warm": self._warm,
+            "restarts": self.restarts,
+            "max_pending": self.max_pending,
+            "in_flight": self._in_flight,
+            "signed": self.signed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "stages_ms": {
+                stage: {
+                    "avg": round(self._stage_sum[stage] / self.signed, 3) if self.signed else 0.0,
+                    "max": round(self._stage_max[stage], 3)
+                }
+                for stage in STAGES
+            }
+        }
+
+
+signing_pool = SigningPool()
@@ -1,9 +1,15 @@
 """
 Cliente SOAP para comunicación con Web Services del SRI Ecuador
 Endpoints: RecepcionComprobantesOffline, AutorizacionComprobantesOffline
+
+Un cliente por ambiente (get_sri_client) con pool de conexiones keep-alive:
+el handshake TLS con el SRI se hace una vez por conexión y no por documento.
 """
+import os
+import time
 import base64
 import asyncio
+from io import BytesIO
 from typing import Optional, Dict, List, Tuple
 from datetime import datetime, timezone
 from lxml import etree
@@ -21,6 +27,18 @@ SRI_ENDPOINTS = {
     }
 }
 
+# Permite apuntar a un servidor SOAP local (tests, ver tests/sri_stub_server.py)
+SRI_BASE_URL_OVERRIDE = {
+    "pruebas": os.environ.get("SRI_BASE_URL_PRUEBAS"),
+    "produccion": os.environ.get("SRI_BASE_URL_PRODUCCION")
+}
+
+SRI_TIMEOUT = float(os.environ.get("SRI_TIMEOUT", "30"))
+SRI_CONNECT_TIMEOUT = float(os.environ.get("SRI_CONNECT_TIMEOUT", "10"))
+SRI_MAX_CONNECTIONS = int(os.environ.get("SRI_MAX_CONNECTIONS", "50"))
+SRI_MAX_KEEPALIVE = int(os.environ.get("SRI_MAX_KEEPALIVE", "20"))
+SRI_KEEPALIVE_EXPIRY = float(os.environ.get("SRI_KEEPALIVE_EXPIRY", "60"))
+
 # Estados SRI
 SRI_STATUS = {
     "RECIBIDA": "RECIBIDA",
@@ -30,206 +48,235 @@ SRI_STATUS = {
     "EN_PROCESO": "EN_PROCESO"
 }
 
+SOAP_HEADERS = {
+    "Content-Type": "text/xml; charset=utf-8",
+    "SOAPAction": ""
+}
+
+# Envelopes SOAP pre-armados: solo se concatena el contenido variable
+RECEPCION_PREFIX = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.recepcion">'
+    b'<soapenv:Header/><soapenv:Body><ec:validarComprobante><xml>'
+)
+RECEPCION_SUFFIX = b'</xml></ec:validarComprobante></soapenv:Body></soapenv:Envelope>'
+
+AUTORIZACION_PREFIX = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.autorizacion">'
+    b'<soapenv:Header/><soapenv:Body><ec:autorizacionComprobante><claveAccesoComprobante>'
+)
+AUTORIZACION_SUFFIX = b'</claveAccesoComprobante></ec:autorizacionComprobante></soapenv:Body></soapenv:Envelope>'
+
+# Campos del mensaje SRI (nombre local -> clave en el dict)
+MENSAJE_CAMPOS = {
+    "identificador": "identificador",
+    "mensaje": "mensaje",
+    "informacionAdicional": "informacion_adicional",
+    "tipo": "tipo"
+}
+
+
+def build_recepcion_envelope(xml_signed: bytes) -> bytes:
+    """Envelope de validarComprobante con el XML firmado en base64"""
+    return RECEPCION_PREFIX + base64.b64encode(xml_signed) + RECEPCION_SUFFIX
+
+
+def build_autorizacion_envelope(access_key: str) -> bytes:
+    """Envelope de autorizacionComprobante para la clave de acceso"""
+    return AUTORIZACION_PREFIX + access_key.encode("ascii") + AUTORIZACION_SUFFIX
+
+
+def normalize_estado(estado: Optional[str]) -> Optional[str]:
+    """El SRI responde "NO AUTORIZADO" / "EN PROCESO" con espacio; internamente se usa "NO_AUTORIZADO" """
+    if not estado:
+        return None
+    return "_".join(estado.upper().split())
+
+
+def parse_sri_response(content: bytes) -> Dict:
+    """
+    Parser único (streaming) para las respuestas de recepción y autorización.
+    Compara por nombre local: el SRI responde los hijos sin namespace y el
+    envelope con namespace, así que no depende del prefijo usado.
+
+    Retorna estado (normalizado con normalize_estado), numero_autorizacion,
+    fecha_autorizacion, mensajes y la cantidad de nodos <autorizacion> (0 = aún en proceso).
+    Solo se toma la primera autorización, como hace el SRI al listar el historial.
+    """
+    result = {
+        "estado": None,
+        "numero_autorizacion": None,
+        "fecha_autorizacion": None,
+        "mensajes": [],
+        "autorizaciones": 0
+    }
+    parser = etree.iterparse(
+        BytesIO(content), events=("end",), resolve_entities=False, no_network=True, huge_tree=True
+    )
+    for _, elem in parser:
+        if not isinstance(elem.tag, str):
+            continue
+        name = etree.QName(elem).localname
+
+        if name == "mensaje" and len(elem):
+            if result["autorizaciones"] == 0:
+                mensaje = {clave: "" for clave in MENSAJE_CAMPOS.values()}
+                for child in elem:
+                    clave = MENSAJE_CAMPOS.get(etree.QName(child).localname) if isinstance(child.tag, str) else None
+                    if clave:
+                        mensaje[clave] = (child.text or "").strip()
+                result["mensajes"].append(mensaje)
+            elem.clear()
+        elif name == "estado":
+            if result["estado"] is None:
+                result["estado"] = normalize_estado(elem.text)
+        elif name == "numeroAutorizacion":
+            if result["numero_autorizacion"] is None:
+                result["numero_autorizacion"] = (elem.text or "").strip() or None
+        elif name == "fechaAutorizacion":
+            if result["fecha_autorizacion"] is None and elem.text:
+                try:
+                    result["fecha_autorizacion"] = datetime.fromisoformat(elem.text.strip().replace('Z', '+00:00'))
+                except ValueError:
+                    pass
+        elif name == "faultstring":
+            result["mensajes"].append({"mensaje": (elem.text or "").strip(), "tipo": "ERROR"})
+        elif name == "autorizacion":
+            result["autorizaciones"] += 1
+            elem.clear()
+        elif name == "comprobante":
+            # El comprobante autorizado viene como texto (XML escapado): no se necesita
+            elem.clear()
+    return result
+
+
 class SRIClient:
     """
     Cliente para interactuar con Web Services del SRI Ecuador
+    Usar get_sri_client(ambiente) para compartir el pool de conexiones.
     """
     
-    def __init__(self, ambiente: str = "pruebas"):
+    def __init__(self, ambiente: str = "pruebas", base_url: Optional[str] = None):
         """
         Inicializa el cliente con el ambiente especificado
         
         Args:
             ambiente: "pruebas" o "produccion"
+            base_url: reemplaza el host del SRI (p.ej. servidor SOAP local en tests)
         """
         self.ambiente = ambiente
         self.endpoints = SRI_ENDPOINTS[ambiente]
-        self.timeout = 30.0
+        self.timeout = SRI_TIMEOUT
+        base_url = base_url or SRI_BASE_URL_OVERRIDE.get(ambiente)
+        # URLs de los servicios (sin ?wsdl)
+        self.urls = {}
+        for servicio, url in self.endpoints.items():
+            url = url.replace("?wsdl", "")
+            if base_url:
+                url = base_url.rstrip("/") + url[url.index("/", len("https://")):]
+            self.urls[servicio] = url
+        self._http: Optional[httpx.AsyncClient] = None
     
-    def _build_soap_envelope(self, body_content: str) -> str:
-        """
-        Construye el envelope SOAP
-        """
-        return f'''<?xml version="1.0" encoding="UTF-8"?>
-<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ec="http://ec.gob.sri.ws.recepcion">
-    <soapenv:Header/>
-    <soapenv:Body>
-        {body_content}
-    </soapenv:Body>
-</soapenv:Envelope>'''
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=SRI_CONNECT_TIMEOUT),
+                verify=False,
+                headers=SOAP_HEADERS,
+                limits=httpx.Limits(
+                    max_connections=SRI_MAX_CONNECTIONS,
+                    max_keepalive_connections=SRI_MAX_KEEPALIVE,
+                    keepalive_expiry=SRI_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._http
     
-    def _build_recepcion_body(self, xml_signed_b64: str) -> str:
-        """
-        Construye el body para el servicio de recepción
-        """
-        return f'''<ec:validarComprobante>
-            <xml>{xml_signed_b64}</xml>
-        </ec:validarComprobante>'''
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
     
-    def _build_autorizacion_body(self, access_key: str) -> str:
+    async def warm_up(self) -> float:
         """
-        Construye el body para el servicio de autorización
+        Abre conexiones (TCP + TLS) del pool hacia el SRI pidiendo el WSDL de recepción.
+        Retorna la latencia en ms.
         """
-        return f'''<ec:autorizacionComprobante xmlns:ec="http://ec.gob.sri.ws.autorizacion">
-            <claveAccesoComprobante>{access_key}</claveAccesoComprobante>
-        </ec:autorizacionComprobante>'''
+        t_start = time.perf_counter()
+        await self._get_http().get(self.urls["recepcion"], params={"wsdl": ""})
+        return (time.perf_counter() - t_start) * 1000
+    
+    async def _post(self, servicio: str, envelope: bytes) -> bytes:
+        response = await self._get_http().post(self.urls[servicio], content=envelope)
+        return response.content
     
-    def _parse_recepcion_response(self, xml_response: str) -> Dict:
+    def _parse_recepcion_response(self, content: bytes) -> Dict:
         """
         Parsea la respuesta del servicio de recepción
         """
         try:
-            print(f"[SRI Client] Parseando respuesta recepción...")
-            root = etree.fromstring(xml_response.encode('utf-8'))
-            
-            # Buscar estado - intentar diferentes namespaces
-            estado = root.find('.//{http://ec.gob.sri.ws.recepcion}estado')
-            if estado is None:
-                # Probar sin namespace
-                import re
-                estado_match = re.search(r'<estado>([^<]+)</estado>', xml_response)
-                if estado_match:
-                    estado_text = estado_match.group(1)
-                    print(f"[SRI Client] Estado encontrado con regex: {estado_text}")
-                else:
-                    estado_text = "ERROR"
-                    print(f"[SRI Client] Estado no encontrado, raw: {xml_response[:500]}")
-            else:
-                estado_text = estado.text if estado is not None else "ERROR"
-                print(f"[SRI Client] Estado encontrado con namespace: {estado_text}")
-            
-            # Buscar mensajes
-            mensajes = []
-            comprobantes = root.findall('.//{http://ec.gob.sri.ws.recepcion}comprobante')
-            
-            for comp in comprobantes:
-                mensajes_elem = comp.findall('.//{http://ec.gob.sri.ws.recepcion}mensaje')
-                for msg in mensajes_elem:
-                    identificador = msg.find('{http://ec.gob.sri.ws.recepcion}identificador')
-                    mensaje = msg.find('{http://ec.gob.sri.ws.recepcion}mensaje')
-                    info_adicional = msg.find('{http://ec.gob.sri.ws.recepcion}informacionAdicional')
-                    tipo = msg.find('{http://ec.gob.sri.ws.recepcion}tipo')
-                    
-                    mensajes.append({
-                        "identificador": identificador.text if identificador is not None else "",
-                        "mensaje": mensaje.text if mensaje is not None else "",
-                        "informacion_adicional": info_adicional.text if info_adicional is not None else "",
-                        "tipo": tipo.text if tipo is not None else ""
-                    })
-            
-            return {
-                "estado": estado_text,
-                "mensajes": mensajes,
-                "raw_response": xml_response
-            }
-            
-        except Exception as e:
+            parsed = parse_sri_response(content)
+        except etree.XMLSyntaxError as e:
             return {
                 "estado": "ERROR",
                 "mensajes": [{"mensaje": f"Error parsing response: {str(e)}"}],
-                "raw_response": xml_response
+                "raw_response": content.decode("utf-8", errors="replace")
             }
+        return {
+            "estado": parsed["estado"] or "ERROR",
+            "mensajes": parsed["mensajes"],
+            "raw_response": content.decode("utf-8", errors="replace")
+        }
     
-    def _parse_autorizacion_response(self, xml_response: str) -> Dict:
+    def _parse_autorizacion_response(self, content: bytes) -> Dict:
         """
         Parsea la respuesta del servicio de autorización
         """
         try:
-            root = etree.fromstring(xml_response.encode('utf-8'))
-            
-            # Buscar autorización
-            autorizaciones = root.findall('.//{http://ec.gob.sri.ws.autorizacion}autorizacion')
-            
-            if not autorizaciones:
-                return {
-                    "estado": "EN_PROCESO",
-                    "numero_autorizacion": None,
-                    "fecha_autorizacion": None,
-                    "mensajes": [],
-                    "raw_response": xml_response
-                }
-            
-            autorizacion = autorizaciones[0]
-            
-            estado = autorizacion.find('{http://ec.gob.sri.ws.autorizacion}estado')
-            estado_text = estado.text if estado is not None else "ERROR"
-            
-            num_auth = autorizacion.find('{http://ec.gob.sri.ws.autorizacion}numeroAutorizacion')
-            fecha_auth = autorizacion.find('{http://ec.gob.sri.ws.autorizacion}fechaAutorizacion')
-            
-            # Parsear mensajes
-            mensajes = []
-            mensajes_elem = autorizacion.findall('.//{http://ec.gob.sri.ws.autorizacion}mensaje')
-            
-            for msg in mensajes_elem:
-                identificador = msg.find('{http://ec.gob.sri.ws.autorizacion}identificador')
-                mensaje = msg.find('{http://ec.gob.sri.ws.autorizacion}mensaje')
-                info_adicional = msg.find('{http://ec.gob.sri.ws.autorizacion}informacionAdicional')
-                tipo = msg.find('{http://ec.gob.sri.ws.autorizacion}tipo')
-                
-                mensajes.append({
-                    "identificador": identificador.text if identificador is not None else "",
-                    "mensaje": mensaje.text if mensaje is not None else "",
-                    "informacion_adicional": info_adicional.text if info_adicional is not None else "",
-                    "tipo": tipo.text if tipo is not None else ""
-                })
-            
-            fecha_auth_parsed = None
-            if fecha_auth is not None and fecha_auth.text:
-                try:
-                    fecha_auth_parsed = datetime.fromisoformat(fecha_auth.text.replace('Z', '+00:00'))
-                except:
-                    pass
-            
-            return {
-                "estado": estado_text,
-                "numero_autorizacion": num_auth.text if num_auth is not None else None,
-                "fecha_autorizacion": fecha_auth_parsed,
-                "mensajes": mensajes,
-                "raw_response": xml_response
-            }
-            
-        except Exception as e:
+            parsed = parse_sri_response(content)
+        except etree.XMLSyntaxError as e:
             return {
                 "estado": "ERROR",
                 "numero_autorizacion": None,
                 "fecha_autorizacion": None,
                 "mensajes": [{"mensaje": f"Error parsing response: {str(e)}"}],
-                "raw_response": xml_response
+                "raw_response": content.decode("utf-8", errors="replace")
             }
+        
+        if parsed["autorizaciones"] == 0:
+            # Sin autorizaciones todavía: el SRI sigue procesando
+            return {
+                "estado": "EN_PROCESO",
+                "numero_autorizacion": None,
+                "fecha_autorizacion": None,
+                "mensajes": parsed["mensajes"],
+                "raw_response": content.decode("utf-8", errors="replace")
+            }
+        
+        return {
+            "estado": parsed["estado"] or "ERROR",
+            "numero_autorizacion": parsed["numero_autorizacion"],
+            "fecha_autorizacion": parsed["fecha_autorizacion"],
+            "mensajes": parsed["mensajes"],
+            "raw_response": content.decode("utf-8", errors="replace")
+        }
     
-    async def enviar_comprobante(self, xml_signed: str) -> Dict:
+    async def enviar_comprobante(self, xml_signed) -> Dict:
         """
         Envía un comprobante firmado al SRI para recepción
         
         Args:
-            xml_signed: XML firmado como string
+            xml_signed: XML firmado (str o bytes)
             
         Returns:
             Dict con estado y mensajes del SRI
         """
-        # Codificar XML en Base64
-        xml_b64 = base64.b64encode(xml_signed.encode('utf-8')).decode('utf-8')
-        
-        # Construir SOAP request
-        body = self._build_recepcion_body(xml_b64)
-        soap_request = self._build_soap_envelope(body)
-        
-        # URL del servicio (sin ?wsdl)
-        url = self.endpoints["recepcion"].replace("?wsdl", "")
+        if isinstance(xml_signed, str):
+            xml_signed = xml_signed.encode('utf-8')
         
         try:
-            async with httpx.AsyncClient(timeout=self.timeout, verify=False) as client:
-                response = await client.post(
-                    url,
-                    content=soap_request,
-                    headers={
-                        "Content-Type": "text/xml; charset=utf-8",
-                        "SOAPAction": ""
-                    }
-                )
-                
-                return self._parse_recepcion_response(response.text)
+            content = await self._post("recepcion", build_recepcion_envelope(xml_signed))
+            return self._parse_recepcion_response(content)
                 
         except httpx.TimeoutException:
             return {
@@ -252,25 +299,9 @@ class SRIClient:
         Returns:
             Dict con estado de autorización
         """
-        # Construir SOAP request
-        body = self._build_autorizacion_body(access_key)
-        soap_request = self._build_soap_envelope(body)
-        
-        # URL del servicio (sin ?wsdl)
-        url = self.endpoints["autorizacion"].replace("?wsdl", "")
-        
         try:
-            async with httpx.AsyncClient(timeout=self.timeout, verify=False) as client:
-                response = await client.post(
-                    url,
-                    content=soap_request,
-                    headers={
-                        "Content-Type": "text/xml; charset=utf-8",
-                        "SOAPAction": ""
-                    }
-                )
-                
-                return self._parse_autorizacion_response(response.text)
+            content = await self._post("autorizacion", build_autorizacion_envelope(access_key))
+            return self._parse_autorizacion_response(content)
                 
         except httpx.TimeoutException:
             return {
@@ -292,7 +323,8 @@ class SRIClient:
         xml_signed: str, 
         access_key: str,
         max_retries: int = 3,
-        retry_delay: float = 2.0
+        retry_delay: float = 2.0,
+        timings: Optional[Dict[str, float]] = None
     ) -> Tuple[str, Optional[str], Optional[datetime], List[Dict]]:
         """
         Proceso completo: enviar comprobante y esperar autorización
@@ -302,13 +334,18 @@ class SRIClient:
             access_key: Clave de acceso
             max_retries: Número máximo de intentos de autorización
             retry_delay: Segundos entre intentos
+            timings: si se pasa, recibe la duración (ms) de "reception" y
+                "authorization" (consultas y esperas incluidas)
             
         Returns:
             Tuple (estado, numero_autorizacion, fecha_autorizacion, mensajes)
         """
         # 1. Enviar comprobante
         print(f"[SRI Client] Enviando comprobante...")
+        t_start = time.perf_counter()
         recepcion = await self.enviar_comprobante(xml_signed)
+        if timings is not None:
+            timings["reception"] = (time.perf_counter() - t_start) * 1000
         print(f"[SRI Client] Recepción estado: {recepcion['estado']}")
         
         if recepcion["estado"] == "DEVUELTA":
@@ -319,6 +356,16 @@ class SRIClient:
             print(f"[SRI Client] Error en recepción: {recepcion['mensajes']}")
             return ("ERROR", None, None, recepcion["mensajes"])
         
+        t_start = time.perf_counter()
+        try:
+            return await self._esperar_autorizacion(access_key, max_retries, retry_delay)
+        finally:
+            if timings is not None:
+                timings["authorization"] = (time.perf_counter() - t_start) * 1000
+
+    async def _esperar_autorizacion(
+        self, access_key: str, max_retries: int, retry_delay: float
+    ) -> Tuple[str, Optional[str], Optional[datetime], List[Dict]]:
         # 2. Esperar un momento antes de consultar
         print(f"[SRI Client] Comprobante recibido, consultando autorización...")
         await asyncio.sleep(1.0)
@@ -350,3 +397,21 @@ class SRIClient:
         
         # Si después de todos los intentos sigue en proceso
         return ("EN_PROCESO", None, None, [{"mensaje": "Documento en proceso de autorización"}])
+
+
+_clients: Dict[str, SRIClient] = {}
+
+
+def get_sri_client(ambiente: str = "pruebas") -> SRIClient:
+    """Cliente compartido por ambiente (un pool de conexiones por host del SRI)"""
+    client = _clients.get(ambiente)
+    if client is None:
+        client = SRIClient(ambiente=ambiente)
+        _clients[ambiente] = client
+    return client
+
+
+async def close_sri_clients():
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
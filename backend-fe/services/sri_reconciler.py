@@ -0,0 +1,211 @@
+"""
+Reconciliador de documentos pendientes con el SRI
+
+Consulta la autorización de los documentos EN_PROCESO / ERROR / PENDIENTE:
+- concurrente, acotado por un semáforo (SRI_SYNC_CONCURRENCY)
+- pagina por todos los pendientes (keyset por _id), sin tope fijo
+- justo entre tenants: cada ronda toma un lote por tenant y los intercala,
+  así un tenant con miles de pendientes no deja sin turno a los demás
+- backoff exponencial por documento (sri_sync_attempts, sri_next_sync_at)
+
+Corre como loop programado (un solo proceso a la vez, con lease en
+scheduler_locks) y bajo demanda desde POST /fe/documents/sync-pending.
+"""
+import os
+import socket
+import asyncio
+from datetime import datetime, timezone, timedelta
+from itertools import zip_longest
+from typing import Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from services.sri_client import get_sri_client
+from services.sri_worker import apply_sri_result
+
+PENDING_STATUSES = ["EN_PROCESO", "ERROR", "PENDIENTE"]
+
+SRI_SYNC_CONCURRENCY = int(os.environ.get("SRI_SYNC_CONCURRENCY", "10"))
+SRI_SYNC_TENANT_BATCH = int(os.environ.get("SRI_SYNC_TENANT_BATCH", "20"))
+SRI_SYNC_INTERVAL = float(os.environ.get("SRI_SYNC_INTERVAL", "120"))
+SRI_SYNC_MIN_AGE = float(os.environ.get("SRI_SYNC_MIN_AGE", "60"))
+SRI_SYNC_BASE_DELAY = float(os.environ.get("SRI_SYNC_BASE_DELAY", "60"))
+SRI_SYNC_MAX_DELAY = float(os.environ.get("SRI_SYNC_MAX_DELAY", str(6 * 3600)))
+SRI_SYNC_LOCK_SECONDS = int(SRI_SYNC_INTERVAL * 3)
+
+DOC_PROJECTION = {"_id": 1, "tenant_id": 1, "doc_number": 1, "access_key": 1, "sri_status": 1, "sri_sync_attempts": 1}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def next_sync_delay(attempts: int) -> float:
+    """Segundos hasta la próxima consulta tras `attempts` consultas sin estado final"""
+    return min(SRI_SYNC_BASE_DELAY * (2 ** max(attempts - 1, 0)), SRI_SYNC_MAX_DELAY)
+
+
+def _pending_query(now: datetime, force: bool) -> dict:
+    query = {"sri_status": {"$in": PENDING_STATUSES}, "access_key": {"$nin": [None, ""]}}
+    if not force:
+        # Los recién actualizados los está procesando la emisión (o el worker async)
+        query["updated_at"] = {"$lte": now - timedelta(seconds=SRI_SYNC_MIN_AGE)}
+        query["sri_next_sync_at"] = {"$not": {"$gt": now}}
+    return query
+
+
+async def _reconcile_one(db, doc: dict, ambiente: str, semaphore: asyncio.Semaphore) -> Dict:
+    async with semaphore:
+        autorizacion = await get_sri_client(ambiente).consultar_autorizacion(doc["access_key"])
+
+    estado = autorizacion["estado"]
+    old_status = doc.get("sri_status")
+
+    if estado in ("AUTORIZADO", "NO_AUTORIZADO"):
+        new_status = estado
+        await apply_sri_result(
+            db, doc["_id"], doc["tenant_id"], new_status,
+            autorizacion["numero_autorizacion"], autorizacion["fecha_autorizacion"], autorizacion["mensajes"]
+        )
+        return {
+            "doc_number": doc.get("doc_number"),
+            "old_status": old_status,
+            "new_status": new_status,
+            "authorization": autorizacion["numero_autorizacion"]
+        }
+
+    # Sin estado final (o error de red): reprogramar con backoff
+    attempts = doc.get("sri_sync_attempts", 0) + 1
+    now = _now()
+    await db.documents.update_one(
+        {"_id": doc["_id"]},
+        {"$set": {
+            "sri_sync_attempts": attempts,
+            "sri_last_sync_at": now,
+            "sri_next_sync_at": now + timedelta(seconds=next_sync_delay(attempts))
+        }}
+    )
+    return {"doc_number": doc.get("doc_number"), "old_status": old_status, "new_status": None}
+
+
+async def reconcile_pending(db, tenant_id: Optional[str] = None, force: bool = False,
+                            concurrency: int = SRI_SYNC_CONCURRENCY) -> Dict:
+    """
+    Reconcilia los documentos pendientes (de un tenant o de todos).
+    force=True ignora el backoff y la antigüedad mínima (sincronización manual).
+    """
+    now = _now()
+    base_query = _pending_query(now, force)
+    if tenant_id:
+        tenants = [tenant_id]
+    else:
+        tenants = await db.documents.distinct("tenant_id", base_query)
+
+    ambientes = {}
+    async for config in db.configs_fiscal.find({"tenant_id": {"$in": tenants}}, {"tenant_id": 1, "ambiente": 1}):
+        ambientes[config["tenant_id"]] = config.get("ambiente", "pruebas")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    last_ids = {t: None for t in tenants}
+    active = list(tenants)
+    synced = authorized = not_authorized = still_pending = 0
+    results: List[Dict] = []
+
+    while active:
+        # Una ronda: un lote por tenant, intercalados
+        batches = []
+        for t in list(active):
+            query = {**base_query, "tenant_id": t}
+            if last_ids[t] is not None:
+                query["_id"] = {"$gt": last_ids[t]}
+            docs = await db.documents.find(query, DOC_PROJECTION).sort("_id", 1).to_list(SRI_SYNC_TENANT_BATCH)
+            if len(docs) < SRI_SYNC_TENANT_BATCH:
+                active.remove(t)
+            if docs:
+                last_ids[t] = docs[-1]["_id"]
+                batches.append(docs)
+
+        round_docs = [doc for group in zip_longest(*batches) for doc in group if doc is not None]
+        outcomes = await asyncio.gather(
+            *[_reconcile_one(db, doc, ambientes.get(doc["tenant_id"], "pruebas"), semaphore) for doc in round_docs],
+            return_exceptions=True
+        )
+
+        for doc, outcome in zip(round_docs, outcomes):
+            synced += 1
+            if isinstance(outcome, Exception):
+                print(f"Error sincronizando {doc.get('doc_number')}: {outcome}")
+                still_pending += 1
+            elif outcome["new_status"] == "AUTORIZADO":
+                authorized += 1
+                results.append(outcome)
+            elif outcome["new_status"] == "NO_AUTORIZADO":
+                not_authorized += 1
+                results.append(outcome)
+            else:
+                still_pending += 1
+
+    return {
+        "synced": synced,
+        "authorized": authorized,
+        "not_authorized": not_authorized,
+        "still_pending": still_pending,
+        "tenants": len(tenants),
+        "results": results
+    }
+
+
+class SRIReconciler:
+    """Loop programado de reconciliación (un proceso a la vez vía lease en Mongo)"""
+
+    def __init__(self, interval: float = SRI_SYNC_INTERVAL):
+        self.interval = interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[Dict] = None
+
+    async def start(self, db):
+        self._task = asyncio.create_task(self._loop(db))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _acquire_lock(self, db) -> bool:
+        now = _now()
+        try:
+            await db.scheduler_locks.find_one_and_update(
+                {"_id": "sri_reconciler", "$or": [{"lease_until": {"$lt": now}}, {"owner": self.owner}]},
+                {"$set": {"owner": self.owner, "lease_until": now + timedelta(seconds=SRI_SYNC_LOCK_SECONDS)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # Otro proceso tiene el lease vigente
+            return False
+
+    async def _loop(self, db):
+        while True:
+            try:
+                await asyncio.sleep(self.interval)
+                if not await self._acquire_lock(db):
+                    continue
+                started = _now()
+                summary = await reconcile_pending(db)
+                summary.pop("results", None)
+                self.last_run = {**summary, "started_at": started.isoformat(), "finished_at": _now().isoformat()}
+                if summary["synced"]:
+                    print(f"🔄 Reconciliación SRI: {summary['synced']} consultados, "
+                          f"{summary['authorized']} autorizados, {summary['still_pending']} pendientes")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Error en reconciliación SRI: {e}")
+
+    def stats(self) -> Dict:
+        return {"interval_seconds": self.interval, "last_run": self.last_run}
+
+
+sri_reconciler = SRIReconciler()
@@ -0,0 +1,506 @@
+"""
+Etapa asíncrona de envío al SRI (recepción + autorización)
+
+create_invoice con mode=async deja el documento FIRMADO y encola un job en
+sri_jobs. Los workers envían el comprobante a recepción, consultan la
+autorización con su propia política de reintentos y, cuando el estado es
+final, notifican al POS (webhook del documento/tenant y stream SSE).
+
+El webhook solo se envía al webhook_url registrado en la configuración del
+emisor (https a un host público, se revalida al enviar) y va firmado con
+HMAC-SHA256 (X-FE-Signature sobre "<X-FE-Timestamp>.<body>", webhook_secret).
+La conexión va a la IP que se validó (Host y SNI del webhook): un DNS que
+cambia entre la validación y la conexión no lleva el POST a una red interna.
+
+Los jobs se reclaman con lease: si un proceso muere, otro retoma el job
+cuando vence el lease. Cada reclamo genera un claim_token y todas las
+escrituras del job filtran por él: un worker cuyo lease venció no pisa el
+estado que escribió quien lo reclamó después, y antes de guardar el resultado
+en el documento verifica (renovando el lease) que el job sigue siendo suyo.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlsplit
+
+import httpx
+from pymongo import ReturnDocument
+
+from services.sri_client import get_sri_client
+from services.events import EventRecorder, record_event
+from services.document_counts import document_counts
+from services.xml_archive import xml_archive
+from services.pipeline_metrics import StageTimer, SIGNER_NONE
+from utils.crypto import sign_webhook
+from utils.validators import resolve_webhook_url
+
+SRI_WORKERS = int(os.environ.get("SRI_WORKERS", "4"))
+SRI_JOB_LEASE_SECONDS = int(os.environ.get("SRI_JOB_LEASE_SECONDS", "120"))
+SRI_RECEPCION_MAX_ATTEMPTS = int(os.environ.get("SRI_RECEPCION_MAX_ATTEMPTS", "8"))
+SRI_AUTORIZACION_MAX_ATTEMPTS = int(os.environ.get("SRI_AUTORIZACION_MAX_ATTEMPTS", "10"))
+SRI_RETRY_BASE_DELAY = float(os.environ.get("SRI_RETRY_BASE_DELAY", "2"))
+SRI_RETRY_MAX_DELAY = float(os.environ.get("SRI_RETRY_MAX_DELAY", "300"))
+SRI_AUTORIZACION_FIRST_DELAY = 1.0  # el SRI tarda en tener lista la autorización
+SRI_WORKER_IDLE_SLEEP = 5.0
+WEBHOOK_TIMEOUT = float(os.environ.get("FE_WEBHOOK_TIMEOUT", "10"))
+
+# Identificador SRI para "CLAVE ACCESO REGISTRADA": el comprobante ya fue recibido
+# en un envío anterior (p.ej. timeout después de que el SRI lo aceptó)
+SRI_CLAVE_REGISTRADA = "43"
+
+JOB_PENDING = "pending"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+async def apply_sri_result(db, document_id: str, tenant_id: str, sri_status: str,
+                           auth_number: Optional[str], auth_date: Optional[datetime],
+                           sri_messages: List[Dict], recorder: Optional[EventRecorder] = None,
+                           metadata: Optional[Dict] = None):
+    """
+    Guarda el resultado del SRI en el documento y registra el evento.
+    `recorder` permite escribir en la misma pasada los eventos acumulados en la request.
+    `metadata` se agrega al evento (p.ej. tiempos por etapa de services.pipeline_metrics).
+    """
+    update_data = {
+        "sri_status": sri_status,
+        "sri_messages": sri_messages,
+        "updated_at": _now()
+    }
+    if auth_number:
+        update_data["sri_authorization_number"] = auth_number
+    if auth_date:
+        update_data["sri_authorization_date"] = auth_date
+
+    recorder = recorder or EventRecorder(document_id, tenant_id)
+    recorder.add(
+        sri_status,
+        "success" if sri_status == "AUTORIZADO" else "error",
+        f"Respuesta SRI: {sri_status}",
+        {"messages": sri_messages, **(metadata or {})}
+    )
+    await recorder.flush(db, {"$set": update_data})
+    # Los totales filtrados por sri_status cambian con cada resultado
+    document_counts.invalidate(tenant_id)
+
+
+def _owned(job: dict) -> dict:
+    """Filtro de las escrituras de un job: solo mientras siga siendo de quien lo reclamó"""
+    return {"_id": job["_id"], "claim_token": job["claim_token"]}
+
+
+def _pinned_url(parts, address: str) -> str:
+    """URL del webhook apuntando a una dirección ya validada (sin nueva resolución DNS)"""
+    host = f"[{address}]" if ":" in address else address
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    return parts._replace(netloc=host).geturl()
+
+
+class StatusBroker:
+    """
+    Pub/sub en memoria de cambios de estado por tenant (stream SSE).
+    Solo ve los eventos de los workers de este proceso; el webhook es el
+    canal confiable cuando hay varias réplicas.
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, tenant_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        self._subscribers.setdefault(tenant_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, tenant_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(tenant_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[tenant_id]
+
+    def publish(self, tenant_id: str, payload: dict):
+        for queue in self._subscribers.get(tenant_id, ()):
+            if queue.full():
+                # Cliente lento: se descarta el evento más viejo
+                queue.get_nowait()
+            queue.put_nowait(payload)
+
+
+status_broker = StatusBroker()
+
+
+class SRIWorker:
+    """Workers que procesan sri_jobs (etapas recepcion -> autorizacion)"""
+
+    def __init__(self, workers: int = SRI_WORKERS):
+        self.workers = workers
+        self._db = None
+        self._tasks: List[asyncio.Task] = []
+        self._wake = asyncio.Event()
+        self._http: Optional[httpx.AsyncClient] = None
+
+    async def start(self, db):
+        self._db = db
+        self._tasks = [asyncio.create_task(self._loop(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def wake(self):
+        self._wake.set()
+
+    async def enqueue(self, db, document: dict, ambiente: str, callback_url: Optional[str] = None):
+        """Encola el envío al SRI de un documento ya firmado"""
+        await self.enqueue_many(db, [document], ambiente, callback_url)
+
+    async def enqueue_many(self, db, documents: List[dict], ambiente: str, callback_url: Optional[str] = None,
+                           hold: bool = False):
+        """
+        Encola varios documentos firmados con un solo insert.
+        Con hold=True el worker no los toma hasta dentro de SRI_JOB_LEASE_SECONDS:
+        quien encola los envía él mismo reclamando cada uno con claim() justo
+        antes de enviarlo. Lo que no llegue a reclamar (proceso caído, cliente
+        desconectado sin release_held()) lo toma el worker al vencer la espera.
+        """
+        if not documents:
+            return
+        await db.sri_jobs.insert_many([self._job(document, ambiente, callback_url, hold) for document in documents])
+        if not hold:
+            self.wake()
+
+    async def claim(self, db, document_id: str) -> Optional[dict]:
+        """
+        Reclama (lease de SRI_JOB_LEASE_SECONDS) el job pendiente de un documento
+        encolado con hold=True. None si el worker ya lo tomó.
+        """
+        now = _now()
+        return await db.sri_jobs.find_one_and_update(
+            {"document_id": document_id, "stage": "recepcion", "status": JOB_PENDING},
+            {
+                "$set": {
+                    "status": JOB_PROCESSING,
+                    "lease_until": now + timedelta(seconds=SRI_JOB_LEASE_SECONDS),
+                    "claim_token": uuid.uuid4().hex,
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def renew(self, db, job: dict) -> bool:
+        """Extiende el lease de un job reclamado; False si otro ya lo reclamó"""
+        now = _now()
+        result = await db.sri_jobs.update_one(
+            _owned(job),
+            {"$set": {"lease_until": now + timedelta(seconds=SRI_JOB_LEASE_SECONDS), "updated_at": now}}
+        )
+        return result.matched_count > 0
+
+    async def complete(self, db, job: dict, sri_status: str):
+        """Cierra un job reclamado con claim() tras enviarlo"""
+        await db.sri_jobs.update_one(
+            _owned(job),
+            {"$set": {"status": JOB_DONE, "result": sri_status, "lease_until": None, "updated_at": _now()}}
+        )
+
+    async def release(self, db, job: dict):
+        """Devuelve al worker un job reclamado cuyo envío no terminó"""
+        now = _now()
+        await db.sri_jobs.update_one(
+            _owned(job),
+            {"$set": {"status": JOB_PENDING, "next_attempt_at": now, "lease_until": None, "updated_at": now}}
+        )
+        self.wake()
+
+    async def release_held(self, db, document_ids: List[str]):
+        """Entrega ya al worker los jobs encolados con hold=True que nadie reclamó"""
+        if not document_ids:
+            return
+        await db.sri_jobs.update_many(
+            {"document_id": {"$in": document_ids}, "stage": "recepcion", "status": JOB_PENDING},
+            {"$set": {"next_attempt_at": _now()}}
+        )
+        self.wake()
+
+    @staticmethod
+    def _job(document: dict, ambiente: str, callback_url: Optional[str], hold: bool = False) -> dict:
+        now = _now()
+        return {
+            "_id": str(uuid.uuid4()),
+            "document_id": document["_id"],
+            "tenant_id": document["tenant_id"],
+            "doc_number": document["doc_number"],
+            "access_key": document["access_key"],
+            "ambiente": ambiente,
+            "callback_url": callback_url,
+            "signer": document.get("signer", SIGNER_NONE),
+            "stage": "recepcion",
+            "status": JOB_PENDING,
+            "attempts": 0,
+            "next_attempt_at": now + timedelta(seconds=SRI_JOB_LEASE_SECONDS) if hold else now,
+            "lease_until": None,
+            "claim_token": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+
+    async def _claim(self) -> Optional[dict]:
+        now = _now()
+        return await self._db.sri_jobs.find_one_and_update(
+            {"$or": [
+                {"status": JOB_PENDING, "next_attempt_at": {"$lte": now}},
+                {"status": JOB_PROCESSING, "lease_until": {"$lt": now}}
+            ]},
+            {
+                "$set": {
+                    "status": JOB_PROCESSING,
+                    "lease_until": now + timedelta(seconds=SRI_JOB_LEASE_SECONDS),
+                    "claim_token": uuid.uuid4().hex,
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _loop(self, worker_id: int):
+        while True:
+            try:
+                job = await self._claim()
+                if job is None:
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=SRI_WORKER_IDLE_SLEEP)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ [SRI worker {worker_id}] Error: {e}")
+                await asyncio.sleep(SRI_WORKER_IDLE_SLEEP)
+
+    async def _process(self, job: dict):
+        try:
+            if job["stage"] == "recepcion":
+                await self._recepcion(job)
+            else:
+                await self._autorizacion(job)
+        except Exception as e:
+            messages = [{"mensaje": f"Error interno: {str(e)}"}]
+            if job["stage"] == "recepcion":
+                # Un documento FIRMADO no lo retoma la reconciliación: al agotar queda ERROR
+                await self._retry(job, messages, max_attempts=SRI_RECEPCION_MAX_ATTEMPTS, final_status="ERROR")
+            else:
+                await self._retry(job, messages, max_attempts=SRI_AUTORIZACION_MAX_ATTEMPTS)
+
+    async def _recepcion(self, job: dict):
+        db = self._db
+        xml_doc = await db.document_xml.find_one({"document_id": job["document_id"]})
+        if xml_doc is None:
+            await self._finish(job, "ERROR", None, None, [{"mensaje": "XML firmado no encontrado"}])
+            return
+        xml_signed = await xml_archive.decode(db, xml_doc)
+
+        timer = self._timer(job)
+        with timer.stage("reception"):
+            recepcion = await get_sri_client(job["ambiente"]).enviar_comprobante(xml_signed)
+        estado = recepcion["estado"]
+        ya_registrada = estado == "DEVUELTA" and any(
+            m.get("identificador") == SRI_CLAVE_REGISTRADA for m in recepcion["mensajes"]
+        )
+
+        if estado == "RECIBIDA" or ya_registrada:
+            # Renovar antes de marcar EN_PROCESO: un worker sin lease no pisa el estado del documento
+            if not await self.renew(db, job):
+                print(f"⚠️ [SRI worker] {job['doc_number']}: lease perdido, otro worker retomó el job")
+                return
+            now = _now()
+            timer.observe()
+            await record_event(
+                db, job["document_id"], job["tenant_id"], "RECIBIDO", "success",
+                "Comprobante recibido por el SRI", {"messages": recepcion["mensajes"], **timer.as_metadata()},
+                update={"$set": {"sri_status": "EN_PROCESO", "updated_at": now}}
+            )
+            document_counts.invalidate(job["tenant_id"])
+            if await self._update(job, {"$set": {
+                "stage": "autorizacion",
+                "status": JOB_PENDING,
+                "attempts": 0,
+                "next_attempt_at": now + timedelta(seconds=SRI_AUTORIZACION_FIRST_DELAY),
+                "received_at": now,
+                "lease_until": None,
+                "updated_at": now
+            }}):
+                self.wake()
+        elif estado == "DEVUELTA":
+            await self._finish(job, "RECHAZADO", None, None, recepcion["mensajes"])
+        else:
+            await self._retry(job, recepcion["mensajes"], max_attempts=SRI_RECEPCION_MAX_ATTEMPTS,
+                              final_status="ERROR")
+
+    async def _autorizacion(self, job: dict):
+        autorizacion = await get_sri_client(job["ambiente"]).consultar_autorizacion(job["access_key"])
+        estado = autorizacion["estado"]
+
+        if estado in ("AUTORIZADO", "NO_AUTORIZADO"):
+            # Autorización: desde la recepción hasta la respuesta final (esperas incluidas)
+            timer = self._timer(job)
+            received_at = job.get("received_at")
+            if received_at is not None:
+                if received_at.tzinfo is None:
+                    received_at = received_at.replace(tzinfo=timezone.utc)
+                timer.add("authorization", (_now() - received_at).total_seconds() * 1000)
+                timer.observe()
+            if estado == "AUTORIZADO":
+                await self._finish(job, "AUTORIZADO", autorizacion["numero_autorizacion"],
+                                   autorizacion["fecha_autorizacion"], autorizacion["mensajes"], timer.as_metadata())
+            else:
+                await self._finish(job, "NO_AUTORIZADO", None, None, autorizacion["mensajes"], timer.as_metadata())
+        else:
+            # EN_PROCESO o error de red: reintentar; al agotar queda EN_PROCESO para sync-pending
+            await self._retry(job, autorizacion["mensajes"], max_attempts=SRI_AUTORIZACION_MAX_ATTEMPTS)
+
+    async def _retry(self, job: dict, messages: List[Dict], max_attempts: int = SRI_RECEPCION_MAX_ATTEMPTS,
+                     final_status: Optional[str] = None):
+        now = _now()
+        if job["attempts"] >= max_attempts:
+            if not await self._update(job, {"$set": {
+                "status": JOB_FAILED, "last_error": messages, "lease_until": None, "updated_at": now
+            }}):
+                return
+            if final_status:
+                await apply_sri_result(self._db, job["document_id"], job["tenant_id"], final_status, None, None, messages)
+                await self._notify(job, final_status, None, messages)
+            print(f"⚠️ [SRI worker] {job['doc_number']}: {job['stage']} agotó {max_attempts} intentos")
+            return
+
+        delay = min(SRI_RETRY_BASE_DELAY * (2 ** (job["attempts"] - 1)), SRI_RETRY_MAX_DELAY)
+        delay *= random.uniform(0.8, 1.2)
+        await self._update(job, {"$set": {
+            "status": JOB_PENDING,
+            "next_attempt_at": now + timedelta(seconds=delay),
+            "last_error": messages,
+            "lease_until": None,
+            "updated_at": now
+        }})
+
+    async def _update(self, job: dict, update: dict) -> bool:
+        """Escritura del job reclamado; False si su lease venció y otro worker lo tomó"""
+        result = await self._db.sri_jobs.update_one(_owned(job), update)
+        if result.matched_count == 0:
+            print(f"⚠️ [SRI worker] {job['doc_number']}: lease perdido, otro worker retomó el job")
+            return False
+        return True
+
+    @staticmethod
+    def _timer(job: dict) -> StageTimer:
+        timer = StageTimer(job["tenant_id"], job["ambiente"])
+        timer.signer = job.get("signer", SIGNER_NONE)
+        return timer
+
+    async def _finish(self, job: dict, sri_status: str, auth_number: Optional[str],
+                      auth_date: Optional[datetime], messages: List[Dict], metadata: Optional[Dict] = None):
+        # Renovar antes de escribir el documento: si el lease venció, el resultado lo guarda el nuevo dueño
+        if not await self.renew(self._db, job):
+            print(f"⚠️ [SRI worker] {job['doc_number']}: lease perdido, otro worker retomó el job")
+            return
+        await apply_sri_result(self._db, job["document_id"], job["tenant_id"], sri_status, auth_number, auth_date,
+                               messages, metadata=metadata)
+        if not await self._update(job, {"$set": {
+            "status": JOB_DONE, "result": sri_status, "lease_until": None, "updated_at": _now()
+        }}):
+            return
+        print(f"[SRI worker] {job['doc_number']}: {sri_status}")
+        await self._notify(job, sri_status, auth_number, messages)
+
+    async def _notify(self, job: dict, sri_status: str, auth_number: Optional[str], messages: List[Dict]):
+        payload = {
+            "event": "document.status",
+            "document_id": job["document_id"],
+            "doc_number": job["doc_number"],
+            "access_key": job["access_key"],
+            "sri_status": sri_status,
+            "sri_authorization_number": auth_number,
+            "sri_messages": messages
+        }
+        status_broker.publish(job["tenant_id"], payload)
+
+        callback_url = job.get("callback_url")
+        if not callback_url:
+            return
+        config = await self._db.configs_fiscal.find_one(
+            {"tenant_id": job["tenant_id"]}, {"webhook_url": 1, "webhook_secret": 1}
+        ) or {}
+        # Jobs encolados con otra URL o webhook cambiado/quitado desde entonces
+        if callback_url != config.get("webhook_url"):
+            ok, message = False, "Webhook no enviado: callback_url no coincide con el webhook registrado"
+        elif not config.get("webhook_secret"):
+            ok, message = False, "Webhook no enviado: sin webhook_secret (guarde de nuevo la configuración del emisor)"
+        else:
+            # Revalidar al enviar: el DNS del host pudo cambiar a una IP interna
+            ok, message, addresses = await asyncio.to_thread(resolve_webhook_url, callback_url)
+            if not ok:
+                message = f"Webhook no enviado: {message}"
+        if ok:
+            if self._http is None:
+                self._http = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT, follow_redirects=False)
+            body = json.dumps(payload, default=str).encode("utf-8")
+            timestamp = str(int(time.time()))
+            try:
+                parts = urlsplit(callback_url)
+                response = await self._http.post(
+                    _pinned_url(parts, addresses[0]),
+                    content=body,
+                    headers={
+                        "Host": parts.netloc,
+                        "Content-Type": "application/json",
+                        "X-FE-Timestamp": timestamp,
+                        "X-FE-Signature": sign_webhook(config["webhook_secret"], timestamp, body)
+                    },
+                    # El certificado TLS se valida contra el host del webhook, no contra la IP
+                    extensions={"sni_hostname": parts.hostname}
+                )
+                ok = response.status_code < 400
+                message = f"Webhook {response.status_code}"
+            except httpx.HTTPError as e:
+                ok = False
+                message = f"Webhook falló: {str(e)[:200]}"
+        await record_event(
+            self._db, job["document_id"], job["tenant_id"], "NOTIFICADO",
+            "success" if ok else "error", message, {"callback_url": job["callback_url"]}
+        )
+
+    async def stats(self) -> dict:
+        counts = {}
+        async for row in self._db.sri_jobs.aggregate([
+            {"$match": {"status": {"$in": [JOB_PENDING, JOB_PROCESSING, JOB_FAILED]}}},
+            {"$group": {"_id": {"status": "$status", "stage": "$stage"}, "count": {"$sum": 1}}}
+        ]):
+            counts[f"{row['_id']['stage']}.{row['_id']['status']}"] = row["count"]
+        return {"workers": self.workers, "jobs": counts}
+
+
+sri_worker = SRIWorker()
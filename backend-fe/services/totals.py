@@ -0,0 +1,162 @@
+"""
+Motor de totales de documentos electrónicos
+
+Calcula en una sola pasada con aritmética entera exacta:
+- cantidad y precio unitario en millonésimas (6 decimales, como en el XML)
+- montos en centavos, redondeo half-up (el del SRI) en cada línea
+- tarifa de IVA en centésimas de punto (15% -> 1500)
+
+Reglas SRI:
+- precioTotalSinImpuesto de la línea = redondear(cantidad * precio) - descuento
+- valor de IVA de la línea = redondear(base de la línea * tarifa)
+- totalImpuesto por código de tarifa: baseImponible = suma de las bases de sus
+  líneas y valor = redondear(baseImponible * tarifa)
+
+No se usa float en ningún paso intermedio: los float de entrada se leen por su
+representación decimal (Decimal(repr(x))), así 1.005 es 1.005 y no 1.00499...
+"""
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Optional, Tuple
+
+# Tabla 17 de la ficha técnica SRI: código de tarifa de IVA por porcentaje
+IVA_RATE_CODES = {
+    0: "0",
+    5: "5",
+    8: "8",     # Tarifa diferenciada (feriados turísticos)
+    12: "2",
+    13: "10",
+    14: "3",
+    15: "4",
+}
+IVA_CODE_NOT_SUBJECT = "6"  # No objeto de impuesto
+IVA_CODE_EXEMPT = "7"       # Exento de IVA
+KNOWN_IVA_CODES = set(IVA_RATE_CODES.values()) | {IVA_CODE_NOT_SUBJECT, IVA_CODE_EXEMPT}
+
+QUANTITY_UNITS = 10 ** 6
+RATE_UNITS = 100 * 100  # porcentaje con 2 decimales, en tanto por uno
+
+_units_cache: Dict[Tuple[float, int], int] = {}
+
+
+def _to_units(value, digits: int) -> int:
+    """Valor decimal exacto escalado a entero (half-up al último dígito)"""
+    if isinstance(value, int):
+        return value * 10 ** digits
+    key = (value, digits)
+    units = _units_cache.get(key)
+    if units is None:
+        units = int(Decimal(repr(value)).scaleb(digits).to_integral_value(rounding=ROUND_HALF_UP))
+        if len(_units_cache) < 4096:
+            _units_cache[key] = units
+    return units
+
+
+def _round_div(numerator: int, denominator: int) -> int:
+    """numerator / denominator redondeado half-up (alejándose de cero)"""
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if 2 * remainder >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def _cents(value: int) -> float:
+    return value / 100
+
+
+def iva_code_for(rate_bp: int, explicit_code: Optional[str] = None) -> str:
+    """Código SRI de la tarifa (rate_bp: porcentaje * 100)"""
+    if explicit_code:
+        if explicit_code not in KNOWN_IVA_CODES:
+            raise ValueError(f"Código de tarifa de IVA desconocido: {explicit_code}")
+        return explicit_code
+    if rate_bp % 100 == 0 and rate_bp // 100 in IVA_RATE_CODES:
+        return IVA_RATE_CODES[rate_bp // 100]
+    raise ValueError(f"Tarifa de IVA no soportada por el SRI: {rate_bp / 100}%")
+
+
+def calculate_totals(items: list, iva_default: float = 15) -> Tuple[dict, List[dict]]:
+    """
+    Calcula totales a partir de items
+    Retorna (totales, items procesados); totals["iva_breakdown"] trae un
+    totalImpuesto por código de tarifa.
+    """
+    default_bp = _to_units(iva_default, 2)
+    buckets: Dict[str, list] = {}  # código -> [tarifa_bp, base_centavos]
+    total_discount = 0
+    processed_items = []
+    append = processed_items.append
+
+    for i, item in enumerate(items):
+        quantity = float(item.quantity)
+        unit_price = float(item.unit_price)
+        discount = float(item.discount) if item.discount else 0
+        explicit_code = getattr(item, "iva_code", None)
+        if explicit_code in (IVA_CODE_NOT_SUBJECT, IVA_CODE_EXEMPT):
+            rate_bp = 0
+        else:
+            rate_bp = _to_units(float(item.iva_rate), 2) if item.iva_rate is not None else default_bp
+        code = iva_code_for(rate_bp, explicit_code)
+
+        gross = _round_div(_to_units(quantity, 6) * _to_units(unit_price, 6), QUANTITY_UNITS * QUANTITY_UNITS // 100)
+        discount_cents = _to_units(discount, 2)
+        base = gross - discount_cents
+        iva = _round_div(base * rate_bp, RATE_UNITS)
+
+        bucket = buckets.get(code)
+        if bucket is None:
+            buckets[code] = [rate_bp, base]
+        else:
+            bucket[1] += base
+        total_discount += discount_cents
+
+        append({
+            "sequence": i + 1,
+            "code": item.code,
+            "auxiliary_code": item.auxiliary_code,
+            "description": item.description,
+            "quantity": quantity,
+            "unit_price": unit_price,
+            "discount": discount,
+            "subtotal_before_discount": _cents(gross),
+            "subtotal": _cents(base),
+            "iva_rate": rate_bp / 100,
+            "iva_code": code,
+            "iva_amount": _cents(iva),
+            "total": _cents(base + iva)
+        })
+
+    breakdown = []
+    subtotal = total_iva = 0
+    by_code: Dict[str, Tuple[int, int]] = {}
+    # Mismo orden que el XML anterior: 0%, 12%, 15% (por tarifa, luego código)
+    for code, (rate_bp, base) in sorted(buckets.items(), key=lambda entry: (entry[1][0], int(entry[0]))):
+        value = _round_div(base * rate_bp, RATE_UNITS)
+        by_code[code] = (base, value)
+        subtotal += base
+        total_iva += value
+        breakdown.append({"code": code, "rate": rate_bp / 100, "base": _cents(base), "value": _cents(value)})
+
+    def base_of(code: str) -> float:
+        return _cents(by_code.get(code, (0, 0))[0])
+
+    def value_of(code: str) -> float:
+        return _cents(by_code.get(code, (0, 0))[1])
+
+    totals = {
+        "subtotal_0": base_of("0"),
+        "subtotal_12": base_of("2"),
+        "subtotal_15": base_of("4"),
+        "subtotal_not_subject": base_of(IVA_CODE_NOT_SUBJECT),
+        "subtotal_exempt": base_of(IVA_CODE_EXEMPT),
+        "subtotal": _cents(subtotal),
+        "total_discount": _cents(total_discount),
+        "total_iva_0": 0.0,
+        "total_iva_12": value_of("2"),
+        "total_iva_15": value_of("4"),
+        "total_iva": _cents(total_iva),
+        "iva_breakdown": breakdown,
+        "propina": 0.0,
+        "total": _cents(subtotal + total_iva)
+    }
+
+    return totals, processed_items
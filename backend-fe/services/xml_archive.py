@@ -0,0 +1,338 @@
+"""
+Archivo compacto de XML firmados (document_xml)
+
+Los XML de un mismo tenant comparten la mayor parte de sus bytes (bloque del
+emisor, estructura de la firma, certificado). Con zstd y un diccionario
+entrenado por tenant cada documento ocupa una fracción de lo que ocupa con
+gzip independiente.
+
+Formatos de fila en document_xml (se leen todos, se escribe el configurado):
+- codec "zstd": xml_data (zstd, con o sin diccionario) + dict_id
+- codec "gzip" / filas antiguas sin codec: xml_gzip (gzip.compress)
+- sin comprimir: xml_signed (texto)
+
+Los diccionarios viven en xml_dictionaries ({tenant_id}:{version}) y son
+inmutables: una fila siempre se puede leer con el diccionario que la comprimió.
+El job de compactación (python -m services.xml_archive compact) entrena un
+diccionario nuevo, recomprime las filas del tenant y borra los diccionarios
+que ya no usa ninguna fila. Un diccionario reemplazado se sigue usando para
+escribir durante XML_DICT_CACHE_TTL en los procesos que lo tienen cacheado como
+vigente, así que solo se borra cuando el vigente tiene más de
+XML_DICT_RETIRE_AFTER segundos (bastante más que el TTL) y, justo antes de
+borrarlo, se vuelve a comprobar que ninguna fila lo usa.
+"""
+import os
+import gzip
+import zlib
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional: sin la librería se archiva con gzip
+    zstandard = None
+
+XML_ARCHIVE_CODEC = os.environ.get("XML_ARCHIVE_CODEC", "zstd")
+XML_ZSTD_LEVEL = int(os.environ.get("XML_ZSTD_LEVEL", "9"))
+XML_DICT_SIZE = int(os.environ.get("XML_DICT_SIZE", str(32 * 1024)))
+XML_DICT_MIN_SAMPLES = int(os.environ.get("XML_DICT_MIN_SAMPLES", "100"))
+XML_DICT_MAX_SAMPLES = int(os.environ.get("XML_DICT_MAX_SAMPLES", "2000"))
+XML_DICT_CACHE_TTL = float(os.environ.get("XML_DICT_CACHE_TTL", "300"))
+# Tiempo mínimo desde que un diccionario dejó de ser el vigente antes de poder borrarlo
+XML_DICT_RETIRE_AFTER = max(
+    float(os.environ.get("XML_DICT_RETIRE_AFTER", "3600")), XML_DICT_CACHE_TTL * 4
+)
+XML_CHUNK_SIZE = 64 * 1024
+
+CODEC_ZSTD = "zstd"
+CODEC_GZIP = "gzip"
+CODEC_PLAIN = "plain"
+
+# Campos de contenido que reemplaza la recompresión
+CONTENT_FIELDS = ("xml_data", "xml_gzip", "xml_signed", "dict_id", "codec")
+
+
+class ArchiveDictionary:
+    """Diccionario zstd de un tenant con su compresor y descompresor listos"""
+
+    def __init__(self, dict_id: str, data: bytes):
+        self.dict_id = dict_id
+        self.data = data
+        zdict = zstandard.ZstdCompressionDict(data)
+        self.compressor = zstandard.ZstdCompressor(level=XML_ZSTD_LEVEL, dict_data=zdict)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+
+
+_plain_zstd: Dict[str, object] = {}
+
+
+def _zstd_compressor():
+    if "c" not in _plain_zstd:
+        _plain_zstd["c"] = zstandard.ZstdCompressor(level=XML_ZSTD_LEVEL)
+    return _plain_zstd["c"]
+
+
+def _zstd_decompressor():
+    if "d" not in _plain_zstd:
+        _plain_zstd["d"] = zstandard.ZstdDecompressor()
+    return _plain_zstd["d"]
+
+
+def row_codec(xml_doc: dict) -> str:
+    if xml_doc.get("codec"):
+        return xml_doc["codec"]
+    return CODEC_GZIP if xml_doc.get("is_compressed") and xml_doc.get("xml_gzip") else CODEC_PLAIN
+
+
+def encode_xml(xml: bytes, dictionary: Optional[ArchiveDictionary] = None,
+               codec: str = XML_ARCHIVE_CODEC) -> dict:
+    """Campos de contenido de una fila de document_xml para `xml`"""
+    if codec == CODEC_ZSTD and zstandard is not None:
+        compressor = dictionary.compressor if dictionary is not None else _zstd_compressor()
+        return {
+            "codec": CODEC_ZSTD,
+            "xml_data": compressor.compress(xml),
+            "dict_id": dictionary.dict_id if dictionary is not None else None,
+            "is_compressed": True,
+            "size_bytes": len(xml)
+        }
+    return {
+        "codec": CODEC_GZIP,
+        "xml_gzip": gzip.compress(xml),
+        "is_compressed": True,
+        "size_bytes": len(xml)
+    }
+
+
+def iter_xml_chunks(xml_doc: dict, dictionary: Optional[ArchiveDictionary] = None,
+                    chunk_size: int = XML_CHUNK_SIZE) -> Iterator[bytes]:
+    """XML de la fila por bloques, descomprimiendo de forma incremental"""
+    codec = row_codec(xml_doc)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("XML archivado con zstd pero la librería zstandard no está instalada")
+        if xml_doc.get("dict_id") and dictionary is None:
+            raise LookupError(f"Diccionario {xml_doc['dict_id']} no cargado")
+        compressed = xml_doc["xml_data"]
+        decompressor = (dictionary.decompressor if dictionary is not None else _zstd_decompressor()).decompressobj()
+    elif codec == CODEC_GZIP:
+        compressed = xml_doc["xml_gzip"]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        if xml_doc.get("xml_signed"):
+            yield xml_doc["xml_signed"].encode("utf-8")
+        return
+
+    for start in range(0, len(compressed), chunk_size):
+        chunk = decompressor.decompress(compressed[start:start + chunk_size])
+        if chunk:
+            yield chunk
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def decode_xml(xml_doc: dict, dictionary: Optional[ArchiveDictionary] = None) -> bytes:
+    return b"".join(iter_xml_chunks(xml_doc, dictionary))
+
+
+def stored_size(xml_doc: dict) -> int:
+    for field in ("xml_data", "xml_gzip"):
+        if xml_doc.get(field):
+            return len(xml_doc[field])
+    return len((xml_doc.get("xml_signed") or "").encode("utf-8"))
+
+
+def train_dictionary_bytes(samples: List[bytes], dict_size: int = XML_DICT_SIZE) -> bytes:
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+class XMLArchive:
+    """Codec de document_xml con diccionarios por tenant cacheados en memoria"""
+
+    def __init__(self):
+        self._dictionaries: Dict[str, ArchiveDictionary] = {}
+        self._current: Dict[str, Tuple[float, Optional[str]]] = {}
+
+    async def dictionary(self, db, dict_id: Optional[str]) -> Optional[ArchiveDictionary]:
+        if not dict_id:
+            return None
+        dictionary = self._dictionaries.get(dict_id)
+        if dictionary is None:
+            row = await db.xml_dictionaries.find_one({"_id": dict_id})
+            if row is None:
+                raise LookupError(f"Diccionario {dict_id} no encontrado")
+            dictionary = ArchiveDictionary(dict_id, row["dict_data"])
+            self._dictionaries[dict_id] = dictionary
+        return dictionary
+
+    async def current_dictionary(self, db, tenant_id: str) -> Optional[ArchiveDictionary]:
+        if zstandard is None or XML_ARCHIVE_CODEC != CODEC_ZSTD:
+            return None
+        cached = self._current.get(tenant_id)
+        if cached is None or time.monotonic() - cached[0] > XML_DICT_CACHE_TTL:
+            row = await db.xml_dictionaries.find_one(
+                {"tenant_id": tenant_id}, {"_id": 1}, sort=[("version", -1)]
+            )
+            cached = (time.monotonic(), row["_id"] if row else None)
+            self._current[tenant_id] = cached
+        return await self.dictionary(db, cached[1])
+
+    async def encode(self, db, tenant_id: str, xml: bytes) -> dict:
+        """Campos de contenido para guardar un XML nuevo del tenant"""
+        return encode_xml(xml, await self.current_dictionary(db, tenant_id))
+
+    async def prepare(self, db, xml_doc: dict) -> Optional[ArchiveDictionary]:
+        """Diccionario necesario para leer la fila (para iter_xml_chunks)"""
+        if row_codec(xml_doc) != CODEC_ZSTD:
+            return None
+        return await self.dictionary(db, xml_doc.get("dict_id"))
+
+    async def decode(self, db, xml_doc: dict) -> bytes:
+        return decode_xml(xml_doc, await self.prepare(db, xml_doc))
+
+    async def train(self, db, tenant_id: str) -> Optional[str]:
+        """Entrena un diccionario con los XML más recientes del tenant"""
+        if zstandard is None:
+            return None
+        samples = []
+        cursor = db.document_xml.find({"tenant_id": tenant_id}).sort("created_at", -1).limit(XML_DICT_MAX_SAMPLES)
+        async for xml_doc in cursor:
+            samples.append(await self.decode(db, xml_doc))
+        if len(samples) < XML_DICT_MIN_SAMPLES:
+            return None
+
+        last = await db.xml_dictionaries.find_one({"tenant_id": tenant_id}, {"version": 1}, sort=[("version", -1)])
+        version = (last["version"] + 1) if last else 1
+        dict_id = f"{tenant_id}:{version}"
+        data = train_dictionary_bytes(samples)
+        await db.xml_dictionaries.insert_one({
+            "_id": dict_id,
+            "tenant_id": tenant_id,
+            "version": version,
+            "dict_data": data,
+            "samples": len(samples),
+            "created_at": datetime.now(timezone.utc)
+        })
+        self._dictionaries[dict_id] = ArchiveDictionary(dict_id, data)
+        self._current[tenant_id] = (time.monotonic(), dict_id)
+        return dict_id
+
+    async def compact_tenant(self, db, tenant_id: str, train: bool = True, batch_size: int = 500) -> dict:
+        """Recomprime las filas del tenant con el diccionario vigente"""
+        dict_id = await self.train(db, tenant_id) if train else None
+        dictionary = await self.dictionary(db, dict_id) if dict_id else await self.current_dictionary(db, tenant_id)
+        target_dict_id = dictionary.dict_id if dictionary is not None else None
+        target_codec = CODEC_ZSTD if zstandard is not None and XML_ARCHIVE_CODEC == CODEC_ZSTD else CODEC_GZIP
+
+        rows = bytes_before = bytes_after = 0
+        last_id = None
+        while True:
+            query = {"tenant_id": tenant_id}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = await db.document_xml.find(query).sort("_id", 1).to_list(batch_size)
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+
+            ops = []
+            for xml_doc in batch:
+                if row_codec(xml_doc) == target_codec and xml_doc.get("dict_id") == target_dict_id:
+                    continue
+                fields = encode_xml(await self.decode(db, xml_doc), dictionary)
+                unset = {f: "" for f in CONTENT_FIELDS if f not in fields and f in xml_doc}
+                update = {"$set": fields}
+                if unset:
+                    update["$unset"] = unset
+                ops.append(UpdateOne({"_id": xml_doc["_id"]}, update))
+                rows += 1
+                bytes_before += stored_size(xml_doc)
+                bytes_after += stored_size(fields)
+            if ops:
+                await db.document_xml.bulk_write(ops, ordered=False)
+
+        removed = await self._remove_retired(db, tenant_id, target_dict_id)
+
+        return {
+            "tenant_id": tenant_id,
+            "dict_id": target_dict_id,
+            "rows_rewritten": rows,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "dictionaries_removed": removed
+        }
+
+    async def _remove_retired(self, db, tenant_id: str, target_dict_id: Optional[str]) -> int:
+        """
+        Borra los diccionarios anteriores al vigente que ya no usa ninguna fila,
+        solo si el vigente existe desde hace XML_DICT_RETIRE_AFTER: antes de eso
+        otros procesos pueden seguir escribiendo filas con el anterior (caché de
+        XML_DICT_CACHE_TTL) aunque la recompresión ya las haya migrado.
+        """
+        if target_dict_id is None:
+            return 0
+        target = await db.xml_dictionaries.find_one({"_id": target_dict_id}, {"version": 1, "created_at": 1})
+        if target is None:
+            return 0
+        created_at = target["created_at"]
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        if datetime.now(timezone.utc) - created_at < timedelta(seconds=XML_DICT_RETIRE_AFTER):
+            return 0
+
+        removed = 0
+        retired = db.xml_dictionaries.find(
+            {"tenant_id": tenant_id, "version": {"$lt": target["version"]}}, {"_id": 1}
+        )
+        async for row in retired:
+            # Re-chequeo inmediatamente antes de borrar
+            if await db.document_xml.count_documents({"dict_id": row["_id"]}, limit=1) == 0:
+                await db.xml_dictionaries.delete_one({"_id": row["_id"]})
+                self._dictionaries.pop(row["_id"], None)
+                removed += 1
+        return removed
+
+    async def compact(self, db, tenant_id: Optional[str] = None, train: bool = True) -> List[dict]:
+        tenants = [tenant_id] if tenant_id else await db.document_xml.distinct("tenant_id")
+        return [await self.compact_tenant(db, t, train=train) for t in tenants]
+
+
+xml_archive = XMLArchive()
+
+
+async def _main():
+    import argparse
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Compactación del archivo de XML firmados")
+    parser.add_argument("command", choices=["compact", "train"])
+    parser.add_argument("--tenant", help="tenant_id (por defecto todos)")
+    parser.add_argument("--no-train", action="store_true", help="recomprimir con el diccionario vigente")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db = client[os.environ.get("DB_NAME", "fe_db")]
+    try:
+        if args.command == "train":
+            tenants = [args.tenant] if args.tenant else await db.document_xml.distinct("tenant_id")
+            for t in tenants:
+                dict_id = await xml_archive.train(db, t)
+                print(f"{t}: {dict_id or 'sin muestras suficientes'}")
+        else:
+            for summary in await xml_archive.compact(db, args.tenant, train=not args.no_train):
+                saved = summary["bytes_before"] - summary["bytes_after"]
+                print(f"{summary['tenant_id']}: {summary['rows_rewritten']} filas recomprimidas, "
+                      f"{saved} bytes ahorrados (diccionario {summary['dict_id']})")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+    asyncio.run(_main())
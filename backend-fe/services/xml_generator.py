@@ -3,15 +3,18 @@ Generador de XML para Documentos Electrónicos SRI Ecuador
 Soporta: Facturas (01), Notas de Crédito (04)
 Versión XML: 2.1.0
 """
-from lxml import etree
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Dict, Optional
 import re
 
 # Mapeo de tarifas IVA a códigos SRI
 IVA_CODES = {
     0: "0",      # 0%
+    5: "5",      # 5%
+    8: "8",      # 8% (tarifa diferenciada)
     12: "2",     # 12%
+    13: "10",    # 13%
     14: "3",     # 14%
     15: "4",     # 15% (vigente desde 2024)
 }
@@ -44,6 +47,196 @@ def get_iva_code(rate: float) -> str:
     rate_int = int(rate)
     return IVA_CODES.get(rate_int, "4")  # Default 15%
 
+def tax_buckets(totals: dict) -> List[tuple]:
+    """
+    (codigoPorcentaje, baseImponible, valor) de cada totalImpuesto.
+    Usa totals["iva_breakdown"] (services.totals) si viene; si no, los
+    subtotales 0/12/15 de documentos anteriores.
+    """
+    breakdown = totals.get("iva_breakdown")
+    if breakdown is not None:
+        return [(tax["code"], tax["base"], tax["value"]) for tax in breakdown]
+    buckets = []
+    if totals.get("subtotal_0", 0) > 0:
+        buckets.append(("0", totals["subtotal_0"], 0))
+    if totals.get("subtotal_12", 0) > 0:
+        buckets.append(("2", totals["subtotal_12"], totals["total_iva_12"]))
+    if totals.get("subtotal_15", 0) > 0:
+        buckets.append(("4", totals["subtotal_15"], totals["total_iva_15"]))
+    return buckets
+
+def line_amounts(item: dict) -> tuple:
+    """
+    (precioTotalSinImpuesto, codigoPorcentaje, tarifa, valor) de una línea.
+    Los items procesados por services.totals traen los montos ya redondeados.
+    """
+    iva_rate = item.get("iva_rate", 15)
+    if "subtotal" in item and "iva_amount" in item:
+        return item["subtotal"], item.get("iva_code") or get_iva_code(iva_rate), iva_rate, item["iva_amount"]
+    subtotal = item["quantity"] * item["unit_price"] - item.get("discount", 0)
+    return subtotal, get_iva_code(iva_rate), iva_rate, subtotal * iva_rate / 100
+
+
+# ============================================================
+# Generador precompilado
+# Produce exactamente los mismos bytes que la construcción con lxml que reemplazó
+# (referencia en tests/xml_generator_dom.py):
+# - secciones del emisor serializadas una vez y cacheadas (lru_cache por contenido,
+#   así un cambio de configuración del tenant genera una entrada nueva)
+# - escape en una pasada (str.translate) en lugar de regex + replaces por campo
+# - detalles serializados con una plantilla por línea, sin armar el árbol completo
+# ============================================================
+
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# clean_xml_string en un solo translate: quita caracteres de control y escapa entidades
+_CLEAN_TABLE = {c: None for c in [*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20), 0x7f]}
+_CLEAN_TABLE.update({
+    ord("&"): "&amp;",
+    ord("<"): "&lt;",
+    ord(">"): "&gt;",
+    ord('"'): "&quot;",
+    ord("'"): "&apos;"
+})
+
+# Escape de texto que aplica lxml al serializar
+_TEXT_TABLE = {
+    ord("&"): "&amp;",
+    ord("<"): "&lt;",
+    ord(">"): "&gt;",
+    ord("\r"): "&#13;"
+}
+
+
+def _clean(text) -> str:
+    """Equivalente a clean_xml_string"""
+    if not text:
+        return ""
+    return str(text).translate(_CLEAN_TABLE)[:300]
+
+
+def _esc(text: str) -> str:
+    return text.translate(_TEXT_TABLE)
+
+
+def _el(tag: str, text: Optional[str]) -> str:
+    """Elemento con texto ya limpio (None = elemento vacío, como .text sin asignar)"""
+    if text is None:
+        return f"<{tag}/>"
+    return f"<{tag}>{_esc(text)}</{tag}>"
+
+
+@lru_cache(maxsize=1024)
+def _emitter_sections(ambiente: str, razon_social: str, nombre_comercial: Optional[str], ruc: str,
+                      direccion: str, contribuyente_especial: Optional[str],
+                      obligado_contabilidad: Optional[str]) -> Dict[str, str]:
+    """Fragmentos del emisor que se repiten en todos sus documentos"""
+    head = (
+        _el("ambiente", "1" if ambiente == "pruebas" else "2")
+        + _el("tipoEmision", "1")
+        + _el("razonSocial", _clean(razon_social))
+    )
+    if nombre_comercial:
+        head += _el("nombreComercial", _clean(nombre_comercial))
+    head += _el("ruc", ruc)
+
+    dir_establecimiento = _el("dirEstablecimiento", _clean(direccion)) if direccion else ""
+    especial = _el("contribuyenteEspecial", contribuyente_especial) if contribuyente_especial else ""
+    return {
+        "info_tributaria_head": "<infoTributaria>" + head,
+        "info_tributaria_tail": _el("dirMatriz", _clean(direccion)) + "</infoTributaria>",
+        "dir_establecimiento": dir_establecimiento,
+        "especial_obligado": especial + _el("obligadoContabilidad", obligado_contabilidad)
+    }
+
+
+def _sections_for(emitter: dict, ambiente: str) -> Dict[str, str]:
+    return _emitter_sections(
+        ambiente,
+        emitter["razon_social"],
+        emitter.get("nombre_comercial"),
+        emitter["ruc"],
+        emitter["direccion"],
+        emitter.get("contribuyente_especial"),
+        emitter.get("obligado_contabilidad", "NO")
+    )
+
+
+def _info_tributaria(sections: dict, access_key: str, cod_doc: str, store_code: str,
+                     emission_point: str, sequential: int) -> str:
+    return (
+        sections["info_tributaria_head"]
+        + _el("claveAcceso", access_key)
+        + _el("codDoc", cod_doc)
+        + _el("estab", store_code.zfill(3))
+        + _el("ptoEmi", emission_point.zfill(3))
+        + _el("secuencial", str(sequential).zfill(9))
+        + sections["info_tributaria_tail"]
+    )
+
+
+def _total_impuesto(codigo_porcentaje: str, base: float, valor: float) -> str:
+    return (
+        "<totalImpuesto>"
+        + _el("codigo", CODIGO_IVA)
+        + _el("codigoPorcentaje", codigo_porcentaje)
+        + _el("baseImponible", format_decimal(base))
+        + _el("valor", format_decimal(valor))
+        + "</totalImpuesto>"
+    )
+
+
+def _total_con_impuestos(totals: dict) -> str:
+    parts = [_total_impuesto(*bucket) for bucket in tax_buckets(totals)]
+    if not parts:
+        return "<totalConImpuestos/>"
+    return "<totalConImpuestos>" + "".join(parts) + "</totalConImpuestos>"
+
+
+# Plantilla de la parte numérica de cada <detalle> (todo lo que sigue a <descripcion>)
+_DETALLE_TAIL = (
+    "<cantidad>{cantidad}</cantidad>"
+    "<precioUnitario>{precio}</precioUnitario>"
+    "<descuento>{descuento}</descuento>"
+    "<precioTotalSinImpuesto>{subtotal}</precioTotalSinImpuesto>"
+    "<impuestos><impuesto>"
+    "<codigo>" + CODIGO_IVA + "</codigo>"
+    "<codigoPorcentaje>{codigo_porcentaje}</codigoPorcentaje>"
+    "<tarifa>{tarifa}</tarifa>"
+    "<baseImponible>{subtotal}</baseImponible>"
+    "<valor>{valor}</valor>"
+    "</impuesto></impuestos></detalle>"
+)
+
+
+def _write_detalles(items: List[dict], code_tag: str, aux_tag: str) -> str:
+    """Serializa <detalles> línea por línea con una plantilla, sin armar el árbol"""
+    if not items:
+        return "<detalles/>"
+    parts = ["<detalles>"]
+    append = parts.append
+    tail = _DETALLE_TAIL.format
+    for item in items:
+        append("<detalle>")
+        append(_el(code_tag, item["code"][:25]))
+        if item.get("auxiliary_code"):
+            append(_el(aux_tag, item["auxiliary_code"][:25]))
+        append(_el("descripcion", _clean(item["description"])))
+
+        subtotal, codigo_porcentaje, iva_rate, iva_amount = line_amounts(item)
+        append(tail(
+            cantidad=format_decimal(item["quantity"], 6),
+            precio=format_decimal(item["unit_price"], 6),
+            descuento=format_decimal(item.get("discount", 0)),
+            subtotal=format_decimal(subtotal),
+            codigo_porcentaje=codigo_porcentaje,
+            tarifa=format_decimal(iva_rate),
+            valor=format_decimal(iva_amount)
+        ))
+    append("</detalles>")
+    return "".join(parts)
+
+
 def generate_invoice_xml(
     access_key: str,
     emitter: dict,
@@ -59,139 +252,56 @@ def generate_invoice_xml(
 ) -> str:
     """
     Genera XML de Factura según formato SRI Ecuador v2.1.0
+    (mismos bytes que generate_invoice_xml_dom)
     """
-    # Crear elemento raíz
-    factura = etree.Element("factura", id="comprobante", version="2.1.0")
-    
-    # === INFO TRIBUTARIA ===
-    info_tributaria = etree.SubElement(factura, "infoTributaria")
-    
-    # Ambiente: 1=Pruebas, 2=Producción (según documentación SRI)
-    etree.SubElement(info_tributaria, "ambiente").text = "1" if ambiente == "pruebas" else "2"
-    etree.SubElement(info_tributaria, "tipoEmision").text = "1"  # Normal
-    etree.SubElement(info_tributaria, "razonSocial").text = clean_xml_string(emitter["razon_social"])
-    
-    if emitter.get("nombre_comercial"):
-        etree.SubElement(info_tributaria, "nombreComercial").text = clean_xml_string(emitter["nombre_comercial"])
-    
-    etree.SubElement(info_tributaria, "ruc").text = emitter["ruc"]
-    etree.SubElement(info_tributaria, "claveAcceso").text = access_key
-    etree.SubElement(info_tributaria, "codDoc").text = "01"  # Factura
-    etree.SubElement(info_tributaria, "estab").text = store_code.zfill(3)
-    etree.SubElement(info_tributaria, "ptoEmi").text = emission_point.zfill(3)
-    etree.SubElement(info_tributaria, "secuencial").text = str(sequential).zfill(9)
-    etree.SubElement(info_tributaria, "dirMatriz").text = clean_xml_string(emitter["direccion"])
-    
-    # === INFO FACTURA ===
-    info_factura = etree.SubElement(factura, "infoFactura")
-    
-    # La fecha de emisión viene ya ajustada según el ambiente desde la ruta
-    etree.SubElement(info_factura, "fechaEmision").text = issue_date.strftime("%d/%m/%Y")
-    
-    if emitter.get("direccion"):
-        etree.SubElement(info_factura, "dirEstablecimiento").text = clean_xml_string(emitter["direccion"])
-    
-    if emitter.get("contribuyente_especial"):
-        etree.SubElement(info_factura, "contribuyenteEspecial").text = emitter["contribuyente_especial"]
-    
-    etree.SubElement(info_factura, "obligadoContabilidad").text = emitter.get("obligado_contabilidad", "NO")
-    etree.SubElement(info_factura, "tipoIdentificacionComprador").text = customer["identification_type"]
-    
+    sections = _sections_for(emitter, ambiente)
+    parts = [
+        XML_DECLARATION,
+        '<factura id="comprobante" version="2.1.0">',
+        _info_tributaria(sections, access_key, "01", store_code, emission_point, sequential),
+        "<infoFactura>",
+        _el("fechaEmision", issue_date.strftime("%d/%m/%Y")),
+        sections["dir_establecimiento"],
+        sections["especial_obligado"],
+        _el("tipoIdentificacionComprador", customer["identification_type"])
+    ]
     if customer.get("guia_remision"):
-        etree.SubElement(info_factura, "guiaRemision").text = customer["guia_remision"]
-    
-    etree.SubElement(info_factura, "razonSocialComprador").text = clean_xml_string(customer["name"])
-    etree.SubElement(info_factura, "identificacionComprador").text = customer["identification"]
-    
+        parts.append(_el("guiaRemision", customer["guia_remision"]))
+    parts.append(_el("razonSocialComprador", _clean(customer["name"])))
+    parts.append(_el("identificacionComprador", customer["identification"]))
     if customer.get("address"):
-        etree.SubElement(info_factura, "direccionComprador").text = clean_xml_string(customer["address"])
-    
-    # Calcular total de IVA
+        parts.append(_el("direccionComprador", _clean(customer["address"])))
+
     total_iva = totals.get("total_iva", 0) or (
-        totals.get("total_iva_0", 0) + 
-        totals.get("total_iva_12", 0) + 
+        totals.get("total_iva_0", 0) +
+        totals.get("total_iva_12", 0) +
         totals.get("total_iva_15", 0)
     )
-    
-    # Totales
-    etree.SubElement(info_factura, "totalSinImpuestos").text = format_decimal(totals["total"] - total_iva)
-    etree.SubElement(info_factura, "totalDescuento").text = format_decimal(totals.get("total_discount", 0))
-    
-    # Total con impuestos
-    total_con_impuestos = etree.SubElement(info_factura, "totalConImpuestos")
-    
-    # IVA 0%
-    if totals.get("subtotal_0", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "0"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_0"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(0)
-    
-    # IVA 12%
-    if totals.get("subtotal_12", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "2"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_12"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(totals["total_iva_12"])
-    
-    # IVA 15%
-    if totals.get("subtotal_15", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "4"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_15"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(totals["total_iva_15"])
-    
-    etree.SubElement(info_factura, "propina").text = format_decimal(totals.get("propina", 0))
-    etree.SubElement(info_factura, "importeTotal").text = format_decimal(totals["total"])
-    etree.SubElement(info_factura, "moneda").text = "DOLAR"
-    
-    # Pagos
-    pagos = etree.SubElement(info_factura, "pagos")
-    for payment in payments:
-        pago = etree.SubElement(pagos, "pago")
-        etree.SubElement(pago, "formaPago").text = payment.get("method", "01")
-        etree.SubElement(pago, "total").text = format_decimal(payment["total"])
-        if payment.get("term", 0) > 0:
-            etree.SubElement(pago, "plazo").text = str(payment["term"])
-            etree.SubElement(pago, "unidadTiempo").text = payment.get("time_unit", "dias")
-    
-    # === DETALLES ===
-    detalles = etree.SubElement(factura, "detalles")
-    
-    for i, item in enumerate(items):
-        detalle = etree.SubElement(detalles, "detalle")
-        
-        etree.SubElement(detalle, "codigoPrincipal").text = item["code"][:25]
-        
-        if item.get("auxiliary_code"):
-            etree.SubElement(detalle, "codigoAuxiliar").text = item["auxiliary_code"][:25]
-        
-        etree.SubElement(detalle, "descripcion").text = clean_xml_string(item["description"])
-        etree.SubElement(detalle, "cantidad").text = format_decimal(item["quantity"], 6)
-        etree.SubElement(detalle, "precioUnitario").text = format_decimal(item["unit_price"], 6)
-        etree.SubElement(detalle, "descuento").text = format_decimal(item.get("discount", 0))
-        
-        # Precio total sin impuesto
-        subtotal = item["quantity"] * item["unit_price"] - item.get("discount", 0)
-        etree.SubElement(detalle, "precioTotalSinImpuesto").text = format_decimal(subtotal)
-        
-        # Impuestos del detalle
-        impuestos = etree.SubElement(detalle, "impuestos")
-        impuesto = etree.SubElement(impuestos, "impuesto")
-        
-        etree.SubElement(impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(impuesto, "codigoPorcentaje").text = get_iva_code(item.get("iva_rate", 15))
-        etree.SubElement(impuesto, "tarifa").text = format_decimal(item.get("iva_rate", 15))
-        etree.SubElement(impuesto, "baseImponible").text = format_decimal(subtotal)
-        
-        iva_amount = subtotal * item.get("iva_rate", 15) / 100
-        etree.SubElement(impuesto, "valor").text = format_decimal(iva_amount)
-    
-    # Generar XML string (sin pretty_print para mantener firma válida)
-    return etree.tostring(factura, pretty_print=False, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+    parts.append(_el("totalSinImpuestos", format_decimal(totals["total"] - total_iva)))
+    parts.append(_el("totalDescuento", format_decimal(totals.get("total_discount", 0))))
+    parts.append(_total_con_impuestos(totals))
+    parts.append(_el("propina", format_decimal(totals.get("propina", 0))))
+    parts.append(_el("importeTotal", format_decimal(totals["total"])))
+    parts.append(_el("moneda", "DOLAR"))
+
+    if payments:
+        parts.append("<pagos>")
+        for payment in payments:
+            parts.append("<pago>")
+            parts.append(_el("formaPago", payment.get("method", "01")))
+            parts.append(_el("total", format_decimal(payment["total"])))
+            if payment.get("term", 0) > 0:
+                parts.append(_el("plazo", str(payment["term"])))
+                parts.append(_el("unidadTiempo", payment.get("time_unit", "dias")))
+            parts.append("</pago>")
+        parts.append("</pagos>")
+    else:
+        parts.append("<pagos/>")
+    parts.append("</infoFactura>")
+
+    parts.append(_write_detalles(items, "codigoPrincipal", "codigoAuxiliar"))
+    parts.append("</factura>")
+    return "".join(parts)
 
 
 def generate_credit_note_xml(
@@ -209,110 +319,30 @@ def generate_credit_note_xml(
 ) -> str:
     """
     Genera XML de Nota de Crédito según formato SRI Ecuador v1.1.0
+    (mismos bytes que generate_credit_note_xml_dom)
     """
-    # Crear elemento raíz
-    nota_credito = etree.Element("notaCredito", id="comprobante", version="1.1.0")
-    
-    # === INFO TRIBUTARIA ===
-    info_tributaria = etree.SubElement(nota_credito, "infoTributaria")
-    
-    etree.SubElement(info_tributaria, "ambiente").text = "1" if ambiente == "pruebas" else "2"
-    etree.SubElement(info_tributaria, "tipoEmision").text = "1"
-    etree.SubElement(info_tributaria, "razonSocial").text = clean_xml_string(emitter["razon_social"])
-    
-    if emitter.get("nombre_comercial"):
-        etree.SubElement(info_tributaria, "nombreComercial").text = clean_xml_string(emitter["nombre_comercial"])
-    
-    etree.SubElement(info_tributaria, "ruc").text = emitter["ruc"]
-    etree.SubElement(info_tributaria, "claveAcceso").text = access_key
-    etree.SubElement(info_tributaria, "codDoc").text = "04"  # Nota de crédito
-    etree.SubElement(info_tributaria, "estab").text = store_code.zfill(3)
-    etree.SubElement(info_tributaria, "ptoEmi").text = emission_point.zfill(3)
-    etree.SubElement(info_tributaria, "secuencial").text = str(sequential).zfill(9)
-    etree.SubElement(info_tributaria, "dirMatriz").text = clean_xml_string(emitter["direccion"])
-    
-    # === INFO NOTA CREDITO ===
-    info_nc = etree.SubElement(nota_credito, "infoNotaCredito")
-    
-    etree.SubElement(info_nc, "fechaEmision").text = issue_date.strftime("%d/%m/%Y")
-    
-    if emitter.get("direccion"):
-        etree.SubElement(info_nc, "dirEstablecimiento").text = clean_xml_string(emitter["direccion"])
-    
-    etree.SubElement(info_nc, "tipoIdentificacionComprador").text = customer["identification_type"]
-    etree.SubElement(info_nc, "razonSocialComprador").text = clean_xml_string(customer["name"])
-    etree.SubElement(info_nc, "identificacionComprador").text = customer["identification"]
-    
-    if emitter.get("contribuyente_especial"):
-        etree.SubElement(info_nc, "contribuyenteEspecial").text = emitter["contribuyente_especial"]
-    
-    etree.SubElement(info_nc, "obligadoContabilidad").text = emitter.get("obligado_contabilidad", "NO")
-    
-    # Documento modificado
-    etree.SubElement(info_nc, "codDocModificado").text = "01"  # Factura
-    etree.SubElement(info_nc, "numDocModificado").text = invoice_reference["doc_number"]
-    etree.SubElement(info_nc, "fechaEmisionDocSustento").text = invoice_reference["issue_date"].strftime("%d/%m/%Y")
-    
-    etree.SubElement(info_nc, "totalSinImpuestos").text = format_decimal(totals["total"] - totals["total_iva"])
-    etree.SubElement(info_nc, "valorModificacion").text = format_decimal(totals["total"])
-    etree.SubElement(info_nc, "moneda").text = "DOLAR"
-    
-    # Impuestos
-    total_con_impuestos = etree.SubElement(info_nc, "totalConImpuestos")
-    
-    if totals.get("subtotal_0", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "0"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_0"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(0)
-    
-    if totals.get("subtotal_12", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "2"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_12"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(totals["total_iva_12"])
-    
-    if totals.get("subtotal_15", 0) > 0:
-        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
-        etree.SubElement(total_impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(total_impuesto, "codigoPorcentaje").text = "4"
-        etree.SubElement(total_impuesto, "baseImponible").text = format_decimal(totals["subtotal_15"])
-        etree.SubElement(total_impuesto, "valor").text = format_decimal(totals["total_iva_15"])
-    
-    # Motivo de la nota de crédito (va al final de infoNotaCredito)
-    etree.SubElement(info_nc, "motivo").text = clean_xml_string(invoice_reference["reason"])
-    
-    # === DETALLES ===
-    detalles = etree.SubElement(nota_credito, "detalles")
-    
-    for i, item in enumerate(items):
-        detalle = etree.SubElement(detalles, "detalle")
-        
-        etree.SubElement(detalle, "codigoInterno").text = item["code"][:25]
-        
-        if item.get("auxiliary_code"):
-            etree.SubElement(detalle, "codigoAdicional").text = item["auxiliary_code"][:25]
-        
-        etree.SubElement(detalle, "descripcion").text = clean_xml_string(item["description"])
-        etree.SubElement(detalle, "cantidad").text = format_decimal(item["quantity"], 6)
-        etree.SubElement(detalle, "precioUnitario").text = format_decimal(item["unit_price"], 6)
-        etree.SubElement(detalle, "descuento").text = format_decimal(item.get("discount", 0))
-        
-        subtotal = item["quantity"] * item["unit_price"] - item.get("discount", 0)
-        etree.SubElement(detalle, "precioTotalSinImpuesto").text = format_decimal(subtotal)
-        
-        impuestos = etree.SubElement(detalle, "impuestos")
-        impuesto = etree.SubElement(impuestos, "impuesto")
-        
-        etree.SubElement(impuesto, "codigo").text = CODIGO_IVA
-        etree.SubElement(impuesto, "codigoPorcentaje").text = get_iva_code(item.get("iva_rate", 15))
-        etree.SubElement(impuesto, "tarifa").text = format_decimal(item.get("iva_rate", 15))
-        etree.SubElement(impuesto, "baseImponible").text = format_decimal(subtotal)
-        
-        iva_amount = subtotal * item.get("iva_rate", 15) / 100
-        etree.SubElement(impuesto, "valor").text = format_decimal(iva_amount)
-    
-    # Generar XML string (sin pretty_print para mantener firma válida)
-    return etree.tostring(nota_credito, pretty_print=False, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+    sections = _sections_for(emitter, ambiente)
+    parts = [
+        XML_DECLARATION,
+        '<notaCredito id="comprobante" version="1.1.0">',
+        _info_tributaria(sections, access_key, "04", store_code, emission_point, sequential),
+        "<infoNotaCredito>",
+        _el("fechaEmision", issue_date.strftime("%d/%m/%Y")),
+        sections["dir_establecimiento"],
+        _el("tipoIdentificacionComprador", customer["identification_type"]),
+        _el("razonSocialComprador", _clean(customer["name"])),
+        _el("identificacionComprador", customer["identification"]),
+        sections["especial_obligado"],
+        _el("codDocModificado", "01"),
+        _el("numDocModificado", invoice_reference["doc_number"]),
+        _el("fechaEmisionDocSustento", invoice_reference["issue_date"].strftime("%d/%m/%Y")),
+        _el("totalSinImpuestos", format_decimal(totals["total"] - totals["total_iva"])),
+        _el("valorModificacion", format_decimal(totals["total"])),
+        _el("moneda", "DOLAR"),
+        _total_con_impuestos(totals),
+        _el("motivo", _clean(invoice_reference["reason"])),
+        "</infoNotaCredito>",
+        _write_detalles(items, "codigoInterno", "codigoAdicional"),
+        "</notaCredito>"
+    ]
+    return "".join(parts)
@@ -5,6 +5,8 @@ Basado en la especificación oficial del SRI
 import base64
 import hashlib
 import random
+import time
+from typing import Optional
 from datetime import datetime, timezone
 from lxml import etree
 from cryptography.hazmat.primitives import serialization, hashes
@@ -58,6 +60,41 @@ def format_issuer_name(certificate) -> str:
     return ','.join(parts)
 
 
+def load_signing_material(p12_data: bytes, password: str) -> dict:
+    """
+    Carga el .p12 y precalcula todo lo que no depende del documento:
+    clave privada, certificado en Base64, digest del certificado,
+    módulo/exponente de la clave pública, serial e issuer.
+    
+    Es la parte costosa de la firma (parseo PKCS#12); el resultado se
+    puede reutilizar para firmar muchos documentos.
+    """
+    # Cargar certificado
+    private_key, certificate, _ = pkcs12.load_key_and_certificates(
+        p12_data, password.encode(), default_backend()
+    )
+    
+    # Obtener datos del certificado
+    cert_der = certificate.public_bytes(serialization.Encoding.DER)
+    
+    # Modulus y exponente de la clave pública
+    pub_numbers = certificate.public_key().public_numbers()
+    modulus_bytes = pub_numbers.n.to_bytes((pub_numbers.n.bit_length() + 7) // 8, byteorder='big')
+    exponent_bytes = pub_numbers.e.to_bytes((pub_numbers.e.bit_length() + 7) // 8, byteorder='big')
+    
+    return {
+        "private_key": private_key,
+        "certificate": certificate,
+        "cert_b64": base64.b64encode(cert_der).decode(),
+        "cert_sha1": sha1_base64(cert_der),
+        "modulus_b64": base64.b64encode(modulus_bytes).decode(),
+        "exponent_b64": base64.b64encode(exponent_bytes).decode(),
+        # Serial number y issuer
+        "serial_number": str(certificate.serial_number),
+        "issuer_name": format_issuer_name(certificate)
+    }
+
+
 def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     """
     Firma XML con XAdES-BES según especificación SRI Ecuador
@@ -70,10 +107,28 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     Returns:
         XML firmado como string
     """
-    # Cargar certificado
-    private_key, certificate, _ = pkcs12.load_key_and_certificates(
-        p12_data, password.encode(), default_backend()
-    )
+    return sign_xml_xades_sri_with_material(xml_content, load_signing_material(p12_data, password))
+
+
+def sign_xml_xades_sri_with_material(xml_content: str, material: dict, timings: Optional[dict] = None) -> str:
+    """
+    Firma XML con XAdES-BES usando material precargado por load_signing_material
+    
+    Args:
+        xml_content: XML del comprobante sin firmar
+        material: Clave y fragmentos del certificado precalculados
+        timings: Si se pasa, se llena con la duración (ms) de c14n_digest, rsa_sign y assemble
+    
+    Returns:
+        XML firmado como string
+    """
+    private_key = material["private_key"]
+    cert_b64 = material["cert_b64"]
+    cert_sha1 = material["cert_sha1"]
+    modulus_b64 = material["modulus_b64"]
+    exponent_b64 = material["exponent_b64"]
+    serial_number = material["serial_number"]
+    issuer_name = material["issuer_name"]
     
     # Generar números aleatorios para IDs (como hace el SRI)
     rand = random.randint(100000, 999999)
@@ -85,23 +140,6 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     reference_id_number = rand + 5
     object_number = rand + 6
     
-    # Obtener datos del certificado
-    cert_der = certificate.public_bytes(serialization.Encoding.DER)
-    cert_b64 = base64.b64encode(cert_der).decode()
-    cert_sha1 = sha1_base64(cert_der)
-    
-    # Modulus y exponente de la clave pública
-    pub_key = certificate.public_key()
-    pub_numbers = pub_key.public_numbers()
-    modulus_bytes = pub_numbers.n.to_bytes((pub_numbers.n.bit_length() + 7) // 8, byteorder='big')
-    exponent_bytes = pub_numbers.e.to_bytes((pub_numbers.e.bit_length() + 7) // 8, byteorder='big')
-    modulus_b64 = base64.b64encode(modulus_bytes).decode()
-    exponent_b64 = base64.b64encode(exponent_bytes).decode()
-    
-    # Serial number y issuer
-    serial_number = str(certificate.serial_number)
-    issuer_name = format_issuer_name(certificate)
-    
     # Fecha/hora de firma
     signing_time = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
     
@@ -149,6 +187,7 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     key_info = key_info.replace('\n', '')
     
     # 3. Calcular digests
+    t_digest = time.perf_counter()
     # Parsear XML para agregar namespaces si no los tiene
     xml_clean = xml_content.strip()
     
@@ -199,6 +238,7 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
         '<ds:SignedInfo xmlns:ds="http://www.w3.org/2000/09/xmldsig#"'
     )
     
+    t_sign = time.perf_counter()
     signature_bytes = private_key.sign(
         signed_info_with_ns.encode('utf-8'),
         padding.PKCS1v15(),
@@ -206,6 +246,8 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     )
     signature_value = base64.b64encode(signature_bytes).decode()
     
+    t_assemble = time.perf_counter()
+    
     # 6. Construir firma completa XAdES-BES
     xades_signature = f'''<ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#" xmlns:etsi="http://uri.etsi.org/01903/v1.3.2#" Id="Signature{signature_number}">
 {signed_info}
@@ -237,4 +279,10 @@ def sign_xml_xades_sri(xml_content: str, p12_data: bytes, password: str) -> str:
     # Agregar declaración XML
     signed_xml = '<?xml version="1.0" encoding="UTF-8"?>' + signed_xml
     
+    if timings is not None:
+        t_end = time.perf_counter()
+        timings["c14n_digest"] = (t_sign - t_digest) * 1000
+        timings["rsa_sign"] = (t_assemble - t_sign) * 1000
+        timings["assemble"] = (t_end - t_assemble) * 1000
+    
     return signed_xml
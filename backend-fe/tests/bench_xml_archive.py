@@ -0,0 +1,131 @@
+"""
+Benchmark del archivo de XML firmados: bytes por documento y tiempo de lectura
+
+Genera facturas sintéticas de un mismo emisor con una firma XAdES simulada
+(certificado fijo, digests y SignatureValue aleatorios), entrena el diccionario
+con la primera mitad y mide sobre la segunda mitad.
+
+    python tests/bench_xml_archive.py [--docs 2000]
+"""
+import os
+import sys
+import time
+import base64
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.xml_generator import generate_invoice_xml  # noqa: E402
+from services.xml_archive import (  # noqa: E402
+    ArchiveDictionary, encode_xml, decode_xml, stored_size, train_dictionary_bytes, CODEC_GZIP, CODEC_ZSTD
+)
+
+EMITTER = {
+    "ruc": "1790012345001",
+    "razon_social": "COMERCIALIZADORA DEL PACIFICO S.A.",
+    "nombre_comercial": "Pacífico Market",
+    "direccion": "Av. Amazonas N34-120 y Av. República, Quito",
+    "obligado_contabilidad": "SI",
+    "contribuyente_especial": None
+}
+CERTIFICATE = base64.b64encode(random.Random(0).randbytes(1800)).decode()
+
+SIGNATURE_TEMPLATE = (
+    '<ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#" xmlns:etsi="http://uri.etsi.org/01903/v1.3.2#" '
+    'Id="Signature{n}"><ds:SignedInfo Id="Signature-SignedInfo{n}">'
+    '<ds:CanonicalizationMethod Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"/>'
+    '<ds:SignatureMethod Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1"/>'
+    '<ds:Reference Id="SignedPropertiesID{n}" Type="http://uri.etsi.org/01903#SignedProperties" '
+    'URI="#Signature{n}-SignedProperties{n}"><ds:DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/>'
+    '<ds:DigestValue>{d1}</ds:DigestValue></ds:Reference><ds:Reference URI="#Certificate{n}">'
+    '<ds:DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/><ds:DigestValue>{d2}</ds:DigestValue>'
+    '</ds:Reference><ds:Reference Id="Reference-ID-{n}" URI="#comprobante"><ds:Transforms>'
+    '<ds:Transform Algorithm="http://www.w3.org/2000/09/xmldsig#enveloped-signature"/></ds:Transforms>'
+    '<ds:DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/><ds:DigestValue>{d3}</ds:DigestValue>'
+    '</ds:Reference></ds:SignedInfo><ds:SignatureValue Id="SignatureValue{n}">{sv}</ds:SignatureValue>'
+    '<ds:KeyInfo Id="Certificate{n}"><ds:X509Data><ds:X509Certificate>' + CERTIFICATE +
+    '</ds:X509Certificate></ds:X509Data></ds:KeyInfo><ds:Object Id="Signature{n}-Object{n}">'
+    '<etsi:QualifyingProperties Target="#Signature{n}"><etsi:SignedProperties Id="Signature{n}-SignedProperties{n}">'
+    '<etsi:SignedSignatureProperties><etsi:SigningTime>{ts}</etsi:SigningTime></etsi:SignedSignatureProperties>'
+    '</etsi:SignedProperties></etsi:QualifyingProperties></ds:Object></ds:Signature>'
+)
+
+
+def build_signed_xml(rng: random.Random, n: int) -> bytes:
+    """Factura firmada sintética número `n`"""
+    items = []
+    for i in range(rng.randint(1, 12)):
+        items.append({
+            "code": f"PRD{rng.randint(1, 500):05d}",
+            "description": rng.choice(["Arroz 2kg", "Aceite girasol 1L", "Leche entera", "Café molido 500g",
+                                       "Detergente 3kg", "Atún en lata"]) + f" #{i}",
+            "quantity": rng.randint(1, 5),
+            "unit_price": round(rng.uniform(0.5, 40), 2),
+            "discount": 0,
+            "iva_rate": rng.choice([0, 15])
+        })
+    xml = generate_invoice_xml(
+        access_key=f"{rng.randrange(10 ** 48, 10 ** 49)}",
+        emitter=EMITTER,
+        customer={
+            "identification_type": "05",
+            "identification": f"17{rng.randrange(10 ** 7, 10 ** 8)}",
+            "name": f"CLIENTE {rng.randint(1, 5000)}",
+            "address": "Quito"
+        },
+        items=items,
+        totals={"subtotal_0": 1.0, "subtotal_15": 10.0, "total_iva_15": 1.5, "total_iva": 1.5,
+                "total_discount": 0, "total": 12.5},
+        payments=[{"method": "01", "total": 12.5}],
+        issue_date=datetime(2024, 5, 6),
+        store_code="001",
+        emission_point="001",
+        sequential=n,
+        ambiente="produccion"
+    )
+
+    def digest(size: int) -> str:
+        return base64.b64encode(rng.randbytes(size)).decode()
+
+    signature = SIGNATURE_TEMPLATE.format(
+        n=rng.randint(100000, 999999), d1=digest(20), d2=digest(20), d3=digest(20), sv=digest(256),
+        ts="2024-05-06T10:00:00-05:00"
+    )
+    return xml.replace("</factura>", signature + "</factura>").encode("utf-8")
+
+
+def measure(name: str, rows: list, dictionary=None):
+    start = time.perf_counter()
+    for row in rows:
+        decode_xml(row, dictionary)
+    elapsed = time.perf_counter() - start
+    size = sum(stored_size(row) for row in rows) / len(rows)
+    print(f"{name:<22} {size:>10.0f} B/doc {elapsed / len(rows) * 1e6:>10.1f} µs/decode")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    xmls = [build_signed_xml(rng, n) for n in range(args.docs)]
+    half = len(xmls) // 2
+    training, sample = xmls[:half], xmls[half:]
+
+    raw = sum(len(x) for x in sample) / len(sample)
+    print(f"{len(sample)} documentos, XML medio {raw:.0f} B")
+
+    measure("gzip", [encode_xml(x, codec=CODEC_GZIP) for x in sample])
+    measure("zstd", [encode_xml(x, codec=CODEC_ZSTD) for x in sample])
+
+    start = time.perf_counter()
+    dictionary = ArchiveDictionary("bench:1", train_dictionary_bytes(training))
+    print(f"{'(entrenamiento)':<22} {time.perf_counter() - start:>10.2f} s")
+    measure("zstd + diccionario", [encode_xml(x, dictionary, codec=CODEC_ZSTD) for x in sample], dictionary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Servidor SOAP local que imita RecepcionComprobantesOffline y
+AutorizacionComprobantesOffline del SRI para tests.
+
+Uso standalone:
+    python tests/sri_stub_server.py --port 8099
+    SRI_BASE_URL_PRUEBAS=http://127.0.0.1:8099 uvicorn server:app --port 8002
+"""
+import re
+import base64
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECEPCION_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<ns2:validarComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.recepcion">
+<RespuestaRecepcionComprobante><estado>{estado}</estado><comprobantes>{comprobantes}</comprobantes></RespuestaRecepcionComprobante>
+</ns2:validarComprobanteResponse></soap:Body></soap:Envelope>'''
+
+DEVUELTA_COMPROBANTE = '''<comprobante><claveAcceso>{clave}</claveAcceso><mensajes><mensaje>
+<identificador>43</identificador><mensaje>CLAVE ACCESO REGISTRADA</mensaje><tipo>ERROR</tipo>
+</mensaje></mensajes></comprobante>'''
+
+AUTORIZACION_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<ns2:autorizacionComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.autorizacion">
+<RespuestaAutorizacionComprobante><claveAccesoConsultada>{clave}</claveAccesoConsultada>
+<numeroComprobantes>{numero}</numeroComprobantes><autorizaciones>{autorizaciones}</autorizaciones>
+</RespuestaAutorizacionComprobante></ns2:autorizacionComprobanteResponse></soap:Body></soap:Envelope>'''
+
+AUTORIZACION_NODE = '''<autorizacion><estado>{estado}</estado><numeroAutorizacion>{clave}</numeroAutorizacion>
+<fechaAutorizacion>{fecha}</fechaAutorizacion><ambiente>PRUEBAS</ambiente>
+<comprobante><![CDATA[<factura id="comprobante"></factura>]]></comprobante><mensajes/></autorizacion>'''
+
+
+class SRIStubState:
+    """Comportamiento configurable del servidor"""
+
+    def __init__(self):
+        self.devolver = set()       # claves de acceso que la recepción devuelve
+        self.en_proceso = set()     # claves sin autorización todavía
+        self.no_autorizar = set()   # claves que el SRI responde "NO AUTORIZADO"
+        self.recibidas = []         # claves recibidas (en orden)
+        self.connections = 0        # conexiones TCP aceptadas
+        self.requests = 0
+
+
+class SRIStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    state: SRIStubState = None
+
+    def setup(self):
+        super().setup()
+        self.state.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        self.state.requests += 1
+
+        if self.path.endswith("RecepcionComprobantesOffline"):
+            payload = self._recepcion(body)
+        elif self.path.endswith("AutorizacionComprobantesOffline"):
+            payload = self._autorizacion(body)
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = payload.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _recepcion(self, body: str) -> str:
+        xml_b64 = re.search(r"<xml>([^<]*)</xml>", body).group(1)
+        xml = base64.b64decode(xml_b64).decode("utf-8")
+        match = re.search(r"<claveAcceso>(\d+)</claveAcceso>", xml)
+        clave = match.group(1) if match else ""
+        self.state.recibidas.append(clave)
+        if clave in self.state.devolver:
+            return RECEPCION_RESPONSE.format(estado="DEVUELTA", comprobantes=DEVUELTA_COMPROBANTE.format(clave=clave))
+        return RECEPCION_RESPONSE.format(estado="RECIBIDA", comprobantes="")
+
+    def _autorizacion(self, body: str) -> str:
+        clave = re.search(r"<claveAccesoComprobante>(\d+)</claveAccesoComprobante>", body).group(1)
+        if clave in self.state.en_proceso:
+            return AUTORIZACION_RESPONSE.format(clave=clave, numero=0, autorizaciones="")
+        fecha = datetime.now(timezone.utc).isoformat()
+        estado = "NO AUTORIZADO" if clave in self.state.no_autorizar else "AUTORIZADO"
+        return AUTORIZACION_RESPONSE.format(
+            clave=clave, numero=1, autorizaciones=AUTORIZACION_NODE.format(clave=clave, fecha=fecha, estado=estado)
+        )
+
+
+def start_stub_server(host: str = "127.0.0.1", port: int = 0):
+    """Inicia el servidor en un thread. Retorna (server, state, base_url)."""
+    state = SRIStubState()
+    handler = type("Handler", (SRIStubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, state, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor SOAP local del SRI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+    server, _, base_url = start_stub_server(args.host, args.port)
+    print(f"SRI stub escuchando en {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,31 @@
+"""
+Test de eventos embebidos: cuándo get_document puede servir documents.events
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.events import EventRecorder, embedded_events_complete, DOCUMENT_EVENTS_MAX  # noqa: E402
+
+
+def test_attach_marks_document():
+    document = {"_id": "doc-1"}
+    recorder = EventRecorder("doc-1", "tenant-1")
+    recorder.add("CREADO", "success", "Documento creado")
+    recorder.attach(document)
+    assert document["events_embedded"] is True
+    assert [e["event_type"] for e in document["events"]] == ["CREADO"]
+    assert embedded_events_complete(document)
+
+
+def test_legacy_document_with_pushed_events_is_incomplete():
+    # Documento anterior: el primer $push (reconciliación, reenvío) crea un array parcial
+    document = {"_id": "doc-1", "events": [{"event_type": "AUTORIZADO"}]}
+    assert not embedded_events_complete(document)
+
+
+def test_capped_array_is_incomplete():
+    document = {"_id": "doc-1", "events_embedded": True,
+                "events": [{"event_type": "EN_PROCESO"}] * DOCUMENT_EVENTS_MAX}
+    assert not embedded_events_complete(document)
@@ -0,0 +1,205 @@
+"""
+Test del lote de facturas: los documentos firmados quedan en sri_jobs antes de
+la primera línea del stream, aunque el cliente se desconecte enseguida
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("lxml")
+
+from models.document import InvoiceCreate  # noqa: E402
+from middleware.tenant import TenantContext  # noqa: E402
+import services.invoice_batch as invoice_batch  # noqa: E402
+from services.java_signer_client import JavaSignerError  # noqa: E402
+
+
+class _Collection:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def find(self, query, projection=None):
+        return _EmptyCursor()
+
+
+class _EmptyCursor:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class _DB:
+    def __init__(self):
+        self.documents = _Collection()
+        self.document_xml = _Collection()
+        self.document_events = _Collection()
+
+
+class _Allocator:
+    def __init__(self):
+        self.finished = []
+
+    async def reserve(self, db, tenant_id, store_code, emission_point, doc_type, count):
+        return "lease-1", 1, count
+
+    async def finish(self, db, lease_id, last_used):
+        self.finished.append((lease_id, last_used))
+
+
+class _Worker:
+    def __init__(self):
+        self.enqueued = []
+        self.documents = []
+        self.claimed = []
+        self.completed = []
+        self.released = []
+        self.released_held = []
+
+    async def enqueue_many(self, db, documents, ambiente, callback_url=None, hold=False):
+        self.enqueued.extend((document["_id"], hold) for document in documents)
+        self.documents.extend(documents)
+
+    async def claim(self, db, document_id):
+        self.claimed.append(document_id)
+        return {"_id": "job-" + document_id, "document_id": document_id, "claim_token": "t"}
+
+    async def renew(self, db, job):
+        return True
+
+    async def complete(self, db, job, sri_status):
+        self.completed.append(job["document_id"])
+
+    async def release(self, db, job):
+        self.released.append(job["document_id"])
+
+    async def release_held(self, db, document_ids):
+        self.released_held.extend(document_ids)
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    allocator, worker = _Allocator(), _Worker()
+
+    async def sign(signing_context, xmls):
+        return list(xmls)
+
+    async def encode(db, tenant_id, xml):
+        return {"codec": "plain", "xml_signed": xml.decode("utf-8")}
+
+    class _SRIClient:
+        calls = 0
+
+        async def emitir_y_autorizar(self, *args, **kwargs):
+            # Solo el primer envío responde; el resto queda en vuelo
+            _SRIClient.calls += 1
+            if _SRIClient.calls > 1:
+                await asyncio.sleep(3600)
+            return "AUTORIZADO", "123", None, []
+
+    async def apply_sri_result(*args):
+        return None
+
+    monkeypatch.setattr(invoice_batch, "sequential_allocator", allocator)
+    monkeypatch.setattr(invoice_batch, "sri_worker", worker)
+    monkeypatch.setattr(invoice_batch, "sign_batch_with_java", sign)
+    monkeypatch.setattr(invoice_batch.xml_archive, "encode", encode)
+    monkeypatch.setattr(invoice_batch, "get_sri_client", lambda ambiente: _SRIClient())
+    monkeypatch.setattr(invoice_batch, "apply_sri_result", apply_sri_result)
+    return allocator, worker
+
+
+def _context() -> TenantContext:
+    tenant = {"ruc": "1790012345001", "razon_social": "EMISOR S.A.", "address": {"direccion": "Quito"}}
+    config = {"ambiente": "pruebas", "config": {"iva_default": 15}}
+    return TenantContext("tenant-1", tenant, config, {"certificate_info": {}})
+
+
+def _invoices(n: int):
+    return [
+        InvoiceCreate(
+            customer={"identification_type": "07", "identification": "9999999999999", "name": "CONSUMIDOR FINAL"},
+            items=[{"code": "P1", "description": "Producto", "quantity": 1, "unit_price": 10}]
+        )
+        for _ in range(n)
+    ]
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_signed_documents_are_queued_before_first_line(batch, mode):
+    allocator, worker = batch
+    db = _DB()
+
+    async def run():
+        stream = invoice_batch.stream_invoice_batch(db, _context(), None, _invoices(3), mode)
+        first = await stream.__anext__()
+        # Cliente desconectado después de la primera línea
+        await stream.aclose()
+        return first
+
+    first = asyncio.run(run())
+    assert first
+    ids = [doc["_id"] for doc in db.documents.docs]
+    assert len(ids) == 3
+    assert sorted(doc_id for doc_id, _ in worker.enqueued) == sorted(ids)
+    assert all(hold == (mode == "sync") for _, hold in worker.enqueued)
+    assert allocator.finished == [("lease-1", 3)]
+    if mode == "sync":
+        # Lo que la request no llegó a enviar vuelve al worker SRI: lo reclamado
+        # con release() y lo que seguía esperando turno con release_held()
+        assert len(worker.completed) == 1
+        assert sorted(worker.completed + worker.released) == sorted(worker.claimed)
+        assert set(worker.released_held) | set(worker.claimed) == set(ids)
+
+
+def test_sync_jobs_are_claimed_when_their_send_starts(batch, monkeypatch):
+    allocator, worker = batch
+    monkeypatch.setattr(invoice_batch, "INVOICE_BATCH_SRI_CONCURRENCY", 1)
+    db = _DB()
+
+    async def run():
+        stream = invoice_batch.stream_invoice_batch(db, _context(), None, _invoices(3), "sync")
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first
+
+    asyncio.run(run())
+    ids = [doc["_id"] for doc in db.documents.docs]
+    # El tercero nunca tuvo turno: su lease no empezó a correr mientras esperaba
+    assert len(worker.claimed) == 2
+    unclaimed = set(ids) - set(worker.claimed)
+    assert unclaimed and unclaimed <= set(worker.released_held)
+    assert worker.released == [worker.claimed[1]]
+
+
+def test_batch_is_signed_in_one_java_call_with_python_fallback(batch, monkeypatch):
+    allocator, worker = batch
+    calls = []
+
+    async def sign_batch(signing_context, xmls):
+        calls.append(len(xmls))
+        return [JavaSignerError("XML inválido") if i == 1 else xml for i, xml in enumerate(xmls)]
+
+    class _Pool:
+        async def sign(self, signing_context, xml):
+            return xml
+
+    monkeypatch.setattr(invoice_batch, "sign_batch_with_java", sign_batch)
+    monkeypatch.setattr(invoice_batch, "signing_pool", _Pool())
+    db = _DB()
+
+    async def run():
+        return [line async for line in invoice_batch.stream_invoice_batch(db, _context(), None, _invoices(3), "async")]
+
+    asyncio.run(run())
+    assert calls == [3]
+    assert [doc["sri_status"] for doc in db.documents.docs] == ["FIRMADO"] * 3
+    assert sorted(doc["signer"] for doc in worker.documents) == ["java", "java", "python"]
@@ -0,0 +1,72 @@
+"""
+Test del cliente del firmador Java: firma por lote (/sign/batch) y re-registro del handle
+"""
+import os
+import sys
+import json
+import base64
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+import services.java_signer_client as java_signer_client  # noqa: E402
+from services.java_signer_client import JavaSignerError, sign_batch_with_java  # noqa: E402
+
+
+class _SigningContext:
+    def __init__(self):
+        self.java_handle = "h-viejo"
+        self.java_lock = asyncio.Lock()
+        self.p12_data = b"p12"
+        self.password = "clave"
+
+
+def _b64(text: str) -> str:
+    return base64.b64encode(text.encode("utf-8")).decode()
+
+
+@pytest.fixture
+def signer(monkeypatch):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        requests.append((request.url.path, body))
+        if request.url.path == "/certificates":
+            return httpx.Response(200, json={"success": True, "handle": "h-nuevo"})
+        if body["handle"] != "h-nuevo":
+            return httpx.Response(404, json={"success": False, "code": "UNKNOWN_HANDLE", "error": "no registrado"})
+        results = []
+        for xml in body["xmls"]:
+            text = base64.b64decode(xml).decode("utf-8")
+            if "malo" in text:
+                results.append({"success": False, "error": "XML inválido"})
+            else:
+                results.append({"success": True, "signed_xml": _b64(text + "<firma/>")})
+        return httpx.Response(200, json={"success": True, "results": results})
+
+    def client():
+        return httpx.AsyncClient(base_url="http://signer", transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(java_signer_client, "get_java_signer_client", client)
+    return requests
+
+
+def test_batch_reregisters_handle_and_reports_errors_per_document(signer):
+    context = _SigningContext()
+    results = asyncio.run(sign_batch_with_java(context, ["<a/>", "<malo/>", "<b/>"]))
+
+    assert results[0] == "<a/><firma/>"
+    assert isinstance(results[1], JavaSignerError)
+    assert results[2] == "<b/><firma/>"
+    assert context.java_handle == "h-nuevo"
+    # Un solo lote tras re-registrar el handle: no un round trip por documento
+    assert [path for path, _ in signer] == ["/sign/batch", "/certificates", "/sign/batch"]
+
+
+def test_empty_batch_makes_no_request(signer):
+    assert asyncio.run(sign_batch_with_java(_SigningContext(), [])) == []
+    assert signer == []
@@ -0,0 +1,66 @@
+"""
+Test de los tiempos por etapa (services/pipeline_metrics.py) y su exposición Prometheus
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.pipeline_metrics import StageHistograms, StageTimer, metrics_authorized  # noqa: E402
+
+NAME = "fe_pipeline_stage_duration_seconds"
+
+
+def test_timer_accumulates_stages():
+    timer = StageTimer("tenant-0000001", "produccion")
+    with timer.stage("store"):
+        pass
+    timer.add("store", 2.0)
+    timer.add("sign", 12.3456)
+    timer.signer = "java"
+
+    metadata = timer.as_metadata()
+    assert metadata["signer"] == "java"
+    assert metadata["timings_ms"]["sign"] == 12.346
+    assert metadata["timings_ms"]["store"] >= 2.0
+
+
+def test_histogram_buckets_are_cumulative():
+    histograms = StageHistograms(buckets=(0.01, 0.1, 1.0), tenants=frozenset({"tenant-0000001"}))
+    for ms in (5, 50, 500, 5000):
+        histograms.observe("tenant-0000001", "pruebas", "python", {"sign": ms})
+
+    text = histograms.render()
+    labels = 'stage="sign",tenant="tenant-0000001",ambiente="pruebas",signer="python"'
+    assert f'{NAME}_bucket{{{labels},le="0.01"}} 1' in text
+    assert f'{NAME}_bucket{{{labels},le="0.1"}} 2' in text
+    assert f'{NAME}_bucket{{{labels},le="1.0"}} 3' in text
+    assert f'{NAME}_bucket{{{labels},le="+Inf"}} 4' in text
+    assert f"{NAME}_count{{{labels}}} 4" in text
+    assert f"{NAME}_sum{{{labels}}} 5.555000" in text
+
+
+def test_stages_render_in_pipeline_order():
+    histograms = StageHistograms()
+    histograms.observe("tenant-0000001", "pruebas", "java", {"authorization": 1500, "lookup": 1, "sign": 20})
+    text = histograms.render()
+    assert text.index('stage="lookup"') < text.index('stage="sign"') < text.index('stage="authorization"')
+
+
+def test_tenant_label_is_opt_in():
+    histograms = StageHistograms(tenants=frozenset({"tenant-a000001"}))
+    for tenant in ("tenant-a000001", "tenant-b000001", "tenant-c000001"):
+        histograms.observe(tenant, "pruebas", "java", {"xml": 1})
+    text = histograms.render()
+    assert 'tenant="tenant-a000001"' in text
+    assert "tenant-b000001" not in text and "tenant-c000001" not in text
+    assert f'{NAME}_count{{stage="xml",tenant="other",ambiente="pruebas",signer="java"}} 2' in text
+
+
+def test_metrics_require_token():
+    assert metrics_authorized("Bearer s3cret", token="s3cret")
+    assert metrics_authorized("bearer s3cret", token="s3cret")
+    assert not metrics_authorized("Bearer otro", token="s3cret")
+    assert not metrics_authorized(None, token="s3cret")
+    # Sin METRICS_TOKEN el endpoint queda cerrado
+    assert not metrics_authorized("Bearer ", token="")
@@ -0,0 +1,44 @@
+"""
+Test del render de RIDE: el lock por documento se libera aunque el render falle
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("reportlab")
+
+import services.ride_cache as ride_cache_module  # noqa: E402
+from services.ride_cache import RideRenderer  # noqa: E402
+
+
+class _Files:
+    async def find_one(self, query, projection=None):
+        return None
+
+
+class _DB:
+    def __getitem__(self, name):
+        return _Files()
+
+
+def _renderer(monkeypatch, render):
+    monkeypatch.setattr(ride_cache_module, "AsyncIOMotorGridFSBucket", lambda db, bucket_name: None)
+    renderer = RideRenderer(workers=0)
+    monkeypatch.setattr(renderer, "_render", render)
+    return renderer
+
+
+def test_lock_released_when_render_fails(monkeypatch):
+    async def render(document, emitter, logo_base64):
+        raise RuntimeError("reportlab")
+
+    renderer = _renderer(monkeypatch, render)
+    document = {"_id": "doc-1", "tenant_id": "t1"}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(renderer.get_pdf(_DB(), document, {}, None, "etag"))
+    assert renderer._render_locks == {}
@@ -0,0 +1,63 @@
+"""
+Test del caché de firma: una réplica con el TenantContext viejo no firma con
+un certificado que otra réplica ya desactivó
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("lxml")
+
+import services.signing_cache as signing_cache_module  # noqa: E402
+from services.signing_cache import get_signing_context  # noqa: E402
+from middleware.tenant import tenant_cache, TenantContext  # noqa: E402
+
+
+class _Certificates:
+    def __init__(self, active_id):
+        self.active_id = active_id
+
+    async def find_one(self, query, projection=None):
+        if self.active_id is None or not query.get("is_active"):
+            return None
+        return {"_id": self.active_id}
+
+
+class _DB:
+    def __init__(self, active_id):
+        self.certificates = _Certificates(active_id)
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    certificates = []
+
+    async def get_or_load(db, tenant_id, certificate):
+        certificates.append(certificate["_id"])
+        return certificate["_id"]
+
+    monkeypatch.setattr(signing_cache_module.signing_cache, "get_or_load", get_or_load)
+    return certificates
+
+
+def test_signs_with_active_certificate_when_context_is_stale(loaded):
+    tenant_cache.put(TenantContext("tenant-0000001", {}, {}, {"_id": "cert-viejo"}))
+    asyncio.run(get_signing_context(_DB("cert-nuevo"), "tenant-0000001", {"_id": "cert-viejo"}))
+    assert loaded == ["cert-nuevo"]
+    # El contexto viejo se descarta en esta réplica
+    assert tenant_cache.get("tenant-0000001") is None
+
+
+def test_current_certificate_is_used_as_is(loaded):
+    asyncio.run(get_signing_context(_DB("cert-1"), "tenant-0000001", {"_id": "cert-1", "certificate_info": {}}))
+    assert loaded == ["cert-1"]
+
+
+def test_no_active_certificate_fails(loaded):
+    with pytest.raises(ValueError):
+        asyncio.run(get_signing_context(_DB(None), "tenant-0000001", {"_id": "cert-1"}))
+    assert loaded == []
@@ -0,0 +1,59 @@
+"""
+Test del pool de firma: recuperación cuando un proceso del pool muere
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("lxml")
+
+from services.signing_pool import SigningPool, _warm_up  # noqa: E402
+
+
+def test_broken_pool_is_rebuilt():
+    async def run():
+        pool = SigningPool(workers=1, max_pending=2)
+        await pool.start()
+        try:
+            broken = pool._executor
+            # Un proceso que termina abruptamente rompe el executor completo
+            with pytest.raises(Exception):
+                await asyncio.get_running_loop().run_in_executor(broken, os._exit, 1)
+            pid = await pool._run_in_pool(_warm_up)
+            return pool, pool._executor is not broken, pid
+        finally:
+            await pool.shutdown()
+
+    pool, replaced, pid = asyncio.run(run())
+    assert pid > 0
+    assert replaced
+    assert pool.restarts == 1
+
+
+def test_warm_cleared_while_rebuilding():
+    async def run():
+        pool = SigningPool(workers=1, max_pending=2)
+        await pool.start()
+        observed = []
+        try:
+            original_start = pool._start_executor
+
+            async def start_executor():
+                observed.append(pool.is_warm)
+                await original_start()
+
+            pool._start_executor = start_executor
+            with pytest.raises(Exception):
+                await asyncio.get_running_loop().run_in_executor(pool._executor, os._exit, 1)
+            await pool._run_in_pool(_warm_up)
+            return observed, pool.is_warm
+        finally:
+            await pool.shutdown()
+
+    observed, warm_after = asyncio.run(run())
+    assert observed == [False]
+    assert warm_after is True
@@ -0,0 +1,137 @@
+"""
+Test SRIClient contra el servidor SOAP local (tests/sri_stub_server.py)
+Valida envelopes, parser y reutilización de conexiones keep-alive
+"""
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services.sri_client import SRIClient, parse_sri_response, build_autorizacion_envelope  # noqa: E402
+from sri_stub_server import start_stub_server  # noqa: E402
+
+ACCESS_KEY = "1501202401179001234500110010010000000011234567813"
+XML_SIGNED = f'<?xml version="1.0" encoding="UTF-8"?><factura id="comprobante"><infoTributaria><claveAcceso>{ACCESS_KEY}</claveAcceso></infoTributaria></factura>'
+
+
+@pytest.fixture
+def stub():
+    server, state, base_url = start_stub_server()
+    yield state, base_url
+    server.shutdown()
+
+
+class TestSRIParser:
+    """Tests del parser de respuestas SOAP"""
+
+    def test_parse_unqualified_children(self):
+        content = b'''<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+        <ns2:validarComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.recepcion">
+        <RespuestaRecepcionComprobante><estado>DEVUELTA</estado><comprobantes><comprobante>
+        <mensajes><mensaje><identificador>35</identificador><mensaje>ARCHIVO NO CUMPLE</mensaje>
+        <informacionAdicional>detalle</informacionAdicional><tipo>ERROR</tipo></mensaje></mensajes>
+        </comprobante></comprobantes></RespuestaRecepcionComprobante>
+        </ns2:validarComprobanteResponse></soap:Body></soap:Envelope>'''
+        parsed = parse_sri_response(content)
+        assert parsed["estado"] == "DEVUELTA"
+        assert parsed["mensajes"] == [{
+            "identificador": "35",
+            "mensaje": "ARCHIVO NO CUMPLE",
+            "informacion_adicional": "detalle",
+            "tipo": "ERROR"
+        }]
+
+    def test_parse_namespaced_children(self):
+        content = b'''<ns2:RespuestaRecepcionComprobante xmlns:ns2="http://ec.gob.sri.ws.recepcion">
+        <ns2:estado>RECIBIDA</ns2:estado></ns2:RespuestaRecepcionComprobante>'''
+        assert parse_sri_response(content)["estado"] == "RECIBIDA"
+
+    def test_estado_with_space_is_normalized(self):
+        content = b'''<RespuestaAutorizacionComprobante><autorizaciones><autorizacion>
+        <estado>NO AUTORIZADO</estado></autorizacion></autorizaciones></RespuestaAutorizacionComprobante>'''
+        assert parse_sri_response(content)["estado"] == "NO_AUTORIZADO"
+
+    def test_autorizacion_envelope(self):
+        envelope = build_autorizacion_envelope(ACCESS_KEY)
+        assert f"<claveAccesoComprobante>{ACCESS_KEY}</claveAccesoComprobante>".encode() in envelope
+
+
+class TestSRIClientStub:
+    """Tests de SRIClient contra el servidor local"""
+
+    def test_emitir_y_autorizar(self, stub):
+        state, base_url = stub
+
+        async def run():
+            client = SRIClient(ambiente="pruebas", base_url=base_url)
+            try:
+                return await client.emitir_y_autorizar(XML_SIGNED, ACCESS_KEY, retry_delay=0.1)
+            finally:
+                await client.aclose()
+
+        estado, numero, fecha, mensajes = asyncio.run(run())
+        assert estado == "AUTORIZADO"
+        assert numero == ACCESS_KEY
+        assert fecha is not None
+        assert state.recibidas == [ACCESS_KEY]
+
+    def test_no_autorizado(self, stub):
+        state, base_url = stub
+        state.no_autorizar.add(ACCESS_KEY)
+
+        async def run():
+            client = SRIClient(ambiente="pruebas", base_url=base_url)
+            try:
+                return await client.emitir_y_autorizar(XML_SIGNED, ACCESS_KEY, retry_delay=0.1)
+            finally:
+                await client.aclose()
+
+        estado, numero, _, _ = asyncio.run(run())
+        assert estado == "NO_AUTORIZADO"
+        assert numero is None
+
+    def test_devuelta(self, stub):
+        state, base_url = stub
+        state.devolver.add(ACCESS_KEY)
+
+        async def run():
+            client = SRIClient(ambiente="pruebas", base_url=base_url)
+            try:
+                return await client.enviar_comprobante(XML_SIGNED)
+            finally:
+                await client.aclose()
+
+        recepcion = asyncio.run(run())
+        assert recepcion["estado"] == "DEVUELTA"
+        assert recepcion["mensajes"][0]["identificador"] == "43"
+
+    def test_en_proceso(self, stub):
+        state, base_url = stub
+        state.en_proceso.add(ACCESS_KEY)
+
+        async def run():
+            client = SRIClient(ambiente="pruebas", base_url=base_url)
+            try:
+                return await client.consultar_autorizacion(ACCESS_KEY)
+            finally:
+                await client.aclose()
+
+        assert asyncio.run(run())["estado"] == "EN_PROCESO"
+
+    def test_reuses_connection(self, stub):
+        state, base_url = stub
+
+        async def run():
+            client = SRIClient(ambiente="pruebas", base_url=base_url)
+            try:
+                for _ in range(5):
+                    await client.consultar_autorizacion(ACCESS_KEY)
+            finally:
+                await client.aclose()
+
+        asyncio.run(run())
+        assert state.requests == 5
+        assert state.connections == 1
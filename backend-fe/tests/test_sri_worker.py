@@ -0,0 +1,84 @@
+"""
+Test del worker SRI: las escrituras de un job filtran por su claim_token, así
+un worker cuyo lease venció no pisa al que lo reclamó después
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("lxml")
+
+import services.sri_worker as sri_worker_module  # noqa: E402
+from services.sri_worker import SRIWorker, JOB_DONE, JOB_PENDING, JOB_PROCESSING  # noqa: E402
+
+
+class _Result:
+    def __init__(self, matched_count: int):
+        self.matched_count = matched_count
+
+
+class _Jobs:
+    def __init__(self, *jobs):
+        self.jobs = {job["_id"]: dict(job) for job in jobs}
+
+    async def update_one(self, query, update):
+        for job in self.jobs.values():
+            if all(job.get(key) == value for key, value in query.items()):
+                job.update(update.get("$set", {}))
+                return _Result(1)
+        return _Result(0)
+
+
+class _DB:
+    def __init__(self, *jobs):
+        self.sri_jobs = _Jobs(*jobs)
+
+
+def _job(claim_token: str) -> dict:
+    return {
+        "_id": "job-1", "document_id": "doc-1", "tenant_id": "tenant-1", "doc_number": "001-001-000000001",
+        "access_key": "0" * 49, "ambiente": "pruebas", "stage": "autorizacion", "status": JOB_PROCESSING,
+        "attempts": 1, "claim_token": claim_token, "callback_url": None
+    }
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    results = []
+
+    async def apply_sri_result(db, document_id, tenant_id, sri_status, *args, **kwargs):
+        results.append(sri_status)
+
+    monkeypatch.setattr(sri_worker_module, "apply_sri_result", apply_sri_result)
+    return results
+
+
+def test_stale_worker_does_not_overwrite_result(applied):
+    # El lease del worker viejo venció y otro reclamó el job (claim_token "nuevo")
+    db = _DB(_job("nuevo"))
+    worker = SRIWorker(workers=0)
+    worker._db = db
+
+    asyncio.run(worker._finish(_job("viejo"), "NO_AUTORIZADO", None, None, []))
+    assert applied == []
+    assert db.sri_jobs.jobs["job-1"]["status"] == JOB_PROCESSING
+
+    asyncio.run(worker._finish(_job("nuevo"), "AUTORIZADO", "123", None, []))
+    assert applied == ["AUTORIZADO"]
+    assert db.sri_jobs.jobs["job-1"]["status"] == JOB_DONE
+
+
+def test_stale_worker_retry_is_ignored(applied):
+    db = _DB(_job("nuevo"))
+    worker = SRIWorker(workers=0)
+    worker._db = db
+
+    asyncio.run(worker._retry(_job("viejo"), [{"mensaje": "timeout"}], max_attempts=5))
+    assert db.sri_jobs.jobs["job-1"]["status"] == JOB_PROCESSING
+
+    asyncio.run(worker._retry(_job("nuevo"), [{"mensaje": "timeout"}], max_attempts=5))
+    assert db.sri_jobs.jobs["job-1"]["status"] == JOB_PENDING
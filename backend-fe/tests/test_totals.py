@@ -0,0 +1,137 @@
+"""
+Test del motor de totales (services/totals.py)
+Compara contra un cálculo de referencia con Decimal y valida las reglas SRI
+"""
+import os
+import sys
+import random
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models.document import ItemModel  # noqa: E402
+from services.totals import calculate_totals  # noqa: E402
+from services.xml_generator import generate_invoice_xml  # noqa: E402
+from xml_generator_dom import generate_invoice_xml_dom  # noqa: E402
+
+CENT = Decimal("0.01")
+RATE_CODES = {0: "0", 5: "5", 8: "8", 12: "2", 13: "10", 14: "3", 15: "4"}
+
+
+def item(quantity, unit_price, iva_rate=15, discount=0, iva_code=None, code="P1"):
+    return ItemModel(code=code, description="Producto", quantity=quantity, unit_price=unit_price,
+                     discount=discount, iva_rate=iva_rate, iva_code=iva_code)
+
+
+def reference_totals(items):
+    """Reglas SRI con Decimal: base por línea redondeada, IVA por tarifa sobre la suma de bases"""
+    bases = {}
+    for it in items:
+        base = (Decimal(repr(it.quantity)) * Decimal(repr(it.unit_price))).quantize(CENT, ROUND_HALF_UP)
+        base -= Decimal(repr(it.discount)).quantize(CENT, ROUND_HALF_UP)
+        rate = Decimal(repr(it.iva_rate))
+        code = it.iva_code or RATE_CODES[int(it.iva_rate)]
+        if it.iva_code in ("6", "7"):
+            rate = Decimal(0)
+        bases.setdefault(code, [rate, Decimal(0)])[1] += base
+    subtotal = sum(b for _, b in bases.values())
+    iva = {code: (b * r / 100).quantize(CENT, ROUND_HALF_UP) for code, (r, b) in bases.items()}
+    return bases, iva, subtotal + sum(iva.values())
+
+
+def random_items(rng, count):
+    return [
+        item(
+            quantity=rng.choice([1, 2, 3, 0.5, 1.25, 0.333333, 12.75]),
+            unit_price=rng.choice([0.01, 0.99, 1.005, 2.675, 19.99, round(rng.uniform(0, 500), 4)]),
+            iva_rate=rng.choice([0, 5, 8, 12, 15]),
+            discount=rng.choice([0, 0, 0.01, 0.5]),
+            code=f"P{i}"
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_matches_decimal_reference(seed):
+    rng = random.Random(seed)
+    items = random_items(rng, rng.choice([1, 10, 600]))
+    totals, processed = calculate_totals(items)
+    bases, iva, total = reference_totals(items)
+
+    assert Decimal(repr(totals["total"])) == total
+    breakdown = {tax["code"]: tax for tax in totals["iva_breakdown"]}
+    assert set(breakdown) == set(bases)
+    for code, (_, base) in bases.items():
+        assert Decimal(repr(breakdown[code]["base"])) == base
+        assert Decimal(repr(breakdown[code]["value"])) == iva[code]
+    assert len(processed) == len(items)
+
+
+def test_half_up_rounding():
+    # 2.675 en float es 2.67499999...; el SRI espera 2.68
+    totals, processed = calculate_totals([item(1, 2.675, iva_rate=0)])
+    assert processed[0]["subtotal"] == 2.68
+    assert totals["subtotal_0"] == 2.68
+
+    # 0.10 * 15% = 0.015 -> 0.02
+    totals, _ = calculate_totals([item(1, 0.10)])
+    assert totals["total_iva_15"] == 0.02
+    assert totals["total"] == 0.12
+
+
+def test_iva_is_computed_on_rate_base_not_per_line():
+    # 3 líneas de 0.10 al 15%: IVA por línea 0.02 (suma 0.06), por tarifa 0.05
+    totals, processed = calculate_totals([item(1, 0.10, code=f"P{i}") for i in range(3)])
+    assert [p["iva_amount"] for p in processed] == [0.02, 0.02, 0.02]
+    assert totals["total_iva_15"] == 0.05
+    assert totals["total"] == 0.35
+
+
+def test_other_rates_are_not_filed_as_15():
+    totals, processed = calculate_totals([item(1, 10, iva_rate=5), item(1, 10, iva_rate=8), item(1, 10, iva_rate=15)])
+    assert totals["subtotal_15"] == 10.0
+    assert totals["total_iva_15"] == 1.5
+    assert [(t["code"], t["base"], t["value"]) for t in totals["iva_breakdown"]] == [
+        ("5", 10.0, 0.5), ("8", 10.0, 0.8), ("4", 10.0, 1.5)
+    ]
+    assert [p["iva_code"] for p in processed] == ["5", "8", "4"]
+    assert totals["total"] == 32.8
+
+
+def test_not_subject_and_exempt():
+    totals, _ = calculate_totals([item(1, 4, iva_code="6"), item(1, 6, iva_code="7"), item(1, 10, iva_rate=0)])
+    assert totals["subtotal_not_subject"] == 4.0
+    assert totals["subtotal_exempt"] == 6.0
+    assert totals["subtotal_0"] == 10.0
+    assert totals["total_iva"] == 0.0
+    assert totals["total"] == 20.0
+
+
+def test_unsupported_rate():
+    with pytest.raises(ValueError):
+        calculate_totals([item(1, 10, iva_rate=7)])
+    with pytest.raises(ValueError):
+        calculate_totals([item(1, 10, iva_code="99")])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_xml_uses_breakdown(seed):
+    rng = random.Random(seed)
+    items = random_items(rng, 8)
+    totals, processed = calculate_totals(items)
+    kwargs = dict(
+        access_key="0605202401179001234500110010010000000421234567811",
+        emitter={"ruc": "1790012345001", "razon_social": "EMPRESA", "direccion": "Quito"},
+        customer={"identification_type": "05", "identification": "1712345678", "name": "CLIENTE"},
+        items=processed, totals=totals, payments=[{"method": "01", "total": totals["total"]}],
+        issue_date=datetime(2024, 5, 6), store_code="001", emission_point="001", sequential=1
+    )
+    xml = generate_invoice_xml(**kwargs)
+    assert xml == generate_invoice_xml_dom(**kwargs)
+    for tax in totals["iva_breakdown"]:
+        assert f"<codigoPorcentaje>{tax['code']}</codigoPorcentaje><baseImponible>{tax['base']:.2f}</baseImponible>" in xml
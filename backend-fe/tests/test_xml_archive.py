@@ -0,0 +1,243 @@
+"""
+Test del codec de archivo de XML firmados (zstd con diccionario, gzip y filas antiguas)
+"""
+import os
+import sys
+import copy
+import gzip
+import random
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+zstandard = pytest.importorskip("zstandard")
+
+from services.xml_archive import (  # noqa: E402
+    ArchiveDictionary, XMLArchive, encode_xml, decode_xml, iter_xml_chunks, row_codec, stored_size,
+    train_dictionary_bytes, CODEC_GZIP, CODEC_ZSTD
+)
+from bench_xml_archive import build_signed_xml  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = random.Random(7)
+    return [build_signed_xml(rng, n) for n in range(300)]
+
+
+@pytest.fixture(scope="module")
+def dictionary(corpus):
+    return ArchiveDictionary("tenant-1:1", train_dictionary_bytes(corpus[:200], dict_size=16 * 1024))
+
+
+class TestRoundTrip:
+
+    def test_zstd_with_dictionary(self, corpus, dictionary):
+        for xml in corpus[200:]:
+            row = encode_xml(xml, dictionary, codec=CODEC_ZSTD)
+            assert row["codec"] == CODEC_ZSTD and row["dict_id"] == "tenant-1:1"
+            assert row["size_bytes"] == len(xml)
+            assert decode_xml(row, dictionary) == xml
+
+    def test_zstd_without_dictionary(self, corpus):
+        row = encode_xml(corpus[0], codec=CODEC_ZSTD)
+        assert row["dict_id"] is None
+        assert decode_xml(row) == corpus[0]
+
+    def test_gzip(self, corpus):
+        row = encode_xml(corpus[0], codec=CODEC_GZIP)
+        assert row_codec(row) == CODEC_GZIP
+        assert decode_xml(row) == corpus[0]
+
+    def test_legacy_rows(self, corpus):
+        legacy_gzip = {"xml_gzip": gzip.compress(corpus[0]), "is_compressed": True}
+        legacy_plain = {"xml_signed": corpus[1].decode("utf-8"), "is_compressed": False}
+        assert decode_xml(legacy_gzip) == corpus[0]
+        assert decode_xml(legacy_plain) == corpus[1]
+
+    def test_chunks_match_full_decode(self, corpus, dictionary):
+        xml = b"".join(corpus[200:220])
+        row = encode_xml(xml, dictionary, codec=CODEC_ZSTD)
+        chunks = list(iter_xml_chunks(row, dictionary, chunk_size=256))
+        assert len(chunks) > 1
+        assert b"".join(chunks) == xml
+
+    def test_missing_dictionary(self, corpus, dictionary):
+        row = encode_xml(corpus[0], dictionary, codec=CODEC_ZSTD)
+        with pytest.raises(LookupError):
+            decode_xml(row)
+
+
+def test_dictionary_shrinks_rows(corpus, dictionary):
+    sample = corpus[200:]
+    with_dict = sum(stored_size(encode_xml(x, dictionary, codec=CODEC_ZSTD)) for x in sample)
+    gzip_only = sum(stored_size(encode_xml(x, codec=CODEC_GZIP)) for x in sample)
+    assert with_dict * 2 < gzip_only
+
+
+# ---- Compactación con escrituras concurrentes (colecciones en memoria) ----
+
+def _matches(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            for op, arg in condition.items():
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class _Cursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, field, direction=1):
+        self._docs.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self._docs = self._docs[:n]
+        return self
+
+    async def to_list(self, n):
+        return self._docs[:n]
+
+    def __aiter__(self):
+        self._iter = iter(self._docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _Collection:
+    def __init__(self):
+        self.docs = {}
+        self.on_bulk_write = None
+
+    def find(self, query, projection=None):
+        return _Cursor([copy.deepcopy(d) for d in self.docs.values() if _matches(d, query)])
+
+    async def find_one(self, query, projection=None, sort=None):
+        cursor = self.find(query)
+        if sort:
+            cursor.sort(*sort[0])
+        found = await cursor.to_list(1)
+        return found[0] if found else None
+
+    async def count_documents(self, query, limit=0):
+        return len([d for d in self.docs.values() if _matches(d, query)])
+
+    async def insert_one(self, doc):
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    async def delete_one(self, query):
+        for _id, doc in list(self.docs.items()):
+            if _matches(doc, query):
+                del self.docs[_id]
+                return
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            doc = self.docs[op._filter["_id"]]
+            doc.update(op._doc.get("$set", {}))
+            for field in op._doc.get("$unset", {}):
+                doc.pop(field, None)
+        if self.on_bulk_write is not None:
+            await self.on_bulk_write()
+
+
+class _DB:
+    def __init__(self):
+        self.document_xml = _Collection()
+        self.xml_dictionaries = _Collection()
+
+
+def _old(days: int = 2) -> datetime:
+    return datetime.now(timezone.utc) - timedelta(days=days)
+
+
+class TestCompactionWithConcurrentWrites:
+
+    def test_superseded_dictionary_survives_late_writes(self, corpus):
+        async def run():
+            db = _DB()
+            # v1 vigente desde hace tiempo; las filas del tenant usan v1
+            await db.xml_dictionaries.insert_one({
+                "_id": "tenant-1:1", "tenant_id": "tenant-1", "version": 1,
+                "dict_data": train_dictionary_bytes(corpus[:150], dict_size=16 * 1024), "created_at": _old()
+            })
+            writer = XMLArchive()   # otro proceso de backend-fe con v1 cacheado como vigente
+            for n, xml in enumerate(corpus[:150]):
+                fields = await writer.encode(db, "tenant-1", xml)
+                await db.document_xml.insert_one({"_id": f"row-{n:04d}", "tenant_id": "tenant-1",
+                                                  "created_at": _old(), **fields})
+
+            # Mientras la compactación recomprime, el otro proceso sigue escribiendo con v1
+            # (la compactación las alcanza y migra); la última llega después de que terminó
+            late = iter(enumerate(corpus[150:160]))
+
+            async def write_late_row():
+                n, xml = next(late, (None, None))
+                if xml is not None:
+                    fields = await writer.encode(db, "tenant-1", xml)
+                    await db.document_xml.insert_one({"_id": f"zz-{n:04d}", "tenant_id": "tenant-1",
+                                                      "created_at": datetime.now(timezone.utc), **fields})
+
+            db.document_xml.on_bulk_write = write_late_row
+            summary = await XMLArchive().compact_tenant(db, "tenant-1", train=True, batch_size=50)
+            db.document_xml.on_bulk_write = None
+            late = iter([(99, corpus[299])])
+            await write_late_row()
+            return db, summary
+
+        db, summary = asyncio.run(run())
+        assert summary["dict_id"] == "tenant-1:2"
+        assert summary["dictionaries_removed"] == 0
+        assert "tenant-1:1" in db.xml_dictionaries.docs
+        assert any(row.get("dict_id") == "tenant-1:1" for row in db.document_xml.docs.values())
+
+        # Un proceso recién iniciado (sin cachés) lee todas las filas
+        async def read_all():
+            reader = XMLArchive()
+            return [await reader.decode(db, row) for row in db.document_xml.docs.values()]
+
+        assert len(asyncio.run(read_all())) == len(db.document_xml.docs)
+
+    def test_retired_dictionary_removed_after_grace(self, corpus):
+        async def run():
+            db = _DB()
+            for version in (1, 2):
+                await db.xml_dictionaries.insert_one({
+                    "_id": f"tenant-1:{version}", "tenant_id": "tenant-1", "version": version,
+                    "dict_data": train_dictionary_bytes(corpus[:150], dict_size=16 * 1024),
+                    "created_at": _old(days=3 - version)
+                })
+            old = XMLArchive()
+            old._current["tenant-1"] = (float("inf"), "tenant-1:1")
+            for n, xml in enumerate(corpus[:20]):
+                fields = await old.encode(db, "tenant-1", xml)
+                await db.document_xml.insert_one({"_id": f"row-{n:04d}", "tenant_id": "tenant-1", **fields})
+            summary = await XMLArchive().compact_tenant(db, "tenant-1", train=False)
+            reader = XMLArchive()
+            decoded = [await reader.decode(db, row) for row in db.document_xml.docs.values()]
+            return db, summary, decoded
+
+        db, summary, decoded = asyncio.run(run())
+        assert summary["dict_id"] == "tenant-1:2"
+        assert summary["dictionaries_removed"] == 1
+        assert set(db.xml_dictionaries.docs) == {"tenant-1:2"}
+        assert decoded == corpus[:20]
@@ -0,0 +1,93 @@
+"""
+Test del generador XML precompilado
+Debe producir exactamente los mismos bytes que la implementación DOM de referencia
+"""
+import os
+import sys
+import random
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from services.xml_generator import generate_invoice_xml, generate_credit_note_xml  # noqa: E402
+from xml_generator_dom import generate_invoice_xml_dom, generate_credit_note_xml_dom  # noqa: E402
+
+ACCESS_KEY = "0605202401179001234500110010010000000421234567811"
+TEXT_CHARS = "abcXYZ 0123&<>\"'\r\n\t\x01\x7féñ€"
+CODE_CHARS = "AB12&<>\"é"
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(TEXT_CHARS) for _ in range(length))
+
+
+def build_case(rng: random.Random):
+    emitter = {
+        "ruc": "1790012345001",
+        "razon_social": random_text(rng, rng.choice([1, 20, 320])),
+        "nombre_comercial": rng.choice([None, "", random_text(rng, 15)]),
+        "direccion": random_text(rng, rng.choice([0, 30])),
+        "obligado_contabilidad": rng.choice(["SI", "NO"]),
+        "contribuyente_especial": rng.choice([None, "5368"])
+    }
+    customer = {
+        "identification_type": rng.choice(["05", "07"]),
+        "identification": "1712345678",
+        "name": random_text(rng, 25),
+        "address": rng.choice([None, random_text(rng, 40)])
+    }
+    items = []
+    for _ in range(rng.choice([1, 4, 120])):
+        items.append({
+            "code": "".join(rng.choice(CODE_CHARS) for _ in range(30)),
+            "auxiliary_code": rng.choice([None, "AUX&1"]),
+            "description": random_text(rng, rng.choice([5, 310])),
+            "quantity": rng.uniform(0.1, 10),
+            "unit_price": rng.uniform(0, 100),
+            "discount": rng.choice([0, 0.5]),
+            "iva_rate": rng.choice([0, 5, 12, 15])
+        })
+    totals = {
+        "subtotal_0": rng.choice([0, 10.5]),
+        "subtotal_12": rng.choice([0, 3.3]),
+        "subtotal_15": rng.choice([0, 7.77]),
+        "total_iva_12": 0.4,
+        "total_iva_15": 1.17,
+        "total_iva": 1.57,
+        "total_discount": 0.5,
+        "total": 23.14
+    }
+    payments = rng.choice([[], [{"method": "01", "total": 23.14, "term": 0}],
+                           [{"method": "19", "total": 23.14, "term": 30, "time_unit": "dias"}]])
+    return emitter, customer, items, totals, payments
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_invoice_xml_byte_identical(seed):
+    rng = random.Random(seed)
+    emitter, customer, items, totals, payments = build_case(rng)
+    kwargs = dict(
+        access_key=ACCESS_KEY, emitter=emitter, customer=customer, items=items, totals=totals,
+        payments=payments, issue_date=datetime(2024, 5, 6), store_code="1", emission_point="001",
+        sequential=42, ambiente=rng.choice(["pruebas", "produccion"])
+    )
+    assert generate_invoice_xml(**kwargs) == generate_invoice_xml_dom(**kwargs)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_credit_note_xml_byte_identical(seed):
+    rng = random.Random(seed)
+    emitter, customer, items, totals, _ = build_case(rng)
+    kwargs = dict(
+        access_key=ACCESS_KEY, emitter=emitter, customer=customer, items=items, totals=totals,
+        invoice_reference={
+            "doc_number": "001-001-000000001",
+            "issue_date": datetime(2024, 1, 2),
+            "reason": random_text(rng, 40)
+        },
+        issue_date=datetime(2024, 5, 6), store_code="001", emission_point="1", sequential=7
+    )
+    assert generate_credit_note_xml(**kwargs) == generate_credit_note_xml_dom(**kwargs)
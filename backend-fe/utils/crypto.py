@@ -2,10 +2,13 @@
 Utilidades de criptografía para el backend FE
 - Encriptación/desencriptación de contraseñas de certificados
 - Hashing
+- Firma HMAC de webhooks
 """
 import os
+import hmac
 import base64
 import hashlib
+from functools import lru_cache
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -14,9 +17,11 @@ from cryptography.hazmat.backends import default_backend
 # Obtener clave de encriptación del entorno
 ENCRYPTION_KEY = os.environ.get("ENCRYPTION_KEY", "fe-encryption-key-32-bytes-here!")
 
+@lru_cache(maxsize=8)
 def get_fernet_key(key: str) -> bytes:
     """
     Deriva una clave Fernet válida desde una clave string
+    (cacheada: PBKDF2 con 100k iteraciones es costoso y el resultado es determinista)
     """
     # Usar PBKDF2 para derivar clave de 32 bytes
     kdf = PBKDF2HMAC(
@@ -73,6 +78,14 @@ def hash_data(data: str) -> str:
     """
     return hashlib.sha256(data.encode()).hexdigest()
 
+def sign_webhook(secret: str, timestamp: str, body: bytes) -> str:
+    """
+    Firma HMAC-SHA256 de un webhook sobre "<timestamp>.<body>"
+    El receptor recalcula la firma con su webhook_secret y compara (X-FE-Signature)
+    """
+    mac = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256)
+    return f"sha256={mac.hexdigest()}"
+
 def generate_random_key(length: int = 32) -> str:
     """
     Genera una clave aleatoria segura
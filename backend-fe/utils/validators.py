@@ -2,7 +2,10 @@
 Validadores para datos fiscales SRI Ecuador
 """
 import re
-from typing import Tuple
+import socket
+import ipaddress
+from typing import List, Tuple
+from urllib.parse import urlsplit
 
 def validate_ruc(ruc: str) -> Tuple[bool, str]:
     """
@@ -122,6 +125,44 @@ def validate_phone(phone: str) -> Tuple[bool, str]:
     
     return True, "Teléfono válido"
 
+def validate_webhook_url(url: str) -> Tuple[bool, str]:
+    """
+    Valida el webhook del emisor: solo https y a un host público
+    (resuelve el DNS: ninguna dirección puede ser privada, loopback o link-local)
+    """
+    ok, message, _ = resolve_webhook_url(url)
+    return ok, message
+
+def resolve_webhook_url(url: str) -> Tuple[bool, str, List[str]]:
+    """
+    Como validate_webhook_url, y además retorna las direcciones validadas: el
+    envío se conecta a una de ellas (sin volver a resolver el DNS, que pudo
+    cambiar a una IP interna entre la validación y la conexión)
+    """
+    if not url:
+        return True, "Webhook vacío (opcional)", []
+    
+    parts = urlsplit(url)
+    if parts.scheme != "https":
+        return False, "El webhook debe usar https", []
+    if not parts.hostname or parts.username or parts.password:
+        return False, "URL de webhook inválida", []
+    
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        return False, "No se pudo resolver el host del webhook", []
+    
+    addresses = []
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            return False, "El webhook no puede apuntar a una red privada o interna", []
+        if str(ip) not in addresses:
+            addresses.append(str(ip))
+    
+    return True, "Webhook válido", addresses
+
 def validate_establishment_code(code: str) -> Tuple[bool, str]:
     """
     Valida código de establecimiento (3 dígitos)
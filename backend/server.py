@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, File, UploadFile, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, File, UploadFile
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Dict
 from datetime import datetime, timezone, timedelta
@@ -19,6 +23,7 @@ import base64
 import io
 import asyncio
 import secrets
+import hashlib
 from PIL import Image
 from dotenv import load_dotenv
 from pathlib import Path
@@ -426,6 +431,15 @@ class InvoiceCreate(BaseModel):
     mesero_id: Optional[str] = None
     mesero_nombre: Optional[str] = None
 
+class VentaOfflineCreate(InvoiceCreate):
+    """Venta registrada sin conexión en el dispositivo POS"""
+    idempotency_id: str  # Generado por el dispositivo, único por venta
+    fecha_cliente: Optional[str] = None  # ISO-8601 del momento de la venta en el dispositivo
+
+class FacturasBatchCreate(BaseModel):
+    ventas: List[VentaOfflineCreate]
+    enviar_cocina: bool = True
+
 class ImpuestoDesglose(BaseModel):
     nombre: str
     tasa: float
@@ -873,6 +887,105 @@ async def get_propietario_user(current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo el propietario puede gestionar usuarios")
     return current_user
 
+# ============ IDEMPOTENCIA (header Idempotency-Key) ============
+# Las respuestas exitosas se guardan en idempotency_keys (índice TTL sobre "creado")
+# para que los reintentos del POS devuelvan el mismo resultado sin re-ejecutar.
+
+IDEMPOTENCY_TTL_SEGUNDOS = int(os.environ.get("IDEMPOTENCY_TTL_SEGUNDOS", str(24 * 60 * 60)))
+# Tiempo tras el cual una ejecución "en_proceso" se considera abandonada; la
+# ejecución viva lo extiende cada IDEMPOTENCY_LOCK_SEGUNDOS / 3
+IDEMPOTENCY_LOCK_SEGUNDOS = 120
+
+async def _extender_bloqueo_idempotencia(key_id: str, propietario: str):
+    """Mantiene el bloqueo mientras la ejecución sigue viva (solo si aún es del propietario)"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LOCK_SEGUNDOS / 3)
+        try:
+            await db.idempotency_keys.update_one(
+                {"_id": key_id, "propietario": propietario, "estado": "en_proceso"},
+                {"$set": {"bloqueado_hasta": datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_LOCK_SEGUNDOS)}}
+            )
+        except Exception as e:
+            print(f"⚠️ Error extendiendo bloqueo de idempotencia: {e}")
+
+async def ejecutar_idempotente(request: Request, current_user: dict, payload: BaseModel, ejecutar):
+    """
+    Ejecuta `ejecutar()` una sola vez por Idempotency-Key.
+    - Sin header: ejecuta normalmente.
+    - Clave ya completada: devuelve la respuesta guardada (mismo payload) o 422 si el payload cambió.
+    - Clave en proceso: 409 para que el cliente reintente más tarde.
+    Los errores no se guardan: la clave se libera y el reintento vuelve a ejecutar.
+    Cada ejecución toma la clave con un token de propietario y extiende el bloqueo
+    mientras corre; liberar la clave o guardar la respuesta solo aplica si la
+    clave sigue siendo suya.
+    """
+    clave = request.headers.get("Idempotency-Key")
+    if not clave:
+        return await ejecutar()
+    
+    if len(clave) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado largo")
+    
+    key_id = f"{current_user['organizacion_id']}:{current_user['_id']}:{request.method}:{request.url.path}:{clave}"
+    huella = hashlib.sha256(payload.model_dump_json().encode()).hexdigest()
+    ahora = datetime.now(timezone.utc)
+    propietario = uuid.uuid4().hex
+    
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": key_id,
+            "organizacion_id": current_user["organizacion_id"],
+            "ruta": request.url.path,
+            "huella": huella,
+            "estado": "en_proceso",
+            "propietario": propietario,
+            "bloqueado_hasta": ahora + timedelta(seconds=IDEMPOTENCY_LOCK_SEGUNDOS),
+            "creado": ahora
+        })
+    except DuplicateKeyError:
+        existente = await db.idempotency_keys.find_one({"_id": key_id})
+        if existente and existente.get("huella") != huella:
+            raise HTTPException(
+                status_code=422,
+                detail={"code": "IDEMPOTENCY_KEY_REUSED", "message": "La Idempotency-Key ya se usó con otros datos"}
+            )
+        if existente and existente.get("estado") == "completado":
+            return JSONResponse(
+                content=existente["respuesta"],
+                status_code=existente.get("status_code", 200),
+                headers={"Idempotent-Replayed": "true"}
+            )
+        # En proceso: solo se retoma si la ejecución anterior quedó abandonada
+        tomado = await db.idempotency_keys.find_one_and_update(
+            {"_id": key_id, "estado": "en_proceso", "bloqueado_hasta": {"$lt": ahora}},
+            {"$set": {"propietario": propietario, "bloqueado_hasta": ahora + timedelta(seconds=IDEMPOTENCY_LOCK_SEGUNDOS)}}
+        )
+        if not tomado:
+            raise HTTPException(
+                status_code=409,
+                detail={"code": "IDEMPOTENCY_IN_PROGRESS", "message": "La petición original aún está en proceso"}
+            )
+    
+    bloqueo = asyncio.create_task(_extender_bloqueo_idempotencia(key_id, propietario))
+    try:
+        resultado = await ejecutar()
+    except BaseException:
+        await db.idempotency_keys.delete_one({"_id": key_id, "estado": "en_proceso", "propietario": propietario})
+        raise
+    finally:
+        bloqueo.cancel()
+    
+    await db.idempotency_keys.update_one(
+        {"_id": key_id, "propietario": propietario},
+        {"$set": {
+            "estado": "completado",
+            "status_code": 200,
+            "respuesta": jsonable_encoder(resultado),
+            "completado": datetime.now(timezone.utc)
+        }}
+    )
+    return resultado
+
 @app.on_event("startup")
 async def startup_db():
     admin_exists = await db.usuarios.find_one({"username": "admin"})
@@ -936,6 +1049,37 @@ async def startup_db():
         ]
         await db.metodos_pago.insert_many(metodos_default)
 
+    try:
+        # Normalizar organizacion_id de usuarios a string (datos legacy con ObjectId)
+        await db.usuarios.update_many(
+            {"organizacion_id": {"$type": "objectId"}},
+            [{"$set": {"organizacion_id": {"$toString": "$organizacion_id"}}}]
+        )
+
+        # Índices para login por PIN y resolución de códigos de tienda
+        await db.codigos_tienda.create_index("codigo", unique=True)
+        await db.codigos_tienda.create_index("tienda_id")
+        await db.usuarios.create_index([("organizacion_id", 1), ("pin", 1)])
+        
+        # Idempotency-Key: las respuestas guardadas expiran solas
+        await db.idempotency_keys.create_index("creado", expireAfterSeconds=IDEMPOTENCY_TTL_SEGUNDOS)
+        
+        # Ventas offline subidas por lote: una factura por idempotency_id
+        await db.facturas.create_index(
+            [("organizacion_id", 1), ("idempotency_id", 1)],
+            unique=True,
+            partialFilterExpression={"idempotency_id": {"$exists": True}}
+        )
+    except Exception as e:
+        print(f"⚠️ Error creando índices: {e}")
+
+    try:
+        if await db.codigos_tienda.estimated_document_count() == 0:
+            await sincronizar_codigos_tienda()
+    except Exception as e:
+        # resolver_codigo_tienda recurre a las búsquedas legacy para los códigos que falten
+        print(f"⚠️ Error cargando codigos_tienda: {e}")
+
 def generar_codigo_tienda(nombre_tienda: str) -> str:
     palabras = nombre_tienda.upper().replace('-', ' ').replace('_', ' ').split()
     letras = ''
@@ -953,9 +1097,103 @@ def generar_codigo_tienda(nombre_tienda: str) -> str:
     
     letras = letras[:4].ljust(4, 'X')
     digitos = str(uuid.uuid4().hex[:4]).upper()
-    
+
     return f"{letras}-{digitos}"
 
+# ============ BÚSQUEDA NORMALIZADA DE CÓDIGOS DE TIENDA ============
+# La colección codigos_tienda tiene un documento por código (índice único en "codigo")
+# con organizacion_id siempre como string, para que login por PIN y verificación
+# de tienda resuelvan el código con una sola lectura indexada.
+
+async def generar_codigo_tienda_unico(nombre_tienda: str) -> str:
+    """Genera un código de tienda que no esté registrado en codigos_tienda"""
+    for _ in range(10):
+        codigo = generar_codigo_tienda(nombre_tienda)
+        if not await db.codigos_tienda.find_one({"codigo": codigo}, {"_id": 1}):
+            return codigo
+    raise HTTPException(status_code=500, detail="No se pudo generar un código de tienda único")
+
+async def registrar_codigo_tienda(codigo: str, organizacion_id, tienda_id: Optional[str] = None, tienda_nombre: Optional[str] = None):
+    """
+    Registra un código en codigos_tienda.
+    Los códigos de tienda reemplazan la entrada existente; los de organización
+    (sin tienda_id) solo se insertan si el código aún no está registrado.
+    """
+    codigo = codigo.upper()
+    entrada = {
+        "codigo": codigo,
+        "organizacion_id": str(organizacion_id),
+        "tienda_id": tienda_id,
+        "tienda_nombre": tienda_nombre,
+        "actualizado": datetime.now(timezone.utc).isoformat()
+    }
+    operador = "$set" if tienda_id else "$setOnInsert"
+    await db.codigos_tienda.update_one({"codigo": codigo}, {operador: entrada}, upsert=True)
+
+async def resolver_codigo_tienda(codigo: str) -> Optional[dict]:
+    """
+    Resuelve un código de tienda a {organizacion_id, tienda_id, tienda_nombre}.
+    Primero hace una lectura puntual en codigos_tienda; si no existe, recurre a las
+    búsquedas legacy y registra el resultado para las siguientes llamadas.
+    """
+    codigo_upper = codigo.upper()
+    entrada = await db.codigos_tienda.find_one({"codigo": codigo_upper}, {"_id": 0})
+    if entrada:
+        return entrada
+
+    tienda = await db.tiendas.find_one({"codigo_tienda": codigo_upper})
+    if tienda:
+        await registrar_codigo_tienda(codigo_upper, tienda["organizacion_id"], tienda.get("id"), tienda.get("nombre"))
+        return {
+            "organizacion_id": str(tienda["organizacion_id"]),
+            "tienda_id": tienda.get("id"),
+            "tienda_nombre": tienda.get("nombre")
+        }
+
+    # codigo_establecimiento (compatibilidad): no es único entre organizaciones, no se registra
+    tienda = await db.tiendas.find_one({"codigo_establecimiento": codigo_upper})
+    if tienda:
+        return {
+            "organizacion_id": str(tienda["organizacion_id"]),
+            "tienda_id": tienda.get("id"),
+            "tienda_nombre": tienda.get("nombre")
+        }
+
+    org = await db.organizaciones.find_one({
+        "$or": [
+            {"codigo": codigo_upper},
+            {"codigo_tienda": codigo_upper},
+            {"_id": codigo}
+        ]
+    })
+    if org:
+        if codigo_upper in (org.get("codigo"), org.get("codigo_tienda")):
+            await registrar_codigo_tienda(codigo_upper, org["_id"])
+        return {"organizacion_id": str(org["_id"]), "tienda_id": None, "tienda_nombre": None}
+
+    return None
+
+async def sincronizar_codigos_tienda():
+    """
+    Carga inicial de codigos_tienda desde organizaciones y tiendas existentes.
+    Un código legacy duplicado o mal formado no corta la carga del resto.
+    """
+    fallidos = 0
+    async for org in db.organizaciones.find({"codigo_tienda": {"$exists": True, "$ne": None}}, {"codigo_tienda": 1}):
+        try:
+            await registrar_codigo_tienda(org["codigo_tienda"], org["_id"])
+        except Exception as e:
+            fallidos += 1
+            print(f"⚠️ No se pudo registrar el código de la organización {org['_id']}: {e}")
+    async for tienda in db.tiendas.find({"codigo_tienda": {"$exists": True, "$ne": None}}, {"codigo_tienda": 1, "organizacion_id": 1, "id": 1, "nombre": 1}):
+        try:
+            await registrar_codigo_tienda(tienda["codigo_tienda"], tienda["organizacion_id"], tienda.get("id"), tienda.get("nombre"))
+        except Exception as e:
+            fallidos += 1
+            print(f"⚠️ No se pudo registrar el código de la tienda {tienda.get('id')}: {e}")
+    if fallidos:
+        print(f"⚠️ codigos_tienda: {fallidos} códigos no registrados (se resolverán con la búsqueda legacy)")
+
 @app.post("/api/auth/login-pos")
 async def login_pos(pos_login: POSLogin, response: Response):
     org = await db.organizaciones.find_one({"codigo_tienda": pos_login.codigo_tienda.upper()})
@@ -2712,36 +2950,19 @@ async def validar_pin(request: ValidarPINRequest):
     PASO 1 del login: Valida el PIN y retorna los TPVs disponibles.
     No crea sesión aún - solo valida credenciales y muestra opciones.
     """
-    tienda = None
-    organizacion_id = None
+    # Resolver la tienda con una lectura indexada en codigos_tienda
+    resolucion = await resolver_codigo_tienda(request.codigo_tienda)
+    if not resolucion:
+        raise HTTPException(status_code=401, detail="Código de tienda no válido")
     
-    # Buscar la tienda por su codigo_tienda único
-    tienda = await db.tiendas.find_one({
-        "codigo_tienda": request.codigo_tienda.upper()
-    })
-    
-    if tienda:
-        organizacion_id = tienda["organizacion_id"]
-    else:
-        # Buscar por codigo_establecimiento (compatibilidad)
-        tienda = await db.tiendas.find_one({
-            "codigo_establecimiento": request.codigo_tienda.upper()
-        })
-        
-        if tienda:
-            organizacion_id = tienda["organizacion_id"]
-        else:
-            raise HTTPException(status_code=401, detail="Código de tienda no válido")
+    tienda_nombre = resolucion.get("tienda_nombre") or "Tienda"
     
-    # Buscar usuario con ese PIN
-    org_id_str = str(organizacion_id)
+    # Buscar usuario con ese PIN (organizacion_id normalizado a string)
+    org_id_str = resolucion["organizacion_id"]
     user = await db.usuarios.find_one({
+        "organizacion_id": org_id_str,
         "pin": request.pin,
-        "pin_activo": True,
-        "$or": [
-            {"organizacion_id": organizacion_id},
-            {"organizacion_id": org_id_str}
-        ]
+        "pin_activo": True
     })
     
     if not user:
@@ -2768,7 +2989,7 @@ async def validar_pin(request: ValidarPINRequest):
             },
             "tienda": {
                 "codigo": request.codigo_tienda.upper(),
-                "nombre": tienda["nombre"] if tienda else "Tienda"
+                "nombre": tienda_nombre
             },
             "sesion_activa": {
                 "tpv_id": tpv_id,
@@ -2780,7 +3001,7 @@ async def validar_pin(request: ValidarPINRequest):
             "tpvs_disponibles": [{
                 "id": tpv_id,
                 "nombre": (tpv_info.get("nombre") if tpv_info else "TPV") + " (Tu sesión activa)",
-                "tienda_nombre": tienda["nombre"] if tienda else "Tienda",
+                "tienda_nombre": tienda_nombre,
                 "punto_emision": tpv_info.get("punto_emision", "001") if tpv_info else "001",
                 "es_mi_caja": True
             }] if tpv_id else []
@@ -2811,7 +3032,7 @@ async def validar_pin(request: ValidarPINRequest):
             },
             "tienda": {
                 "codigo": request.codigo_tienda.upper(),
-                "nombre": tienda["nombre"] if tienda else "Tienda"
+                "nombre": tienda_nombre
             },
             "sesion_pausada": {
                 "tpv_id": tpv_id,
@@ -2865,7 +3086,7 @@ async def validar_pin(request: ValidarPINRequest):
         },
         "tienda": {
             "codigo": request.codigo_tienda.upper(),
-            "nombre": tienda["nombre"] if tienda else "Tienda"
+            "nombre": tienda_nombre
         },
         "sesion_pausada": None,
         "tpvs_disponibles": tpvs_disponibles,
@@ -2877,50 +3098,19 @@ async def validar_pin(request: ValidarPINRequest):
 async def login_con_pin(pin_login: PINLogin):
     """Login usando PIN + Código de Tienda (para cajeros, meseros y empleados con PIN activo)"""
     
-    tienda = None
-    organizacion_id = None
-    
-    # Primero buscar la tienda por su codigo_tienda único
-    tienda = await db.tiendas.find_one({
-        "codigo_tienda": pin_login.codigo_tienda.upper()
-    })
-    
-    if tienda:
-        organizacion_id = tienda["organizacion_id"]
-    else:
-        # Buscar por codigo_establecimiento (compatibilidad)
-        tienda = await db.tiendas.find_one({
-            "codigo_establecimiento": pin_login.codigo_tienda.upper()
-        })
-        
-        if tienda:
-            organizacion_id = tienda["organizacion_id"]
-        else:
-            # También buscar en organizaciones por código, codigo_tienda o ID
-            org = await db.organizaciones.find_one({
-                "$or": [
-                    {"codigo": pin_login.codigo_tienda.upper()},
-                    {"codigo_tienda": pin_login.codigo_tienda.upper()},
-                    {"_id": pin_login.codigo_tienda}
-                ]
-            })
-            if org:
-                organizacion_id = org["_id"]
-            else:
-                raise HTTPException(
-                    status_code=401, 
-                    detail="Código de tienda no válido"
-                )
+    # Resolver la tienda con una lectura indexada en codigos_tienda
+    resolucion = await resolver_codigo_tienda(pin_login.codigo_tienda)
+    if not resolucion:
+        raise HTTPException(
+            status_code=401, 
+            detail="Código de tienda no válido"
+        )
     
-    # Buscar usuario con ese PIN en esa organización
-    org_id_str = str(organizacion_id)
+    # Buscar usuario con ese PIN en esa organización (organizacion_id normalizado a string)
     user = await db.usuarios.find_one({
+        "organizacion_id": resolucion["organizacion_id"],
         "pin": pin_login.pin,
-        "pin_activo": True,
-        "$or": [
-            {"organizacion_id": organizacion_id},
-            {"organizacion_id": org_id_str}
-        ]
+        "pin_activo": True
     })
     
     if not user:
@@ -3179,7 +3369,7 @@ async def login_con_pin(pin_login: PINLogin):
     access_token = create_access_token(data={"sub": user_id, "session_id": session_id})
     
     # Obtener nombre de la tienda para mostrar
-    tienda_nombre = tienda["nombre"] if tienda else "Tienda Principal"
+    tienda_nombre = resolucion.get("tienda_nombre") or "Tienda Principal"
     
     # Obtener permisos del perfil del usuario
     permisos_response = None
@@ -3235,46 +3425,18 @@ async def login_con_pin(pin_login: PINLogin):
 async def verificar_codigo_tienda(codigo: str):
     """Verificar si un código de tienda es válido y devolver info básica + TPVs disponibles"""
     
-    tienda = None
-    organizacion_id = None
-    tienda_id = None
+    # Resolver la tienda con una lectura indexada en codigos_tienda
+    resolucion = await resolver_codigo_tienda(codigo)
+    if not resolucion:
+        raise HTTPException(status_code=404, detail="Código de tienda no encontrado")
     
-    # Primero buscar en tiendas por codigo_tienda (código único de cada tienda)
-    tienda = await db.tiendas.find_one({
-        "codigo_tienda": codigo.upper()
-    })
-    
-    if tienda:
-        organizacion_id = tienda["organizacion_id"]
-        tienda_id = tienda.get("id")
-    else:
-        # Buscar por codigo_establecimiento (compatibilidad)
-        tienda = await db.tiendas.find_one({
-            "codigo_establecimiento": codigo.upper()
-        })
-        
-        if tienda:
-            organizacion_id = tienda["organizacion_id"]
-            tienda_id = tienda.get("id")
-        else:
-            # Buscar en organizaciones por múltiples campos
-            org = await db.organizaciones.find_one({
-                "$or": [
-                    {"codigo": codigo.upper()},
-                    {"codigo_tienda": codigo.upper()},
-                    {"_id": codigo}
-                ]
-            })
-            
-            if org:
-                organizacion_id = org["_id"]
-            else:
-                raise HTTPException(status_code=404, detail="Código de tienda no encontrado")
+    organizacion_id = resolucion["organizacion_id"]
+    tienda_id = resolucion.get("tienda_id")
     
     # Obtener info de la organización
     org = await db.organizaciones.find_one({"_id": organizacion_id})
     org_nombre = org.get("nombre", "Organización") if org else "Organización"
-    tienda_nombre = tienda["nombre"] if tienda else "Tienda Principal"
+    tienda_nombre = resolucion.get("tienda_nombre") or "Tienda Principal"
     
     # Obtener TPVs disponibles para esta tienda/organización
     tpvs_query = {"organizacion_id": str(organizacion_id)}
@@ -3478,6 +3640,8 @@ async def delete_organizacion(org_id: str, current_user: dict = Depends(get_curr
     await db.clientes.delete_many({"organizacion_id": org_id})
     await db.cajas.delete_many({"organizacion_id": org_id})
     await db.configuraciones.delete_one({"_id": org_id})
+    # Si no, el login por PIN seguiría resolviendo los códigos de la organización eliminada
+    await db.codigos_tienda.delete_many({"organizacion_id": str(org["_id"])})
     await db.organizaciones.delete_one({"_id": org_id})
     
     return {"message": "Organización eliminada correctamente"}
@@ -3906,7 +4070,7 @@ async def create_tienda(tienda: TiendaCreate, current_user: dict = Depends(get_c
     tienda_id = str(uuid.uuid4())
     
     # Generar código único para esta tienda
-    codigo_tienda = generar_codigo_tienda(tienda.nombre)
+    codigo_tienda = await generar_codigo_tienda_unico(tienda.nombre)
     
     nueva_tienda = {
         "id": tienda_id,
@@ -3923,6 +4087,7 @@ async def create_tienda(tienda: TiendaCreate, current_user: dict = Depends(get_c
     }
     
     await db.tiendas.insert_one(nueva_tienda)
+    await registrar_codigo_tienda(codigo_tienda, current_user["organizacion_id"], tienda_id, tienda.nombre)
     
     return TiendaResponse(
         id=tienda_id,
@@ -3971,6 +4136,12 @@ async def update_tienda(tienda_id: str, tienda: TiendaCreate, current_user: dict
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Tienda no encontrada")
     
+    # Mantener el nombre en la colección de búsqueda de códigos
+    await db.codigos_tienda.update_many(
+        {"tienda_id": tienda_id},
+        {"$set": {"tienda_nombre": tienda.nombre, "actualizado": datetime.now(timezone.utc).isoformat()}}
+    )
+    
     # Obtener la tienda actualizada y el código de tienda
     tienda_actualizada = await db.tiendas.find_one({"id": tienda_id}, {"_id": 0})
     org = await db.organizaciones.find_one({"_id": current_user["organizacion_id"]})
@@ -4002,6 +4173,8 @@ async def delete_tienda(tienda_id: str, current_user: dict = Depends(get_current
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Tienda no encontrada")
     
+    await db.codigos_tienda.delete_many({"tienda_id": tienda_id})
+    
     return {"message": "Tienda eliminada correctamente"}
 
 @app.post("/api/tiendas/{tienda_id}/regenerar-codigo")
@@ -4019,13 +4192,17 @@ async def regenerar_codigo_tienda(tienda_id: str, current_user: dict = Depends(g
         raise HTTPException(status_code=404, detail="Tienda no encontrada")
     
     # Generar nuevo código único
-    nuevo_codigo = generar_codigo_tienda(tienda["nombre"])
+    nuevo_codigo = await generar_codigo_tienda_unico(tienda["nombre"])
     
     await db.tiendas.update_one(
         {"id": tienda_id},
         {"$set": {"codigo_tienda": nuevo_codigo}}
     )
     
+    # Reemplazar el código anterior en la colección de búsqueda
+    await db.codigos_tienda.delete_many({"tienda_id": tienda_id})
+    await registrar_codigo_tienda(nuevo_codigo, current_user["organizacion_id"], tienda_id, tienda["nombre"])
+    
     return {"codigo_tienda": nuevo_codigo, "message": "Código regenerado correctamente"}
 
 # TPV (Dispositivos de Punto de Venta)
@@ -4500,7 +4677,10 @@ async def get_tickets_abiertos_pos(current_user: dict = Depends(get_current_user
     return result
 
 @app.post("/api/tickets-abiertos-pos")
-async def create_ticket_abierto(ticket: TicketAbiertoCreate, current_user: dict = Depends(get_current_user)):
+async def create_ticket_abierto(ticket: TicketAbiertoCreate, request: Request, current_user: dict = Depends(get_current_user)):
+    return await ejecutar_idempotente(request, current_user, ticket, lambda: _create_ticket_abierto(ticket, current_user))
+
+async def _create_ticket_abierto(ticket: TicketAbiertoCreate, current_user: dict):
     caja_id = None
     
     # Los meseros no necesitan caja activa para guardar tickets
@@ -5535,7 +5715,10 @@ async def get_caja_activa(current_user: dict = Depends(get_current_user)):
     )
 
 @app.post("/api/caja/abrir")
-async def abrir_caja(apertura: CajaApertura, current_user: dict = Depends(get_current_user)):
+async def abrir_caja(apertura: CajaApertura, request: Request, current_user: dict = Depends(get_current_user)):
+    return await ejecutar_idempotente(request, current_user, apertura, lambda: _abrir_caja(apertura, current_user))
+
+async def _abrir_caja(apertura: CajaApertura, current_user: dict):
     caja_abierta = await db.cajas.find_one({
         "usuario_id": current_user["_id"],
         "estado": "abierta"
@@ -6059,24 +6242,11 @@ async def cerrar_caja_admin(caja_id: str, cierre: CajaCierre, current_user: dict
         ventas_por_metodo=ventas_por_metodo
     )
 
-@app.post("/api/facturas", response_model=InvoiceResponse)
-async def create_factura(invoice: InvoiceCreate, current_user: dict = Depends(get_current_user)):
-    # Verificar límite de facturas del plan
-    puede, mensaje, _, _ = await verificar_limite_plan(current_user["organizacion_id"], "facturas")
-    if not puede:
-        raise HTTPException(status_code=403, detail={"code": "PLAN_LIMIT", "message": mensaje})
-    
-    caja_activa = await db.cajas.find_one({
-        "usuario_id": current_user["_id"],
-        "estado": "abierta"
-    })
-    
-    if not caja_activa:
-        raise HTTPException(status_code=400, detail="Debes abrir una caja antes de realizar ventas")
-    
-    invoice_id = str(uuid.uuid4())
-    
-    # Determinar el formato de numeración de factura (Formato SRI obligatorio)
+async def _obtener_punto_emision(caja_activa: dict, current_user: dict) -> tuple:
+    """
+    Retorna (codigo_establecimiento, punto_emision) de la caja activa.
+    Si la caja no tiene datos de TPV, los obtiene o crea un TPV automáticamente.
+    """
     codigo_establecimiento = caja_activa.get("codigo_establecimiento")
     punto_emision = caja_activa.get("punto_emision")
     
@@ -6169,41 +6339,69 @@ async def create_factura(invoice: InvoiceCreate, current_user: dict = Depends(ge
                 }}
             )
     
-    # Numeración SRI: XXX-YYY-ZZZZZZZZZ
-    contador_id = f"factura_{current_user['organizacion_id']}_{codigo_establecimiento}_{punto_emision}"
-    counter = await db.contadores.find_one({"_id": contador_id})
-    if not counter:
-        numero = 1
-        await db.contadores.insert_one({"_id": contador_id, "seq": 1})
-    else:
-        numero = counter["seq"] + 1
-        await db.contadores.update_one(
-            {"_id": contador_id},
-            {"$set": {"seq": numero}}
-        )
-    
-    numero_factura = f"{codigo_establecimiento}-{punto_emision}-{numero:09d}"
-    
-    cliente_nombre = None
-    if invoice.cliente_id:
-        cliente = await db.clientes.find_one({"_id": invoice.cliente_id})
-        if cliente:
-            cliente_nombre = cliente["nombre"]
-    
-    # Obtener nombre del método de pago
-    metodo_pago_nombre = None
-    if invoice.metodo_pago_id:
-        metodo = await db.metodos_pago.find_one({"id": invoice.metodo_pago_id}, {"_id": 0})
-        if metodo:
-            metodo_pago_nombre = metodo["nombre"]
-    
-    # Obtener nombre del tipo de pedido
-    tipo_pedido_nombre = None
-    if invoice.tipo_pedido_id:
-        tipo = await db.tipos_pedido.find_one({"id": invoice.tipo_pedido_id}, {"_id": 0})
-        if tipo:
-            tipo_pedido_nombre = tipo["nombre"]
-    
+    return codigo_establecimiento, punto_emision
+
+def _contador_factura_id(organizacion_id: str, codigo_establecimiento: str, punto_emision: str) -> str:
+    return f"factura_{organizacion_id}_{codigo_establecimiento}_{punto_emision}"
+
+async def _reservar_numeros_factura(organizacion_id: str, codigo_establecimiento: str, punto_emision: str, cantidad: int = 1) -> int:
+    """
+    Reserva atómicamente `cantidad` secuenciales consecutivos del contador de la caja.
+    Retorna el primer número reservado.
+    """
+    counter = await db.contadores.find_one_and_update(
+        {"_id": _contador_factura_id(organizacion_id, codigo_establecimiento, punto_emision)},
+        {"$inc": {"seq": cantidad}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - cantidad + 1
+
+async def _compactar_numeros_lote(organizacion_id: str, codigo_establecimiento: str, punto_emision: str,
+                                  primer_numero: int, reservados: int, insertados: list, ordenes_cocina: dict):
+    """
+    Un lote reservó `reservados` números pero no todas sus facturas se insertaron
+    (p.ej. idempotency_id subido en paralelo por otro request). Renumera las
+    insertadas de forma consecutiva desde primer_numero y devuelve al contador los
+    números sobrantes si nadie reservó después; si alguien lo hizo, los sobrantes
+    quedan registrados en numeros_factura_descartados.
+    """
+    cambios = []
+    for offset, documento in enumerate(insertados):
+        numero_factura = f"{codigo_establecimiento}-{punto_emision}-{primer_numero + offset:09d}"
+        if documento["numero"] != numero_factura:
+            documento["numero"] = numero_factura
+            cambios.append(UpdateOne({"_id": documento["_id"]}, {"$set": {"numero": numero_factura}}))
+            if documento["id"] in ordenes_cocina:
+                ordenes_cocina[documento["id"]]["numero"] = numero_factura
+    if cambios:
+        # En orden: cada factura baja a un número ya libre (rechazado o dejado por la anterior)
+        await db.facturas.bulk_write(cambios, ordered=True)
+    
+    sobrantes = reservados - len(insertados)
+    ultimo = primer_numero + reservados - 1
+    devuelto = await db.contadores.find_one_and_update(
+        {"_id": _contador_factura_id(organizacion_id, codigo_establecimiento, punto_emision), "seq": ultimo},
+        {"$inc": {"seq": -sobrantes}}
+    )
+    if devuelto is None:
+        await db.numeros_factura_descartados.insert_one({
+            "id": str(uuid.uuid4()),
+            "organizacion_id": organizacion_id,
+            "numeros": [
+                f"{codigo_establecimiento}-{punto_emision}-{numero:09d}"
+                for numero in range(primer_numero + len(insertados), ultimo + 1)
+            ],
+            "motivo": "Ventas del lote no insertadas (duplicadas o con error)",
+            "fecha": datetime.now(timezone.utc).isoformat()
+        })
+
+def _calcular_totales_factura(invoice: InvoiceCreate, impuestos_activos: Optional[list]) -> dict:
+    """
+    Calcula subtotal, descuentos, desglose de impuestos y total de una venta.
+    Si el frontend envió desglose de impuestos se usa tal cual; si no, se calcula
+    con impuestos_activos.
+    """
     # Calcular subtotal de items (sin impuestos)
     subtotal = sum(item.subtotal for item in invoice.items)
     
@@ -6214,17 +6412,12 @@ async def create_factura(invoice: InvoiceCreate, current_user: dict = Depends(ge
     # Subtotal después de descuentos
     subtotal_con_descuento = subtotal - descuento_total
     
-    # Si el frontend envió desglose de impuestos, usarlo; si no, calcular en backend
     if invoice.desglose_impuestos and len(invoice.desglose_impuestos) > 0:
         desglose_impuestos = invoice.desglose_impuestos
         total_impuestos = invoice.impuesto or 0
         total_final = invoice.total
     else:
-        # Obtener impuestos activos de la organización
-        impuestos_activos = await db.impuestos.find({
-            "organizacion_id": current_user["organizacion_id"],
-            "activo": True
-        }, {"_id": 0}).to_list(100)
+        impuestos_activos = impuestos_activos or []
         
         # Calcular impuestos sobre el subtotal con descuento
         desglose_impuestos = []
@@ -6251,20 +6444,87 @@ async def create_factura(invoice: InvoiceCreate, current_user: dict = Depends(ge
         else:
             total_final = subtotal_con_descuento
     
-    total_impuestos = round(total_impuestos, 2)
-    total_final = round(total_final, 2)
+    return {
+        "subtotal": subtotal,
+        "descuento": descuento_total,
+        "descuentos_detalle": [d.model_dump() if hasattr(d, 'model_dump') else d for d in descuentos_detalle],
+        "total_impuestos": round(total_impuestos, 2),
+        "desglose_impuestos": desglose_impuestos,
+        "total": round(total_final, 2)
+    }
+
+async def _cargar_grupos_cocina(organizacion_id: str) -> Optional[dict]:
+    """
+    Retorna el mapeo categoría -> grupos de impresora de cocina,
+    o None si la función de impresoras de cocina no está activa.
+    """
+    config_funciones = await db.config_funciones.find_one({"organizacion_id": organizacion_id})
+    if not (config_funciones and config_funciones.get("impresoras_cocina", False)):
+        return None
+    
+    grupos_impresora = await db.grupos_impresora.find(
+        {"organizacion_id": organizacion_id}
+    ).to_list(100)
     
-    new_invoice = {
+    # Crear mapeo de categoría -> grupos
+    categoria_grupos = {}
+    for grupo in grupos_impresora:
+        for cat_id in grupo.get("categorias", []):
+            if cat_id not in categoria_grupos:
+                categoria_grupos[cat_id] = []
+            categoria_grupos[cat_id].append({
+                "grupo_id": grupo["id"],
+                "grupo_nombre": grupo["nombre"]
+            })
+    return categoria_grupos
+
+def _construir_orden_cocina(invoice: InvoiceCreate, invoice_id: str, numero_factura: str, current_user: dict, categoria_grupos: dict) -> Optional[dict]:
+    """Crea la orden de impresión para cocina (venta directa); None si no hay items para imprimir"""
+    orden_cocina = {
+        "id": str(uuid.uuid4()),
+        "factura_id": invoice_id,
+        "numero": numero_factura,
+        "mesa": invoice.comentarios if invoice.comentarios else None,
+        "mesero": invoice.mesero_nombre if invoice.mesero_nombre else None,
+        "cajero": current_user["nombre"],
+        "items": [],
+        "organizacion_id": current_user["organizacion_id"],
+        "impreso": False,
+        "creado": datetime.now(timezone.utc).isoformat(),
+        "tipo": "venta_directa"
+    }
+    
+    # Agregar items con sus grupos de destino
+    for item in invoice.items:
+        item_dict = item.model_dump() if hasattr(item, 'model_dump') else item
+        categoria_id = item_dict.get("categoria_id")
+        if categoria_id and categoria_id in categoria_grupos:
+            for grupo_destino in categoria_grupos[categoria_id]:
+                orden_cocina["items"].append({
+                    "producto_id": item_dict.get("producto_id"),
+                    "nombre": item_dict.get("nombre"),
+                    "cantidad": item_dict.get("cantidad"),
+                    "notas": item_dict.get("notas", ""),
+                    "grupo_id": grupo_destino["grupo_id"],
+                    "grupo_nombre": grupo_destino["grupo_nombre"]
+                })
+    
+    # Solo guardar si hay items para imprimir
+    return orden_cocina if orden_cocina["items"] else None
+
+def _construir_documento_factura(invoice: InvoiceCreate, invoice_id: str, numero_factura: str, totales: dict, current_user: dict, caja_activa: dict, nombres: dict, fecha: str) -> dict:
+    """Arma el documento de factura a insertar en db.facturas"""
+    return {
         "_id": invoice_id,
         "id": invoice_id,
         "numero": numero_factura,
         "items": [item.model_dump() for item in invoice.items],
-        "subtotal": subtotal,
-        "descuento": descuento_total,
-        "descuentos_detalle": [d.model_dump() if hasattr(d, 'model_dump') else d for d in descuentos_detalle],
-        "total_impuestos": total_impuestos,
-        "desglose_impuestos": desglose_impuestos,
-        "total": total_final,
+        "subtotal": totales["subtotal"],
+        "descuento": totales["descuento"],
+        "descuentos_detalle": totales["descuentos_detalle"],
+        "total_impuestos": totales["total_impuestos"],
+        "desglose_impuestos": totales["desglose_impuestos"],
+        "total": totales["total"],
         "vendedor": current_user["_id"],
         "vendedor_nombre": current_user["nombre"],
         # Guardar mesero original si viene del frontend (ticket guardado por mesero)
@@ -6276,109 +6536,312 @@ async def create_factura(invoice: InvoiceCreate, current_user: dict = Depends(ge
         "organizacion_id": current_user["organizacion_id"],
         "caja_id": caja_activa["_id"],
         "cliente_id": invoice.cliente_id,
-        "cliente_nombre": cliente_nombre,
+        "cliente_nombre": nombres.get("cliente"),
         "comentarios": invoice.comentarios,
         "metodo_pago_id": invoice.metodo_pago_id,
-        "metodo_pago_nombre": metodo_pago_nombre,
+        "metodo_pago_nombre": nombres.get("metodo_pago"),
         "tipo_pedido_id": invoice.tipo_pedido_id,
-        "tipo_pedido_nombre": tipo_pedido_nombre,
-        "fecha": datetime.now(timezone.utc).isoformat()
+        "tipo_pedido_nombre": nombres.get("tipo_pedido"),
+        "fecha": fecha
     }
+
+def _factura_response(factura: dict) -> InvoiceResponse:
+    return InvoiceResponse(
+        id=factura["id"],
+        numero=factura["numero"],
+        items=factura["items"],
+        subtotal=factura["subtotal"],
+        descuento=factura["descuento"],
+        descuentos_detalle=factura["descuentos_detalle"],
+        total_impuestos=factura["total_impuestos"],
+        desglose_impuestos=[ImpuestoDesglose(**imp) for imp in factura["desglose_impuestos"]],
+        total=factura["total"],
+        vendedor=factura["vendedor"],
+        vendedor_nombre=factura["vendedor_nombre"],
+        organizacion_id=factura["organizacion_id"],
+        caja_id=factura["caja_id"],
+        cliente_id=factura["cliente_id"],
+        cliente_nombre=factura["cliente_nombre"],
+        comentarios=factura["comentarios"],
+        metodo_pago_id=factura["metodo_pago_id"],
+        metodo_pago_nombre=factura["metodo_pago_nombre"],
+        tipo_pedido_id=factura["tipo_pedido_id"],
+        tipo_pedido_nombre=factura["tipo_pedido_nombre"],
+        fecha=factura["fecha"],
+        mesero_id=factura["mesero_id"],
+        mesero_nombre=factura["mesero_nombre"],
+        cobrado_por_id=factura["cobrado_por_id"],
+        cobrado_por_nombre=factura["cobrado_por_nombre"]
+    )
+
+@app.post("/api/facturas", response_model=InvoiceResponse)
+async def create_factura(invoice: InvoiceCreate, request: Request, current_user: dict = Depends(get_current_user)):
+    return await ejecutar_idempotente(request, current_user, invoice, lambda: _create_factura(invoice, current_user))
+
+async def _create_factura(invoice: InvoiceCreate, current_user: dict):
+    # Verificar límite de facturas del plan
+    puede, mensaje, _, _ = await verificar_limite_plan(current_user["organizacion_id"], "facturas")
+    if not puede:
+        raise HTTPException(status_code=403, detail={"code": "PLAN_LIMIT", "message": mensaje})
+    
+    caja_activa = await db.cajas.find_one({
+        "usuario_id": current_user["_id"],
+        "estado": "abierta"
+    })
+    
+    if not caja_activa:
+        raise HTTPException(status_code=400, detail="Debes abrir una caja antes de realizar ventas")
+    
+    invoice_id = str(uuid.uuid4())
+    
+    # Determinar el formato de numeración de factura (Formato SRI obligatorio)
+    codigo_establecimiento, punto_emision = await _obtener_punto_emision(caja_activa, current_user)
+    
+    # Numeración SRI: XXX-YYY-ZZZZZZZZZ
+    numero = await _reservar_numeros_factura(current_user["organizacion_id"], codigo_establecimiento, punto_emision)
+    numero_factura = f"{codigo_establecimiento}-{punto_emision}-{numero:09d}"
+    
+    nombres = {}
+    if invoice.cliente_id:
+        cliente = await db.clientes.find_one({"_id": invoice.cliente_id})
+        if cliente:
+            nombres["cliente"] = cliente["nombre"]
+    
+    # Obtener nombre del método de pago
+    if invoice.metodo_pago_id:
+        metodo = await db.metodos_pago.find_one({"id": invoice.metodo_pago_id}, {"_id": 0})
+        if metodo:
+            nombres["metodo_pago"] = metodo["nombre"]
+    
+    # Obtener nombre del tipo de pedido
+    if invoice.tipo_pedido_id:
+        tipo = await db.tipos_pedido.find_one({"id": invoice.tipo_pedido_id}, {"_id": 0})
+        if tipo:
+            nombres["tipo_pedido"] = tipo["nombre"]
+    
+    # Si el frontend no envió desglose de impuestos, calcular con los impuestos activos
+    impuestos_activos = None
+    if not invoice.desglose_impuestos:
+        impuestos_activos = await db.impuestos.find({
+            "organizacion_id": current_user["organizacion_id"],
+            "activo": True
+        }, {"_id": 0}).to_list(100)
+    
+    totales = _calcular_totales_factura(invoice, impuestos_activos)
+    
+    new_invoice = _construir_documento_factura(
+        invoice, invoice_id, numero_factura, totales, current_user, caja_activa, nombres,
+        datetime.now(timezone.utc).isoformat()
+    )
     await db.facturas.insert_one(new_invoice)
     
     # ============ ENVIAR A IMPRESORAS DE COCINA ============
-    # Verificar si la función de impresoras de cocina está activa
-    config_funciones = await db.config_funciones.find_one({"organizacion_id": current_user["organizacion_id"]})
-    if config_funciones and config_funciones.get("impresoras_cocina", False):
-        # Obtener grupos de impresora
-        grupos_impresora = await db.grupos_impresora.find(
-            {"organizacion_id": current_user["organizacion_id"]}
-        ).to_list(100)
-        
-        if grupos_impresora:
-            # Crear mapeo de categoría -> grupos
-            categoria_grupos = {}
-            for grupo in grupos_impresora:
-                for cat_id in grupo.get("categorias", []):
-                    if cat_id not in categoria_grupos:
-                        categoria_grupos[cat_id] = []
-                    categoria_grupos[cat_id].append({
-                        "grupo_id": grupo["id"],
-                        "grupo_nombre": grupo["nombre"]
-                    })
-            
-            # Crear orden de impresión para cocina (venta directa)
-            orden_cocina = {
-                "id": str(uuid.uuid4()),
-                "factura_id": invoice_id,
-                "numero": numero_factura,
-                "mesa": invoice.comentarios if invoice.comentarios else None,
-                "mesero": invoice.mesero_nombre if invoice.mesero_nombre else None,
-                "cajero": current_user["nombre"],
-                "items": [],
-                "organizacion_id": current_user["organizacion_id"],
-                "impreso": False,
-                "creado": datetime.now(timezone.utc).isoformat(),
-                "tipo": "venta_directa"
-            }
-            
-            # Agregar items con sus grupos de destino
-            for item in invoice.items:
-                item_dict = item.model_dump() if hasattr(item, 'model_dump') else item
-                categoria_id = item_dict.get("categoria_id")
-                if categoria_id and categoria_id in categoria_grupos:
-                    for grupo_destino in categoria_grupos[categoria_id]:
-                        orden_cocina["items"].append({
-                            "producto_id": item_dict.get("producto_id"),
-                            "nombre": item_dict.get("nombre"),
-                            "cantidad": item_dict.get("cantidad"),
-                            "notas": item_dict.get("notas", ""),
-                            "grupo_id": grupo_destino["grupo_id"],
-                            "grupo_nombre": grupo_destino["grupo_nombre"]
-                        })
-            
-            # Solo guardar si hay items para imprimir
-            if orden_cocina["items"]:
-                await db.ordenes_cocina.insert_one(orden_cocina)
+    categoria_grupos = await _cargar_grupos_cocina(current_user["organizacion_id"])
+    if categoria_grupos:
+        orden_cocina = _construir_orden_cocina(invoice, invoice_id, numero_factura, current_user, categoria_grupos)
+        if orden_cocina:
+            await db.ordenes_cocina.insert_one(orden_cocina)
     # ============ FIN IMPRESORAS DE COCINA ============
     
     await db.cajas.update_one(
         {"_id": caja_activa["_id"]},
         {
             "$inc": {
-                "monto_ventas": total_final,
+                "monto_ventas": totales["total"],
                 "total_ventas": 1
             }
         }
     )
     
-    return InvoiceResponse(
-        id=invoice_id,
-        numero=numero_factura,
-        items=invoice.items,
-        subtotal=subtotal,
-        descuento=descuento_total,
-        descuentos_detalle=[d.model_dump() if hasattr(d, 'model_dump') else d for d in descuentos_detalle],
-        total_impuestos=total_impuestos,
-        desglose_impuestos=[ImpuestoDesglose(**imp) for imp in desglose_impuestos],
-        total=total_final,
-        vendedor=current_user["_id"],
-        vendedor_nombre=current_user["nombre"],
-        organizacion_id=current_user["organizacion_id"],
-        caja_id=caja_activa["_id"],
-        cliente_id=invoice.cliente_id,
-        cliente_nombre=cliente_nombre,
-        comentarios=invoice.comentarios,
-        metodo_pago_id=invoice.metodo_pago_id,
-        metodo_pago_nombre=metodo_pago_nombre,
-        tipo_pedido_id=invoice.tipo_pedido_id,
-        tipo_pedido_nombre=tipo_pedido_nombre,
-        fecha=new_invoice["fecha"],
-        mesero_id=invoice.mesero_id,
-        mesero_nombre=invoice.mesero_nombre,
-        cobrado_por_id=current_user["_id"],
-        cobrado_por_nombre=current_user["nombre"]
-    )
+    return _factura_response(new_invoice)
+
+
+FACTURAS_BATCH_MAX = int(os.environ.get("FACTURAS_BATCH_MAX", "500"))
+
+@app.post("/api/facturas/batch")
+async def create_facturas_batch(batch: FacturasBatchCreate, current_user: dict = Depends(get_current_user)):
+    """
+    Sube en un solo request las ventas registradas sin conexión.
+    Resuelve caja, numeración, nombres, impuestos y cocina una sola vez, reserva un
+    bloque de secuenciales, inserta con insert_many y aplica un único $inc a la caja.
+    Cada venta trae un idempotency_id: las ya subidas se reportan como "duplicada".
+    Si alguna venta del bloque no se inserta, las demás se renumeran para no dejar
+    huecos (ver _compactar_numeros_lote).
+    """
+    organizacion_id = current_user["organizacion_id"]
+    ventas = batch.ventas
+    if len(ventas) > FACTURAS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {FACTURAS_BATCH_MAX} ventas por lote")
+    
+    resultados: List[Optional[dict]] = [None] * len(ventas)
+    
+    # Ventas ya subidas en lotes anteriores
+    ids = list({v.idempotency_id for v in ventas})
+    existentes = {
+        f["idempotency_id"]: f
+        for f in await db.facturas.find(
+            {"organizacion_id": organizacion_id, "idempotency_id": {"$in": ids}},
+            {"_id": 0, "id": 1, "numero": 1, "idempotency_id": 1}
+        ).to_list(len(ids))
+    }
+    
+    ahora = datetime.now(timezone.utc)
+    nuevas = []  # (indice, venta, fecha)
+    vistos = set()
+    for i, venta in enumerate(ventas):
+        if venta.idempotency_id in existentes or venta.idempotency_id in vistos:
+            continue  # Se resuelve como duplicada al final
+        
+        fecha = ahora
+        if venta.fecha_cliente:
+            try:
+                fecha = datetime.fromisoformat(venta.fecha_cliente.replace("Z", "+00:00"))
+                if fecha.tzinfo is None:
+                    fecha = fecha.replace(tzinfo=timezone.utc)
+            except ValueError:
+                resultados[i] = {"idempotency_id": venta.idempotency_id, "estado": "error", "error": "fecha_cliente inválida"}
+                continue
+        
+        vistos.add(venta.idempotency_id)
+        nuevas.append((i, venta, fecha.astimezone(timezone.utc).isoformat()))
+    
+    if nuevas:
+        # Verificar límite de facturas del plan para todo el lote
+        puede, mensaje, _, _ = await verificar_limite_plan(organizacion_id, "facturas", len(nuevas))
+        if not puede:
+            raise HTTPException(status_code=403, detail={"code": "PLAN_LIMIT", "message": mensaje})
+        
+        caja_activa = await db.cajas.find_one({
+            "usuario_id": current_user["_id"],
+            "estado": "abierta"
+        })
+        if not caja_activa:
+            raise HTTPException(status_code=400, detail="Debes abrir una caja antes de realizar ventas")
+        
+        codigo_establecimiento, punto_emision = await _obtener_punto_emision(caja_activa, current_user)
+        primer_numero = await _reservar_numeros_factura(organizacion_id, codigo_establecimiento, punto_emision, len(nuevas))
+        
+        # Nombres de clientes, métodos de pago y tipos de pedido en una consulta cada uno
+        cliente_ids = list({v.cliente_id for _, v, _ in nuevas if v.cliente_id})
+        metodo_ids = list({v.metodo_pago_id for _, v, _ in nuevas if v.metodo_pago_id})
+        tipo_ids = list({v.tipo_pedido_id for _, v, _ in nuevas if v.tipo_pedido_id})
+        clientes = {
+            c["_id"]: c["nombre"]
+            for c in await db.clientes.find({"_id": {"$in": cliente_ids}}, {"nombre": 1}).to_list(len(cliente_ids))
+        } if cliente_ids else {}
+        metodos = {
+            m["id"]: m["nombre"]
+            for m in await db.metodos_pago.find({"id": {"$in": metodo_ids}}, {"_id": 0, "id": 1, "nombre": 1}).to_list(len(metodo_ids))
+        } if metodo_ids else {}
+        tipos = {
+            t["id"]: t["nombre"]
+            for t in await db.tipos_pedido.find({"id": {"$in": tipo_ids}}, {"_id": 0, "id": 1, "nombre": 1}).to_list(len(tipo_ids))
+        } if tipo_ids else {}
+        
+        impuestos_activos = None
+        if any(not v.desglose_impuestos for _, v, _ in nuevas):
+            impuestos_activos = await db.impuestos.find({
+                "organizacion_id": organizacion_id,
+                "activo": True
+            }, {"_id": 0}).to_list(100)
+        
+        categoria_grupos = await _cargar_grupos_cocina(organizacion_id) if batch.enviar_cocina else None
+        
+        documentos = []
+        ordenes_cocina = {}
+        for offset, (i, venta, fecha) in enumerate(nuevas):
+            invoice_id = str(uuid.uuid4())
+            numero_factura = f"{codigo_establecimiento}-{punto_emision}-{primer_numero + offset:09d}"
+            nombres = {
+                "cliente": clientes.get(venta.cliente_id),
+                "metodo_pago": metodos.get(venta.metodo_pago_id),
+                "tipo_pedido": tipos.get(venta.tipo_pedido_id)
+            }
+            totales = _calcular_totales_factura(venta, impuestos_activos)
+            documento = _construir_documento_factura(
+                venta, invoice_id, numero_factura, totales, current_user, caja_activa, nombres, fecha
+            )
+            documento["idempotency_id"] = venta.idempotency_id
+            documento["fecha_sincronizacion"] = ahora.isoformat()
+            documentos.append(documento)
+            
+            if categoria_grupos:
+                orden = _construir_orden_cocina(venta, invoice_id, numero_factura, current_user, categoria_grupos)
+                if orden:
+                    ordenes_cocina[invoice_id] = orden
+        
+        fallidos = {}  # indice en documentos -> código de error
+        try:
+            await db.facturas.insert_many(documentos, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                fallidos[error["index"]] = error
+        
+        insertados = [documento for offset, documento in enumerate(documentos) if offset not in fallidos]
+        if fallidos:
+            # Las rechazadas no deben dejar huecos en la numeración de la caja
+            await _compactar_numeros_lote(organizacion_id, codigo_establecimiento, punto_emision,
+                                          primer_numero, len(documentos), insertados, ordenes_cocina)
+        
+        for offset, documento in enumerate(documentos):
+            i = nuevas[offset][0]
+            error = fallidos.get(offset)
+            if error is None:
+                resultados[i] = {
+                    "idempotency_id": documento["idempotency_id"],
+                    "estado": "creada",
+                    "factura": jsonable_encoder(_factura_response(documento))
+                }
+            elif error.get("code") != 11000:
+                resultados[i] = {
+                    "idempotency_id": documento["idempotency_id"],
+                    "estado": "error",
+                    "error": error.get("errmsg", "Error insertando la factura")
+                }
+            # code 11000: otro request subió la misma venta; se resuelve como duplicada
+        
+        ordenes = [ordenes_cocina[d["id"]] for d in insertados if d["id"] in ordenes_cocina]
+        if ordenes:
+            await db.ordenes_cocina.insert_many(ordenes)
+        
+        if insertados:
+            await db.cajas.update_one(
+                {"_id": caja_activa["_id"]},
+                {
+                    "$inc": {
+                        "monto_ventas": round(sum(d["total"] for d in insertados), 2),
+                        "total_ventas": len(insertados)
+                    }
+                }
+            )
+    
+    # Resolver duplicadas (de lotes anteriores, repetidas en el lote o subidas en paralelo)
+    pendientes = [i for i, r in enumerate(resultados) if r is None]
+    if pendientes:
+        ids_pendientes = list({ventas[i].idempotency_id for i in pendientes})
+        subidas = {
+            f["idempotency_id"]: f
+            for f in await db.facturas.find(
+                {"organizacion_id": organizacion_id, "idempotency_id": {"$in": ids_pendientes}},
+                {"_id": 0, "id": 1, "numero": 1, "idempotency_id": 1}
+            ).to_list(len(ids_pendientes))
+        }
+        for i in pendientes:
+            factura = subidas.get(ventas[i].idempotency_id, {})
+            resultados[i] = {
+                "idempotency_id": ventas[i].idempotency_id,
+                "estado": "duplicada",
+                "factura_id": factura.get("id"),
+                "numero": factura.get("numero")
+            }
+    
+    return {
+        "total": len(resultados),
+        "creadas": sum(1 for r in resultados if r["estado"] == "creada"),
+        "duplicadas": sum(1 for r in resultados if r["estado"] == "duplicada"),
+        "errores": sum(1 for r in resultados if r["estado"] == "error"),
+        "resultados": resultados
+    }
 
 
 # ============================================
@@ -6394,95 +6857,294 @@ class EmitirFERequest(BaseModel):
     metodo_pago: str = "01"
 
 
-async def _emitir_fe_background(factura_id: str, organizacion_id: str, cliente: dict, items: list, total: float, metodo_pago: str, token: str):
+# ============ COLA DURABLE DE EMISIÓN DE FACTURAS ELECTRÓNICAS ============
+# Los trabajos se guardan en fe_jobs y los reclaman workers (corrutinas) con un
+# lease: si el proceso se reinicia, el lease vence y otro worker retoma el trabajo.
+# Estados: pendiente -> procesando -> completado | fallido (dead-letter)
+
+FE_QUEUE_WORKERS = int(os.environ.get("FE_QUEUE_WORKERS", "4"))
+FE_QUEUE_MAX_POR_TENANT = int(os.environ.get("FE_QUEUE_MAX_POR_TENANT", "2"))
+FE_QUEUE_MAX_INTENTOS = int(os.environ.get("FE_QUEUE_MAX_INTENTOS", "6"))
+FE_QUEUE_BACKOFF_BASE = float(os.environ.get("FE_QUEUE_BACKOFF_BASE", "5"))
+FE_QUEUE_BACKOFF_MAX = float(os.environ.get("FE_QUEUE_BACKOFF_MAX", "600"))
+FE_QUEUE_POLL_INTERVAL = float(os.environ.get("FE_QUEUE_POLL_INTERVAL", "2"))
+# El lease debe superar el timeout de la llamada a backend-fe
+FE_QUEUE_LEASE_SEGUNDOS = float(os.environ.get("FE_QUEUE_LEASE_SEGUNDOS", "120"))
+FE_QUEUE_TIMEOUT_EMISION = 60.0
+
+_fe_workers: List[asyncio.Task] = []
+_fe_jobs_activos: Dict[str, int] = {}
+_fe_claim_lock = asyncio.Lock()
+
+class FEJobError(Exception):
+    """Error de emisión; permanente=True envía el trabajo directo a fallido"""
+    def __init__(self, mensaje: str, permanente: bool = False):
+        super().__init__(mensaje)
+        self.permanente = permanente
+
+FE_JOB_ESTADOS_ACTIVOS = ["pendiente", "procesando"]
+
+async def encolar_emision_fe(factura_id: str, organizacion_id: str, cliente: dict, items: list, total: float, metodo_pago: str) -> dict:
     """
-    Función que se ejecuta en background para emitir la factura electrónica.
-    No bloquea el flujo principal de facturación.
+    Crea (o reutiliza si ya hay uno activo) el trabajo de emisión de una factura.
+    El índice único parcial factura_id (estados activos) garantiza un solo
+    trabajo activo aunque dos requests encolen la misma factura a la vez.
     """
-    try:
-        # No validamos configuración aquí - si llegó a este endpoint es porque 
-        # el usuario quiere emitir FE. La validación se hace en el frontend.
-        
-        # Preparar datos para la FE
-        fe_data = {
-            "store_code": "001",
-            "emission_point": "001",
-            "customer": cliente,
+    filtro_activo = {"factura_id": factura_id, "estado": {"$in": FE_JOB_ESTADOS_ACTIVOS}}
+    existente = await db.fe_jobs.find_one(filtro_activo)
+    if existente:
+        return existente
+    
+    ahora = datetime.now(timezone.utc)
+    job = {
+        "_id": str(uuid.uuid4()),
+        "factura_id": factura_id,
+        "organizacion_id": organizacion_id,
+        "payload": {
+            "cliente": cliente,
             "items": items,
-            "payments": [{
-                "method": metodo_pago,
-                "total": total,
-                "term": 0,
-                "time_unit": "dias"
-            }]
+            "total": total,
+            "metodo_pago": metodo_pago
+        },
+        "estado": "pendiente",
+        "intentos": 0,
+        "max_intentos": FE_QUEUE_MAX_INTENTOS,
+        "proximo_intento": ahora,
+        "lease_hasta": None,
+        "worker_id": None,
+        "ultimo_error": None,
+        "creado": ahora,
+        "actualizado": ahora
+    }
+    try:
+        await db.fe_jobs.insert_one(job)
+    except DuplicateKeyError:
+        # Otra request la encoló entre la consulta y el insert: ya está en cola
+        existente = await db.fe_jobs.find_one(filtro_activo)
+        if existente:
+            return existente
+        raise
+    return job
+
+async def _reclamar_fe_job(worker_id: str) -> Optional[dict]:
+    """Reclama atómicamente el siguiente trabajo listo respetando el límite por tenant"""
+    async with _fe_claim_lock:
+        ahora = datetime.now(timezone.utc)
+        saturados = [org for org, activos in _fe_jobs_activos.items() if activos >= FE_QUEUE_MAX_POR_TENANT]
+        filtro = {
+            "$or": [
+                {"estado": "pendiente", "proximo_intento": {"$lte": ahora}},
+                # Lease vencido: el worker anterior murió o se reinició
+                {"estado": "procesando", "lease_hasta": {"$lt": ahora}}
+            ]
         }
+        if saturados:
+            filtro["organizacion_id"] = {"$nin": saturados}
         
-        # Llamar al servicio de FE
-        fe_url = os.environ.get("FE_BACKEND_URL", "http://localhost:8002")
-        async with httpx.AsyncClient(timeout=60.0) as client_http:
-            response = await client_http.post(
-                f"{fe_url}/fe/documents/invoice",
-                json=fe_data,
-                headers={
-                    "X-Tenant-ID": organizacion_id
-                }
+        job = await db.fe_jobs.find_one_and_update(
+            filtro,
+            {
+                "$set": {
+                    "estado": "procesando",
+                    "worker_id": worker_id,
+                    "lease_hasta": ahora + timedelta(seconds=FE_QUEUE_LEASE_SEGUNDOS),
+                    "actualizado": ahora
+                },
+                "$inc": {"intentos": 1}
+            },
+            sort=[("proximo_intento", 1)],
+            return_document=True
+        )
+        if job:
+            org = job["organizacion_id"]
+            _fe_jobs_activos[org] = _fe_jobs_activos.get(org, 0) + 1
+        return job
+
+async def _emitir_fe(job: dict) -> dict:
+    """
+    Llama a backend-fe para emitir la factura del trabajo; lanza FEJobError si falla.
+    El reintento es seguro: external_reference=pos:<factura_id> hace que backend-fe
+    retorne la factura ya creada (índice único) en vez de emitir otra si la
+    respuesta anterior se perdió (timeout, reinicio, lease vencido).
+    """
+    payload = job["payload"]
+    fe_data = {
+        "external_reference": f"pos:{job['factura_id']}",
+        "store_code": "001",
+        "emission_point": "001",
+        "customer": payload["cliente"],
+        "items": payload["items"],
+        "payments": [{
+            "method": payload["metodo_pago"],
+            "total": payload["total"],
+            "term": 0,
+            "time_unit": "dias"
+        }]
+    }
+    
+    fe_url = os.environ.get("FE_BACKEND_URL", BACKEND_FE_URL)
+    try:
+        response = await get_fe_http_client().post(
+            f"{fe_url}/fe/documents/invoice",
+            json=fe_data,
+            headers={"X-Tenant-ID": job["organizacion_id"]},
+            timeout=FE_QUEUE_TIMEOUT_EMISION
+        )
+    except httpx.HTTPError as e:
+        raise FEJobError(f"Error de conexión con backend-fe: {str(e) or type(e).__name__}")
+    
+    if response.status_code == 200:
+        return response.json()
+    
+    # 4xx (excepto 408/429) son errores de datos o configuración: no se reintentan
+    permanente = 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+    raise FEJobError(f"{response.status_code} - {response.text[:500]}", permanente=permanente)
+
+async def _procesar_fe_job(job: dict, worker_id: str):
+    """Procesa un trabajo reclamado y registra el resultado (éxito, reintento o fallido)"""
+    factura_id = job["factura_id"]
+    propio = {"_id": job["_id"], "worker_id": worker_id}
+    
+    try:
+        fe_result = await _emitir_fe(job)
+    except FEJobError as e:
+        ahora = datetime.now(timezone.utc)
+        agotado = job["intentos"] >= job.get("max_intentos", FE_QUEUE_MAX_INTENTOS)
+        
+        if e.permanente or agotado:
+            print(f"[FE] Factura {factura_id} enviada a fallidos tras {job['intentos']} intentos: {e}")
+            await db.fe_jobs.update_one(propio, {"$set": {
+                "estado": "fallido",
+                "lease_hasta": None,
+                "ultimo_error": str(e)[:500],
+                "actualizado": ahora
+            }})
+            await db.facturas.update_one(
+                {"id": factura_id},
+                {"$set": {
+                    "factura_electronica": {
+                        "estado": "ERROR",
+                        "error": str(e)[:500],
+                        "intentos": job["intentos"],
+                        "emitida_at": ahora.isoformat()
+                    }
+                }}
             )
-            
-            if response.status_code == 200:
-                fe_result = response.json()
-                # Actualizar la factura del POS con los datos de FE
-                await db.facturas.update_one(
-                    {"id": factura_id},
-                    {"$set": {
-                        "factura_electronica": {
-                            "clave_acceso": fe_result.get("access_key"),
-                            "estado": fe_result.get("sri_status"),
-                            "numero_autorizacion": fe_result.get("sri_authorization_number"),
-                            "documento_id": fe_result.get("document_id"),
-                            "numero_documento": fe_result.get("doc_number"),
-                            "emitida_at": datetime.now(timezone.utc).isoformat()
-                        }
-                    }}
-                )
-                print(f"[FE] Factura {factura_id} emitida: {fe_result.get('sri_status')}")
-            else:
-                print(f"[FE] Error emitiendo factura {factura_id}: {response.status_code} - {response.text}")
-                # Guardar el error para que el usuario pueda ver qué pasó
-                await db.facturas.update_one(
-                    {"id": factura_id},
-                    {"$set": {
-                        "factura_electronica": {
-                            "estado": "ERROR",
-                            "error": response.text[:500],
-                            "emitida_at": datetime.now(timezone.utc).isoformat()
-                        }
-                    }}
-                )
-    except Exception as e:
-        print(f"[FE] Excepción emitiendo factura {factura_id}: {str(e)}")
+            return
+        
+        espera = min(FE_QUEUE_BACKOFF_MAX, FE_QUEUE_BACKOFF_BASE * (2 ** (job["intentos"] - 1)))
+        espera *= random.uniform(0.8, 1.2)
+        print(f"[FE] Error emitiendo factura {factura_id} (intento {job['intentos']}), reintento en {espera:.0f}s: {e}")
+        await db.fe_jobs.update_one(propio, {"$set": {
+            "estado": "pendiente",
+            "proximo_intento": ahora + timedelta(seconds=espera),
+            "lease_hasta": None,
+            "ultimo_error": str(e)[:500],
+            "actualizado": ahora
+        }})
         await db.facturas.update_one(
             {"id": factura_id},
             {"$set": {
-                "factura_electronica": {
-                    "estado": "ERROR",
-                    "error": str(e)[:500],
-                    "emitida_at": datetime.now(timezone.utc).isoformat()
-                }
+                "factura_electronica.intentos": job["intentos"],
+                "factura_electronica.ultimo_error": str(e)[:500]
             }}
         )
+        return
+    
+    # Actualizar la factura del POS con los datos de FE
+    await db.facturas.update_one(
+        {"id": factura_id},
+        {"$set": {
+            "factura_electronica": {
+                "clave_acceso": fe_result.get("access_key"),
+                "estado": fe_result.get("sri_status"),
+                "numero_autorizacion": fe_result.get("sri_authorization_number"),
+                "documento_id": fe_result.get("document_id"),
+                "numero_documento": fe_result.get("doc_number"),
+                "emitida_at": datetime.now(timezone.utc).isoformat()
+            }
+        }}
+    )
+    await db.fe_jobs.update_one(propio, {"$set": {
+        "estado": "completado",
+        "lease_hasta": None,
+        "ultimo_error": None,
+        "documento_id": fe_result.get("document_id"),
+        "actualizado": datetime.now(timezone.utc)
+    }})
+    print(f"[FE] Factura {factura_id} emitida: {fe_result.get('sri_status')}")
+
+async def _fe_worker(worker_id: str):
+    """Loop de un worker de la cola de emisión"""
+    while True:
+        try:
+            job = await _reclamar_fe_job(worker_id)
+            if not job:
+                await asyncio.sleep(FE_QUEUE_POLL_INTERVAL)
+                continue
+            try:
+                await _procesar_fe_job(job, worker_id)
+            finally:
+                org = job["organizacion_id"]
+                _fe_jobs_activos[org] = _fe_jobs_activos.get(org, 1) - 1
+                if _fe_jobs_activos[org] <= 0:
+                    _fe_jobs_activos.pop(org, None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[FE] Error en worker {worker_id}: {str(e)}")
+            await asyncio.sleep(FE_QUEUE_POLL_INTERVAL)
+
+@app.on_event("startup")
+async def start_fe_workers():
+    try:
+        await db.fe_jobs.create_index([("estado", 1), ("proximo_intento", 1)])
+        await db.fe_jobs.create_index([("estado", 1), ("lease_hasta", 1)])
+        await db.fe_jobs.create_index([("factura_id", 1), ("estado", 1)])
+        await db.fe_jobs.create_index([("organizacion_id", 1), ("estado", 1)])
+    except Exception as e:
+        print(f"⚠️ Error creando índices de fe_jobs: {e}")
+    try:
+        # Un solo trabajo activo por factura (encolar_emision_fe maneja el DuplicateKeyError)
+        await db.fe_jobs.create_index(
+            "factura_id",
+            name="factura_id_activo_unique",
+            unique=True,
+            partialFilterExpression={"estado": {"$in": FE_JOB_ESTADOS_ACTIVOS}}
+        )
+    except Exception as e:
+        print(f"⚠️ Error creando índice único de fe_jobs activos (¿trabajos duplicados?): {e}")
+    
+    prefijo = f"{os.uname().nodename}-{os.getpid()}"
+    for n in range(FE_QUEUE_WORKERS):
+        _fe_workers.append(asyncio.create_task(_fe_worker(f"{prefijo}-{n}")))
+
+@app.on_event("shutdown")
+async def stop_fe_workers():
+    # Los trabajos en curso quedan con lease y se retoman al vencer
+    for task in _fe_workers:
+        task.cancel()
+    await asyncio.gather(*_fe_workers, return_exceptions=True)
+    _fe_workers.clear()
 
 
 @app.post("/api/facturas/{factura_id}/emitir-fe")
 async def emitir_factura_electronica(
     factura_id: str,
     request: EmitirFERequest,
-    background_tasks: BackgroundTasks,
+    http_request: Request,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Endpoint para emitir factura electrónica de forma ASINCRONA.
-    Retorna inmediatamente y procesa la FE en background.
+    Encola la emisión en fe_jobs y retorna inmediatamente.
     """
+    return await ejecutar_idempotente(
+        http_request, current_user, request,
+        lambda: _emitir_factura_electronica(factura_id, request, current_user)
+    )
+
+async def _emitir_factura_electronica(factura_id: str, request: EmitirFERequest, current_user: dict):
     # Verificar que la factura existe
     factura = await db.facturas.find_one({
         "id": factura_id,
@@ -6500,43 +7162,54 @@ async def emitir_factura_electronica(
             "factura_electronica": factura.get("factura_electronica")
         }
     
-    # Obtener token del header
-    token = ""
-    
-    # Marcar como "en proceso" inmediatamente
-    await db.facturas.update_one(
-        {"id": factura_id},
-        {"$set": {
-            "factura_electronica": {
-                "estado": "EN_PROCESO",
-                "emitida_at": datetime.now(timezone.utc).isoformat()
-            }
-        }}
-    )
-    
-    # Agregar tarea en background
-    background_tasks.add_task(
-        _emitir_fe_background,
+    job = await encolar_emision_fe(
         factura_id,
         current_user["organizacion_id"],
         request.cliente,
         request.items,
         request.total,
-        request.metodo_pago,
-        token
+        request.metodo_pago
     )
     
+    # Marcar como "en proceso" inmediatamente
+    if job["intentos"] == 0 and job["estado"] == "pendiente":
+        await db.facturas.update_one(
+            {"id": factura_id},
+            {"$set": {
+                "factura_electronica": {
+                    "estado": "EN_PROCESO",
+                    "emitida_at": datetime.now(timezone.utc).isoformat()
+                }
+            }}
+        )
+    
     return {
         "status": "processing",
         "message": "Factura electrónica en proceso de emisión",
-        "factura_id": factura_id
+        "factura_id": factura_id,
+        "job_id": job["_id"]
+    }
+
+
+def _resumen_fe_job(job: Optional[dict]) -> Optional[dict]:
+    if not job:
+        return None
+    proximo = job.get("proximo_intento")
+    return {
+        "job_id": job["_id"],
+        "estado": job["estado"],
+        "intentos": job.get("intentos", 0),
+        "max_intentos": job.get("max_intentos", FE_QUEUE_MAX_INTENTOS),
+        "proximo_intento": proximo.isoformat() if isinstance(proximo, datetime) else proximo,
+        "ultimo_error": job.get("ultimo_error")
     }
 
 
 @app.get("/api/facturas/{factura_id}/fe-status")
 async def get_fe_status(factura_id: str, current_user: dict = Depends(get_current_user)):
     """
-    Consulta el estado de la factura electrónica de una factura del POS.
+    Consulta el estado de la factura electrónica de una factura del POS,
+    junto con el último trabajo de emisión en la cola.
     """
     factura = await db.facturas.find_one({
         "id": factura_id,
@@ -6546,9 +7219,47 @@ async def get_fe_status(factura_id: str, current_user: dict = Depends(get_curren
     if not factura:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
     
+    job = await db.fe_jobs.find_one(
+        {"factura_id": factura_id, "organizacion_id": current_user["organizacion_id"]},
+        sort=[("creado", -1)]
+    )
+    
     return {
         "factura_id": factura_id,
-        "factura_electronica": factura.get("factura_electronica")
+        "factura_electronica": factura.get("factura_electronica"),
+        "cola": _resumen_fe_job(job)
+    }
+
+
+@app.get("/api/facturas-electronicas/cola")
+async def get_fe_cola(current_user: dict = Depends(get_current_user)):
+    """
+    Estado de la cola de emisión de la organización: conteo por estado y
+    estado de cada factura pendiente o fallida (vía get_fe_status).
+    """
+    organizacion_id = current_user["organizacion_id"]
+    conteo = {"pendiente": 0, "procesando": 0, "completado": 0, "fallido": 0}
+    async for grupo in db.fe_jobs.aggregate([
+        {"$match": {"organizacion_id": organizacion_id}},
+        {"$group": {"_id": "$estado", "total": {"$sum": 1}}}
+    ]):
+        conteo[grupo["_id"]] = grupo["total"]
+    
+    jobs = await db.fe_jobs.find(
+        {"organizacion_id": organizacion_id, "estado": {"$in": ["pendiente", "procesando", "fallido"]}},
+        {"factura_id": 1}
+    ).sort("creado", -1).to_list(100)
+    
+    facturas = []
+    for j in jobs:
+        try:
+            facturas.append(await get_fe_status(j["factura_id"], current_user))
+        except HTTPException:
+            continue  # La factura fue eliminada
+    
+    return {
+        "conteo": conteo,
+        "facturas": facturas
     }
 
 
@@ -8107,12 +8818,133 @@ async def obtener_mis_pagos(current_user: dict = Depends(get_current_user)):
 
 BACKEND_FE_URL = os.environ.get("BACKEND_FE_URL", "http://localhost:8002")
 
+# Pool de conexiones compartido durante toda la vida de la aplicación
+FE_PROXY_MAX_CONNECTIONS = int(os.environ.get("FE_PROXY_MAX_CONNECTIONS", "50"))
+FE_PROXY_MAX_KEEPALIVE = int(os.environ.get("FE_PROXY_MAX_KEEPALIVE", "20"))
+
+# Timeouts (segundos) por prefijo de ruta; el primero que coincida gana
+FE_PROXY_TIMEOUTS = [
+    ("health", 5.0),
+    ("documents/invoice", 60.0),
+    ("documents/credit-note", 60.0),
+    ("documents/sync-pending", 120.0),
+    ("documents/", 30.0),
+    ("config", 15.0),
+]
+FE_PROXY_TIMEOUT_DEFAULT = 30.0
+
+# Headers hop-by-hop que no se reenvían
+FE_PROXY_HOP_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding", "upgrade", "te", "trailer", "proxy-connection"}
+
+_fe_http_client: Optional[httpx.AsyncClient] = None
+
+def get_fe_http_client() -> httpx.AsyncClient:
+    """Cliente HTTP compartido hacia backend-fe (keep-alive, límites de conexión, HTTP/2 si está disponible)"""
+    global _fe_http_client
+    if _fe_http_client is None or _fe_http_client.is_closed:
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        _fe_http_client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(FE_PROXY_TIMEOUT_DEFAULT, connect=5.0, pool=5.0),
+            limits=httpx.Limits(
+                max_connections=FE_PROXY_MAX_CONNECTIONS,
+                max_keepalive_connections=FE_PROXY_MAX_KEEPALIVE,
+                keepalive_expiry=30.0
+            )
+        )
+    return _fe_http_client
+
+@app.on_event("shutdown")
+async def close_fe_http_client():
+    if _fe_http_client is not None:
+        await _fe_http_client.aclose()
+
+def get_fe_proxy_timeout(path: str) -> httpx.Timeout:
+    """Timeout de lectura según la ruta del backend-fe"""
+    segundos = FE_PROXY_TIMEOUT_DEFAULT
+    for prefijo, valor in FE_PROXY_TIMEOUTS:
+        if path.startswith(prefijo):
+            segundos = valor
+            break
+    return httpx.Timeout(segundos, connect=5.0, pool=5.0)
+
+class CircuitBreaker:
+    """
+    Circuit breaker simple para servicios externos.
+    - closed: las peticiones pasan; se cuentan fallos consecutivos
+    - open: se rechazan sin llamar al servicio hasta que pase reset_timeout
+    - half-open: se deja pasar una petición de prueba
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if asyncio.get_event_loop().time() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.half_open_in_flight:
+            self.half_open_in_flight = True
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        restante = self.reset_timeout - (asyncio.get_event_loop().time() - self.opened_at)
+        return max(1, int(restante))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.half_open_in_flight = False
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            self.opened_at = asyncio.get_event_loop().time()
+
+    def release_probe(self):
+        """Libera la petición de prueba sin contarla (cliente desconectado, saturación local)"""
+        self.half_open_in_flight = False
+
+fe_circuit_breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get("FE_PROXY_FAILURE_THRESHOLD", "5")),
+    reset_timeout=float(os.environ.get("FE_PROXY_RESET_TIMEOUT", "30"))
+)
+
 @app.api_route("/api/fe/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def proxy_fe(request: Request, path: str):
     """
     Proxy para el backend de Facturación Electrónica
-    Redirige todas las peticiones /api/fe/* al backend-fe
+    Redirige todas las peticiones /api/fe/* al backend-fe.
+    Usa un pool de conexiones compartido y transmite request y response en streaming.
     """
+    if not fe_circuit_breaker.allow_request():
+        raise HTTPException(
+            status_code=503,
+            detail="Servicio de facturación electrónica no disponible temporalmente",
+            headers={"Retry-After": str(fe_circuit_breaker.retry_after())}
+        )
+    # True solo para la petición de prueba del estado half-open
+    es_prueba = fe_circuit_breaker.half_open_in_flight
+    
     # Construir URL destino
     target_url = f"{BACKEND_FE_URL}/fe/{path}"
     
@@ -8120,37 +8952,58 @@ async def proxy_fe(request: Request, path: str):
     if request.query_params:
         target_url += f"?{request.query_params}"
     
-    # Copiar headers relevantes
+    # Copiar headers relevantes (content-length se conserva para no forzar chunked)
     headers = {}
     for key, value in request.headers.items():
-        if key.lower() not in ['host', 'content-length']:
+        if key.lower() not in FE_PROXY_HOP_HEADERS:
             headers[key] = value
     
-    # Obtener body si existe
-    body = await request.body()
+    # El body se transmite en streaming sin cargarlo en memoria
+    content = request.stream() if request.method in ("POST", "PUT", "PATCH", "DELETE") else None
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
+    client = get_fe_http_client()
+    fe_request = client.build_request(
+        method=request.method,
+        url=target_url,
+        headers=headers,
+        content=content,
+        timeout=get_fe_proxy_timeout(path)
+    )
+    
+    try:
         try:
-            response = await client.request(
-                method=request.method,
-                url=target_url,
-                headers=headers,
-                content=body
-            )
-            
-            # Filtrar headers de respuesta
-            response_headers = {}
-            for key, value in response.headers.items():
-                if key.lower() not in ['content-encoding', 'content-length', 'transfer-encoding']:
-                    response_headers[key] = value
-            
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=response_headers,
-                media_type=response.headers.get('content-type')
-            )
+            response = await client.send(fe_request, stream=True)
+        except httpx.PoolTimeout:
+            # Pool local agotado: es carga de este proceso, no una falla de backend-fe
+            raise HTTPException(status_code=503, detail="Servicio de facturación electrónica saturado, intente nuevamente")
         except httpx.TimeoutException:
+            fe_circuit_breaker.record_failure()
             raise HTTPException(status_code=504, detail="Timeout conectando con servicio de facturación electrónica")
         except Exception as e:
+            fe_circuit_breaker.record_failure()
             raise HTTPException(status_code=502, detail=f"Error conectando con servicio de facturación electrónica: {str(e)}")
+        
+        # Un 503 de backend-fe es una respuesta esperada (pool de firma ocupado,
+        # servicio calentando) y no debe abrir el circuito para todos los tenants
+        if response.status_code in (502, 504):
+            fe_circuit_breaker.record_failure()
+        else:
+            fe_circuit_breaker.record_success()
+    finally:
+        # CancelledError (cliente desconectado) y PoolTimeout no pasan por
+        # record_*: sin esto el circuito quedaría half-open con la prueba "en vuelo"
+        if es_prueba:
+            fe_circuit_breaker.release_probe()
+    
+    # Filtrar headers de respuesta (el body se reenvía sin decodificar)
+    response_headers = {}
+    for key, value in response.headers.items():
+        if key.lower() not in FE_PROXY_HOP_HEADERS:
+            response_headers[key] = value
+    
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=response_headers,
+        background=BackgroundTask(response.aclose)
+    )
@@ -131,6 +131,8 @@ export const feApi = {
     if (filters.date_from) params.append('date_from', filters.date_from);
     if (filters.date_to) params.append('date_to', filters.date_to);
     if (filters.customer_id) params.append('customer_id', filters.customer_id);
+    if (filters.cursor) params.append('cursor', filters.cursor);
+    if (filters.with_total === false) params.append('with_total', 'false');
     
     const response = await fetch(`${FE_API_URL}/api/fe/documents?${params}`, {
       headers: getHeaders()
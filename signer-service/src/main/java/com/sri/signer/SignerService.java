@@ -2,11 +2,15 @@ package com.sri.signer;
 
 import static spark.Spark.*;
 import com.google.gson.Gson;
+import com.google.gson.JsonArray;
+import com.google.gson.JsonElement;
 import com.google.gson.JsonObject;
 import java.io.*;
 import java.security.*;
 import java.security.cert.*;
 import java.util.Base64;
+import java.util.LinkedHashMap;
+import java.util.Map;
 import javax.xml.parsers.*;
 import javax.xml.transform.*;
 import javax.xml.transform.dom.*;
@@ -23,8 +27,41 @@ public class SignerService {
     
     private static final Gson gson = new Gson();
     
+    // Máximo de certificados registrados en memoria (LRU)
+    private static final int MAX_CERTIFICATES = Integer.parseInt(
+        System.getenv().getOrDefault("SIGNER_MAX_CERTIFICATES", "512"));
+    
+    // Firmadores por handle: el .p12 se parsea una sola vez al registrarlo
+    private static final Map<String, XadesSigner> signers = new LinkedHashMap<String, XadesSigner>(16, 0.75f, true) {
+        @Override
+        protected boolean removeEldestEntry(Map.Entry<String, XadesSigner> eldest) {
+            return size() > MAX_CERTIFICATES;
+        }
+    };
+    
+    private static final ThreadLocal<DocumentBuilder> documentBuilder = ThreadLocal.withInitial(() -> {
+        try {
+            DocumentBuilderFactory dbf = DocumentBuilderFactory.newInstance();
+            dbf.setNamespaceAware(true);
+            return dbf.newDocumentBuilder();
+        } catch (ParserConfigurationException e) {
+            throw new IllegalStateException(e);
+        }
+    });
+    
+    private static final ThreadLocal<Transformer> transformer = ThreadLocal.withInitial(() -> {
+        try {
+            Transformer t = TransformerFactory.newInstance().newTransformer();
+            t.setOutputProperty(OutputKeys.ENCODING, "UTF-8");
+            t.setOutputProperty(OutputKeys.OMIT_XML_DECLARATION, "no");
+            return t;
+        } catch (TransformerConfigurationException e) {
+            throw new IllegalStateException(e);
+        }
+    });
+    
     public static void main(String[] args) {
-        int port = 8003;
+        int port = Integer.parseInt(System.getenv().getOrDefault("SIGNER_PORT", "8003"));
         port(port);
         
         System.out.println("Iniciando servicio de firma XAdES en puerto " + port);
@@ -32,26 +69,78 @@ public class SignerService {
         // Health check
         get("/health", (req, res) -> {
             res.type("application/json");
-            return "{\"status\": \"ok\", \"service\": \"xades-signer\"}";
+            JsonObject result = new JsonObject();
+            result.addProperty("status", "ok");
+            result.addProperty("service", "xades-signer");
+            synchronized (signers) {
+                result.addProperty("certificates", signers.size());
+            }
+            return gson.toJson(result);
         });
         
-        // Endpoint para firmar XML
+        // Registrar certificado: recibe el .p12 una vez y retorna un handle
+        post("/certificates", (req, res) -> {
+            res.type("application/json");
+            
+            try {
+                JsonObject input = gson.fromJson(req.body(), JsonObject.class);
+                byte[] p12Data = Base64.getDecoder().decode(input.get("p12").getAsString());
+                String password = input.get("password").getAsString();
+                
+                // El handle es el SHA-256 del .p12: registrar dos veces el mismo certificado es idempotente
+                String handle = sha256Hex(p12Data);
+                XadesSigner signer = createSigner(p12Data, password);
+                synchronized (signers) {
+                    signers.put(handle, signer);
+                }
+                
+                JsonObject result = new JsonObject();
+                result.addProperty("success", true);
+                result.addProperty("handle", handle);
+                return gson.toJson(result);
+                
+            } catch (Exception e) {
+                e.printStackTrace();
+                return error(res, 400, null, e.getMessage());
+            }
+        });
+        
+        // Eliminar certificado registrado
+        delete("/certificates/:handle", (req, res) -> {
+            res.type("application/json");
+            boolean removed;
+            synchronized (signers) {
+                removed = signers.remove(req.params(":handle")) != null;
+            }
+            JsonObject result = new JsonObject();
+            result.addProperty("success", true);
+            result.addProperty("removed", removed);
+            return gson.toJson(result);
+        });
+        
+        // Endpoint para firmar XML (por handle, o con p12/password en cada request)
         post("/sign", (req, res) -> {
             res.type("application/json");
             
             try {
                 JsonObject input = gson.fromJson(req.body(), JsonObject.class);
                 
-                String xmlBase64 = input.get("xml").getAsString();
-                String p12Base64 = input.get("p12").getAsString();
-                String password = input.get("password").getAsString();
+                XadesSigner signer;
+                if (input.has("handle")) {
+                    signer = findSigner(input.get("handle").getAsString());
+                    if (signer == null) {
+                        return error(res, 404, "UNKNOWN_HANDLE", "Certificado no registrado");
+                    }
+                } else {
+                    byte[] p12Data = Base64.getDecoder().decode(input.get("p12").getAsString());
+                    signer = createSigner(p12Data, input.get("password").getAsString());
+                }
                 
                 // Decodificar XML
-                String xmlContent = new String(Base64.getDecoder().decode(xmlBase64), "UTF-8");
-                byte[] p12Data = Base64.getDecoder().decode(p12Base64);
+                String xmlContent = new String(Base64.getDecoder().decode(input.get("xml").getAsString()), "UTF-8");
                 
                 // Firmar
-                String signedXml = signXml(xmlContent, p12Data, password);
+                String signedXml = signXml(xmlContent, signer);
                 
                 JsonObject result = new JsonObject();
                 result.addProperty("success", true);
@@ -61,11 +150,44 @@ public class SignerService {
                 
             } catch (Exception e) {
                 e.printStackTrace();
-                JsonObject error = new JsonObject();
-                error.addProperty("success", false);
-                error.addProperty("error", e.getMessage());
-                res.status(500);
-                return gson.toJson(error);
+                return error(res, 500, null, e.getMessage());
+            }
+        });
+        
+        // Firma por lote: varios XML con el mismo handle en un solo round trip
+        post("/sign/batch", (req, res) -> {
+            res.type("application/json");
+            
+            try {
+                JsonObject input = gson.fromJson(req.body(), JsonObject.class);
+                XadesSigner signer = findSigner(input.get("handle").getAsString());
+                if (signer == null) {
+                    return error(res, 404, "UNKNOWN_HANDLE", "Certificado no registrado");
+                }
+                
+                JsonArray results = new JsonArray();
+                for (JsonElement xmlElement : input.getAsJsonArray("xmls")) {
+                    JsonObject item = new JsonObject();
+                    try {
+                        String xmlContent = new String(Base64.getDecoder().decode(xmlElement.getAsString()), "UTF-8");
+                        String signedXml = signXml(xmlContent, signer);
+                        item.addProperty("success", true);
+                        item.addProperty("signed_xml", Base64.getEncoder().encodeToString(signedXml.getBytes("UTF-8")));
+                    } catch (Exception e) {
+                        item.addProperty("success", false);
+                        item.addProperty("error", e.getMessage());
+                    }
+                    results.add(item);
+                }
+                
+                JsonObject result = new JsonObject();
+                result.addProperty("success", true);
+                result.add("results", results);
+                return gson.toJson(result);
+                
+            } catch (Exception e) {
+                e.printStackTrace();
+                return error(res, 500, null, e.getMessage());
             }
         });
         
@@ -75,7 +197,33 @@ public class SignerService {
         awaitInitialization();
     }
     
-    private static String signXml(String xmlContent, byte[] p12Data, String password) throws Exception {
+    private static String error(spark.Response res, int status, String code, String message) {
+        JsonObject error = new JsonObject();
+        error.addProperty("success", false);
+        if (code != null) {
+            error.addProperty("code", code);
+        }
+        error.addProperty("error", message);
+        res.status(status);
+        return gson.toJson(error);
+    }
+    
+    private static XadesSigner findSigner(String handle) {
+        synchronized (signers) {
+            return signers.get(handle);
+        }
+    }
+    
+    private static String sha256Hex(byte[] data) throws NoSuchAlgorithmException {
+        byte[] digest = MessageDigest.getInstance("SHA-256").digest(data);
+        StringBuilder sb = new StringBuilder();
+        for (byte b : digest) {
+            sb.append(String.format("%02x", b));
+        }
+        return sb.toString();
+    }
+    
+    private static XadesSigner createSigner(byte[] p12Data, String password) throws Exception {
         // Cargar el certificado PKCS12
         KeyStore keyStore = KeyStore.getInstance("PKCS12");
         keyStore.load(new ByteArrayInputStream(p12Data), password.toCharArray());
@@ -89,17 +237,14 @@ public class SignerService {
             (PrivateKey) keyStore.getKey(alias, password.toCharArray())
         );
         
-        // Configurar el perfil XAdES-BES
+        // Configurar el perfil XAdES-BES y crear el firmador (reutilizable entre hilos)
         XadesSigningProfile profile = new XadesBesSigningProfile(kdp);
-        
-        // Crear el firmador
-        XadesSigner signer = profile.newSigner();
-        
+        return profile.newSigner();
+    }
+    
+    private static String signXml(String xmlContent, XadesSigner signer) throws Exception {
         // Parsear el documento XML
-        DocumentBuilderFactory dbf = DocumentBuilderFactory.newInstance();
-        dbf.setNamespaceAware(true);
-        DocumentBuilder db = dbf.newDocumentBuilder();
-        Document doc = db.parse(new InputSource(new StringReader(xmlContent)));
+        Document doc = documentBuilder.get().parse(new InputSource(new StringReader(xmlContent)));
         
         // Obtener el elemento raíz
         Element elementToSign = doc.getDocumentElement();
@@ -123,13 +268,8 @@ public class SignerService {
         signer.sign(dataObjs, elementToSign);
         
         // Convertir a String
-        TransformerFactory tf = TransformerFactory.newInstance();
-        Transformer transformer = tf.newTransformer();
-        transformer.setOutputProperty(OutputKeys.ENCODING, "UTF-8");
-        transformer.setOutputProperty(OutputKeys.OMIT_XML_DECLARATION, "no");
-        
         StringWriter writer = new StringWriter();
-        transformer.transform(new DOMSource(doc), new StreamResult(writer));
+        transformer.get().transform(new DOMSource(doc), new StreamResult(writer));
         
         return writer.toString();
     }